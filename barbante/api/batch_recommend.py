@@ -5,80 +5,249 @@
     save them to file.
 
     Command-line parameters:
+        *--csv* or *--jsonl* - Optional output format (CSV is the default when an output file is informed).
+
+        *--resume* - Optional. Resumes a previous (crashed) run from its checkpoint file.
+
         *environment* - The db host name.
 
         *n_recommendations* - The intended number of recommendations.
 
         *algorithm* - The algorithm to be used.
 
+        *output_file* - Optional. The file where recommendations are streamed to,
+        as they are produced. A checkpoint file named *output_file*.checkpoint is kept
+        alongside it, so that an interrupted run can be resumed with *--resume*.
+
     Example of usage
 
-        ``python recommend.py development 10 UBCF``
+        ``python batch_recommend.py --jsonl development 10 UBCF recommendations.jsonl``
+
+    Users are read in pages, in ascending order of id, and each page is sent to a
+    pool of worker processes, which recommend for all users of a page sharing
+    bulk-loaded data (see barbante.context.init_sessions). Results are written in
+    the order of the pages, so memory usage does not grow with the number of users.
 
     **Output**
 
-    Returns a JSON object as follows:
-        {"products": a map {user: {product_id : {"score" : score, "rank",
-        rank}}}, "success": "true"}, if recommendation ran fine; {"message":
-        "some error message", "success": "false"}, otherwise.
+    When an output file is informed, returns a JSON object as follows:
+        {"users": number of users written, "output": output file name,
+        "success": "true"}.
 
-    Notice that the returned map of recommendations is not ordered. This is
-    not an issue, since the recommendations *must* be ordered anyway after
-    querying the database for satellite data.
+    Otherwise, returns a JSON object as follows:
+        {"products": a map {user: list of [score, product_id] pairs}, "success": "true"},
+        or the same recommendations in CSV format if *--csv* is informed.
+
+    In case of errors, returns {"message": "some error message", "success": "false"}.
 """
 
+import collections
+import concurrent.futures
+import json
+import os
 import sys
 import traceback
 
 from barbante.utils.profiling import profile
 import barbante.utils.logging as barbante_logging
-from barbante.context import init_session
+from barbante.context import init_session, init_sessions
 from barbante.context.context_manager import new_context
 
 
 log = barbante_logging.get_logger(__name__)
 
 
+CSV = "csv"
+JSONL = "jsonl"
+OUTPUT_FORMATS = (CSV, JSONL)
+
+CSV_SEPARATOR = ";"
+
+DEFAULT_PAGE_SIZE = 100
+""" The number of users sent to a worker process at a time.
+"""
+CHECKPOINT_INTERVAL = 10
+""" The number of written pages between two consecutive checkpoints.
+"""
+
+
+def _recommend_page(env, user_ids, count_recommendations, algorithm):
+    """ Runs within a worker process.
+
+        :returns: A list of (user_id, list of [score, product_id] pairs) tuples, in the same order of *user_ids*.
+    """
+    with new_context(environment=env):
+        result = []
+        sessions = init_sessions(environment=env, user_ids=user_ids, algorithm=algorithm)
+        for user_id in user_ids:
+            try:
+                recommender = sessions[user_id].get_recommender()
+                recommendations = recommender.recommend(count_recommendations)
+            except Exception:
+                log.exception("Could not recommend for user [{0}]".format(user_id))
+                recommendations = []
+            result += [(user_id, recommendations)]
+        return result
+
+
+def _pages(user_ids, page_size):
+    page = []
+    for user_id in user_ids:
+        page += [user_id]
+        if len(page) == page_size:
+            yield page
+            page = []
+    if len(page) > 0:
+        yield page
+
+
+def iterate_recommendations_all_users(env, count_recommendations, algorithm, after_user_id=None,
+                                      page_size=DEFAULT_PAGE_SIZE, max_workers=None):
+    """ Recommends products for all users, in ascending order of user id.
+
+        :param env: The environment.
+        :param count_recommendations: The intended number of recommendations per user.
+        :param algorithm: The algorithm to be used.
+        :param after_user_id: If not None, only users with greater ids will be processed.
+        :param page_size: The number of users sent to a worker process at a time.
+        :param max_workers: The number of worker processes (None means the number of cores).
+
+        :returns: A generator yielding, for each page of users, a list of (user_id, list of [score, product_id]
+            pairs) tuples.
+    """
+    session = init_session(env)
+    all_users = session.data_proxy.fetch_all_user_ids(ordered=True, after_user_id=after_user_id)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_pages_in_flight = 2 * max_workers  # bounds memory usage no matter how many users there are
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for page in _pages(all_users, page_size):
+            pending.append(executor.submit(_recommend_page, env, page, count_recommendations, algorithm))
+            while len(pending) >= max_pages_in_flight:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
 @profile
 def recommend_products_all_users(env, count_recommendations, algorithm):
-    result = {}
-    session = init_session(env)
+    """ Recommends products for all users, keeping all results in memory.
+        See export_recommendations_all_users() for large user bases.
 
-    all_users = session.data_proxy.fetch_all_user_ids()
+        :returns: A map {user_id: list of [score, product_id] pairs}.
+    """
+    result = {}
     done = 0
-    for user_id in all_users:
-        session = init_session(env, user_id, algorithm=algorithm)
-        recommender = session.get_recommender()
-        recommendations = recommender.recommend(count_recommendations)
-        result[user_id] = recommendations
-        done += 1
-        if done % 1000 == 0:
-            log.debug("Processed %d users." % done)
-
+    for page in iterate_recommendations_all_users(env, count_recommendations, algorithm):
+        for user_id, recommendations in page:
+            result[user_id] = recommendations
+        done += len(page)
+        log.debug("Processed %d users." % done)
     return result
 
 
+def _load_checkpoint(checkpoint_filename):
+    if not os.path.exists(checkpoint_filename):
+        return None
+    with open(checkpoint_filename) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def _save_checkpoint(checkpoint_filename, checkpoint):
+    temp_filename = checkpoint_filename + ".tmp"
+    with open(temp_filename, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_filename, checkpoint_filename)  # atomic, so that a crash never leaves a corrupt checkpoint
+
+
+def _csv_header(n_recommendations):
+    return CSV_SEPARATOR.join(["USER"] + ["PRODUCT_" + str(i + 1) for i in range(n_recommendations)])
+
+
+def _csv_row(user_id, recommendations):
+    return CSV_SEPARATOR.join([str(user_id)] + [str(r[1]) for r in recommendations])
+
+
+def _jsonl_row(user_id, recommendations):
+    return json.dumps({"user": user_id, "products": recommendations})
+
+
+@profile
+def export_recommendations_all_users(env, count_recommendations, algorithm, output_filename,
+                                     output_format=CSV, resume=False, checkpoint_filename=None,
+                                     page_size=DEFAULT_PAGE_SIZE, max_workers=None):
+    """ Recommends products for all users, streaming the results to a file.
+
+        :param env: The environment.
+        :param count_recommendations: The intended number of recommendations per user.
+        :param algorithm: The algorithm to be used.
+        :param output_filename: The name of the output file.
+        :param output_format: Either CSV or JSONL.
+        :param resume: If True, resumes a previous run from its checkpoint (if any).
+        :param checkpoint_filename: The name of the checkpoint file. Defaults to *output_filename*.checkpoint.
+        :param page_size: The number of users sent to a worker process at a time.
+        :param max_workers: The number of worker processes (None means the number of cores).
+
+        :returns: The total number of users written to the output file.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Invalid output format: {0}".format(output_format))
+    if checkpoint_filename is None:
+        checkpoint_filename = output_filename + ".checkpoint"
+
+    settings = {"env": env, "count_recommendations": count_recommendations, "algorithm": algorithm,
+                "output_format": output_format}
+    checkpoint = _load_checkpoint(checkpoint_filename) if resume else None
+    if checkpoint is not None:
+        if checkpoint["settings"] != settings:
+            raise ValueError("The checkpoint was created with different settings: {0}".format(checkpoint["settings"]))
+        os.truncate(output_filename, checkpoint["offset"])  # discards rows written after the checkpoint
+        log.info("Resuming after user [{0}] ({1} users already done)".format(
+            checkpoint["last_user_id"], checkpoint["users"]))
+    else:
+        checkpoint = {"settings": settings, "last_user_id": None, "users": 0, "offset": 0}
+
+    format_row = _csv_row if output_format == CSV else _jsonl_row
+
+    with open(output_filename, "ab" if checkpoint["offset"] > 0 else "wb") as output_file:
+        if checkpoint["offset"] == 0 and output_format == CSV:
+            output_file.write((_csv_header(count_recommendations) + "\n").encode("utf-8"))
+
+        pages_since_checkpoint = 0
+        for page in iterate_recommendations_all_users(env, count_recommendations, algorithm,
+                                                      after_user_id=checkpoint["last_user_id"],
+                                                      page_size=page_size, max_workers=max_workers):
+            for user_id, recommendations in page:
+                output_file.write((format_row(user_id, recommendations) + "\n").encode("utf-8"))
+            checkpoint["users"] += len(page)
+            checkpoint["last_user_id"] = page[-1][0]
+
+            pages_since_checkpoint += 1
+            if pages_since_checkpoint == CHECKPOINT_INTERVAL:
+                output_file.flush()
+                checkpoint["offset"] = output_file.tell()
+                _save_checkpoint(checkpoint_filename, checkpoint)
+                pages_since_checkpoint = 0
+                log.info("Processed %d users." % checkpoint["users"])
+
+        output_file.flush()
+        checkpoint["offset"] = output_file.tell()
+        _save_checkpoint(checkpoint_filename, checkpoint)
+
+    log.info("Done. Exported recommendations for %d users." % checkpoint["users"])
+    return checkpoint["users"]
+
+
 def map_to_csv(recommendations_map, separator, n_recommendations):
-    csv_as_list = []
-    for user_id in recommendations_map:
-        scores_by_product = recommendations_map[user_id]
-        product_tuples = []
-        for product_id in scores_by_product:
-            product_tuple = (scores_by_product[product_id]["rank"], product_id)
-            product_tuples += [product_tuple]
-        sorted_product_tuples = sorted(product_tuples)
-        row = [str(user_id)]
-        for product_tuple in sorted_product_tuples:
-            row += [str(product_tuple[1])]
-        row_as_string = separator.join(row)
-        csv_as_list += [row_as_string]
-    csv = "USER" + separator
-    for i in range(n_recommendations):
-        csv += "PRODUCT_" + str(i + 1)
-        if i < n_recommendations - 1:
-            csv += separator
-    csv += "\n" + "\n".join(csv_as_list)
-    return csv
+    """ Converts a map {user_id: list of [score, product_id] pairs} into a CSV string.
+    """
+    rows = ["USER" + separator + separator.join(["PRODUCT_" + str(i + 1) for i in range(n_recommendations)])]
+    for user_id, recommendations in recommendations_map.items():
+        rows += [separator.join([str(user_id)] + [str(r[1]) for r in recommendations])]
+    return "\n".join(rows)
 
 
 def main(argv):
@@ -87,13 +256,26 @@ def main(argv):
                                              "recommendations and the algorithm."}
     try:
         # command-line arguments
-        export_to_csv = False
-        if argv[0] == "--csv":
-            export_to_csv = True
+        output_format = None
+        resume = False
+        while len(argv) > 0 and argv[0].startswith("--"):
+            option = argv[0][2:]
+            if option in OUTPUT_FORMATS:
+                output_format = option
+            elif option == "resume":
+                resume = True
+            else:
+                raise ValueError("Unknown option: {0}".format(argv[0]))
             del (argv[0])
         env = argv[0]
         count_recommendations = int(argv[1])
         algorithm = argv[2]
+        output_filename = argv[3] if len(argv) > 3 else None
+
+        if output_filename is not None:
+            users = export_recommendations_all_users(env, count_recommendations, algorithm, output_filename,
+                                                     output_format=output_format or CSV, resume=resume)
+            return {"success": True, "users": users, "output": output_filename}
 
         results = recommend_products_all_users(env, count_recommendations, algorithm)
 
@@ -101,8 +283,8 @@ def main(argv):
         log.exception('Exception on {0}:'.format(__name__))
         return {"success": False, "message": traceback.format_exc()}
 
-    if export_to_csv:
-        return map_to_csv(results, ";", count_recommendations)
+    if output_format == CSV:
+        return map_to_csv(results, CSV_SEPARATOR, count_recommendations)
     else:
         if results is not None:
             return_json = {"success": True, "products": results}
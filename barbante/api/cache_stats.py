@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 """ Retrieve and display cache statistics
+
+    The in-process caches (the local tier of the context filters cache, and the product models cache)
+    belong to the process which runs this script. When served by a pool of worker processes
+    (see barbante.server.reel), the statistics are those of a single worker, identified by *pid*.
 """
 
+import os
 import sys
 import traceback
 
@@ -31,7 +36,10 @@ def main(argv):
         else:
             stats = "No cache being used"
 
-        return {"success": True, "stats": stats}
+        return {"success": True, "pid": os.getpid(), "stats": stats,
+                "product_models": session.product_models_cache.get_stats(),
+                "specialist_executor": session.specialist_executor.get_stats(),
+                "io_executor": session.io_executor.get_stats()}
 
     except Exception:
         log.exception('Exception on {0}:'.format(__name__))
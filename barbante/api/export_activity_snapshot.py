@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Dumps the activity window of the batch maintenance processes into a compact, columnar snapshot
+    (see barbante.maintenance.activity_snapshot), to be read by generate_user_templates and
+    generate_product_templates instead of the database.
+
+    Command-line parameters:
+        *environment* - The db host name.
+
+        *path* - The snapshot directory.
+
+    Example of usage
+
+        ``python export_activity_snapshot.py development /tmp/activities``
+
+    **Output**
+
+    Returns a JSON object as follows:
+        {"activities": number of exported activities, "success": "true"},
+        if the snapshot was exported fine; {"message": "some error message", "success": "false"}, otherwise.
+"""
+
+import datetime as dt
+import sys
+import traceback
+
+from barbante.maintenance.activity_snapshot import ActivitySnapshot
+import barbante.utils.logging as barbante_logging
+from barbante.context import init_session
+from barbante.context.context_manager import new_context
+
+
+log = barbante_logging.get_logger(__name__)
+
+
+def main(argv):
+    if len(argv) < 2:
+        msg = "You must specify the environment and the snapshot directory"
+        log.error(msg)
+        return {"success": False, "message": msg}
+    try:
+        # command-line arguments
+        env = argv[0]
+        path = argv[1]
+
+        session = init_session(env)
+        # the widest window among those of the batch processes which read the snapshot
+        window = max(session.user_user_strengths_window, session.product_product_strengths_window)
+        snapshot = ActivitySnapshot.export(session, path, session.get_present_date() - dt.timedelta(window))
+        return {"success": True, "activities": len(snapshot)}
+
+    except Exception:
+        log.exception('Exception on {0}:'.format(__name__))
+        return {"success": False, "message": traceback.format_exc()}
+
+
+if __name__ == '__main__':
+    with new_context():
+        print(main(sys.argv[1:]))
@@ -3,11 +3,18 @@
 
 """ Computes all product-to-product strengths (via collaborative filtering)
     from scratch and saves them in the database.
+
+    Command-line parameters:
+        *environment* - The db host name.
+
+        *snapshot* - Optional. The directory of an activity snapshot (see barbante.api.export_activity_snapshot)
+        to read the activities from, rather than the database.
 """
 
 import sys
 import traceback
 
+from barbante.maintenance.activity_snapshot import ActivitySnapshot
 import barbante.maintenance.product_templates as pt
 import barbante.utils.logging as barbante_logging
 from barbante.context.context_manager import new_context
@@ -25,9 +32,10 @@ def main(argv):
     try:
         # command-line arguments
         env = argv[0]
+        snapshot = ActivitySnapshot.load(argv[1]) if len(argv) >= 2 else None
 
         session = init_session(env)
-        pt.generate_templates(session)
+        pt.generate_templates(session, snapshot)
         return {"success": True}
 
     except Exception:
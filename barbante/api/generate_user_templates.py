@@ -7,11 +7,18 @@
     by a user is interesting to another user.
 
     Our scoring function aims at maximizing precision. It gives no special attention to recall.
+
+    Command-line parameters:
+        *environment* - The db host name.
+
+        *snapshot* - Optional. The directory of an activity snapshot (see barbante.api.export_activity_snapshot)
+        to read the activities from, rather than the database.
 """
 
 import sys
 import traceback
 
+from barbante.maintenance.activity_snapshot import ActivitySnapshot
 import barbante.maintenance.user_templates as ut
 import barbante.utils.logging as barbante_logging
 from barbante.context import init_session
@@ -29,9 +36,10 @@ def main(argv):
     try:
         # command-line arguments
         env = argv[0]
+        snapshot = ActivitySnapshot.load(argv[1]) if len(argv) >= 2 else None
 
         session = init_session(env)
-        ut.generate_templates(session)
+        ut.generate_templates(session, snapshot)
         return {"success": True}
 
     except Exception:
@@ -4,6 +4,9 @@
 """ Processes several products in batch, including:
     - indexing of the TF's and DF's of the product terms
     - update of product vs product strengths (tfidf based)
+
+    When processing all products (--all), an optional trailing --processes flag makes the
+    stemming of products run on a pool of worker processes, so that it is not serialized by the GIL.
 """
 
 import pymongo
@@ -37,7 +40,8 @@ def main(argv):
                 days = None
             else:
                 days = int(argv[2])
-            maintenance.process_products(session, days)
+            use_processes = len(argv) > 3 and argv[3] == "--processes"
+            maintenance.process_products(session, days, use_processes=use_processes)
 
         elif product_id == "--resume":
             maintenance.process_products(session, resume=True)
@@ -36,15 +36,37 @@
     Observe that the returned map of recommendations is not ordered. This is
     not an issue, since the recommendations *must* be ordered anyway after
     querying the database for satellite data.
+
+    **Batch mode**
+
+    Function *main_batch* takes the same parameters, except that *user_id* is replaced by
+    a list of user ids (or a string of comma-separated user ids). The data of all users is
+    loaded with a few bulk queries, which are then shared by all recommenders.
+
+        ``python recommend.py --batch development 02398547023,02398547024 10 UBCF``
+
+    It returns {"products_by_user": {user_id: recommendations}, "failures": {user_id: message},
+    "success": "true"}.
+
+    **Asynchronous mode**
+
+    Coroutine *main_async* takes the same parameters as *main*, and returns the same output. It is meant to
+    be yielded on the IOLoop of a Tornado server (see barbante.server.reel): the user data is loaded by means
+    of the asynchronous reads of the data proxy, so that the IOLoop serves other requests in the meantime.
+    The recommender itself is CPU-bound, so it is run on the optional *executor* given to *main_async*,
+    leaving the IOLoop free; without an executor, it is run on the IOLoop.
 """
 
 import sys
 import traceback
 from time import time
 
-from barbante.context import init_session
+from tornado import gen
+
+from barbante.context import init_session, init_session_async, init_sessions, get_preloaded_customer_context
+from barbante.utils.deadline import Deadline
 import barbante.utils.logging as barbante_logging
-from barbante.context.context_manager import new_context
+from barbante.context.context_manager import new_context, wrap
 
 
 log = barbante_logging.get_logger(__name__)
@@ -59,19 +81,14 @@ def main(argv):
     try:
         start = time()
 
-        # command-line arguments
-        env = argv[0]
-        user_id = argv[1]
-        count_recommendations = int(argv[2])
-        algorithm = argv[3]
-        if len(argv) >= 5:
-            context_filter_string = argv[4]
-        else:
-            context_filter_string = None
+        env, user_id, count_recommendations, algorithm, context_filter_string = _parse_arguments(argv)
+
+        # the time budget of the request counts from its very start
+        deadline = Deadline(get_preloaded_customer_context(env).request_timeout, start)
 
         log.info('Initializing session...')
         session = init_session(environment=env, user_id=user_id,
-                               context_filter_string=context_filter_string, algorithm=algorithm)
+                               context_filter_string=context_filter_string, algorithm=algorithm, deadline=deadline)
 
         log.info('Calling recommender...')
         recommender = session.get_recommender()
@@ -81,6 +98,62 @@ def main(argv):
         log.exception('Exception on {0}'.format(__name__))
         return {"success": False, "message": ex.args[0], "stack_trace": traceback.format_exc()}
 
+    return _build_response(results, start)
+
+
+@gen.coroutine
+def main_async(argv, executor=None):
+    if len(argv) < 4:
+        msg = "You must specify the environment, the user_id, the number of recommendations " \
+            "and the algorithm."
+        log.error(msg)
+        return {"success": False, "message": msg}
+    try:
+        start = time()
+
+        env, user_id, count_recommendations, algorithm, context_filter_string = _parse_arguments(argv)
+
+        # the time budget of the request counts from its very start
+        deadline = Deadline(get_preloaded_customer_context(env).request_timeout, start)
+
+        log.info('Initializing session asynchronously...')
+        session = yield init_session_async(environment=env, user_id=user_id,
+                                           context_filter_string=context_filter_string, algorithm=algorithm,
+                                           deadline=deadline)
+
+        log.info('Calling recommender...')
+        if executor is not None:
+            results = yield executor.submit(wrap(_recommend), session, count_recommendations)
+        else:
+            results = _recommend(session, count_recommendations)
+
+    except Exception as ex:
+        log.exception('Exception on {0}'.format(__name__))
+        return {"success": False, "message": ex.args[0], "stack_trace": traceback.format_exc()}
+
+    return _build_response(results, start)
+
+
+def _recommend(session, count_recommendations):
+    recommender = session.get_recommender()
+    return recommender.recommend(count_recommendations)
+
+
+def _parse_arguments(argv):
+    """ :returns: A tuple (env, user_id, count_recommendations, algorithm, context_filter_string).
+    """
+    env = argv[0]
+    user_id = argv[1]
+    count_recommendations = int(argv[2])
+    algorithm = argv[3]
+    if len(argv) >= 5:
+        context_filter_string = argv[4]
+    else:
+        context_filter_string = None
+    return env, user_id, count_recommendations, algorithm, context_filter_string
+
+
+def _build_response(results, start):
     if results is not None:
         log.info("Recommendation took [%.6f] seconds overall" % (time() - start))
         return {"success": True, "products": results}
@@ -90,6 +163,52 @@ def main(argv):
         return {"success": False, "message": msg}
 
 
+def main_batch(argv):
+    if len(argv) < 4:
+        msg = "You must specify the environment, the list of user ids, the number of recommendations " \
+            "and the algorithm."
+        log.error(msg)
+        return {"success": False, "message": msg}
+    try:
+        start = time()
+
+        # command-line arguments
+        env = argv[0]
+        user_ids = argv[1]
+        if isinstance(user_ids, str):
+            user_ids = [user_id for user_id in user_ids.split(",") if user_id]
+        count_recommendations = int(argv[2])
+        algorithm = argv[3]
+        if len(argv) >= 5:
+            context_filter_string = argv[4]
+        else:
+            context_filter_string = None
+
+        log.info('Initializing sessions for [%d] users...' % len(user_ids))
+        sessions = init_sessions(environment=env, user_ids=user_ids,
+                                 context_filter_string=context_filter_string, algorithm=algorithm)
+
+    except Exception as ex:
+        log.exception('Exception on {0}'.format(__name__))
+        return {"success": False, "message": ex.args[0], "stack_trace": traceback.format_exc()}
+
+    products_by_user = {}
+    failures = {}
+    for user_id, session in sessions.items():
+        try:
+            recommender = session.get_recommender()
+            products_by_user[user_id] = recommender.recommend(count_recommendations)
+        except Exception as ex:
+            log.exception('Exception on {0} for user [{1}]'.format(__name__, user_id))
+            failures[user_id] = str(ex)
+
+    log.info("Batch recommendation for [%d] users took [%.6f] seconds overall" % (len(sessions), time() - start))
+    return {"success": True, "products_by_user": products_by_user, "failures": failures}
+
+
 if __name__ == '__main__':
     with new_context():
-        print(main(sys.argv[1:]))
+        if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+            print(main_batch(sys.argv[2:]))
+        else:
+            print(main(sys.argv[1:]))
@@ -2,10 +2,13 @@
 """
 
 import json
+import os
+import tempfile
 
 import nose.tools
 
 import barbante.api.generate_user_templates as script
+import barbante.api.batch_recommend as batch_recommend
 import barbante.utils.logging as barbante_logging
 import barbante.tests as tests
 
@@ -22,5 +25,25 @@ def test_script():
     nose.tools.ok_(result_json)  # a well-formed json is enough
 
 
+def test_export_jsonl():
+    """ Tests the streaming export of recommendations, including a resumed run.
+    """
+    output_filename = os.path.join(tempfile.mkdtemp(), "recommendations.jsonl")
+    users = batch_recommend.export_recommendations_all_users(tests.TEST_ENV, 10, "HRChunks", output_filename,
+                                                             output_format=batch_recommend.JSONL, page_size=3)
+    with open(output_filename) as output_file:
+        rows = [json.loads(line) for line in output_file]
+    nose.tools.eq_(len(rows), users, "Wrong number of rows")
+    nose.tools.ok_(os.path.exists(output_filename + ".checkpoint"), "Missing checkpoint")
+
+    # A resumed run on a finished export should not write anything else
+    resumed_users = batch_recommend.export_recommendations_all_users(
+        tests.TEST_ENV, 10, "HRChunks", output_filename, output_format=batch_recommend.JSONL, resume=True)
+    nose.tools.eq_(resumed_users, users, "Wrong number of users after resuming")
+    with open(output_filename) as output_file:
+        nose.tools.eq_(len(output_file.readlines()), users, "Rows should not be duplicated when resuming")
+
+
 if __name__ == '__main__':
-    test_script()
\ No newline at end of file
+    test_script()
+    test_export_jsonl()
\ No newline at end of file
@@ -0,0 +1,27 @@
+""" Tests barbante.api.export_activity_snapshot.
+"""
+
+import json
+import tempfile
+
+import nose.tools
+
+import barbante.api.export_activity_snapshot as script
+import barbante.utils.logging as barbante_logging
+import barbante.tests as tests
+
+
+log = barbante_logging.get_logger(__name__)
+
+
+def test_script():
+    """ Tests a call to script barbante.api.export_activity_snapshot.
+    """
+    result = script.main([tests.TEST_ENV, tempfile.mkdtemp()])
+    log.debug(result)
+    result_json = json.dumps(result)
+    nose.tools.ok_(result_json)  # a well-formed json is enough
+
+
+if __name__ == '__main__':
+    test_script()
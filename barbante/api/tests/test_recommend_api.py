@@ -1,11 +1,17 @@
 """ Tests barbante.api.recommend.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import json
+import threading
+import unittest.mock as mock
 
 import nose.tools
+from tornado import gen
+from tornado.ioloop import IOLoop
 
 import barbante.api.recommend as script
+from barbante.context import get_preloaded_customer_context
 import barbante.utils.logging as barbante_logging
 import barbante.tests as tests
 
@@ -22,5 +28,76 @@ def test_script():
     nose.tools.ok_(result_json)  # a well-formed json is enough
 
 
+def test_script_async():
+    """ Tests a call to script barbante.api.recommend in asynchronous mode.
+    """
+    io_loop = IOLoop()
+    try:
+        result = io_loop.run_sync(lambda: script.main_async([tests.TEST_ENV, "xxx", 10, "HRChunks"]))
+    finally:
+        io_loop.close()
+    log.debug(result)
+    result_json = json.dumps(result)
+    nose.tools.ok_(result_json)  # a well-formed json is enough
+
+
+def test_script_async_with_asynchronous_reads():
+    """ Tests a call to script barbante.api.recommend in asynchronous mode, with a data proxy whose
+        asynchronous reads actually yield to the IOLoop (as those of barbante.data.AsyncMongoDBProxy do)
+        and with an executor to run the recommender on.
+    """
+    data_proxy = get_preloaded_customer_context(tests.TEST_ENV).data_proxy
+    async_reads = ['fetch_day_of_latest_user_activity_async', 'fetch_activity_summaries_by_user_async',
+                   'fetch_impressions_summary_async', 'fetch_user_templates_async',
+                   'fetch_product_templates_async', 'fetch_product_models_async']
+    calls = []
+
+    def fake_async_read(name):
+        blocking_read = getattr(data_proxy, name[:-len('_async')])
+
+        @gen.coroutine
+        def read(*args, **kwargs):
+            calls.append(name)
+            yield gen.moment
+            return blocking_read(*args, **kwargs)
+        return read
+
+    recommender_threads = []
+
+    def recommend(session, count_recommendations):
+        recommender_threads.append(threading.current_thread())
+        return session.get_recommender().recommend(count_recommendations)
+
+    io_loop = IOLoop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        with mock.patch.multiple(data_proxy, **{name: fake_async_read(name) for name in async_reads}), \
+                mock.patch.object(script, '_recommend', recommend):
+            result = io_loop.run_sync(lambda: script.main_async([tests.TEST_ENV, "xxx", 10, "HRChunks"], executor))
+    finally:
+        executor.shutdown()
+        io_loop.close()
+    log.debug(result)
+    nose.tools.ok_(result["success"], "Wrong success indicator")
+    nose.tools.ok_("fetch_activity_summaries_by_user_async" in calls, "The user data was not read asynchronously")
+    nose.tools.eq_(len(recommender_threads), 1, "The recommender should have run once")
+    nose.tools.ok_(recommender_threads[0] is not threading.current_thread(),
+                   "The recommender should have run on the executor, off the IOLoop")
+
+
+def test_script_batch():
+    """ Tests a call to script barbante.api.recommend in batch mode.
+    """
+    result = script.main_batch([tests.TEST_ENV, ["xxx", "yyy"], 10, "HRChunks"])  # non-existing users (on purpose)
+    log.debug(result)
+    result_json = json.dumps(result)
+    nose.tools.ok_(result_json)  # a well-formed json is enough
+    nose.tools.ok_(result["success"], "Wrong success indicator")
+    nose.tools.eq_(set(result["products_by_user"].keys()), {"xxx", "yyy"}, "Wrong users")
+
+
 if __name__ == '__main__':
-    test_script()
\ No newline at end of file
+    test_script()
+    test_script_async()
+    test_script_async_with_asynchronous_reads()
+    test_script_batch()
\ No newline at end of file
@@ -4,10 +4,14 @@
     requests)
 """
 import copy
+import os
+
+from tornado import gen
 
 from barbante import config
 from barbante.context.customer_context import CustomerContext
 from barbante.context.session_context import SessionContext
+from barbante.context.user_batch_data import UserBatchData
 from barbante.data.MongoDBProxy import MongoDBProxy
 import barbante.utils.logging as barbante_logging
 
@@ -31,11 +35,18 @@ _customer_contexts_by_env = {}
     number of concurrent recommendation algorithms running on each hybrid recommender instance.
 """
 
+_customer_contexts_pid = os.getpid()
+""" The id of the process which loaded the customer contexts. Database connections must not be shared
+    with forked processes (e.g. process pool workers), which must therefore load their own contexts.
+"""
+
 
 """ Configuration Constants
 """
 BEFORE_SCORING = 'BEFORE_SCORING'
 AFTER_SCORING = 'AFTER_SCORING'
+UPSERT_ENGINE = 'UPSERT'
+SPARSE_ENGINE = 'SPARSE'
 
 
 class _DatabaseConfig(object):
@@ -163,12 +174,17 @@ def get_preloaded_customer_context(env):
         :param env: The environment name
         :returns: A CostumerContext instance
     """
+    global _customer_contexts_pid
+    if _customer_contexts_pid != os.getpid():
+        _customer_contexts_by_env.clear()
+        _customer_contexts_pid = os.getpid()
     if env not in _customer_contexts_by_env:
         _customer_contexts_by_env[env] = create_customer_context(env)
     return _customer_contexts_by_env[env]
 
 
-def init_session(environment=None, user_id=None, context_filter_string=None, customer_ctx=None, algorithm=None):
+def init_session(environment=None, user_id=None, context_filter_string=None, customer_ctx=None, algorithm=None,
+                 deadline=None):
     """ Initializes a session.
 
         :param environment: Session environment. Mandatory if customer_ctx is None, otherwise optional.
@@ -176,6 +192,7 @@ def init_session(environment=None, user_id=None, context_filter_string=None, cus
         :param context_filter_string: A ContextFilter instance.
         :param customer_ctx: A CustomerContext instance. Mandatory if environment is None, otherwise optional.
             Used only in tests; should be None for production.
+        :param deadline: The Deadline of the request served by the session. If None, the session is unbounded.
 
         :returns: A new SessionContext
     """
@@ -184,4 +201,47 @@ def init_session(environment=None, user_id=None, context_filter_string=None, cus
         customer_ctx = get_preloaded_customer_context(environment)
 
     return SessionContext(customer_ctx, user_id=user_id,
-                          context_filter_string=context_filter_string, algorithm=algorithm)
+                          context_filter_string=context_filter_string, algorithm=algorithm, deadline=deadline)
+
+
+@gen.coroutine
+def init_session_async(environment=None, user_id=None, context_filter_string=None, customer_ctx=None, algorithm=None,
+                       deadline=None):
+    """ Coroutine version of init_session(), which loads the user data by means of the asynchronous reads
+        of the data proxy (see UserContext.refresh_async()).
+
+        :returns: A new SessionContext
+    """
+    if customer_ctx is None:
+        customer_ctx = get_preloaded_customer_context(environment)
+
+    session = SessionContext(customer_ctx, user_id=user_id, context_filter_string=context_filter_string,
+                             algorithm=algorithm, deadline=deadline, load=False)
+    yield session.refresh_async()
+    return session
+
+
+def init_sessions(environment=None, user_ids=None, context_filter_string=None, customer_ctx=None, algorithm=None,
+                  deadline=None):
+    """ Initializes one session per target user, all of them sharing a single UserBatchData instance,
+        so that the data of all users is loaded with a few bulk queries.
+
+        :param environment: Session environment. Mandatory if customer_ctx is None, otherwise optional.
+        :param user_ids: A list of external user ids.
+        :param context_filter_string: A ContextFilter instance, shared by all sessions.
+        :param customer_ctx: A CustomerContext instance. Mandatory if environment is None, otherwise optional.
+            Used only in tests; should be None for production.
+        :param deadline: The Deadline of the whole batch, shared by all sessions. If None, the sessions are unbounded.
+
+        :returns: A map {user_id: SessionContext}.
+    """
+    if customer_ctx is None:
+        customer_ctx = get_preloaded_customer_context(environment)
+
+    batch_session = SessionContext(customer_ctx, context_filter_string=context_filter_string, algorithm=algorithm,
+                                   deadline=deadline)
+    user_batch_data = UserBatchData(batch_session, user_ids)
+
+    return {user_id: SessionContext(customer_ctx, user_id=user_id, context_filter_string=context_filter_string,
+                                    algorithm=algorithm, user_batch_data=user_batch_data, deadline=deadline)
+            for user_id in user_batch_data.user_ids}
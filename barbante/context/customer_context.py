@@ -1,4 +1,6 @@
+import numpy as np
 import pytz
+from tornado import gen
 
 from barbante import config
 import barbante.context
@@ -6,7 +8,8 @@ from barbante.data.BaseProxy import BaseProxy
 import barbante.model.product_model as pm
 from barbante.model.product_model_factory import ProductModelFactory
 from barbante.utils import decay_functions as df
-from barbante.utils.cache import Cache
+from barbante.utils.cache import Cache, LocalCache
+from barbante.utils.executors import DeadlineExecutor
 import barbante.utils.logging as barbante_logging
 log = barbante_logging.get_logger(__name__)
 
@@ -170,6 +173,10 @@ class CustomerContext(object):
         self.page_size_product_product_denominators = self._get_setting("PAGE_SIZE_PRODUCT_PRODUCT_DENOMINATORS")
         """ The number of template products in product-product pairs in each processing unit (page) of denominators.
         """
+        self.page_size_product_product_tfidf = self._get_setting("PAGE_SIZE_PRODUCT_PRODUCT_TFIDF")
+        """ The number of base products in product-product pairs (tfidf) in each processing unit (page)
+            of the sparse engine.
+        """
         self.page_size_batch_process_products = self._get_setting("PAGE_SIZE_BATCH_PROCESS_PRODUCTS")
         """ The number of products to be processed in each processing unit (page) during creation of product models.
         """
@@ -188,6 +195,25 @@ class CustomerContext(object):
         self.flush_size = self._get_setting("FLUSH_SIZE")
         """ The number of queued db operations which forces a flush.
         """
+        self.bulk_write_max_batch_ops = self._get_setting("BULK_WRITE_MAX_BATCH_OPS")
+        """ The maximum number of operations of each batch of bulk writes.
+        """
+        self.bulk_write_max_batch_bytes = self._get_setting("BULK_WRITE_MAX_BATCH_BYTES")
+        """ The maximum size (in bytes) of each batch of bulk writes.
+        """
+        self.bulk_write_max_in_flight = self._get_setting("BULK_WRITE_MAX_IN_FLIGHT")
+        """ The maximum number of unacknowledged batches of bulk writes per collection.
+        """
+        self.bulk_write_background = self._get_setting("BULK_WRITE_BACKGROUND")
+        """ If True, bulk writes which need not be waited for are sent by writer threads (see barbante.data.BulkWriter).
+        """
+        self.strengths_engine = self._get_setting("STRENGTHS_ENGINE") or barbante.context.UPSERT_ENGINE
+        """ The engine used to generate collaborative and tfidf strengths from scratch (UPSERT_ENGINE or SPARSE_ENGINE).
+        """
+        self.prune_product_product_strengths_tfidf = self._get_setting("PRUNE_PRODUCT_PRODUCT_STRENGTHS_TFIDF")
+        """ If True, only the strongest tfidf-based templates of each product (as many as the consolidation
+            of product templates reads) are saved during the generation of product-product strengths (tfidf).
+        """
         self.max_recommendations = self._get_setting("MAX_RECOMMENDATIONS")
         """ Hard limit for recommendation queries. If a query goes beyond the limit an Exception is raised.
         """
@@ -195,6 +221,18 @@ class CustomerContext(object):
         """ The timeout in seconds a hybrid recommender will wait for a specialist request to return
             If a specialist reaches timeout its results are ignored
         """
+        self.request_timeout = self._get_setting("REQUEST_TIMEOUT")
+        """ The time budget in seconds of each recommendation request (see barbante.utils.deadline.Deadline).
+        """
+        self.specialist_executor = DeadlineExecutor(self._get_setting("MAX_WORKERS_SPECIALISTS"))
+        """ A thread pool shared by all sessions of this customer, where hybrid recommenders run their specialists.
+        """
+        self.concurrent_user_context_loading = self._get_setting("CONCURRENT_USER_CONTEXT_LOADING")
+        """ If True, the independent stages of the loading of the user data run concurrently, on self.io_executor.
+        """
+        self.io_executor = DeadlineExecutor(self._get_setting("MAX_WORKERS_IO"))
+        """ A thread pool shared by all sessions of this customer, where database reads are run concurrently.
+        """
         self.min_rating_recommendable_from_user = self._get_setting("MIN_RATING_RECOMMENDABLE_FROM_USER")
         """ The minimum rating of recommendable products in user-to-user strategies.
         """
@@ -260,10 +298,21 @@ class CustomerContext(object):
         self.initial_date = self._get_setting("PRESENT_DATE")
         """ Used only in tests to set the present date """
 
-        self.context_filters_cache = Cache(cache_settings, 'context_filters') if cache_settings else None
+        self.context_filters_cache = Cache(cache_settings, 'context_filters',
+                                           local_max_size=self._get_setting("MAX_CACHE_SIZE_CONTEXT_FILTERS"),
+                                           local_max_weight=self._get_setting("MAX_CACHE_WEIGHT_CONTEXT_FILTERS"),
+                                           local_ttl=self._get_setting("CACHE_TTL_CONTEXT_FILTERS")) \
+            if cache_settings else None
         """ A cache for product_ids that correspond to recently used context filters.
         """
 
+        self.product_models_cache = LocalCache(max_size=self._get_setting("MAX_CACHE_SIZE_PRODUCT_MODELS"),
+                                               ttl=self._get_setting("CACHE_TTL_PRODUCT_MODELS"))
+        """ A process-wide LRU cache {product_id: ProductModel instance} shared by all sessions of this customer.
+            Its entries are tagged with the generation of the context filters cache, which is shared by all processes
+            and incremented upon every product change, so that product models are invalidated across processes.
+        """
+
     def set_data_proxy(self, db_proxy):
         if isinstance(db_proxy, BaseProxy):
             self.data_proxy = db_proxy
@@ -286,6 +335,59 @@ class CustomerContext(object):
         if self.context_filters_cache:
             self.context_filters_cache.set(filter, products)
 
+    def get_product_models(self, product_ids, max_time_ms=None):
+        """ Retrieves product models from the process-wide cache, fetching the missing ones from the database.
+
+            :param product_ids: A list of product ids.
+            :param max_time_ms: See barbante.data.BaseProxy.fetch_product_models().
+
+            :returns: A map {product_id: ProductModel instance}.
+        """
+        result = self.product_models_cache.get_many(product_ids, self._product_models_generation())
+        missing_product_ids = [p for p in product_ids if p not in result]
+        if len(missing_product_ids) > 0:
+            fetched_product_models = self.data_proxy.fetch_product_models(product_ids=missing_product_ids,
+                                                                          max_time_ms=max_time_ms)
+            self.cache_product_models(fetched_product_models)
+            result.update(fetched_product_models)
+        return result
+
+    @gen.coroutine
+    def get_product_models_async(self, product_ids, max_time_ms=None):
+        """ Coroutine version of get_product_models().
+        """
+        result = self.product_models_cache.get_many(product_ids, self._product_models_generation())
+        missing_product_ids = [p for p in product_ids if p not in result]
+        if len(missing_product_ids) > 0:
+            fetched_product_models = yield self.data_proxy.fetch_product_models_async(
+                product_ids=missing_product_ids, max_time_ms=max_time_ms)
+            self.cache_product_models(fetched_product_models)
+            result.update(fetched_product_models)
+        return result
+
+    def cache_product_models(self, product_models):
+        """ Stores product models in the process-wide cache.
+
+            :param product_models: A map {product_id: ProductModel instance}.
+        """
+        self.product_models_cache.set_many(product_models, self._product_models_generation())
+
+    def invalidate_product_models(self, product_ids=None):
+        """ Evicts product models from the process-wide cache of this process right away, and from those of
+            the other processes (which share the generation of the context filters cache) upon their next
+            check of the generation.
+
+            :param product_ids: A list of product ids, or None to evict all product models.
+        """
+        if product_ids is None:
+            self.product_models_cache.clear()
+        else:
+            self.product_models_cache.invalidate(product_ids)
+        self.clear_context_filters_cache()
+
+    def _product_models_generation(self):
+        return self.context_filters_cache.get_generation() if self.context_filters_cache else None
+
     def _load_activity_types(self):
         customer_settings = config.customers[self.customer]
         for activity_type, act in customer_settings['ACTIVITIES'].items():
@@ -367,6 +469,39 @@ class CustomerContext(object):
 
         return result
 
+    def obtain_product_age_decay_factors(self, product_dates, present_date):
+        """ Batch version of obtain_product_age_decay_factor().
+
+            :param product_dates: A list of product dates.
+            :param present_date: The current date.
+
+            :returns: A numpy array with the age decay factor of each product.
+        """
+        if self.product_age_decay_function_name is None:
+            return np.ones(len(product_dates))
+
+        if any(product_date is None for product_date in product_dates):
+            return np.array([self.obtain_product_age_decay_factor(product_date, present_date)
+                             for product_date in product_dates], dtype=float)
+
+        utc_product_dates = np.array([product_date if product_date.tzinfo is None else
+                                      product_date.astimezone(pytz.utc).replace(tzinfo=None)
+                                      for product_date in product_dates], dtype="datetime64[us]")
+        utc_present_date = np.datetime64(present_date.astimezone(pytz.utc).replace(tzinfo=None), "us")
+        # true division of timedelta64 arrays (unlike floor division) is supported by numpy 1.9;
+        # flooring matches timedelta.days, also for future (negative) ages
+        product_ages_in_days = np.floor((utc_present_date - utc_product_dates) / np.timedelta64(1, "D")).astype(int)
+
+        function_name = self.product_age_decay_function_name
+        if function_name == "linear":
+            ttl = self.product_age_decay_linear_function_ttl
+        elif function_name == "step":
+            ttl = self.product_age_decay_step_function_ttl
+        else:
+            ttl = None
+        return df.decay_factors(function_name, product_ages_in_days, ttl=ttl,
+                                halflife=self.product_age_decay_exponential_function_halflife)
+
     def _get_setting(self, attribute):
         """ Retrieves an attribute from the customer settings.
 
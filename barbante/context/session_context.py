@@ -1,9 +1,11 @@
 import datetime as dt
 import pytz
+from tornado import gen
 
 from barbante.context.user_context import UserContext
 from barbante.recommendation.filters.context_filter import ContextFilter
 import barbante.utils.date as du
+from barbante.utils.deadline import Deadline
 
 import barbante.utils.logging as barbante_logging
 log = barbante_logging.get_logger(__name__)
@@ -11,7 +13,8 @@ log = barbante_logging.get_logger(__name__)
 
 class SessionContext(object):
 
-    def __init__(self, customer_context, user_id=None, context_filter_string=None, algorithm=None):
+    def __init__(self, customer_context, user_id=None, context_filter_string=None, algorithm=None,
+                 user_batch_data=None, deadline=None, load=True):
         self.customer_context = customer_context
         """ The customer context.
         """
@@ -30,6 +33,12 @@ class SessionContext(object):
         self.algorithm = algorithm
         """ The algorithm that will be used for recommending products throughout this session.
         """
+        self.user_batch_data = user_batch_data
+        """ A UserBatchData instance shared by the sessions of a batch of target users, if any.
+        """
+        self.deadline = deadline if deadline is not None else Deadline()
+        """ The Deadline of the request served by this session (unbounded, unless informed).
+        """
         self._present_date = None
         """ The system date. Can be overriden for tests.
         """
@@ -47,7 +56,8 @@ class SessionContext(object):
         """
 
         self.set_present_date(self.customer_context.initial_date)
-        self.refresh()
+        if load:
+            self.refresh()
 
     def __getattr__(self, item):
         if self.user_context is None:
@@ -79,10 +89,26 @@ class SessionContext(object):
         """ See CustomerContext.obtain_product_age_decay_factor(). """
         return self.customer_context.obtain_product_age_decay_factor(product_date, self.get_present_date())
 
+    def obtain_product_age_decay_factors(self, product_dates):
+        """ See CustomerContext.obtain_product_age_decay_factors(). """
+        return self.customer_context.obtain_product_age_decay_factors(product_dates, self.get_present_date())
+
     def refresh(self):
         if self.user_id is not None:
-            self.user_context = UserContext(self, self.user_id, self.context_filter, self.algorithm)
+            self.user_context = UserContext(self, self.user_id, self.context_filter, self.algorithm,
+                                            self.user_batch_data)
+
+    @gen.coroutine
+    def refresh_async(self):
+        """ Coroutine version of refresh(). See UserContext.refresh_async().
+        """
+        if self.user_id is not None:
+            user_context = UserContext(self, self.user_id, self.context_filter, self.algorithm,
+                                       self.user_batch_data, load=False)
+            yield user_context.refresh_async()
+            self.user_context = user_context
 
     def new_session(self):
-        return SessionContext(self.customer_context, self.user_id, self.context_filter_string, self.algorithm)
+        return SessionContext(self.customer_context, self.user_id, self.context_filter_string, self.algorithm,
+                              self.user_batch_data, self.deadline)
 
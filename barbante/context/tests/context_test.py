@@ -1,12 +1,14 @@
 import nose.tools
 import datetime as dt
 import pytz
+import unittest.mock as mock
 
 from barbante import tests
 from barbante import context
 from barbante.config import database
 import barbante.maintenance.tasks as tasks
 import barbante.utils.date as du
+from barbante.utils.deadline import Deadline
 
 
 class TestContext():
@@ -31,6 +33,15 @@ class TestContext():
             test_context = context.create_customer_context(env, self.context.data_proxy)
             nose.tools.ok_(test_context is not None, 'Env [{0}] context has failed to load'.format(env))
 
+    def test_expired_deadline_skips_optional_stages(self):
+        """ Tests that optional user data (impressions, user templates) is not loaded once the deadline is reached.
+        """
+        session = tests.init_session(user_id="u_eco_1", algorithm="UBCF", deadline=Deadline(1, start=0))
+        nose.tools.eq_(session.user_impressions_summary, None, "User impressions should not have been loaded")
+        nose.tools.eq_(session.user_templates, [], "User templates should not have been loaded")
+        nose.tools.eq_(session.recent_activities_by_template_user, {},
+                       "Activities of template users should not have been loaded")
+
     @nose.tools.raises(ValueError)
     def test_invalid_attribute_pre_filter(self):
         target_user = "u_filter_1"
@@ -93,3 +104,22 @@ class TestContext():
         nose.tools.ok_(abs(session_context.obtain_previous_consumption_factor("p_eco_2") - 0.1) < tests.FLOAT_DELTA,
                        "Wrong previous consumption factor")
 
+    def test_product_age_decay_factors(self):
+        """ Tests that the vectorized product age decay factors match those computed one product at a time.
+        """
+        customer_context = self.context.customer_context
+        present_date = pytz.utc.localize(dt.datetime(2014, 10, 16, 12, 0))
+        product_dates = [dt.datetime(2014, 10, 1, 18, 30),                     # 14.75 days old
+                         pytz.utc.localize(dt.datetime(2014, 10, 16, 11, 59)),  # less than one day old
+                         dt.datetime(2014, 10, 17, 0, 0)]                       # half a day in the future
+        # the rational function is left out: it is singular at the (floored) age of the future-dated product
+        for function_name in ["linear", "exponential", "step"]:
+            with mock.patch.multiple(customer_context, product_age_decay_function_name=function_name,
+                                     product_age_decay_linear_function_ttl=30,
+                                     product_age_decay_step_function_ttl=14,
+                                     product_age_decay_exponential_function_halflife=7):
+                factors = customer_context.obtain_product_age_decay_factors(product_dates, present_date)
+                for product_date, factor in zip(product_dates, factors):
+                    expected_factor = customer_context.obtain_product_age_decay_factor(product_date, present_date)
+                    message = "Wrong [{0}] decay factor for product date [{1}]".format(function_name, product_date)
+                    nose.tools.ok_(abs(factor - expected_factor) < tests.FLOAT_DELTA, message)
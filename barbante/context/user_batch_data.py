@@ -0,0 +1,254 @@
+""" Bulk-loaded data shared by the user contexts of a batch of target users.
+"""
+
+import datetime as dt
+import threading
+from time import time
+
+import barbante.config as config
+import barbante.utils.logging as barbante_logging
+
+
+log = barbante_logging.get_logger(__name__)
+
+
+class UserBatchData(object):
+    """ Loads the data required by the UserContext instances of several target users with a few $in queries,
+        instead of a few queries per user.
+
+        Each collection is loaded lazily, for all users of the batch at once, the first time some UserContext
+        asks for it. That way only the data actually required by the session's algorithm is fetched.
+    """
+
+    def __init__(self, session_context, user_ids):
+        """ Constructor.
+
+            :param session_context: A customer-level SessionContext (i.e., with no user id), whose
+                context filter and algorithm are shared by all users of the batch.
+            :param user_ids: A list with the ids of all target users.
+        """
+        self.session_context = session_context
+        """ The customer-level session context.
+        """
+        self.user_ids = list(user_ids)
+        """ The ids of all target users in the batch.
+        """
+        self.latest_activity_day_by_user = None
+        """ A map {user_id: day of the latest activity}.
+        """
+        self.recent_activities_by_user = None
+        """ A map {user_id: list of activity dicts in descending order of dates}, with the activities
+            of each target user within the short term window relative to her latest activity.
+        """
+        self.impressions_summary_by_user = None
+        """ A map {user_id: {product: (count, first_impression_date)}}.
+        """
+        self.user_templates_by_user = None
+        """ A map {user_id: list of [strength, template_id] pairs}.
+        """
+        self.recent_activities_by_template_user = None
+        """ A map {template_id: list of activity dicts in descending order of dates}, for the union
+            of the templates of all target users.
+        """
+        self.product_models_for_collaborative_filtering = None
+        """ A map {product_id: ProductModel} with the models of all products recently consumed by the target users
+            and by their templates, which pass the session filter.
+        """
+        self.pre_filtered_product_models = None
+        """ A map {product_id: ProductModel} with all products which pass the session filter.
+        """
+        self.pre_filtered_products = None
+        """ A set with the ids of all products which pass the session filter.
+        """
+        self.product_templates = {}
+        """ A map {product_id: (collaborative templates, content-based templates)}, or None for products
+            without pre-rendered templates.
+        """
+        self._lock = threading.RLock()
+
+    def __getattr__(self, item):
+        return getattr(self.session_context, item)
+
+    def _split_by_anonymity(self, user_ids):
+        anonymous_users = [u for u in user_ids if config.is_anonymous(u)]
+        known_users = [u for u in user_ids if not config.is_anonymous(u)]
+        return [(True, anonymous_users), (False, known_users)]
+
+    def get_day_of_latest_user_activity(self, user_id):
+        """ See barbante.data.BaseProxy.fetch_day_of_latest_user_activity().
+        """
+        with self._lock:
+            if self.latest_activity_day_by_user is None:
+                self.latest_activity_day_by_user = {}
+                for anonymous, user_ids in self._split_by_anonymity(self.user_ids):
+                    if len(user_ids) > 0:
+                        self.latest_activity_day_by_user.update(
+                            self.data_proxy.fetch_days_of_latest_user_activities(user_ids, anonymous))
+        return self.latest_activity_day_by_user.get(user_id)
+
+    def get_recent_activities(self, user_id):
+        """ Retrieves the recent activities of the given user, i.e., those within the short term window
+            relative to the day of her latest activity.
+
+            :returns: A list of activity dicts in descending order of dates.
+        """
+        with self._lock:
+            if self.recent_activities_by_user is None:
+                self._load_recent_activities()
+        return self.recent_activities_by_user.get(user_id, [])
+
+    def _load_recent_activities(self):
+        start = time()
+        self.recent_activities_by_user = {}
+        cutoff_day_by_user = {}
+        for user_id in self.user_ids:
+            latest_activity_day = self.get_day_of_latest_user_activity(user_id)
+            if latest_activity_day is not None:
+                cutoff_day_by_user[user_id] = latest_activity_day - dt.timedelta(self.short_term_window)
+
+        for anonymous, user_ids in self._split_by_anonymity(list(cutoff_day_by_user.keys())):
+            if len(user_ids) == 0:
+                continue
+            # A single query with the earliest cutoff; each user is then trimmed to her own cutoff.
+            activities_by_user = self.data_proxy.fetch_activity_summaries_by_user(
+                user_ids=user_ids,
+                min_day=min(cutoff_day_by_user[u] for u in user_ids),
+                indexed_fields_only=False,
+                anonymous=anonymous)
+            for user_id, activities in activities_by_user.items():
+                cutoff_day = cutoff_day_by_user[user_id]
+                self.recent_activities_by_user[user_id] = [a for a in activities if a["day"] >= cutoff_day]
+        log.info("Loaded recent activities of [%d] users. Took %d milliseconds."
+                 % (len(self.recent_activities_by_user), 1000 * (time() - start)))
+
+    def get_impressions_summary(self, user_id):
+        """ See barbante.data.BaseProxy.fetch_impressions_summary().
+        """
+        with self._lock:
+            if self.impressions_summary_by_user is None:
+                self.impressions_summary_by_user = {}
+                for anonymous, user_ids in self._split_by_anonymity(self.user_ids):
+                    if len(user_ids) > 0:
+                        self.impressions_summary_by_user.update(
+                            self.data_proxy.fetch_impressions_summary(user_ids=user_ids, anonymous=anonymous))
+        return self.impressions_summary_by_user.get(user_id, {})
+
+    def get_user_templates(self, user_id):
+        """ See barbante.data.BaseProxy.fetch_user_templates().
+        """
+        with self._lock:
+            if self.user_templates_by_user is None:
+                self.user_templates_by_user = self.data_proxy.fetch_user_templates(self.user_ids)
+        return self.user_templates_by_user.get(user_id, [])
+
+    def get_recent_activities_of_templates(self, template_ids):
+        """ Retrieves the recent activities of the given template users.
+
+            :returns: A map {template_id: list of activity dicts in descending order of dates}.
+        """
+        with self._lock:
+            if self.recent_activities_by_template_user is None:
+                self._load_recent_activities_of_templates()
+        return {template_id: self.recent_activities_by_template_user[template_id] for template_id in template_ids
+                if template_id in self.recent_activities_by_template_user}
+
+    def _load_recent_activities_of_templates(self):
+        all_templates = set()
+        for user_id in self.user_ids:
+            all_templates |= {t[1] for t in self.get_user_templates(user_id)}
+
+        source_activities = []
+        for r in range(self.min_rating_recommendable_from_user, 6):
+            source_activities += self.activities_by_rating.get(r)
+
+        self.recent_activities_by_template_user = self.data_proxy.fetch_activity_summaries_by_user(
+            user_ids=list(all_templates),
+            activity_types=source_activities,
+            min_day=self.short_term_cutoff_date,
+            anonymous=False)
+
+    def get_product_models_for_collaborative_filtering(self, product_ids):
+        """ Retrieves the models of the given products, among those recently consumed by the target users
+            or by their templates, which pass the session filter.
+
+            :returns: A map {product_id: ProductModel}.
+        """
+        with self._lock:
+            if self.product_models_for_collaborative_filtering is None:
+                self._load_product_models_for_collaborative_filtering()
+        return {p: self.product_models_for_collaborative_filtering[p] for p in product_ids
+                if p in self.product_models_for_collaborative_filtering}
+
+    def _load_product_models_for_collaborative_filtering(self):
+        all_products = set()
+        for user_id in self.user_ids:
+            all_products |= {a["external_product_id"] for a in self.get_recent_activities(user_id)}
+        for activities in self.get_recent_activities_of_templates(
+                {t[1] for u in self.user_ids for t in self.get_user_templates(u)}).values():
+            all_products |= {a["external_product_id"] for a in activities}
+
+        self.product_models_for_collaborative_filtering = self._fetch_product_models_in_chunks(list(all_products))
+
+    def _fetch_product_models_in_chunks(self, product_ids):
+        # MongoDBProxy.fetch_product_models refuses to return more than max_recommendations models at once.
+        result = {}
+        json_filter = self.session_context.context_filter.to_json()
+        chunk_size = self.max_recommendations
+        for idx in range(0, len(product_ids), chunk_size):
+            result.update(self.data_proxy.fetch_product_models(
+                product_ids=product_ids[idx:idx + chunk_size], context_filter=json_filter))
+        return result
+
+    def get_pre_filtered_products(self):
+        """ Retrieves all products which pass the session filter.
+
+            :returns: A tuple (set of product ids, map {product_id: ProductModel}).
+        """
+        with self._lock:
+            if self.pre_filtered_products is None:
+                self._load_pre_filtered_products()
+        return self.pre_filtered_products, self.pre_filtered_product_models
+
+    def _load_pre_filtered_products(self):
+        start = time()
+        json_filter = self.session_context.context_filter.to_json()
+        context_filter_as_canonical_string = str(sorted([item for item in json_filter.items()]))
+
+        filtered_products = None
+        if self.context_filters_cache is not None:
+            filtered_products = self.context_filters_cache.get(context_filter_as_canonical_string)
+
+        if filtered_products is None:
+            self.pre_filtered_product_models = self.data_proxy.fetch_product_models(context_filter=json_filter)
+            filtered_products = set(self.pre_filtered_product_models.keys())
+            self.add_to_context_filters_cache(context_filter_as_canonical_string, filtered_products)
+        else:
+            self.pre_filtered_product_models = self._fetch_product_models_in_chunks(list(filtered_products))
+
+        self.pre_filtered_products = filtered_products
+        log.info("Loaded [%d] pre-filtered products. Took %d milliseconds."
+                 % (len(self.pre_filtered_products), 1000 * (time() - start)))
+
+    def fetch_product_templates(self, product_ids):
+        """ See barbante.data.BaseProxy.fetch_product_templates().
+
+            On its first call, it also loads the templates of the recently consumed products of all target users,
+            so that product-based recommenders of the whole batch are served by a single query.
+        """
+        with self._lock:
+            products_to_fetch = set(product_ids) - self.product_templates.keys()
+            if len(self.product_templates) == 0:
+                for user_id in self.user_ids:
+                    base_products = []
+                    base_products_set = set()
+                    for activity in self.get_recent_activities(user_id):
+                        product = activity["external_product_id"]
+                        if product not in base_products_set:
+                            base_products += [product]
+                            base_products_set.add(product)
+                    products_to_fetch |= set(base_products[:3 * self.base_products_count])
+            if len(products_to_fetch) > 0:
+                templates_map = self.data_proxy.fetch_product_templates(list(products_to_fetch))
+                for product_id in products_to_fetch:
+                    self.product_templates[product_id] = templates_map.get(product_id)  # None means no templates
+        return {p: self.product_templates[p] for p in product_ids if self.product_templates[p] is not None}
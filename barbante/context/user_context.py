@@ -1,9 +1,16 @@
+import collections
 import datetime as dt
+import numpy as np
 from time import time
 
+from tornado import gen
+from tornado.concurrent import is_future
+
 import barbante.config as config
 import barbante.context
+from barbante.context.context_manager import wrap
 import barbante.utils.decay_functions as df
+from barbante.utils.deadline import DeadlineExceeded
 import barbante.utils as utils
 import barbante.utils.logging as barbante_logging
 
@@ -16,7 +23,8 @@ log = barbante_logging.get_logger(__name__)
 
 
 class UserContext(object):
-    def __init__(self, session_context, user_id, context_filter=None, algorithm=None):
+    def __init__(self, session_context, user_id, context_filter=None, algorithm=None, user_batch_data=None,
+                 load=True):
         super().__init__()
 
         if session_context is None:
@@ -89,33 +97,190 @@ class UserContext(object):
         self.most_recently_consumed_products = None
         """ A list with the target user's recently consumed product ids, in descending order of consumption.
         """
+        self.user_batch_data = user_batch_data
+        """ A UserBatchData instance holding data bulk-loaded for a batch of target users (including this one),
+            or None if this context should query the database by itself.
+        """
+        self.product_templates = {}
+        """ A map {product_id: (collaborative templates, content-based templates)} caching the pre-rendered
+            templates already fetched during this session.
+        """
+        self.loading_times = {}
+        """ A map {stage name: elapsed time in seconds} with the duration of each stage of the loading of the user data.
+        """
+        self.skipped_stages = set()
+        """ The names of the optional stages of the loading of the user data which were skipped for lack of time.
+        """
 
         self._determine_specialist_recommenders()
 
-        self.refresh()
+        if load:
+            self.refresh()
 
     def __getattr__(self, item):
         return getattr(self.session_context.customer_context, item)
 
     def refresh(self):
-        self._load_recent_activities()
+        self.skipped_stages = set()
+        stages = self._build_loading_stages()
+
+        if self.concurrent_user_context_loading and self.user_batch_data is None:
+            self.loading_times = self.io_executor.run_graph(
+                {name: (wrap(stage), dependencies) for name, (stage, dependencies) in stages.items()})
+        else:
+            self.loading_times = {}
+            for name, (stage, _) in stages.items():
+                start = time()
+                stage()
+                self.loading_times[name] = time() - start
+
+        self._finish_loading()
+
+    @gen.coroutine
+    def refresh_async(self):
+        """ Coroutine version of refresh(), which loads the user data by means of the asynchronous reads
+            of the data proxy (see barbante.data.BaseProxy), so that a Tornado server may load the data of
+            many users at once on a single thread. Each stage starts as soon as the stages it depends on are done.
+
+            Batch sessions, whose data is already in memory, are simply loaded by refresh().
+        """
+        if self.user_batch_data is not None:
+            self.refresh()
+            return
+
+        self.skipped_stages = set()
+        self.loading_times = {}
+        stage_futures = {}
+        for name, (stage, dependencies) in self._build_loading_stages(asynchronous=True).items():
+            stage_futures[name] = self._run_stage_async(name, stage, [stage_futures[d] for d in dependencies])
+        yield list(stage_futures.values())
+
+        self._finish_loading()
+
+    @gen.coroutine
+    def _run_stage_async(self, name, stage, dependencies):
+        yield dependencies
+        start = time()
+        result = stage()
+        if is_future(result):
+            yield result
+        self.loading_times[name] = time() - start
+
+    def _finish_loading(self):
+        if self.skipped_stages & {"user_templates", "product_models_for_collaborative_filtering"}:
+            # Without user templates, user-user collaborative filtering will yield no recommendations.
+            self.user_templates = []
+            self.recent_activities_by_template_user = {}
+            self.recent_activities_by_product_by_template_user = {}
+
+        log.info("User context loading times (ms): {0}".format(
+            ", ".join("{0}={1:.0f}".format(name, 1000 * elapsed) for name, elapsed in self.loading_times.items())))
+        self.log_stats()
+
+    def _build_loading_stages(self, asynchronous=False):
+        """ Builds the dependency graph of the stages of the loading of the user data.
+
+            :param asynchronous: If True, the stages which read from the database are coroutines
+                (see refresh_async()).
 
+            :returns: An ordered map {stage name: (function with no arguments, set of names of the stages
+                it depends on)}, listed in an order which satisfies the dependencies.
+        """
+        optional_stage = self._optional_stage_async if asynchronous else self._optional_stage
+
+        stages = collections.OrderedDict()
+        stages["recent_activities"] = (
+            self._load_recent_activities_async if asynchronous else self._load_recent_activities, set())
         if len(self.blocking_activities) > 0:
-            self._load_blocked_products()
+            stages["blocked_products"] = (self._load_blocked_products, {"recent_activities"})
+        stages["recently_consumed_products"] = (self._determine_sorted_list_of_recently_consumed_products,
+                                                {"recent_activities"})
 
-        self._determine_sorted_list_of_recently_consumed_products()
-        self._load_user_impressions()
+        # Without impressions, there will be no history decay.
+        stages["user_impressions"] = (optional_stage(
+            "user_impressions", self._load_user_impressions_async if asynchronous else self._load_user_impressions),
+            set())
 
         if self.should_preload_filtered_products():
-            self._determine_pre_filtered_products()
+            stages["pre_filtered_products"] = (self._determine_pre_filtered_products_async if asynchronous
+                                               else self._determine_pre_filtered_products, set())
 
         if self.should_preload_user_user_collaborative_filtering_data():
-            self._load_user_templates()
-            self._load_recent_activities_of_templates()
+            stages["user_templates"] = (optional_stage(
+                "user_templates", self._load_user_templates_and_activities_async if asynchronous
+                else self._load_user_templates_and_activities), set())
             if self.filter_strategy == barbante.context.AFTER_SCORING:
-                self._load_product_models_for_collaborative_filtering()
+                stages["product_models_for_collaborative_filtering"] = (
+                    optional_stage("product_models_for_collaborative_filtering",
+                                   self._load_product_models_for_collaborative_filtering_async if asynchronous
+                                   else self._load_product_models_for_collaborative_filtering,
+                                   prerequisites=["user_templates"]),
+                    {"recent_activities", "user_templates"})
+
+        if asynchronous and self.should_prefetch_product_templates():
+            # Otherwise, the product-based recommenders would block the IOLoop while fetching these templates.
+            stages["product_templates"] = (
+                optional_stage("product_templates", self._prefetch_product_templates_async),
+                {"recently_consumed_products"})
+
+        return stages
+
+    def _optional_stage(self, name, stage, prerequisites=()):
+        """ Wraps a stage of the loading of the user data which the recommendations can do without, so that it is
+            skipped (and added to self.skipped_stages) when the deadline of the session is reached (before or during
+            the stage), or when any of its prerequisite stages has been skipped.
+
+            :param name: The name of the stage.
+            :param stage: A function with no arguments.
+            :param prerequisites: The names of the optional stages whose data this stage relies on.
+
+            :returns: A function with no arguments.
+        """
+        def run_optional_stage():
+            if not self._should_skip_stage(name, prerequisites):
+                try:
+                    stage()
+                except DeadlineExceeded as err:
+                    log.warn("Deadline reached: aborted stage [{0}] ({1})".format(name, err))
+                    self.skipped_stages.add(name)
+
+        return run_optional_stage
+
+    def _optional_stage_async(self, name, stage, prerequisites=()):
+        """ Coroutine version of _optional_stage(), for stages which are coroutines.
+        """
+        @gen.coroutine
+        def run_optional_stage():
+            if not self._should_skip_stage(name, prerequisites):
+                try:
+                    yield stage()
+                except DeadlineExceeded as err:
+                    log.warn("Deadline reached: aborted stage [{0}] ({1})".format(name, err))
+                    self.skipped_stages.add(name)
+
+        return run_optional_stage
+
+    def _should_skip_stage(self, name, prerequisites):
+        """ Checks whether an optional stage should be skipped (see _optional_stage()), adding it to
+            self.skipped_stages if so.
+        """
+        if any(prerequisite in self.skipped_stages for prerequisite in prerequisites):
+            log.warn("Skipped stage [{0}] for lack of prerequisites".format(name))
+        elif self.session_context.deadline.expired():
+            log.warn("Deadline reached: skipped stage [{0}]".format(name))
+        else:
+            return False
+        self.skipped_stages.add(name)
+        return True
 
-        self.log_stats()
+    def _load_user_templates_and_activities(self):
+        self._load_user_templates()
+        self._load_recent_activities_of_templates()
+
+    @gen.coroutine
+    def _load_user_templates_and_activities_async(self):
+        yield self._load_user_templates_async()
+        yield self._load_recent_activities_of_templates_async()
 
     def get_recommender(self, algorithm=None):
         """ Retrieves the intended recommender instance.
@@ -158,40 +323,83 @@ class UserContext(object):
                 self.specialist_recommenders = {self.algorithm}
 
     def _load_recent_activities(self):
+        # All other stages rely on the recent activities, so their queries are not bounded by the deadline.
         log.info("Loading recent activities...")
-        latest_activity_day = self.data_proxy.fetch_day_of_latest_user_activity(
-            self.user_id, anonymous=self.is_anonymous)
-        if latest_activity_day is None:
-            self.recent_activities_by_product = {}  # the user has no activities
+        if self.user_batch_data is not None:
+            latest_activity_day = self.user_batch_data.get_day_of_latest_user_activity(self.user_id)
         else:
-            relative_cutoff_day = latest_activity_day - dt.timedelta(self.session_context.short_term_window)
-
-            self.recent_activities = self.data_proxy.fetch_activity_summaries_by_user(
+            latest_activity_day = self.data_proxy.fetch_day_of_latest_user_activity(
+                self.user_id, anonymous=self.is_anonymous)
+        if latest_activity_day is not None:  # otherwise, the user has no activities
+            if self.user_batch_data is not None:
+                self.recent_activities = self.user_batch_data.get_recent_activities(self.user_id)
+            else:
+                self.recent_activities = self.data_proxy.fetch_activity_summaries_by_user(
+                    user_ids=[self.user_id],
+                    min_day=latest_activity_day - dt.timedelta(self.session_context.short_term_window),
+                    indexed_fields_only=False,
+                    anonymous=self.is_anonymous).get(self.user_id, [])
+        self._index_recent_activities()
+
+    @gen.coroutine
+    def _load_recent_activities_async(self):
+        log.info("Loading recent activities...")
+        latest_activity_day = yield self.data_proxy.fetch_day_of_latest_user_activity_async(
+            self.user_id, anonymous=self.is_anonymous)
+        if latest_activity_day is not None:  # otherwise, the user has no activities
+            activities_by_user = yield self.data_proxy.fetch_activity_summaries_by_user_async(
                 user_ids=[self.user_id],
-                min_day=relative_cutoff_day,
+                min_day=latest_activity_day - dt.timedelta(self.session_context.short_term_window),
                 indexed_fields_only=False,
-                anonymous=self.is_anonymous).get(self.user_id, [])
+                anonymous=self.is_anonymous)
+            self.recent_activities = activities_by_user.get(self.user_id, [])
+        self._index_recent_activities()
 
-            self.recent_activities_by_product = {}
-            for activity in self.recent_activities:
-                product = activity["external_product_id"]
-                date = activity["created_at"]
-                activity_type = activity["activity"]
-                self.recent_activities_by_product[product] = (date, activity_type)
+    def _index_recent_activities(self):
+        self.recent_activities_by_product = {}
+        for activity in self.recent_activities:
+            product = activity["external_product_id"]
+            date = activity["created_at"]
+            activity_type = activity["activity"]
+            self.recent_activities_by_product[product] = (date, activity_type)
         log.info("Loaded [%d] recent activities on [%d] products."
                  % (len(self.recent_activities), len(self.recent_activities_by_product)))
 
     def _load_recent_activities_of_templates(self):
         log.info("Loading recent activities of templates...")
         user_ids = [t[1] for t in self.user_templates]
-        source_activities = []
-        for r in range(self.min_rating_recommendable_from_user, 6):
-            source_activities += self.activities_by_rating.get(r)
-        self.recent_activities_by_template_user = self.data_proxy.fetch_activity_summaries_by_user(
-            user_ids=user_ids,
-            activity_types=source_activities,
+        if self.user_batch_data is not None:
+            self.recent_activities_by_template_user = self.user_batch_data.get_recent_activities_of_templates(
+                user_ids)
+        else:
+            self.recent_activities_by_template_user = self.data_proxy.fetch_activity_summaries_by_user(
+                user_ids=user_ids,
+                activity_types=self._get_recommendable_activity_types(),
+                min_day=self.session_context.short_term_cutoff_date,
+                anonymous=False,  # there is no such thing as an anonymous user template, anyway
+                max_time_ms=self.session_context.deadline.max_time_ms())
+        self._index_recent_activities_of_templates()
+
+    @gen.coroutine
+    def _load_recent_activities_of_templates_async(self):
+        log.info("Loading recent activities of templates...")
+        self.recent_activities_by_template_user = yield self.data_proxy.fetch_activity_summaries_by_user_async(
+            user_ids=[t[1] for t in self.user_templates],
+            activity_types=self._get_recommendable_activity_types(),
             min_day=self.session_context.short_term_cutoff_date,
-            anonymous=False)  # there is no such thing as an anonymous user template, anyway
+            anonymous=False,  # there is no such thing as an anonymous user template, anyway
+            max_time_ms=self.session_context.deadline.max_time_ms())
+        self._index_recent_activities_of_templates()
+
+    def _get_recommendable_activity_types(self):
+        """ Retrieves the types of the activities whose products may be recommended from a template user to another.
+        """
+        activity_types = []
+        for r in range(self.min_rating_recommendable_from_user, 6):
+            activity_types += self.activities_by_rating.get(r)
+        return activity_types
+
+    def _index_recent_activities_of_templates(self):
         self.recent_activities_by_product_by_template_user = {}
 
         activities_count = 0
@@ -212,15 +420,44 @@ class UserContext(object):
             the latest activity w.r.t. each product (if any).
         """
         log.info("Loading impression summaries of the target user...")
-        self.user_impressions_summary = self.data_proxy.fetch_impressions_summary(
-            user_ids=[self.user_id], anonymous=self.is_anonymous).get(self.user_id, {})
+        if self.user_batch_data is not None:
+            self.user_impressions_summary = self.user_batch_data.get_impressions_summary(self.user_id)
+        else:
+            self.user_impressions_summary = self.data_proxy.fetch_impressions_summary(
+                user_ids=[self.user_id], anonymous=self.is_anonymous,
+                max_time_ms=self.session_context.deadline.max_time_ms()).get(self.user_id, {})
+        log.info("Loaded [%d] user impression summaries." % len(self.user_impressions_summary))
+
+    @gen.coroutine
+    def _load_user_impressions_async(self):
+        """ Coroutine version of _load_user_impressions().
+        """
+        log.info("Loading impression summaries of the target user...")
+        impressions_summary_by_user = yield self.data_proxy.fetch_impressions_summary_async(
+            user_ids=[self.user_id], anonymous=self.is_anonymous,
+            max_time_ms=self.session_context.deadline.max_time_ms())
+        self.user_impressions_summary = impressions_summary_by_user.get(self.user_id, {})
         log.info("Loaded [%d] user impression summaries." % len(self.user_impressions_summary))
 
     def _load_user_templates(self):
         """ Loads into the context the top user templates of the user.
         """
         log.info("Loading user templates...")
-        self.user_templates = self.data_proxy.fetch_user_templates([self.user_id]).get(self.user_id, [])
+        if self.user_batch_data is not None:
+            self.user_templates = self.user_batch_data.get_user_templates(self.user_id)
+        else:
+            self.user_templates = self.data_proxy.fetch_user_templates(
+                [self.user_id], max_time_ms=self.session_context.deadline.max_time_ms()).get(self.user_id, [])
+        log.info("Loaded [%d] user templates." % len(self.user_templates))
+
+    @gen.coroutine
+    def _load_user_templates_async(self):
+        """ Coroutine version of _load_user_templates().
+        """
+        log.info("Loading user templates...")
+        templates_by_user = yield self.data_proxy.fetch_user_templates_async(
+            [self.user_id], max_time_ms=self.session_context.deadline.max_time_ms())
+        self.user_templates = templates_by_user.get(self.user_id, [])
         log.info("Loaded [%d] user templates." % len(self.user_templates))
 
     def _load_blocked_products(self):
@@ -239,10 +476,19 @@ class UserContext(object):
         """ Fetches all products whose product models conform to the session context filter.
             It gathers the product models of those products, and adds them to the self.product_models cache.
             It also stores the id's of all such products for later reference in self.filtered_products.
+
+            The recommendations must not do without the filter, so its queries are not bounded by the deadline.
         """
         log.info("Loading pre-filtered products...")
         start = time()
 
+        if self.user_batch_data is not None:
+            self.filtered_products, product_models = self.user_batch_data.get_pre_filtered_products()
+            self.product_models.update(product_models)
+            log.info("Done loading [%d] pre-filtered products from the batch data. Took %d milliseconds."
+                     % (len(self.filtered_products), 1000 * (time() - start)))
+            return
+
         context_filter_as_canonical_string = str(sorted([item for item in self.json_filter().items()]))
         if self.context_filters_cache is not None:
             self.filtered_products = self.context_filters_cache.get(context_filter_as_canonical_string)
@@ -250,37 +496,101 @@ class UserContext(object):
         if self.filtered_products is None:
             log.info("Fetching product models that pass the non-cached filter...")
             this_filter_product_models = self.data_proxy.fetch_product_models(context_filter=self.json_filter())
-            self.product_models.update(this_filter_product_models)
-            self.filtered_products = {p for p in this_filter_product_models}
-            self.add_to_context_filters_cache(context_filter_as_canonical_string, self.filtered_products)
+            self._set_pre_filtered_product_models(context_filter_as_canonical_string, this_filter_product_models)
         else:
             log.info("Pretty easy -- this filter was cached!")
 
-        products_to_fetch = self.filtered_products.copy()
+        products_to_fetch = self._get_products_without_models(self.filtered_products)
+        if len(products_to_fetch) > 0:
+            log.info("Fetching [%d] non-cached product models..." % len(products_to_fetch))
+            new_product_models = self.get_product_models(list(products_to_fetch))
+            self.product_models.update(new_product_models)
+        log.info("Done loading [%d] pre-filtered products. Took %d milliseconds."
+                 % (len(self.filtered_products), 1000 * (time() - start)))
 
-        if self.product_models:
-            products_to_fetch -= self.product_models.keys()
+    @gen.coroutine
+    def _determine_pre_filtered_products_async(self):
+        """ Coroutine version of _determine_pre_filtered_products().
+        """
+        log.info("Loading pre-filtered products...")
+        start = time()
+
+        context_filter_as_canonical_string = str(sorted([item for item in self.json_filter().items()]))
+        if self.context_filters_cache is not None:
+            self.filtered_products = self.context_filters_cache.get(context_filter_as_canonical_string)
 
+        if self.filtered_products is None:
+            log.info("Fetching product models that pass the non-cached filter...")
+            this_filter_product_models = yield self.data_proxy.fetch_product_models_async(
+                context_filter=self.json_filter())
+            self._set_pre_filtered_product_models(context_filter_as_canonical_string, this_filter_product_models)
+        else:
+            log.info("Pretty easy -- this filter was cached!")
+
+        products_to_fetch = self._get_products_without_models(self.filtered_products)
         if len(products_to_fetch) > 0:
             log.info("Fetching [%d] non-cached product models..." % len(products_to_fetch))
-            new_product_models = self.data_proxy.fetch_product_models(product_ids=list(products_to_fetch))
+            new_product_models = yield self.get_product_models_async(list(products_to_fetch))
             self.product_models.update(new_product_models)
         log.info("Done loading [%d] pre-filtered products. Took %d milliseconds."
                  % (len(self.filtered_products), 1000 * (time() - start)))
 
-    def _load_product_models_for_collaborative_filtering(self):
-        log.info("Loading product models for user-user collaborative filtering...")
-        products_to_fetch = set(self.recent_activities_by_product.keys())
-        for _, products in self.recent_activities_by_product_by_template_user.items():
-            for product_id in products:
-                products_to_fetch.add(product_id)
+    def _set_pre_filtered_product_models(self, context_filter_as_canonical_string, this_filter_product_models):
+        self.product_models.update(this_filter_product_models)
+        self.cache_product_models(this_filter_product_models)
+        self.filtered_products = {p for p in this_filter_product_models}
+        self.add_to_context_filters_cache(context_filter_as_canonical_string, self.filtered_products)
+
+    def _get_products_without_models(self, product_ids):
+        """ Retrieves the products, among the given ones, whose models are not in self.product_models yet.
+        """
+        products_to_fetch = set(product_ids)
         if self.product_models:
             products_to_fetch -= self.product_models.keys()
-        new_product_models = self.data_proxy.fetch_product_models(
-            product_ids=list(products_to_fetch), context_filter=self.json_filter())
+        return products_to_fetch
+
+    def _load_product_models_for_collaborative_filtering(self):
+        log.info("Loading product models for user-user collaborative filtering...")
+        products_to_fetch = self._get_products_without_models(self._get_products_for_collaborative_filtering())
+        if self.user_batch_data is not None:
+            new_product_models = self.user_batch_data.get_product_models_for_collaborative_filtering(
+                products_to_fetch)
+        else:
+            new_product_models = self.data_proxy.fetch_product_models(
+                product_ids=list(products_to_fetch), context_filter=self.json_filter(),
+                max_time_ms=self.session_context.deadline.max_time_ms())
+        self.product_models.update(new_product_models)
+        log.info("Loaded [%d] product models for user-user collaborative filtering." % len(new_product_models))
+
+    @gen.coroutine
+    def _load_product_models_for_collaborative_filtering_async(self):
+        log.info("Loading product models for user-user collaborative filtering...")
+        products_to_fetch = self._get_products_without_models(self._get_products_for_collaborative_filtering())
+        new_product_models = yield self.data_proxy.fetch_product_models_async(
+            product_ids=list(products_to_fetch), context_filter=self.json_filter(),
+            max_time_ms=self.session_context.deadline.max_time_ms())
         self.product_models.update(new_product_models)
         log.info("Loaded [%d] product models for user-user collaborative filtering." % len(new_product_models))
 
+    def _get_products_for_collaborative_filtering(self):
+        """ Retrieves the products recently consumed by the target user or by her user templates.
+        """
+        product_ids = set(self.recent_activities_by_product.keys())
+        for _, products in self.recent_activities_by_product_by_template_user.items():
+            product_ids |= products.keys()
+        return product_ids
+
+    @gen.coroutine
+    def _prefetch_product_templates_async(self):
+        """ Fetches the product templates of the most recently consumed products, which serve as the base products of
+            the product-based recommenders (see ProductBasedRecommender), into the templates cache of this session.
+        """
+        log.info("Pre-fetching product templates...")
+        # the same slack as ProductBasedRecommender
+        base_products = self.most_recently_consumed_products[:(3 * self.session_context.base_products_count)]
+        templates_map = yield self.fetch_product_templates_async(base_products)
+        log.info("Pre-fetched product templates of [%d] products." % len(templates_map))
+
     def _determine_sorted_list_of_recently_consumed_products(self):
         log.info("Determining sorted list of recently consumed products...")
         products_list = []
@@ -294,6 +604,52 @@ class UserContext(object):
         log.info("Determined sorted list of [%d] recently consumed products."
                  % len(self.most_recently_consumed_products))
 
+    def fetch_product_templates(self, product_ids):
+        """ Retrieves the pre-rendered templates of the given products, fetching only those which
+            have not been fetched yet during this session (by this or by another specialist recommender).
+
+            Should the deadline be reached while fetching them, the templates which were not fetched are left out,
+            and the product-based recommenders rely on the fill-in algorithm to make up for them.
+
+            :param product_ids: A list with the ids of the intended products.
+            :returns: See barbante.data.BaseProxy.fetch_product_templates().
+        """
+        products_to_fetch = [p for p in product_ids if p not in self.product_templates]
+        if len(products_to_fetch) > 0:
+            try:
+                if self.user_batch_data is not None:
+                    templates_map = self.user_batch_data.fetch_product_templates(products_to_fetch)
+                else:
+                    templates_map = self.data_proxy.fetch_product_templates(
+                        products_to_fetch, max_time_ms=self.session_context.deadline.max_time_ms())
+            except DeadlineExceeded as err:
+                log.warn("Deadline reached: left out the templates of [{0}] products ({1})".format(
+                    len(products_to_fetch), err))
+            else:
+                for product_id in products_to_fetch:
+                    self.product_templates[product_id] = templates_map.get(product_id)
+        return {p: self.product_templates[p] for p in product_ids if self.product_templates.get(p) is not None}
+
+    @gen.coroutine
+    def fetch_product_templates_async(self, product_ids):
+        """ Coroutine version of fetch_product_templates().
+        """
+        if self.user_batch_data is not None:
+            return self.fetch_product_templates(product_ids)
+
+        products_to_fetch = [p for p in product_ids if p not in self.product_templates]
+        if len(products_to_fetch) > 0:
+            try:
+                templates_map = yield self.data_proxy.fetch_product_templates_async(
+                    products_to_fetch, max_time_ms=self.session_context.deadline.max_time_ms())
+            except DeadlineExceeded as err:
+                log.warn("Deadline reached: left out the templates of [{0}] products ({1})".format(
+                    len(products_to_fetch), err))
+            else:
+                for product_id in products_to_fetch:
+                    self.product_templates[product_id] = templates_map.get(product_id)
+        return {p: self.product_templates[p] for p in product_ids if self.product_templates.get(p) is not None}
+
     def apply_pos_filter_to_products(self, product_ids):
         """ Retrieves product models for the informed products that pass the session context filter.
 
@@ -363,6 +719,55 @@ class UserContext(object):
 
         return in_boost
 
+    def obtain_history_decay_factors(self, product_ids):
+        """ Batch version of obtain_history_decay_factor().
+
+            :param product_ids: A list of product ids.
+
+            :returns: A numpy array with the history decay factor of each product.
+        """
+        if self.history_decay_function_name is None:
+            return np.ones(len(product_ids))
+
+        impressions_summary = self.user_impressions_summary or {}
+        latest_impressions_counts = [impressions_summary.get(product_id, (0, None))[0] for product_id in product_ids]
+
+        function_name = self.history_decay_function_name
+        if function_name == "linear":
+            ttl = self.history_decay_linear_function_ttl
+        elif function_name == "step":
+            ttl = self.history_decay_step_function_ttl
+        else:
+            ttl = None
+        return df.decay_factors(function_name, latest_impressions_counts, ttl=ttl,
+                                halflife=self.history_decay_exponential_function_halflife)
+
+    def obtain_previous_consumption_factors(self, product_ids):
+        """ Batch version of obtain_previous_consumption_factor().
+
+            :param product_ids: A list of product ids.
+
+            :returns: A numpy array with the previous consumption factor of each product.
+        """
+        blocked_products = self.blocked_products or set()
+        blocked = np.array([product_id in blocked_products for product_id in product_ids], dtype=bool)
+        return np.where(blocked, self.previous_consumption_factor, 1.0)
+
+    def obtain_in_boosts(self, product_ids):
+        """ Batch version of obtain_in_boost().
+
+            :param product_ids: A list of product ids.
+
+            :returns: A numpy array with the in-boost factor of each product.
+        """
+        in_boost_by_activity = self.session_context.in_boost_by_activity
+        result = np.ones(len(product_ids))
+        for idx, product_id in enumerate(product_ids):
+            product_activity = self.recent_activities_by_product.get(product_id)
+            if product_activity is not None:
+                result[idx] = in_boost_by_activity.get(product_activity[1], 1)
+        return result
+
     def json_filter(self):
         if self.filter:
             return self.filter.to_json()
@@ -390,5 +795,8 @@ class UserContext(object):
     def should_preload_user_user_collaborative_filtering_data(self):
         return "UBCF" in self.specialist_recommenders
 
+    def should_prefetch_product_templates(self):
+        return len(self.specialist_recommenders & {"PBCF", "CB"}) > 0
+
     def should_preload_filtered_products(self):
         return self.filter_strategy == barbante.context.BEFORE_SCORING
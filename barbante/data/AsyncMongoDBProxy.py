@@ -0,0 +1,139 @@
+import functools
+
+import motor
+import pymongo.errors
+from tornado import gen
+
+from barbante.data.MongoDBProxy import MongoDBProxy
+from barbante.utils.deadline import DeadlineExceeded
+
+import barbante.utils.logging as barbante_logging
+
+log = barbante_logging.get_logger(__name__)
+
+
+def _time_limited_async(method):
+    """ Decorates proxy coroutines which accept a *max_time_ms* parameter, translating the
+        errors of queries aborted by the server for exceeding it into DeadlineExceeded errors.
+    """
+    coroutine = gen.coroutine(method)
+
+    @functools.wraps(method)
+    @gen.coroutine
+    def wrapper(*args, **kwargs):
+        try:
+            result = yield coroutine(*args, **kwargs)
+        except pymongo.errors.ExecutionTimeout as err:
+            raise DeadlineExceeded("{0} exceeded its time limit: {1}".format(method.__name__, err)) from err
+        return result
+    return wrapper
+
+
+class AsyncMongoDBProxy(MongoDBProxy):
+    """ Data proxy to be used with MongoDB by Tornado servers.
+
+        The reads used to serve recommendation requests (see the asynchronous reads of barbante.data.BaseProxy)
+        are run by motor, an asynchronous driver, so that a single IOLoop may have many such queries in flight
+        at once. They build exactly the same queries as their blocking counterparts in MongoDBProxy, which,
+        along with all other operations, are inherited as is.
+    """
+
+    def __init__(self, context):
+        super().__init__(context)
+
+        self.database_async = None
+        """ The motor database to be used for asynchronous reads. It is only connected upon the first
+            asynchronous read, so that it is bound to the IOLoop of the server.
+        """
+
+    def _initialize_motor_connection(self):
+        log.info("Initializing MongoDB async connection...")
+
+        settings = self.context.database_settings
+        read_preference = self.parse_read_preferences(settings.read_preference)
+
+        if settings.replica_set:
+            motor_connection = motor.MotorReplicaSetClient(','.join(settings.host),
+                                                           replicaSet=settings.replica_set,
+                                                           read_preference=read_preference,
+                                                           tz_aware=True)
+        else:
+            motor_connection = motor.MotorClient(settings.host,
+                                                 read_preference=read_preference,
+                                                 tz_aware=True)
+
+        log.info("MongoDB async connection ready...")
+        return motor_connection[settings.name]
+
+    @gen.coroutine
+    def _find_async(self, query, max_time_ms=None):
+        """ Runs a FindQuery on the main database, without blocking the IOLoop.
+
+            :param query: The FindQuery.
+            :param max_time_ms: If not None, the server-side execution time limit of the query.
+
+            :returns: A list with all documents matched by the query.
+        """
+        if self.database_async is None:
+            self.database_async = self._initialize_motor_connection()
+
+        cursor = self.database_async[query.collection].find(query.where, query.fields)
+        if query.sort is not None:
+            cursor = cursor.sort(query.sort)
+        if query.limit is not None:
+            cursor = cursor.limit(query.limit)
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+        docs = yield cursor.to_list(length=None)
+        return docs
+
+    @_time_limited_async
+    def fetch_day_of_latest_user_activity_async(self, user_id, anonymous, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        docs = yield self._find_async(self._day_of_latest_user_activity_query(user_id, anonymous), max_time_ms)
+        return self._collect_day_of_latest_user_activity(docs)
+
+    @_time_limited_async
+    def fetch_activity_summaries_by_user_async(self, anonymous, user_ids=None, product_ids=None, activity_types=None,
+                                               num_activities=None, min_day=None,
+                                               indexed_fields_only=True, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        query = self._activity_summaries_by_user_query(anonymous, user_ids, product_ids, activity_types,
+                                                       num_activities, min_day, indexed_fields_only)
+        docs = yield self._find_async(query, max_time_ms)
+        return self._collect_activity_summaries_by_user(docs, indexed_fields_only)
+
+    @_time_limited_async
+    def fetch_impressions_summary_async(self, anonymous, user_ids=None, product_ids=None, group_by_product=False,
+                                        max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        docs = yield self._find_async(self._impressions_summary_query(anonymous, user_ids, product_ids), max_time_ms)
+        return self._collect_impressions_summary(docs, group_by_product)
+
+    @_time_limited_async
+    def fetch_user_templates_async(self, user_ids, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        docs = yield self._find_async(self._user_templates_query(user_ids), max_time_ms)
+        return self._collect_user_templates(docs)
+
+    @_time_limited_async
+    def fetch_product_templates_async(self, product_ids, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        docs = yield self._find_async(self._product_templates_query(product_ids), max_time_ms)
+        return self._collect_product_templates(docs)
+
+    @_time_limited_async
+    def fetch_product_models_async(self, product_ids=None, context_filter=None,
+                                   min_date=None, max_date=None, product_date_field=None, ids_only=False,
+                                   max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        query = self._product_models_query(product_ids, context_filter, min_date, max_date, product_date_field,
+                                           ids_only)
+        docs = yield self._find_async(query, max_time_ms)
+        return self._collect_product_models(docs, ids_only)
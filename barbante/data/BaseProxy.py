@@ -1,5 +1,7 @@
 import abc
 
+from tornado import gen
+
 
 class BaseProxy(object):
     """ Defines the basic interface for data read/write operations.
@@ -17,8 +19,13 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def fetch_all_user_ids(self):
+    def fetch_all_user_ids(self, ordered=False, after_user_id=None):
         """ Retrieves all user ids in the users collection.
+
+            :param ordered: If True, the ids will be yielded in ascending order.
+            :param after_user_id: If not None, only the ids greater than *after_user_id* will be yielded
+                (in ascending order). Useful for resuming long-running batch processes.
+
             :returns: a generator yielding all user ids.
         """
 
@@ -40,10 +47,12 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def fetch_user_templates(self, user_ids):
+    def fetch_user_templates(self, user_ids, max_time_ms=None):
         """ Retrieves a map with the pre-rendered (cached) templates by user_id.
 
             :param user_ids: The list of product ids.
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: A map with each user_id associated to a list
                 containing a [*strength*, *template_id*] entry
@@ -63,12 +72,14 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def fetch_product_templates(self, product_ids):
+    def fetch_product_templates(self, product_ids, max_time_ms=None):
         """ Retrieves a map with the pre-rendered (cached) templates by product_id.
             It actually returns a tuple with two maps: one for the collaborative filtering templates;
                 another for the content-based templates.
 
             :param product_ids: The list of product ids.
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: A map with each product_id associated to a tuple with two lists:
                 the first one, for collaborative filtering templates;
@@ -97,7 +108,7 @@ class BaseProxy(object):
     @abc.abstractmethod
     def fetch_activity_summaries_by_user(self, anonymous, user_ids=None, product_ids=None, activity_types=None,
                                          num_activities=None, min_day=None,
-                                         indexed_fields_only=True):
+                                         indexed_fields_only=True, max_time_ms=None):
         """ Retrieves a map with activities split by user, in descending chronological order.
 
             :param anonymous: if True, it will look for activities in the anonymous activities collection.
@@ -118,6 +129,8 @@ class BaseProxy(object):
                        - the "pp_latest_date" field,
                     since these fields are not indexed.
                     If False, all fields above will be fetched as well.
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: A map {*user_id*: list of {"external_user_id": user_id",
                                                  "external_product_id": product_id,
@@ -131,15 +144,39 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def fetch_day_of_latest_user_activity(self, user_id, anonymous):
+    def fetch_day_of_latest_user_activity(self, user_id, anonymous, max_time_ms=None):
         """ Retrieves the day of latest activity of the informed user.
 
             :param user_id: the intended user id.
             :param anonymous: if True, it will lookup the anonymous activities collection.
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: a datetime object set to midnight GMT of the day of the latest activity.
         """
 
+    @abc.abstractmethod
+    def fetch_days_of_latest_user_activities(self, user_ids, anonymous):
+        """ Retrieves the day of latest activity of each informed user.
+
+            :param user_ids: a list with the intended user ids.
+            :param anonymous: if True, it will lookup the anonymous activities collection.
+
+            :returns: a map {user_id: datetime object set to midnight GMT of the day of the latest activity}.
+                Users without activities are not included in the map.
+        """
+
+    @abc.abstractmethod
+    def fetch_all_activity_summaries(self, min_day=None):
+        """ Retrieves all (non-anonymous) activity summaries of supported activity types, in a single sequential
+            scan, with no particular order. Meant for exporting the activity window of batch processes
+            (see barbante.maintenance.activity_snapshot).
+
+            :param min_day: The day before which no activities will be retrieved. If None, it will be disregarded.
+
+            :returns: A generator yielding {"external_user_id", "external_product_id", "activity", "day"} dicts.
+        """
+
     @abc.abstractmethod
     def fetch_products_by_rating_by_user(self, user_ids=None, min_date=None, max_date=None):
         """ Retrieves all products consumed by each user, grouped by rating (either explicit or implicit).
@@ -186,7 +223,8 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def fetch_impressions_summary(self, anonymous, user_ids=None, product_ids=None, group_by_product=False):
+    def fetch_impressions_summary(self, anonymous, user_ids=None, product_ids=None, group_by_product=False,
+                                  max_time_ms=None):
         """ Retrieves the summary of impressions for the given users and products.
 
             :param anonymous: if True, it will look for impressions in the anonymous impressions collection.
@@ -194,6 +232,8 @@ class BaseProxy(object):
             :param product_ids: the intended products. If None, all products will be considered.
             :param group_by_product: if True, the impressions will be grouped by product;
                                      if False, they will be grouped by user instead.
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: - a map {product_id: {user_id: a (count, first_impression_date) tuple}},
                             if group_by_product is True;
@@ -263,7 +303,8 @@ class BaseProxy(object):
 
     @abc.abstractmethod
     def fetch_product_models(self, product_ids=None, context_filter=None,
-                             min_date=None, max_date=None, product_date_field=None, ids_only=False):
+                             min_date=None, max_date=None, product_date_field=None, ids_only=False,
+                             max_time_ms=None):
         """ Fetches product models satisfying the informed parameters.
 
             :param product_ids: A list with the intended product ids. If None, products will not be filtered by id.
@@ -276,6 +317,8 @@ class BaseProxy(object):
                 If None, the default field name will be used.
             :param ids_only: if True, only the product ids will be retrieved, not the entire product models
                 (this is useful when all one needs to know is which products pass a certain context filter).
+            :param max_time_ms: If not None, the query is aborted (raising DeadlineExceeded) after this many
+                milliseconds.
 
             :returns: A dict {product_id: product_model}, where *product_model* is an instance of ProductModel,
                       if ids_only is False; or
@@ -383,7 +426,7 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def save_user_user_numerators(self, strength_numerators, increment=False, upsert=True):
+    def save_user_user_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
         """ Increments the numerators associated to user-to-user strengths.
 
             :param strength_numerators: A dict {(user, template): strength_numerator_tuple}, where
@@ -391,10 +434,12 @@ class BaseProxy(object):
             :param increment: if True, adds the informed numerators to the existing ones, if any; otherwise,
                        it overwrites whatever existing value might there be.
             :param upsert: if True, performs upserts; if False, inserts each new document.
+            :param wait: if False, the call may return before the writes reach the database
+                       (see flush_bulk_writes()).
         """
 
     @abc.abstractmethod
-    def save_uu_strengths(self, strength_docs_map, upsert=False, deferred_publication=False):
+    def save_uu_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
         """ Saves a sparse matrix of user-to-user strengths, along with operands.
 
             :param strength_docs_map: A dict {(user, template): strength_doc}, where
@@ -409,6 +454,8 @@ class BaseProxy(object):
                            if False, just inserts each new document.
             :param deferred_publication: if True, the informed strengths will be saved to a temporary
                        collection, and will only go live after a call to self.hotswap_uu_strengths().
+            :param wait: if False, the call may return before the writes reach the database
+                       (see flush_bulk_writes()).
         """
 
     @abc.abstractmethod
@@ -446,7 +493,7 @@ class BaseProxy(object):
         """
 
     @abc.abstractmethod
-    def save_product_product_numerators(self, strength_numerators, increment=False, upsert=True):
+    def save_product_product_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
         """ Increments the numerators associated to product-to-product strengths.
 
             :param strength_numerators: A dict {(product, template): strength_numerator_tuple}, where
@@ -454,10 +501,12 @@ class BaseProxy(object):
             :param increment: if True, adds the informed numerators to the existing ones, if any; otherwise,
                        it overwrites whatever existing value might there be.
             :param upsert: if True, performs upserts; if False, inserts each new document.
+            :param wait: if False, the call may return before the writes reach the database
+                       (see flush_bulk_writes()).
         """
 
     @abc.abstractmethod
-    def save_pp_strengths(self, strength_docs_map, upsert=False, deferred_publication=False):
+    def save_pp_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
         """ Saves a sparse matrix of product-to-product strengths, along with operands.
 
             :param strength_docs_map: A dict {(product, template): strength_doc}, where
@@ -472,6 +521,8 @@ class BaseProxy(object):
                            if False, just inserts each new document.
             :param deferred_publication: if True, the informed strengths will be saved to a temporary
                        collection, and will only go live after a call to self.hotswap_pp_strengths().
+            :param wait: if False, the call may return before the writes reach the database
+                       (see flush_bulk_writes()).
         """
 
     @abc.abstractmethod
@@ -511,6 +562,21 @@ class BaseProxy(object):
                        collection, and will only go live after a call to self.hotswap_product_product_strengths_tfidf().
         """
 
+    @abc.abstractmethod
+    def flush_bulk_writes(self):
+        """ Waits for all pending bulk writes (those saved with wait=False) to reach the database.
+            Should be called before reading back or publishing (e.g. hotswapping) what was written.
+        """
+
+    @abc.abstractmethod
+    def get_bulk_write_stats(self):
+        """ Retrieves the throughput of the bulk writes of this proxy.
+
+            :returns: A map {collection name: {"docs": number of written documents, "bytes": number of written bytes,
+                "batches": number of written batches, "in_flight": number of pending batches,
+                "docs_per_second": docs/s, "bytes_per_second": bytes/s}}.
+        """
+
     @abc.abstractmethod
     def hotswap_uu_strengths(self):
         """ Triggers a swap between the actual and the temporary user-user strength collections.
@@ -736,6 +802,27 @@ class BaseProxy(object):
             :returns: A map {product_id: {term: TFIDF}}.
         """
 
+    @abc.abstractmethod
+    def fetch_tfidf_postings(self, attribute, terms):
+        """ Retrieves the products having each informed term as one of their top terms w.r.t. the given attribute,
+            along with the TFIDF of the term in each of them (i.e., the postings of an inverted index of top terms).
+
+            :param attribute: The product attribute to be considered.
+            :param terms: A list with the intended terms.
+
+            :returns: A map {term: {product_id: TFIDF}}.
+        """
+
+    @abc.abstractmethod
+    def fetch_tfidf_sums(self, attribute, products):
+        """ Retrieves the sum of the TFIDF's of the top terms of the informed products w.r.t. the given attribute.
+
+            :param attribute: The product attribute to be considered.
+            :param products: A list with the intended product id's.
+
+            :returns: A map {product_id: sum of the TFIDF's of its top terms}.
+        """
+
     @abc.abstractmethod
     def get_user_count(self):
         """ Returns the number of stored users.
@@ -905,3 +992,57 @@ class BaseProxy(object):
             :param status: The status of this batch run: running, successful, or failed.
             :param elapsed_time: The elapsed time.
         """
+
+    # Asynchronous reads
+    #
+    # The reads used to serve recommendation requests have coroutine versions, to be yielded from Tornado
+    # coroutines (see UserContext.refresh_async()). These default implementations simply call the blocking
+    # versions; proxies backed by asynchronous drivers (see barbante.data.AsyncMongoDBProxy) override them,
+    # so that the IOLoop is free to serve other requests while the queries run.
+
+    @gen.coroutine
+    def fetch_day_of_latest_user_activity_async(self, user_id, anonymous, max_time_ms=None):
+        """ Coroutine version of fetch_day_of_latest_user_activity().
+        """
+        return self.fetch_day_of_latest_user_activity(user_id, anonymous, max_time_ms=max_time_ms)
+
+    @gen.coroutine
+    def fetch_activity_summaries_by_user_async(self, anonymous, user_ids=None, product_ids=None, activity_types=None,
+                                               num_activities=None, min_day=None,
+                                               indexed_fields_only=True, max_time_ms=None):
+        """ Coroutine version of fetch_activity_summaries_by_user().
+        """
+        return self.fetch_activity_summaries_by_user(anonymous, user_ids=user_ids, product_ids=product_ids,
+                                                     activity_types=activity_types, num_activities=num_activities,
+                                                     min_day=min_day, indexed_fields_only=indexed_fields_only,
+                                                     max_time_ms=max_time_ms)
+
+    @gen.coroutine
+    def fetch_impressions_summary_async(self, anonymous, user_ids=None, product_ids=None, group_by_product=False,
+                                        max_time_ms=None):
+        """ Coroutine version of fetch_impressions_summary().
+        """
+        return self.fetch_impressions_summary(anonymous, user_ids=user_ids, product_ids=product_ids,
+                                              group_by_product=group_by_product, max_time_ms=max_time_ms)
+
+    @gen.coroutine
+    def fetch_user_templates_async(self, user_ids, max_time_ms=None):
+        """ Coroutine version of fetch_user_templates().
+        """
+        return self.fetch_user_templates(user_ids, max_time_ms=max_time_ms)
+
+    @gen.coroutine
+    def fetch_product_templates_async(self, product_ids, max_time_ms=None):
+        """ Coroutine version of fetch_product_templates().
+        """
+        return self.fetch_product_templates(product_ids, max_time_ms=max_time_ms)
+
+    @gen.coroutine
+    def fetch_product_models_async(self, product_ids=None, context_filter=None,
+                                   min_date=None, max_date=None, product_date_field=None, ids_only=False,
+                                   max_time_ms=None):
+        """ Coroutine version of fetch_product_models().
+        """
+        return self.fetch_product_models(product_ids=product_ids, context_filter=context_filter,
+                                         min_date=min_date, max_date=max_date, product_date_field=product_date_field,
+                                         ids_only=ids_only, max_time_ms=max_time_ms)
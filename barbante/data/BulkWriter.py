@@ -0,0 +1,140 @@
+import concurrent.futures
+import threading
+from time import time
+
+import bson
+
+import barbante.utils.logging as barbante_logging
+
+
+log = barbante_logging.get_logger(__name__)
+
+
+class BulkWriter(object):
+    """ Sends the bulk writes of a MongoDB collection in unordered batches bounded both in number of operations
+        and in bytes, keeping track of the write throughput.
+
+        Writes may be sent either synchronously, by the calling thread, or in the background, by writer threads,
+        so that the calling thread does not wait for the acknowledgements of the database. At most *max_in_flight*
+        batches are pending at any time: further background writes block until a batch is acknowledged, which
+        bounds the memory held by queued operations. Background writes are only guaranteed to have reached
+        the database after a call to flush().
+    """
+
+    def __init__(self, collection, max_batch_ops, max_batch_bytes, max_in_flight):
+        """
+        :param collection: The pymongo collection.
+        :param max_batch_ops: The maximum number of operations of each batch.
+        :param max_batch_bytes: The maximum size (in bytes) of each batch.
+        :param max_in_flight: The maximum number of pending (unacknowledged) background batches.
+        """
+        self.collection = collection
+        """ The pymongo collection. """
+        self.max_batch_ops = max_batch_ops
+        """ The maximum number of operations of each batch. """
+        self.max_batch_bytes = max_batch_bytes
+        """ The maximum size (in bytes) of each batch. """
+        self.max_in_flight = max_in_flight
+        """ The maximum number of pending (unacknowledged) background batches. """
+        self.docs = 0
+        """ The number of operations written so far. """
+        self.bytes = 0
+        """ The number of bytes written so far. """
+        self.batches = 0
+        """ The number of batches written so far. """
+        self.busy_time = 0
+        """ The overall time (in seconds) during which at least one batch was being written. """
+        self._running = 0
+        self._busy_since = None
+        self._pending = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def write(self, operations, write_concern, background=False):
+        """ Writes many operations, in as many batches as needed.
+
+            :param operations: An iterable of (spec, update clause) pairs, for upserts, or of (None, document) pairs,
+                for inserts.
+            :param write_concern: The write concern of the batches.
+            :param background: If True, the batches are handed over to writer threads and the call returns
+                without waiting for their acknowledgements.
+        """
+        batch = []
+        batch_bytes = 0
+        for spec, clause in operations:
+            operation_bytes = len(bson.BSON.encode(clause)) + (len(bson.BSON.encode(spec)) if spec is not None else 0)
+            if len(batch) > 0 and (len(batch) >= self.max_batch_ops or
+                                   batch_bytes + operation_bytes > self.max_batch_bytes):
+                self._send(batch, batch_bytes, write_concern, background)
+                batch = []
+                batch_bytes = 0
+            batch.append((spec, clause))
+            batch_bytes += operation_bytes
+        if len(batch) > 0:
+            self._send(batch, batch_bytes, write_concern, background)
+
+    def flush(self):
+        """ Waits for all background batches to be acknowledged.
+            If some of them failed, the error of the first one is raised.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        concurrent.futures.wait(pending)
+        for future in pending:
+            future.result()
+
+    def get_stats(self):
+        with self._lock:
+            return {"docs": self.docs,
+                    "bytes": self.bytes,
+                    "batches": self.batches,
+                    "in_flight": len([future for future in self._pending if not future.done()]),
+                    "docs_per_second": self.docs / self.busy_time if self.busy_time > 0 else None,
+                    "bytes_per_second": self.bytes / self.busy_time if self.busy_time > 0 else None}
+
+    def _send(self, batch, batch_bytes, write_concern, background):
+        if not background:
+            self._execute(batch, batch_bytes, write_concern)
+            return
+
+        self._slots.acquire()  # blocks while max_in_flight batches are pending
+        try:
+            future = self._get_executor().submit(self._execute, batch, batch_bytes, write_concern)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._pending = [f for f in self._pending if not f.done() or f.exception() is not None]
+            self._pending.append(future)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+            return self._executor
+
+    def _execute(self, batch, batch_bytes, write_concern):
+        with self._lock:
+            if self._running == 0:
+                self._busy_since = time()
+            self._running += 1
+        try:
+            bulk_op = self.collection.initialize_unordered_bulk_op()
+            for spec, clause in batch:
+                if spec is None:
+                    bulk_op.insert(clause)
+                else:
+                    bulk_op.find(spec).upsert().update(clause)
+            bulk_op.execute(write_concern={'w': write_concern})
+        finally:
+            with self._lock:
+                self._running -= 1
+                if self._running == 0:
+                    self.busy_time += time() - self._busy_since
+        with self._lock:
+            self.docs += len(batch)
+            self.bytes += batch_bytes
+            self.batches += 1
@@ -0,0 +1,1315 @@
+import collections.abc
+import copy
+import datetime as dt
+import functools
+import threading
+from random import random
+
+import pytz
+
+import barbante.config as config
+from barbante.data.BaseProxy import BaseProxy
+from barbante.utils.profiling import profile
+from barbante.model.product_model import ProductModel
+import barbante.utils as utils
+import barbante.utils.date as du
+
+import barbante.utils.logging as barbante_logging
+
+log = barbante_logging.get_logger(__name__)
+
+
+_MISSING = object()
+""" Marks a field which is absent from a document.
+"""
+
+
+def _synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _as_stored(value):
+    """ Mimics a MongoDB round trip: naive datetimes are taken as UTC and all datetimes come back tz-aware.
+    """
+    if isinstance(value, dt.datetime):
+        return pytz.utc.localize(value) if value.tzinfo is None else value.astimezone(pytz.utc)
+    if isinstance(value, dict):
+        return {k: _as_stored(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_as_stored(v) for v in value]
+    return value
+
+
+def _get_field(doc, path):
+    if path in doc:
+        return doc[path]
+    value = doc
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _project(doc, fields):
+    """ Mimics a MongoDB projection: dotted fields are copied back into nested dicts.
+    """
+    result = {}
+    for field in fields:
+        value = _get_field(doc, field)
+        if value is _MISSING:
+            continue
+        path = field.split('.')
+        target = result
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = copy.deepcopy(value)
+    return result
+
+
+def _equals(value, operand):
+    if isinstance(value, list) and not isinstance(operand, list):
+        return operand in value
+    return value == operand
+
+
+def _compare(value, operator, operand):
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if operator == "$ne":
+        return not _equals(value, operand)
+    if operator == "$in":
+        return any(_equals(value, o) for o in operand)
+    if operator == "$nin":
+        return not any(_equals(value, o) for o in operand)
+    if value is _MISSING or value is None:
+        return False
+    values = value if isinstance(value, list) else [value]
+    try:
+        if operator == "$lt":
+            return any(v < operand for v in values)
+        if operator == "$lte":
+            return any(v <= operand for v in values)
+        if operator == "$gt":
+            return any(v > operand for v in values)
+        if operator == "$gte":
+            return any(v >= operand for v in values)
+    except TypeError:
+        return False  # MongoDB never matches values of different types
+    raise ValueError("Unsupported query operator: {0}".format(operator))
+
+
+def matches(doc, query):
+    """ Evaluates a MongoDB-like query against a document. It supports the subset of the query language
+        used by barbante: equality, $and, $or, $ne, $in, $nin, $exists, $lt, $lte, $gt and $gte.
+
+        :param doc: A (possibly nested) dict.
+        :param query: A dict with the query (e.g. a barbante.recommendation.filters.ContextFilter in json form).
+        :returns: True if *doc* satisfies *query*, False otherwise.
+    """
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        else:
+            value = _get_field(doc, key)
+            condition = _as_stored(condition)
+            if isinstance(condition, dict) and all(op.startswith("$") for op in condition):
+                if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                    return False
+            elif not _equals(None if value is _MISSING else value, condition):
+                return False
+    return True
+
+
+def _in_date_range(value, min_date=None, max_date=None):
+    if min_date is None and max_date is None:
+        return True
+    if value is _MISSING or value is None:
+        return False
+    if min_date is not None and not _compare(value, "$gte", _as_stored(min_date)):
+        return False
+    if max_date is not None and not _compare(value, "$lte", _as_stored(max_date)):
+        return False
+    return True
+
+
+def _id_set(ids):
+    """ Builds a set with the given ids, skipping unhashable values (which, as in MongoDB, simply match nothing).
+    """
+    return {i for i in ids if isinstance(i, collections.abc.Hashable)}
+
+
+def _has_strength(doc, field="strength"):
+    return field in doc and doc[field] not in ["", 0]
+
+
+class PairCollection(object):
+    """ A collection of documents keyed by (source, target) pairs, e.g. (user, product) for activities or
+        (user, template_user) for user-user strengths. Documents are indexed both by source and by target.
+        Rankings of targets by descending strength are kept per source, and rebuilt lazily after writes.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        """ A map {(source, target): document}.
+        """
+        self.targets_by_source = {}
+        """ A map {source: set of targets}.
+        """
+        self.sources_by_target = {}
+        """ A map {target: set of sources}.
+        """
+        self._ranking_by_source = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def get(self, source, target):
+        return self.docs.get((source, target))
+
+    def upsert(self, source, target, set_values=None, inc_values=None, set_on_insert=None):
+        """ Mimics a MongoDB update with upsert=True, combining $set, $inc and $setOnInsert clauses.
+
+            :returns: The updated document.
+        """
+        doc = self.docs.get((source, target))
+        if doc is None:
+            doc = {}
+            self.docs[(source, target)] = doc
+            self.targets_by_source.setdefault(source, set()).add(target)
+            self.sources_by_target.setdefault(target, set()).add(source)
+            if set_on_insert:
+                doc.update(_as_stored(set_on_insert))
+        if set_values:
+            doc.update(_as_stored(set_values))
+        if inc_values:
+            for field, increment in inc_values.items():
+                doc[field] = doc.get(field, 0) + increment
+        self._ranking_by_source.pop(source, None)
+        return doc
+
+    def remove(self, source, target):
+        if self.docs.pop((source, target), None) is not None:
+            self.targets_by_source[source].discard(target)
+            self.sources_by_target[target].discard(source)
+            self._ranking_by_source.pop(source, None)
+
+    def find(self, sources=None, targets=None):
+        """ Yields ((source, target), document) tuples, restricted to the given sources and/or targets.
+        """
+        if sources is not None:
+            targets_set = _id_set(targets) if targets is not None else None
+            for source in _id_set(sources):
+                for target in self.targets_by_source.get(source, ()):
+                    if targets_set is None or target in targets_set:
+                        yield (source, target), self.docs[(source, target)]
+        elif targets is not None:
+            for target in _id_set(targets):
+                for source in self.sources_by_target.get(target, ()):
+                    yield (source, target), self.docs[(source, target)]
+        else:
+            for pair, doc in self.docs.items():
+                yield pair, doc
+
+    def ranking(self, source):
+        """ Retrieves a list of (strength, target) tuples in descending order of strength
+            (ties broken by ascending target ids), disregarding null strengths.
+        """
+        ranking = self._ranking_by_source.get(source)
+        if ranking is None:
+            ranking = [(self.docs[(source, t)]["strength"], t) for t in self.targets_by_source.get(source, ())
+                       if _has_strength(self.docs[(source, t)])]
+            ranking.sort(key=lambda r: r[1])
+            ranking.sort(key=lambda r: r[0], reverse=True)
+            self._ranking_by_source[source] = ranking
+        return ranking
+
+
+class TermCollection(object):
+    """ Per-attribute term weights of products (e.g. TFs or TFIDFs), indexed both by product and by term.
+    """
+
+    def __init__(self):
+        self.weights = {}
+        """ A map {attribute: {product_id: {term: weight}}}.
+        """
+        self.products_by_term = {}
+        """ A map {attribute: {term: set of product ids}}.
+        """
+
+    def add(self, attribute, product_id, term, weight):
+        self.weights.setdefault(attribute, {}).setdefault(product_id, {})[term] = weight
+        self.products_by_term.setdefault(attribute, {}).setdefault(term, set()).add(product_id)
+
+    def remove(self, attribute, product_id):
+        terms = self.weights.get(attribute, {}).pop(product_id, {})
+        for term in terms:
+            self.products_by_term[attribute][term].discard(product_id)
+
+
+_COLLECTION_TYPES = {
+    "users": dict,
+    "products": dict,
+    "activities_summary": PairCollection,
+    "anonymous_activities_summary": PairCollection,
+    "impressions_summary": PairCollection,
+    "anonymous_impressions_summary": PairCollection,
+    "popularities_summary": dict,
+    "user_cache": dict,
+    "product_cache": dict,
+    "uu_strengths": PairCollection,
+    "pp_strengths": PairCollection,
+    "product_product_strengths_tfidf": PairCollection,
+    "product_models": dict,
+    "product_terms": TermCollection,
+    "tfidf": TermCollection,
+    "df": dict,
+    "maintenance": list
+}
+""" The factories of all collections, by name. Temporary collections (suffix "_temp") share the type
+    of the corresponding definitive collection.
+"""
+
+
+class InMemoryProxy(BaseProxy):
+    """ Data proxy which keeps all data in indexed Python structures, within the current process.
+
+        It is meant for benchmarks and hermetic tests: recommenders and maintenance routines run unchanged
+        against it, so that their algorithmic cost can be measured regardless of database latency.
+        Its semantics mirror those of barbante.data.MongoDBProxy. All operations are serialized by a lock.
+    """
+
+    _databases = {}
+    """ All in-memory databases of the process, by name, so that proxies of different contexts
+        pointing to the same database share their data (as they would with a real database).
+    """
+    _databases_lock = threading.RLock()
+
+    def __init__(self, context):
+        super().__init__(context)
+
+        self.database_name = context.database_settings.name
+        """ The name of the database.
+        """
+        self.database_backup_name = None
+        """ The name of the database backup (used only for tests).
+        """
+        self.write_concern_level = 0
+        """ Kept for compatibility with MongoDBProxy. All writes are synchronous.
+        """
+        self.default_product_date_field = context.default_product_date_field
+        """ The name of the date field to be used in product queries concerning time when no other field is informed.
+        """
+        self._lock = InMemoryProxy._databases_lock
+
+    def _collection(self, name):
+        collections = self._databases.setdefault(self.database_name, {})
+        collection = collections.get(name)
+        if collection is None:
+            collection_type = _COLLECTION_TYPES[name[:-len("_temp")] if name.endswith("_temp") else name]
+            collection = collection_type()
+            collections[name] = collection
+        return collection
+
+    def _hotswap(self, name):
+        collections = self._databases.setdefault(self.database_name, {})
+        temp_collection = collections.pop(name + "_temp", None)
+        if temp_collection is not None:
+            collections[name] = temp_collection
+
+    def _drop_collection(self, name):
+        self._databases.get(self.database_name, {}).pop(name, None)
+
+    def _activities(self, anonymous):
+        return self._collection("anonymous_activities_summary" if anonymous else "activities_summary")
+
+    def _impressions(self, anonymous):
+        return self._collection("anonymous_impressions_summary" if anonymous else "impressions_summary")
+
+    @profile
+    @_synchronized
+    def fetch_all_user_ids(self, ordered=False, after_user_id=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = [user_id for user_id, user in self._collection("users").items()
+                  if not user.get("anonymous") and (after_user_id is None or user_id > after_user_id)]
+        if ordered or after_user_id is not None:
+            result.sort()
+        return (user_id for user_id in result)
+
+    @profile
+    @_synchronized
+    def fetch_all_product_ids(self, allow_deleted=False, required_fields=None,
+                              min_date=None, max_date=None, product_date_field=None):
+        """ See barbante.data.BaseProxy.
+        """
+        products_map = self.fetch_products(fields_to_project=[], required_fields=required_fields,
+                                           min_date=min_date, max_date=max_date,
+                                           product_date_field=product_date_field,
+                                           allow_deleted=allow_deleted)
+        return (product_id for product_id in products_map)
+
+    @profile
+    @_synchronized
+    def fetch_user_templates(self, user_ids, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        user_cache = self._collection("user_cache")
+        return {user_id: copy.deepcopy(user_cache[user_id]) for user_id in user_ids if user_id in user_cache}
+
+    @profile
+    @_synchronized
+    def fetch_top_uu_strengths(self, user_id, n_templates):
+        """ See barbante.data.BaseProxy.
+        """
+        result = self._collection("uu_strengths").ranking(user_id)[:n_templates]
+        return (r for r in result)
+
+    @profile
+    @_synchronized
+    def fetch_product_templates(self, product_ids, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        product_cache = self._collection("product_cache")
+        for product_id in product_ids:
+            doc = product_cache.get(product_id)
+            if doc is not None:
+                result[product_id] = (copy.deepcopy(doc.get("product_templates", [])),
+                                      copy.deepcopy(doc.get("product_templates_tfidf", [])))
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_top_pp_strengths(self, product_id, n_templates, blocked_products=None,
+                               collaborative=True, tfidf=True, allowed_products=None):
+        """ See barbante.data.BaseProxy.
+        """
+        blocked_products = set(blocked_products) if blocked_products else set()
+        allowed_products = set(allowed_products) if allowed_products else None
+
+        def top(collection_name):
+            templates = []
+            for strength, template in self._collection(collection_name).ranking(product_id):
+                if len(templates) == n_templates:
+                    break
+                if template in blocked_products or (allowed_products is not None and template not in allowed_products):
+                    continue
+                templates.append([strength, template])
+            return templates
+
+        templates = top("pp_strengths") if collaborative else []
+        templates_tfidf = top("product_product_strengths_tfidf") if tfidf else []
+        return templates, templates_tfidf
+
+    @profile
+    @_synchronized
+    def fetch_activity_summaries_by_user(self, anonymous, user_ids=None, product_ids=None, activity_types=None,
+                                         num_activities=None, min_day=None,
+                                         indexed_fields_only=True, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        if user_ids is None and product_ids is None:
+            raise ValueError("Parameters 'user_ids' and 'product_ids' cannot both be None")
+
+        if activity_types is None:
+            activity_types = self.context.supported_activities
+        activity_types = set(activity_types)
+
+        docs = [(pair, doc) for pair, doc in self._activities(anonymous).find(user_ids, product_ids)
+                if doc.get("activity") in activity_types and _in_date_range(doc.get("day"), min_day)]
+
+        date_field = "day" if indexed_fields_only else "created_at"
+        docs.sort(key=lambda d: d[1][date_field], reverse=True)
+        docs.sort(key=lambda d: d[0][0] if user_ids is not None else d[0][1])
+        if num_activities:
+            docs = docs[:num_activities]
+
+        result = {}
+        for (user_id, product_id), doc in docs:
+            activity = {"external_user_id": user_id,
+                        "external_product_id": product_id,
+                        "activity": doc["activity"],
+                        "day": doc["day"]}
+            if not indexed_fields_only:
+                activity["created_at"] = doc["created_at"]
+                activity["contributed_for_popularity"] = doc.get("contributed_for_popularity", False)
+                activity["uu_latest_type"] = doc.get("uu_latest_type")
+                activity["uu_latest_date"] = doc.get("uu_latest_date")
+                activity["pp_latest_type"] = doc.get("pp_latest_type")
+                activity["pp_latest_date"] = doc.get("pp_latest_date")
+            result.setdefault(user_id, []).append(activity)
+
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_day_of_latest_user_activity(self, user_id, anonymous, max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        return self.fetch_days_of_latest_user_activities([user_id], anonymous).get(user_id)
+
+    @profile
+    @_synchronized
+    def fetch_days_of_latest_user_activities(self, user_ids, anonymous):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        for (user_id, _), doc in self._activities(anonymous).find(sources=user_ids):
+            day = doc.get("day")
+            if day is not None and (user_id not in result or day > result[user_id]):
+                result[user_id] = day
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_all_activity_summaries(self, min_day=None):
+        """ See barbante.data.BaseProxy.
+        """
+        activity_types = set(self.context.supported_activities)
+        result = [{"external_user_id": user_id,
+                   "external_product_id": product_id,
+                   "activity": doc["activity"],
+                   "day": doc["day"]}
+                  for (user_id, product_id), doc in self._activities(False).find()
+                  if doc.get("activity") in activity_types and _in_date_range(doc.get("day"), min_day)]
+        return (activity for activity in result)
+
+    @profile
+    @_synchronized
+    def fetch_products_by_rating_by_user(self, user_ids=None, min_date=None, max_date=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        count_products_by_rating = [0] * 5  # initial count 0 for all ratings from 1 to 5
+
+        activities_by_user = self.fetch_activity_summaries_by_user(
+            user_ids=user_ids, min_day=min_date, anonymous=False)
+
+        for user, activities in activities_by_user.items():
+            user_products = set()
+            for activity in activities:
+                product = activity["external_product_id"]
+                if product in user_products:
+                    continue  # only considers the most recent activity for each (user, product) pair
+                user_products.add(product)
+
+                user_results = result.setdefault(user, {r: set() for r in range(1, 6)})
+                rating = self.context.rating_by_activity[activity["activity"]]
+                user_results[rating].add(product)
+                count_products_by_rating[rating - 1] += 1
+
+        return result, count_products_by_rating
+
+    @profile
+    @_synchronized
+    def fetch_users_by_rating_by_product(self, product_ids=None, min_date=None, max_date=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        count_users_by_rating = [0] * 5  # initial count 0 for all ratings from 1 to 5
+
+        activities_by_user = self.fetch_activity_summaries_by_user(
+            product_ids=product_ids, min_day=min_date, anonymous=False)
+
+        for user, activities in activities_by_user.items():
+            user_products = set()
+            for activity in activities:
+                product = activity["external_product_id"]
+                if product in user_products:
+                    continue  # only considers the most recent activity for each (user, product) pair
+                user_products.add(product)
+
+                product_results = result.setdefault(product, {r: set() for r in range(1, 6)})
+                rating = self.context.rating_by_activity[activity["activity"]]
+                product_results[rating].add(user)
+                count_users_by_rating[rating - 1] += 1
+
+        return result, count_users_by_rating
+
+    @profile
+    @_synchronized
+    def fetch_product_popularity(self, product_ids=None, n_products=None, min_day=None):
+        """ See barbante.data.BaseProxy.
+        """
+        if product_ids is None and n_products is None:
+            raise ValueError("Parameters 'product_ids' and 'n_products' cannot both be None")
+
+        if n_products == 0:
+            return {}
+
+        popularities = self._collection("popularities_summary")
+        if product_ids is not None:
+            docs = [popularities[p] for p in _id_set(product_ids) if p in popularities]
+        else:
+            docs = list(popularities.values())
+        docs = [doc for doc in docs if _in_date_range(doc.get("latest"), min_day)]
+        docs.sort(key=lambda doc: doc["popularity"], reverse=True)
+        if n_products is not None:
+            docs = docs[:n_products]
+
+        return {doc["p_id"]: doc["popularity"] for doc in docs}
+
+    @profile
+    @_synchronized
+    def fetch_impressions_summary(self, anonymous, user_ids=None, product_ids=None, group_by_product=False,
+                                  max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        for (user, product), doc in self._impressions(anonymous).find(user_ids, product_ids):
+            if group_by_product:
+                result.setdefault(product, {})[user] = (doc["count"], doc["first"])
+            else:
+                result.setdefault(user, {})[product] = (doc["count"], doc["first"])
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_users_with_impressions_by_product(self, anonymous, product_ids=None, user_ids=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        for (user, product), _ in self._impressions(anonymous).find(user_ids, product_ids):
+            result.setdefault(product, set()).add(user)
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_products_with_impressions_by_user(self, anonymous, user_ids=None, product_ids=None):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+        for (user, product), _ in self._impressions(anonymous).find(user_ids, product_ids):
+            result.setdefault(user, set()).add(product)
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_products(self, product_ids=None, fields_to_project=None, required_fields=None,
+                       min_date=None, max_date=None, product_date_field=None, allow_deleted=False):
+        """ See barbante.data.BaseProxy.
+        """
+        if product_date_field is None:
+            product_date_field = self.default_product_date_field
+
+        products = self._collection("products")
+        if product_ids is not None:
+            candidates = ((p, products[p]) for p in _id_set(product_ids) if p in products)
+        else:
+            candidates = products.items()
+
+        max_date = _as_stored(max_date)
+        result = {}
+        for product_id, product in candidates:
+            if not _in_date_range(_get_field(product, product_date_field), min_date, max_date):
+                continue
+            if not allow_deleted:
+                deleted_on = product.get("deleted_on")
+                if deleted_on is not None and (max_date is None or deleted_on < max_date):
+                    continue
+            if required_fields and any(_get_field(product, f) in (_MISSING, None) for f in required_fields):
+                continue
+
+            if fields_to_project is None:
+                record = copy.deepcopy(product)
+            else:
+                record = _project(product, fields_to_project)
+                record["external_id"] = product_id
+            result[product_id] = record
+
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_product_models_for_top_tfidf_terms(self, attribute, language, terms, min_date=None, max_date=None):
+        """ See barbante.data.BaseProxy.
+        """
+        products_by_term = self._collection("tfidf").products_by_term.get(attribute, {})
+        product_ids = set()
+        for term in terms:
+            product_ids |= products_by_term.get(term, set())
+
+        return self.fetch_product_models(product_ids=list(product_ids), min_date=min_date, max_date=max_date)
+
+    @profile
+    @_synchronized
+    def fetch_product_models(self, product_ids=None, context_filter=None,
+                             min_date=None, max_date=None, product_date_field=None, ids_only=False,
+                             max_time_ms=None):
+        """ See barbante.data.BaseProxy.
+        """
+        if product_date_field is None:
+            product_date_field = self.default_product_date_field
+
+        product_models = self._collection("product_models")
+        if product_ids is not None:
+            candidates = ((p, product_models[p]) for p in _id_set(product_ids) if p in product_models)
+        else:
+            candidates = product_models.items()
+
+        all_model_fields = set(self.context.product_text_fields + self.context.product_non_text_fields)
+        limit = self.context.max_recommendations
+        result = [] if ids_only else {}
+
+        for product_id, doc in candidates:
+            if context_filter and not matches(doc, context_filter):
+                continue
+            if not _in_date_range(_get_field(doc, product_date_field), min_date, max_date):
+                continue
+            if ids_only:
+                result.append(product_id)
+                if len(result) > limit:
+                    break  # as in MongoDBProxy, ids-only queries are silently truncated
+            else:
+                values = {k: v for k, v in utils.flatten_dict(copy.deepcopy(doc)).items()
+                          if k in all_model_fields or k.split('.')[0] in all_model_fields}
+                values["external_product_id"] = product_id
+                result[product_id] = ProductModel.from_dict(product_id, values, self.context.product_model_factory)
+                if len(result) > limit:
+                    raise Exception("Product model query limit reached ({0}).".format(limit))
+
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_date_filtered_products(self, reference_date, lte_date_field=None, gte_date_field=None):
+        """ See barbante.data.BaseProxy.
+        """
+        date_filter = {}
+        if lte_date_field:
+            date_filter[lte_date_field] = {"$lte": reference_date}
+        if gte_date_field:
+            date_filter[gte_date_field] = {"$gte": reference_date}
+        else:
+            date_filter[self.default_product_date_field] = {"$gte": reference_date}
+        return self.fetch_product_models(context_filter=date_filter, ids_only=True)
+
+    @profile
+    @_synchronized
+    def fetch_user_user_strengths(self, users=None, templates=None):
+        """ See barbante.data.BaseProxy.
+        """
+        return {pair: doc["strength"] for pair, doc in self._collection("uu_strengths").find(users, templates)
+                if _has_strength(doc)}
+
+    @profile
+    @_synchronized
+    def fetch_user_user_strength_operands(self, users=None, templates=None, group_by_target=False,
+                                          numerators_only=False):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_strength_operands(self._collection("uu_strengths").find(users, templates),
+                                             group_by_source=group_by_target, numerators_only=numerators_only)
+
+    @profile
+    @_synchronized
+    def fetch_product_product_strengths(self, products=None, templates=None):
+        """ See barbante.data.BaseProxy.
+        """
+        return {pair: doc["strength"] for pair, doc in self._collection("pp_strengths").find(products, templates)
+                if _has_strength(doc)}
+
+    @profile
+    @_synchronized
+    def fetch_product_product_strength_operands(self, products=None, templates=None, group_by_template=False,
+                                                numerators_only=False):
+        """ See barbante.data.BaseProxy.
+        """
+        numerators_map, denominators_map = self._fetch_strength_operands(
+            self._collection("pp_strengths").find(products, templates),
+            group_by_source=False, numerators_only=numerators_only)
+        if group_by_template:
+            numerators_map = self._group_by_template(numerators_map)
+            denominators_map = self._group_by_template(denominators_map)
+        return numerators_map, denominators_map
+
+    @staticmethod
+    def _fetch_strength_operands(docs, group_by_source, numerators_only):
+        numerators_map = {}
+        denominators_map = {}
+        for (source, template), doc in docs:
+            if numerators_only and not _has_strength(doc, "nc"):
+                continue
+            numerators = [doc.get("nc", 0), doc.get("na", 0)]
+            denominator = doc.get("denominator", 0)
+            if group_by_source:
+                if numerators != [0, 0]:
+                    numerators_map.setdefault(source, {})[template] = numerators
+                if denominator != 0 and not numerators_only:
+                    denominators_map.setdefault(source, {})[template] = denominator
+            else:
+                if numerators != [0, 0]:
+                    numerators_map[(source, template)] = numerators
+                if denominator != 0 and not numerators_only:
+                    denominators_map[(source, template)] = denominator
+        return numerators_map, denominators_map
+
+    @staticmethod
+    def _group_by_template(operands_map):
+        result = {}
+        for (product, template), value in operands_map.items():
+            result.setdefault(template, {})[product] = value
+        return result
+
+    @profile
+    @_synchronized
+    def fetch_product_product_strengths_tfidf(self, products=None, templates=None):
+        """ See barbante.data.BaseProxy.
+        """
+        return {pair: doc["strength"] for pair, doc in
+                self._collection("product_product_strengths_tfidf").find(products, templates)
+                if "strength" in doc}
+
+    @profile
+    @_synchronized
+    def save_user_user_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_numerators(self._collection("uu_strengths"), strength_numerators, increment)
+
+    @_synchronized
+    def save_uu_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("uu_strengths_temp" if deferred_publication else "uu_strengths")
+        for (user, template), strength_doc in strength_docs_map.items():
+            collection.upsert(user, template, set_values=strength_doc)
+
+    @profile
+    @_synchronized
+    def save_user_templates(self, templates_by_user):
+        """ See barbante.data.BaseProxy.
+        """
+        self._collection("user_cache").update(copy.deepcopy(templates_by_user))
+
+    @profile
+    @_synchronized
+    def save_product_templates(self, templates_by_product):
+        """ See barbante.data.BaseProxy.
+        """
+        product_cache = self._collection("product_cache")
+        for product, templates_tuple in templates_by_product.items():
+            doc = product_cache.setdefault(product, {})
+            if templates_tuple[0]:
+                doc["product_templates"] = copy.deepcopy(templates_tuple[0])
+            if templates_tuple[1]:
+                doc["product_templates_tfidf"] = copy.deepcopy(templates_tuple[1])
+
+    @profile
+    @_synchronized
+    def save_latest_activity_for_user_user_strengths(self, user, product, activity_type, activity_date):
+        """ See barbante.data.BaseProxy.
+        """
+        self._collection("activities_summary").upsert(
+            user, product, set_values={"uu_latest_type": activity_type, "uu_latest_date": activity_date})
+
+    @profile
+    @_synchronized
+    def copy_all_latest_activities_for_user_user_strengths(self, cutoff_date):
+        """ See barbante.data.BaseProxy.
+        """
+        for _, doc in self._collection("activities_summary").find():
+            if _in_date_range(doc.get("day"), cutoff_date):
+                doc["uu_latest_type"] = doc.get("activity")
+                doc["uu_latest_date"] = doc.get("created_at")
+
+    @profile
+    @_synchronized
+    def save_product_product_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_numerators(self._collection("pp_strengths"), strength_numerators, increment)
+
+    @staticmethod
+    def _save_numerators(collection, strength_numerators, increment):
+        for (source, template), numerators in strength_numerators.items():
+            values = {"nc": numerators[0], "na": numerators[1]}
+            if increment:
+                collection.upsert(source, template, inc_values=values)
+            else:
+                collection.upsert(source, template, set_values=values)
+
+    @_synchronized
+    def save_pp_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("pp_strengths_temp" if deferred_publication else "pp_strengths")
+        for (product, template), strength_doc in strength_docs_map.items():
+            collection.upsert(product, template, set_values=strength_doc)
+
+    @profile
+    @_synchronized
+    def save_latest_activity_for_product_product_strengths(self, user, product, activity_type, activity_date):
+        """ See barbante.data.BaseProxy.
+        """
+        self._collection("activities_summary").upsert(
+            user, product, set_values={"pp_latest_type": activity_type, "pp_latest_date": activity_date})
+
+    @profile
+    @_synchronized
+    def copy_all_latest_activities_for_product_product_strengths(self, cutoff_date):
+        """ See barbante.data.BaseProxy.
+        """
+        for _, doc in self._collection("activities_summary").find():
+            if _in_date_range(doc.get("day"), cutoff_date):
+                doc["pp_latest_type"] = doc.get("activity")
+                doc["pp_latest_date"] = doc.get("created_at")
+
+    @profile
+    @_synchronized
+    def save_product_product_strengths_tfidf(self, strengths, start_index=None, end_index=None,
+                                             deferred_publication=False):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("product_product_strengths_tfidf_temp" if deferred_publication
+                                      else "product_product_strengths_tfidf")
+        if start_index is None:
+            start_index = 0
+        if end_index is None:
+            end_index = len(strengths)
+
+        for index in range(start_index, end_index):
+            strength_doc = strengths[index]
+            collection.upsert(strength_doc["product"], strength_doc["template_product"],
+                              set_values={"strength": strength_doc["strength"]})
+
+    def flush_bulk_writes(self):
+        """ See barbante.data.BaseProxy. All writes are applied right away.
+        """
+        pass
+
+    def get_bulk_write_stats(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return {}
+
+    @_synchronized
+    def hotswap_uu_strengths(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._hotswap("uu_strengths")
+
+    @_synchronized
+    def hotswap_pp_strengths(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._hotswap("pp_strengths")
+
+    @_synchronized
+    def hotswap_product_product_strengths_tfidf(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._hotswap("product_product_strengths_tfidf")
+
+    @_synchronized
+    def hotswap_product_models(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._hotswap("product_models")
+
+    @profile
+    @_synchronized
+    def save_df(self, language, df_by_term, increment=False, upsert=False):
+        """ See barbante.data.BaseProxy.
+        """
+        df_map = self._collection("df").setdefault(language, {})
+        for term, df in df_by_term.items():
+            if df <= 0:
+                continue
+            if upsert and increment:
+                df_map[term] = df_map.get(term, 0) + df
+            else:
+                df_map[term] = df
+
+    @_synchronized
+    def find_df(self, language, term):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._collection("df").get(language, {}).get(term, 0)
+
+    @_synchronized
+    def fetch_df_map(self, language, terms):
+        """ See barbante.data.BaseProxy.
+        """
+        df_map = self._collection("df").get(language, {})
+        return {term: df_map[term] for term in terms if term in df_map}
+
+    @_synchronized
+    def fetch_tf_map(self, attribute, product_ids):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_term_weights("product_terms", attribute, product_ids)
+
+    @_synchronized
+    def fetch_tfidf_map(self, attribute, product_ids):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_term_weights("tfidf", attribute, product_ids)
+
+    @_synchronized
+    def fetch_tfidf_postings(self, attribute, terms):
+        """ See barbante.data.BaseProxy.
+        """
+        tfidf = self._collection("tfidf")
+        products_by_term = tfidf.products_by_term.get(attribute, {})
+        weights_by_product = tfidf.weights.get(attribute, {})
+        result = {}
+        for term in terms:
+            postings = {p: weights_by_product[p][term] for p in products_by_term.get(term, set())}
+            if len(postings) > 0:
+                result[term] = postings
+        return result
+
+    @_synchronized
+    def fetch_tfidf_sums(self, attribute, product_ids):
+        """ See barbante.data.BaseProxy.
+        """
+        weights_by_product = self._collection("tfidf").weights.get(attribute, {})
+        return {p: sum(weights_by_product[p].values()) for p in _id_set(product_ids) if weights_by_product.get(p)}
+
+    def _fetch_term_weights(self, collection_name, attribute, product_ids):
+        weights_by_product = self._collection(collection_name).weights.get(attribute, {})
+        return {p: dict(weights_by_product[p]) for p in product_ids if weights_by_product.get(p)}
+
+    def save_user_model(self, user_id, user_model):
+        """ See barbante.data.BaseProxy.
+        """
+        raise NotImplementedError()
+
+    @_synchronized
+    def save_product_model(self, product_id, product_model, deferred_publication=False):
+        """ See barbante.data.BaseProxy.
+        """
+        product_model_as_dict = _as_stored(product_model.to_dict())
+        if "external_product_id" not in product_model_as_dict:
+            product_model_as_dict["external_product_id"] = product_id
+
+        collection = self._collection("product_models_temp" if deferred_publication else "product_models")
+        collection.setdefault(product_id, {}).update(product_model_as_dict)
+
+    @_synchronized
+    def delete_product(self, product_id, date):
+        """ See barbante.data.BaseProxy.
+        """
+        self.update_product(product_id, "deleted_on", date)
+
+    @_synchronized
+    def delete_product_model(self, product_id):
+        """ See barbante.data.BaseProxy.
+        """
+        self._collection("product_models").pop(product_id, None)
+
+    @_synchronized
+    def update_product(self, product_id, field, new_value):
+        """ See barbante.data.BaseProxy.
+        """
+        product = self._collection("products").get(product_id)
+        if product is not None:
+            product[field] = _as_stored(new_value)
+
+    @_synchronized
+    def remove_product_terms(self, attributes, product_id):
+        """ See barbante.data.BaseProxy.
+        """
+        for attribute in attributes:
+            self._collection("product_terms").remove(attribute, product_id)
+
+    @_synchronized
+    def remove_tfidf(self, attributes, product_id):
+        """ See barbante.data.BaseProxy.
+        """
+        for attribute in attributes:
+            self._collection("tfidf").remove(attribute, product_id)
+
+    @_synchronized
+    def insert_user(self, user):
+        """ See barbante.data.BaseProxy.
+        """
+        if "anonymous" not in user:
+            user["anonymous"] = config.is_anonymous(user["external_id"])
+        self._collection("users")[user["external_id"]] = _as_stored(user)
+
+    @_synchronized
+    def insert_product(self, product):
+        """ See barbante.data.BaseProxy.
+        """
+        self._collection("products")[product["external_id"]] = _as_stored(product)
+
+    @_synchronized
+    def insert_product_models(self, records, deferred_publication=False):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("product_models_temp" if deferred_publication else "product_models")
+        for record in records:
+            collection[record["external_product_id"]] = _as_stored(record)
+
+    @_synchronized
+    def insert_product_terms(self, records):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("product_terms")
+        for record in records:
+            collection.add(record["attribute"], record["external_product_id"], record["term"], record["count"])
+
+    @_synchronized
+    def insert_tfidf_records(self, records):
+        """ See barbante.data.BaseProxy.
+        """
+        collection = self._collection("tfidf")
+        for record in records:
+            collection.add(record["attribute"], record["external_product_id"], record["term"], record["tfidf"])
+
+    @_synchronized
+    def reset_impression_summary(self, user_id, product_id, anonymous):
+        """ See barbante.data.BaseProxy.
+        """
+        doc = self._impressions(anonymous).get(user_id, product_id)
+        if doc is not None:  # we do not want to insert in case it does not exist
+            doc["count"] = 0
+
+    @_synchronized
+    def increment_impression_summary(self, user_id, product_id, date, anonymous):
+        """ See barbante.data.BaseProxy.
+        """
+        self._impressions(anonymous).upsert(user_id, product_id, inc_values={"count": 1},
+                                            set_on_insert={"first": date})
+
+    @_synchronized
+    def update_product_popularity(self, product_id, date, do_increment=True):
+        """ See barbante.data.BaseProxy.
+        """
+        date = _as_stored(date)
+        popularities = self._collection("popularities_summary")
+        doc = popularities.get(product_id)
+
+        if doc is None:
+            popularities[product_id] = {"p_id": product_id,
+                                        "first": du.get_day(date),
+                                        "latest": du.get_day(date),
+                                        "count": 1,
+                                        "popularity": 1}
+            return
+
+        first = min(doc["first"], date)
+        latest = max(doc["latest"], date)
+        new_count = doc["count"] + 1 if do_increment else doc["count"]
+
+        if first != doc["first"] or latest != doc["latest"] or new_count != doc["count"]:
+            first_day = du.get_day(first)
+            latest_day = du.get_day(latest)
+            day_span = (latest_day - first_day).days + 1
+            doc.update({"first": first_day,
+                        "latest": latest_day,
+                        "count": new_count,
+                        "popularity": new_count / day_span})
+
+    @_synchronized
+    def save_activity_summary(self, activity, anonymous, set_popularity_flag=False):
+        """ See barbante.data.BaseProxy.
+        """
+        activity_date = activity["created_at"]
+        set_values = {"activity": activity["activity"],
+                      "day": du.get_day(activity_date),
+                      "created_at": activity_date}
+        if set_popularity_flag:
+            set_values["contributed_for_popularity"] = True
+
+        self._activities(anonymous).upsert(activity["external_user_id"], activity["external_product_id"],
+                                           set_values=set_values)
+
+    @_synchronized
+    def get_user_count(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return sum(1 for user in self._collection("users").values() if not user.get("anonymous"))
+
+    @_synchronized
+    def get_product_count(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return len(self._collection("products"))
+
+    @_synchronized
+    def get_product_model_count(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return len(self._collection("product_models"))
+
+    @_synchronized
+    def sample_users(self, count):
+        """ See barbante.data.BaseProxy.
+        """
+        result = set()
+        total_users = self.get_user_count()
+
+        if total_users == 0:
+            return result
+
+        prob = count / total_users
+        all_users = list(self._collection("users").keys())
+        while len(result) < count:
+            for user_id in all_users:
+                if random() < prob:
+                    result.add(user_id)
+                    if len(result) == count:
+                        break
+
+        return result
+
+    @_synchronized
+    def copy_database(self, fromdb, todb):
+        """ See barbante.data.BaseProxy.
+        """
+        self._databases[todb] = copy.deepcopy(self._databases.get(fromdb, {}))
+
+    @_synchronized
+    def drop_database(self, dbname=None):
+        """ See barbante.data.BaseProxy.
+        """
+        self._databases.pop(dbname or self.database_name, None)
+
+    @_synchronized
+    def backup_database(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self.database_backup_name = '{0}-backup'.format(self.database_name)
+
+        self.drop_database(self.database_backup_name)
+        self.copy_database(fromdb=self.database_name, todb=self.database_backup_name)
+        self.drop_database()
+
+    @_synchronized
+    def restore_database(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self.drop_database()
+        self.copy_database(fromdb=self.database_backup_name, todb=self.database_name)
+
+    @_synchronized
+    def reset_all_product_content_data(self):
+        """ See barbante.data.BaseProxy.
+        """
+        for name in ["product_models_temp", "product_terms", "df", "tfidf"]:
+            self._drop_collection(name)
+
+    @_synchronized
+    def reset_user_user_strength_auxiliary_data(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._drop_collection("uu_strengths")
+        self._drop_collection("uu_strengths_temp")
+
+    @_synchronized
+    def reset_product_product_strength_auxiliary_data(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._drop_collection("pp_strengths")
+        self._drop_collection("pp_strengths_temp")
+
+    @_synchronized
+    def reset_product_product_strength_tfidf_auxiliary_data(self):
+        """ See barbante.data.BaseProxy.
+        """
+        self._drop_collection("product_product_strengths_tfidf_temp")
+
+    def fetch_latest_batch_info_product_models(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_latest_batch_info("process_all_products")
+
+    def fetch_latest_batch_info_user_user_strengths(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_latest_batch_info("generate_user_user_strengths")
+
+    def fetch_latest_batch_info_product_product_strengths(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_latest_batch_info("generate_product_product_strengths")
+
+    def fetch_latest_batch_info_user_template_consolidation(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_latest_batch_info("user_template_consolidation")
+
+    def fetch_latest_batch_info_product_template_consolidation(self):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_latest_batch_info("product_template_consolidation")
+
+    @_synchronized
+    def _fetch_latest_batch_info(self, task):
+        docs = [doc for doc in self._collection("maintenance") if doc["type"] == task]
+        if len(docs) == 0:
+            return None
+        return copy.deepcopy(max(docs, key=lambda doc: doc["timestamp"]))
+
+    def save_timestamp_user_user_strengths(self, timestamp, cutoff_date, elapsed_time):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("generate_user_user_strengths", timestamp, cutoff_date, elapsed_time)
+
+    def save_timestamp_product_product_strengths(self, timestamp, cutoff_date, elapsed_time):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("generate_product_product_strengths", timestamp, cutoff_date, elapsed_time)
+
+    def save_timestamp_product_product_strengths_tfidf(self, timestamp, cutoff_date, elapsed_time):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("generate_product_product_strengths_tfidf", timestamp, cutoff_date, elapsed_time)
+
+    def save_timestamp_product_models(self, timestamp, cutoff_date, elapsed_time):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("process_all_products", timestamp, cutoff_date, elapsed_time)
+
+    def save_timestamp_user_template_consolidation(self, timestamp, status, elapsed_time=None):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("user_template_consolidation", timestamp, status=status,
+                             elapsed_time=elapsed_time, upsert=True)
+
+    def save_timestamp_product_template_consolidation(self, timestamp, status, elapsed_time=None):
+        """ See barbante.data.BaseProxy.
+        """
+        self._save_timestamp("product_template_consolidation", timestamp, status=status,
+                             elapsed_time=elapsed_time, upsert=True)
+
+    @_synchronized
+    def _save_timestamp(self, task, timestamp, cutoff_date=None, elapsed_time=None, status="completed", upsert=False):
+        timestamp = _as_stored(timestamp)
+        values = {"status": status}
+        if cutoff_date:
+            values["cutoff_date"] = _as_stored(cutoff_date)
+        if elapsed_time:
+            values["elapsed_time_sec"] = elapsed_time
+
+        maintenance = self._collection("maintenance")
+        if upsert:
+            for doc in maintenance:
+                if doc["type"] == task and doc["timestamp"] == timestamp:
+                    doc.update(values)
+                    return
+        doc = {"type": task, "timestamp": timestamp}
+        doc.update(values)
+        maintenance.append(doc)
+
+    def ensure_indexes(self, create_ttl_indexes=True):
+        """ All collections are indexed upon creation. Kept for compatibility with MongoDBProxy.
+        """
+        pass
+
+    def ensure_indexes_cache(self):
+        """ All collections are indexed upon creation. Kept for compatibility with MongoDBProxy.
+        """
+        pass
@@ -1,17 +1,54 @@
+import collections
+import functools
+import threading
 import pymongo
+import pymongo.errors
 from pymongo.read_preferences import ReadPreference
 from random import random
 
 import barbante.config as config
 from barbante.data.BaseProxy import BaseProxy
+from barbante.data.BulkWriter import BulkWriter
 from barbante.utils.profiling import profile
 from barbante.model.product_model import ProductModel
 import barbante.utils.date as du
+from barbante.utils.deadline import DeadlineExceeded
 
 import barbante.utils.logging as barbante_logging
 
 log = barbante_logging.get_logger(__name__)
 
+USER_IDS_PAGE_SIZE = 10000
+""" The number of user ids read by each query of an ordered scan of the users (see fetch_all_user_ids()).
+"""
+
+
+def _time_limited(method):
+    """ Decorates proxy methods which accept a *max_time_ms* parameter, translating the
+        errors of queries aborted by the server for exceeding it into DeadlineExceeded errors.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except pymongo.errors.ExecutionTimeout as err:
+            raise DeadlineExceeded("{0} exceeded its time limit: {1}".format(method.__name__, err)) from err
+    return wrapper
+
+
+def _limit_time(cursor, max_time_ms):
+    """ Bounds the server-side execution time of the query of a cursor, if *max_time_ms* is not None.
+    """
+    if max_time_ms is not None:
+        cursor = cursor.max_time_ms(max_time_ms)
+    return cursor
+
+
+FindQuery = collections.namedtuple("FindQuery", ["collection", "where", "fields", "sort", "limit"])
+""" A find() query on a collection of the main database, described independently of the driver which runs it
+    (see MongoDBProxy._find() and AsyncMongoDBProxy._find_async()). *sort* and *limit* may be None.
+"""
+
 
 class MongoDBProxy(BaseProxy):
     """ Data proxy to be used with MongoDB.
@@ -50,6 +87,10 @@ class MongoDBProxy(BaseProxy):
         self.default_product_date_field = context.default_product_date_field
         """ The name of the date field to be used in product queries concerning time when no other field is informed.
         """
+        self.bulk_writers = {}
+        """ The BulkWriters of the collections written in bulk, by (database id, collection name).
+        """
+        self._bulk_writers_lock = threading.Lock()
 
     def _initialize_pymongo_connection(self, context, connection_name, raw=False):
         log.info("Initializing MongoDB %s connection..." % connection_name)
@@ -83,15 +124,49 @@ class MongoDBProxy(BaseProxy):
     def parse_read_preferences(self, read_preference):
         return self._read_preferences.get(read_preference, ReadPreference.PRIMARY)
 
+    def _find(self, query, max_time_ms=None):
+        """ Runs a FindQuery on the main database.
+
+            :param query: The FindQuery.
+            :param max_time_ms: If not None, the server-side execution time limit of the query.
+
+            :returns: A pymongo cursor.
+        """
+        cursor = self.database[query.collection].find(query.where, query.fields)
+        if query.sort is not None:
+            cursor = cursor.sort(query.sort)
+        if query.limit is not None:
+            cursor = cursor.limit(query.limit)
+        return _limit_time(cursor, max_time_ms)
+
     @profile
-    def fetch_all_user_ids(self):
+    def fetch_all_user_ids(self, ordered=False, after_user_id=None):
         """ See barbante.data.BaseProxy.
         """
         fields = {"external_id": True, "_id": False}
+        if ordered or after_user_id is not None:
+            return self._page_user_ids(after_user_id, fields)
         cursor = self.database_raw.users.find({"anonymous": False}, fields)
         result = (rec["external_id"] for rec in cursor)
         return result
 
+    def _page_user_ids(self, after_user_id, fields):
+        """ Yields the ids of the users in ascending order, reading them in pages of USER_IDS_PAGE_SIZE ids.
+            Each page is a separate, short-lived query which resumes after the last id of the previous page,
+            so that slow consumers (such as long batch processes) never hit the server's cursor timeout.
+        """
+        sort_order = [("anonymous", pymongo.ASCENDING), ("external_id", pymongo.ASCENDING)]
+        while True:
+            where = {"anonymous": False}
+            if after_user_id is not None:
+                where["external_id"] = {"$gt": after_user_id}
+            page = [rec["external_id"] for rec in
+                    self.database_raw.users.find(where, fields).sort(sort_order).limit(USER_IDS_PAGE_SIZE)]
+            yield from page
+            if len(page) < USER_IDS_PAGE_SIZE:
+                return
+            after_user_id = page[-1]
+
     @profile
     def fetch_all_product_ids(self, allow_deleted=False, required_fields=None,
                               min_date=None, max_date=None, product_date_field=None):
@@ -107,14 +182,22 @@ class MongoDBProxy(BaseProxy):
         return result
 
     @profile
-    def fetch_user_templates(self, user_ids):
+    @_time_limited
+    def fetch_user_templates(self, user_ids, max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
+        return self._collect_user_templates(self._find(self._user_templates_query(user_ids), max_time_ms))
+
+    @staticmethod
+    def _user_templates_query(user_ids):
         where = {"external_user_id": {"$in": user_ids}}
         fields = {"external_user_id": True, "user_templates": True, "_id": False}
-        cursor = self.database.user_cache.find(where, fields)
-        for rec in cursor:
+        return FindQuery("user_cache", where, fields, None, None)
+
+    @staticmethod
+    def _collect_user_templates(docs):
+        result = {}
+        for rec in docs:
             result[rec["external_user_id"]] = rec.get("user_templates", [])
         return result
 
@@ -132,17 +215,25 @@ class MongoDBProxy(BaseProxy):
         return result
 
     @profile
-    def fetch_product_templates(self, product_ids):
+    @_time_limited
+    def fetch_product_templates(self, product_ids, max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
+        return self._collect_product_templates(self._find(self._product_templates_query(product_ids), max_time_ms))
+
+    @staticmethod
+    def _product_templates_query(product_ids):
         where = {"external_product_id": {"$in": product_ids}}
         fields = {"external_product_id": True,
                   "product_templates": True,
                   "product_templates_tfidf": True,
                   "_id": False}
-        cursor = self.database.product_cache.find(where, fields)
-        for rec in cursor:
+        return FindQuery("product_cache", where, fields, None, None)
+
+    @staticmethod
+    def _collect_product_templates(docs):
+        result = {}
+        for rec in docs:
             result[rec["external_product_id"]] = (rec.get("product_templates", []),
                                                   rec.get("product_templates_tfidf", []))
         return result
@@ -184,17 +275,22 @@ class MongoDBProxy(BaseProxy):
         return result
 
     @profile
+    @_time_limited
     def fetch_activity_summaries_by_user(self, anonymous, user_ids=None, product_ids=None, activity_types=None,
                                          num_activities=None, min_day=None,
-                                         indexed_fields_only=True):
+                                         indexed_fields_only=True, max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
+        query = self._activity_summaries_by_user_query(anonymous, user_ids, product_ids, activity_types,
+                                                       num_activities, min_day, indexed_fields_only)
+        return self._collect_activity_summaries_by_user(self._find(query, max_time_ms), indexed_fields_only)
 
+    def _activity_summaries_by_user_query(self, anonymous, user_ids, product_ids, activity_types,
+                                          num_activities, min_day, indexed_fields_only):
         if user_ids is None and product_ids is None:
             raise ValueError("Parameters 'user_ids' and 'product_ids' cannot both be None")
 
-        collection = self.database.anonymous_activities_summary if anonymous else self.database.activities_summary
+        collection = "anonymous_activities_summary" if anonymous else "activities_summary"
 
         if activity_types is None:
             activity_types = self.context.supported_activities
@@ -223,12 +319,12 @@ class MongoDBProxy(BaseProxy):
             sort_order = [("external_user_id", pymongo.ASCENDING),
                           ("day" if indexed_fields_only else "created_at", pymongo.DESCENDING)]
 
-        if num_activities:
-            cursor = collection.find(where, fields).sort(sort_order).limit(num_activities)
-        else:
-            cursor = collection.find(where, fields).sort(sort_order)
+        return FindQuery(collection, where, fields, sort_order, num_activities if num_activities else None)
 
-        for rec in cursor:
+    @staticmethod
+    def _collect_activity_summaries_by_user(docs, indexed_fields_only):
+        result = {}
+        for rec in docs:
             user_id = rec["external_user_id"]
             product_id = rec["external_product_id"]
             activity_type = rec["activity"]
@@ -252,80 +348,132 @@ class MongoDBProxy(BaseProxy):
         return result
 
     @profile
-    def fetch_day_of_latest_user_activity(self, user_id, anonymous):
+    @_time_limited
+    def fetch_day_of_latest_user_activity(self, user_id, anonymous, max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
-        collection = self.database.anonymous_activities_summary if anonymous else self.database.activities_summary
+        return self._collect_day_of_latest_user_activity(
+            self._find(self._day_of_latest_user_activity_query(user_id, anonymous), max_time_ms))
+
+    @staticmethod
+    def _day_of_latest_user_activity_query(user_id, anonymous):
+        collection = "anonymous_activities_summary" if anonymous else "activities_summary"
         fields = {"day": True, "_id": False}
         sort_order = [("external_user_id", pymongo.ASCENDING),
                       ("day", pymongo.DESCENDING)]
-        cursor = collection.find({"external_user_id": user_id}, fields).sort(sort_order).limit(1)
-        for doc in cursor:
+        return FindQuery(collection, {"external_user_id": user_id}, fields, sort_order, 1)
+
+    @staticmethod
+    def _collect_day_of_latest_user_activity(docs):
+        for doc in docs:
             return doc["day"]
         return None
 
     @profile
-    def fetch_products_by_rating_by_user(self, user_ids=None, min_date=None, max_date=None):
+    def fetch_days_of_latest_user_activities(self, user_ids, anonymous):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
-        count_products_by_rating = [0] * 5  # initial count 0 for all ratings from 1 to 5
-
-        activities_by_user = self.fetch_activity_summaries_by_user(
-            user_ids=user_ids, min_day=min_date, anonymous=False)
-
-        for user, activities in activities_by_user.items():
-            user_products = set()
-
-            for activity in activities:
-                product = activity["external_product_id"]
-                if product in user_products:
-                    continue  # only considers the most recent activity for each (user, product) pair
-                user_products.add(product)
-
-                user_results = result.get(user)
-                if user_results is None:
-                    user_results = {r: set() for r in range(1, 6)}  # ratings from 1 to 5
+        collection = self.database.anonymous_activities_summary if anonymous else self.database.activities_summary
+        pipeline = [{"$match": {"external_user_id": {"$in": user_ids}}},
+                    {"$group": {"_id": "$external_user_id", "day": {"$max": "$day"}}}]
+        response = collection.aggregate(pipeline)
+        return {doc["_id"]: doc["day"] for doc in response["result"]}
 
-                activity_type = activity["activity"]
-                rating = self.context.rating_by_activity[activity_type]
-                user_results[rating].add(product)
-                result[user] = user_results
-                count_products_by_rating[rating - 1] += 1  # -1 because the min rating is 1 whereas the first index is 0
+    @profile
+    def fetch_all_activity_summaries(self, min_day=None):
+        """ See barbante.data.BaseProxy.
+        """
+        where = {"activity": {"$in": self.context.supported_activities}}
+        where.update(self._build_date_clause("day", min_day))
+        fields = {"external_user_id": True,
+                  "external_product_id": True,
+                  "activity": True,
+                  "day": True,
+                  "_id": False}
+        cursor = self.database.activities_summary.find(where, fields)
+        return (rec for rec in cursor)
 
-        return result, count_products_by_rating
+    @profile
+    def fetch_products_by_rating_by_user(self, user_ids=None, min_date=None, max_date=None):
+        """ See barbante.data.BaseProxy.
+        """
+        return self._fetch_ids_by_rating("external_user_id", "external_product_id", user_ids, min_date)
 
     @profile
     def fetch_users_by_rating_by_product(self, product_ids=None, min_date=None, max_date=None):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
-        count_users_by_rating = [0] * 5  # initial count 0 for all ratings from 1 to 5
+        return self._fetch_ids_by_rating("external_product_id", "external_user_id", product_ids, min_date)
 
-        # the activities are fetched in descending order of date
-        activities_by_user = self.fetch_activity_summaries_by_user(
-            product_ids=product_ids, min_day=min_date, anonymous=False)
+    def _fetch_ids_by_rating(self, key_field, value_field, keys, min_day):
+        """ Retrieves, for each key (user or product), the values (products or users) it is related to by
+            (non-anonymous) activities, grouped by rating.
 
-        for user, activities in activities_by_user.items():
-            user_products = set()
+            :param key_field: The activity summary field by which the results are grouped.
+            :param value_field: The activity summary field whose values are collected.
+            :param keys: The intended keys. If None, all keys are considered.
+            :param min_day: The day before which no activities will be considered. If None, it will be disregarded.
 
-            for activity in activities:
-                product = activity["external_product_id"]
-                if product in user_products:
-                    continue  # only considers the most recent activity for each (user, product) pair
-                user_products.add(product)
-
-                product_results = result.get(product)
-                if product_results is None:
-                    product_results = {r: set() for r in range(1, 6)}  # ratings from 1 to 5
-
-                activity_type = activity["activity"]
-                rating = self.context.rating_by_activity[activity_type]
-                product_results[rating].add(user)
-                result[product] = product_results
-                count_users_by_rating[rating - 1] += 1  # -1 because the min rating is 1 whereas the first index is 0
-
-        return result, count_users_by_rating
+            :returns: - a map {key: {rating: set of values}}, and
+                      - a list where the j-th position contains the number of values rated j w.r.t. some key.
+        """
+        result = {}
+        count_by_rating = [0] * 5  # initial count 0 for all ratings from 1 to 5
+
+        for doc in self.aggregate_ids_by_rating(key_field, value_field, keys, min_day):
+            values_by_rating = {r: set() for r in range(1, 6)}  # ratings from 1 to 5
+            for rating_entry in doc["ratings"]:
+                rating = rating_entry["r"]
+                values_by_rating[rating] = set(rating_entry["ids"])
+                count_by_rating[rating - 1] += len(rating_entry["ids"])  # -1 because the min rating is 1
+            result[doc["_id"]] = values_by_rating
+
+        return result, count_by_rating
+
+    def aggregate_ids_by_rating(self, key_field, value_field, keys, min_day):
+        """ Groups the (non-anonymous) activity summaries by key and rating in the database, so that only
+            compact arrays of ids are transferred (rather than one document per activity).
+
+            Since activity summaries hold a single document per (user, product) pair (see save_activity_summary),
+            there is no need to pick the most recent activity of each pair.
+
+            See _fetch_ids_by_rating() for the parameters.
+
+            :returns: A cursor of {"_id": key, "ratings": list of {"r": rating, "ids": list of values}} documents.
+        """
+        activity_types = self.context.supported_activities
+        where = {"activity": {"$in": activity_types}}
+        if keys is not None:
+            where[key_field] = {"$in": keys}
+        where.update(self._build_date_clause("day", min_day))
+
+        pipeline = [{"$match": where},
+                    {"$project": {"_id": False,
+                                  "k": "$" + key_field,
+                                  "v": "$" + value_field,
+                                  "r": self._build_rating_expression(activity_types)}},
+                    {"$group": {"_id": {"k": "$k", "r": "$r"}, "ids": {"$addToSet": "$v"}}},
+                    {"$group": {"_id": "$_id.k", "ratings": {"$push": {"r": "$_id.r", "ids": "$ids"}}}}]
+        return self.database.activities_summary.aggregate(pipeline, allowDiskUse=True, cursor={})
+
+    def _build_rating_expression(self, activity_types):
+        """ Builds an aggregation expression which maps the activity type of an activity summary onto its rating.
+
+            :param activity_types: The (non-empty) list of activity types which the expression must support.
+        """
+        activity_types_by_rating = {}
+        for activity_type in activity_types:
+            rating = self.context.rating_by_activity[activity_type]
+            activity_types_by_rating.setdefault(rating, []).append(activity_type)
+
+        ratings = sorted(activity_types_by_rating)
+        expression = {"$literal": ratings[0]}  # the only rating left once all other ratings are ruled out
+        for rating in ratings[1:]:
+            expression = {"$cond": [{"$or": [{"$eq": ["$activity", activity_type]}
+                                             for activity_type in activity_types_by_rating[rating]]},
+                                    rating,
+                                    expression]}
+        return expression
 
     @profile
     def fetch_product_popularity(self, product_ids=None, n_products=None, min_day=None):
@@ -357,12 +505,18 @@ class MongoDBProxy(BaseProxy):
         return {rec["p_id"]: rec["popularity"] for rec in cursor}
 
     @profile
-    def fetch_impressions_summary(self, anonymous, user_ids=None, product_ids=None, group_by_product=False):
+    @_time_limited
+    def fetch_impressions_summary(self, anonymous, user_ids=None, product_ids=None, group_by_product=False,
+                                  max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
-        result = {}
+        return self._collect_impressions_summary(
+            self._find(self._impressions_summary_query(anonymous, user_ids, product_ids), max_time_ms),
+            group_by_product)
 
-        collection = self.database.anonymous_impressions_summary if anonymous else self.database.impressions_summary
+    @staticmethod
+    def _impressions_summary_query(anonymous, user_ids, product_ids):
+        collection = "anonymous_impressions_summary" if anonymous else "impressions_summary"
 
         where = {}
         fields = {"u_id": True, "p_id": True, "count": True, "first": True, "_id": False}
@@ -371,9 +525,12 @@ class MongoDBProxy(BaseProxy):
         if product_ids is not None:
             where.update({"p_id": {"$in": product_ids}})
 
-        cursor = collection.find(where, fields)
+        return FindQuery(collection, where, fields, None, None)
 
-        for rec in cursor:
+    @staticmethod
+    def _collect_impressions_summary(docs, group_by_product):
+        result = {}
+        for rec in docs:
             user = rec["u_id"]
             product = rec["p_id"]
             count = rec["count"]
@@ -494,10 +651,17 @@ class MongoDBProxy(BaseProxy):
         return self.fetch_product_models(product_ids=list(product_ids), min_date=min_date, max_date=max_date)
 
     @profile
+    @_time_limited
     def fetch_product_models(self, product_ids=None, context_filter=None,
-                             min_date=None, max_date=None, product_date_field=None, ids_only=False):
+                             min_date=None, max_date=None, product_date_field=None, ids_only=False,
+                             max_time_ms=None):
         """ See barbante.data.BaseProxy.
         """
+        query = self._product_models_query(product_ids, context_filter, min_date, max_date, product_date_field,
+                                           ids_only)
+        return self._collect_product_models(self._find(query, max_time_ms), ids_only)
+
+    def _product_models_query(self, product_ids, context_filter, min_date, max_date, product_date_field, ids_only):
         where = {}
 
         fields = {}
@@ -518,14 +682,15 @@ class MongoDBProxy(BaseProxy):
         if len(date_clause) > 0:
             where.update(date_clause)
 
-        limit = self.context.max_recommendations
-        cursor = self.database.product_models.find(where, fields).limit(limit + 1)
+        return FindQuery("product_models", where, fields, None, self.context.max_recommendations + 1)
 
+    def _collect_product_models(self, docs, ids_only):
+        limit = self.context.max_recommendations
         if ids_only:
-            result = [doc['external_product_id'] for doc in cursor]
+            result = [doc['external_product_id'] for doc in docs]
         else:
             result = {}
-            for doc in cursor:
+            for doc in docs:
                 result[doc['external_product_id']] = ProductModel.from_dict(doc['external_product_id'], doc,
                                                                             self.context.product_model_factory)
                 if len(result) > limit:
@@ -682,39 +847,23 @@ class MongoDBProxy(BaseProxy):
         return result
 
     @profile
-    def save_user_user_numerators(self, strength_numerators, increment=False, upsert=True):
+    def save_user_user_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
         """ See barbante.data.BaseProxy.
         """
         if len(strength_numerators) == 0:
             return
 
-        collection = self.database_bulk.uu_strengths
-
         if upsert:
             operator = "$inc" if increment else "$set"
-
-            bulk_op = collection.initialize_unordered_bulk_op()
-            has_operations = False
-
-            for user_and_template, strength_numerator_tuple in strength_numerators.items():
-                has_operations = True
-                user = user_and_template[0]
-                template = user_and_template[1]
-                spec = {"user": user, "template_user": template}
-                update_clause = {operator: {"nc": strength_numerator_tuple[0],
-                                            "na": strength_numerator_tuple[1]}}
-                bulk_op.find(spec).upsert().update(update_clause)
-
-            if has_operations:
-                bulk_op.execute(write_concern={'w': self.write_concern_level})
-
+            operations = (({"user": user, "template_user": template},
+                           {operator: {"nc": strength_numerator_tuple[0], "na": strength_numerator_tuple[1]}})
+                          for (user, template), strength_numerator_tuple in strength_numerators.items())
         else:
-            strength_numerators_list = [{"user": u, "template_user": t, "nc": n[0], "na": n[1]}
-                                        for (u, t), n in strength_numerators.items()]
-            collection.insert(
-                strength_numerators_list, w=self.write_concern_level, manipulate=False)
+            operations = ((None, {"user": u, "template_user": t, "nc": n[0], "na": n[1]})
+                          for (u, t), n in strength_numerators.items())
+        self._bulk_write(self.database_bulk.uu_strengths, operations, wait=wait)
 
-    def save_uu_strengths(self, strength_docs_map, upsert=False, deferred_publication=False):
+    def save_uu_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
         """ See barbante.data.BaseProxy.
         """
         if len(strength_docs_map) == 0:
@@ -728,44 +877,25 @@ class MongoDBProxy(BaseProxy):
             write_concern = self.write_concern_level
 
         if upsert:
-            bulk_op = collection.initialize_unordered_bulk_op()
-            has_operations = False
-
-            for user_and_template, strength_doc in strength_docs_map.items():
-                has_operations = True
-                user = user_and_template[0]
-                template = user_and_template[1]
-                spec = {"user": user, "template_user": template}
-                update_clause = {"$set": strength_doc}
-                bulk_op.find(spec).upsert().update(update_clause)
-
-            if has_operations:
-                bulk_op.execute(write_concern={'w': write_concern})
+            operations = (({"user": user, "template_user": template}, {"$set": strength_doc})
+                          for (user, template), strength_doc in strength_docs_map.items())
         else:
-            collection.insert(strength_docs_map.values(), w=write_concern, manipulate=False)
+            operations = ((None, dict(strength_doc)) for strength_doc in strength_docs_map.values())
+        self._bulk_write(collection, operations, write_concern, wait)
 
     @profile
     def save_user_templates(self, templates_by_user):
         """ See barbante.data.BaseProxy.
         """
-        bulk_op = self.database.user_cache.initialize_unordered_bulk_op()
-        has_operations = False
-
-        for user, templates in templates_by_user.items():
-            has_operations = True
-            spec = {"external_user_id": user}
-            update_clause = {"$set": {"user_templates": templates}}
-            bulk_op.find(spec).upsert().update(update_clause)
-
-        if has_operations:
-            bulk_op.execute(write_concern={'w': self.write_concern_level})
+        operations = (({"external_user_id": user}, {"$set": {"user_templates": templates}})
+                      for user, templates in templates_by_user.items())
+        self._bulk_write(self.database.user_cache, operations)
 
     @profile
     def save_product_templates(self, templates_by_product):
         """ See barbante.data.BaseProxy.
         """
-        bulk_op = self.database.product_cache.initialize_unordered_bulk_op()
-        has_operations = False
+        operations = []
 
         for product, templates_tuple in templates_by_product.items():
             update_map = {}
@@ -774,13 +904,9 @@ class MongoDBProxy(BaseProxy):
             if templates_tuple[1]:
                 update_map["product_templates_tfidf"] = templates_tuple[1]
             if len(update_map) > 0:
-                has_operations = True
-                spec = {"external_product_id": product}
-                update_clause = {"$set": update_map}
-                bulk_op.find(spec).upsert().update(update_clause)
+                operations.append(({"external_product_id": product}, {"$set": update_map}))
 
-        if has_operations:
-            bulk_op.execute(write_concern={'w': self.write_concern_level})
+        self._bulk_write(self.database.product_cache, operations)
 
     @profile
     def save_latest_activity_for_user_user_strengths(self, user, product, activity_type, activity_date):
@@ -812,38 +938,23 @@ class MongoDBProxy(BaseProxy):
         self.database.command("eval", code, nolock=True)  # executes on MongoDB server
 
     @profile
-    def save_product_product_numerators(self, strength_numerators, increment=False, upsert=True):
+    def save_product_product_numerators(self, strength_numerators, increment=False, upsert=True, wait=True):
         """ See barbante.data.BaseProxy.
         """
         if len(strength_numerators) == 0:
             return
 
-        collection = self.database_bulk.pp_strengths
-
         if upsert:
             operator = "$inc" if increment else "$set"
-
-            bulk_op = collection.initialize_unordered_bulk_op()
-            has_operations = False
-
-            for product_and_template, strength_numerator_tuple in strength_numerators.items():
-                has_operations = True
-                product = product_and_template[0]
-                template = product_and_template[1]
-                spec = {"product": product, "template_product": template}
-                update_clause = {operator: {"nc": strength_numerator_tuple[0],
-                                            "na": strength_numerator_tuple[1]}}
-                bulk_op.find(spec).upsert().update(update_clause)
-
-            if has_operations:
-                bulk_op.execute(write_concern={'w': self.write_concern_level})
+            operations = (({"product": product, "template_product": template},
+                           {operator: {"nc": strength_numerator_tuple[0], "na": strength_numerator_tuple[1]}})
+                          for (product, template), strength_numerator_tuple in strength_numerators.items())
         else:
-            strength_numerators_list = [{"product": p, "template_product": t, "nc": n[0], "na": n[1]}
-                                        for (p, t), n in strength_numerators.items()]
-            collection.insert(
-                strength_numerators_list, w=self.write_concern_level, manipulate=False)
+            operations = ((None, {"product": p, "template_product": t, "nc": n[0], "na": n[1]})
+                          for (p, t), n in strength_numerators.items())
+        self._bulk_write(self.database_bulk.pp_strengths, operations, wait=wait)
 
-    def save_pp_strengths(self, strength_docs_map, upsert=False, deferred_publication=False):
+    def save_pp_strengths(self, strength_docs_map, upsert=False, deferred_publication=False, wait=True):
         """ See barbante.data.BaseProxy.
         """
         if len(strength_docs_map) == 0:
@@ -857,21 +968,11 @@ class MongoDBProxy(BaseProxy):
             write_concern = self.write_concern_level
 
         if upsert:
-            bulk_op = collection.initialize_unordered_bulk_op()
-            has_operations = False
-
-            for product_and_template, strength_doc in strength_docs_map.items():
-                has_operations = True
-                product = product_and_template[0]
-                template = product_and_template[1]
-                spec = {"product": product, "template_product": template}
-                update_clause = {"$set": strength_doc}
-                bulk_op.find(spec).upsert().update(update_clause)
-
-            if has_operations:
-                bulk_op.execute(write_concern={'w': write_concern})
+            operations = (({"product": product, "template_product": template}, {"$set": strength_doc})
+                          for (product, template), strength_doc in strength_docs_map.items())
         else:
-            collection.insert(strength_docs_map.values(), w=write_concern, manipulate=False)
+            operations = ((None, dict(strength_doc)) for strength_doc in strength_docs_map.values())
+        self._bulk_write(collection, operations, write_concern, wait)
 
     @profile
     def save_latest_activity_for_product_product_strengths(self, user, product, activity_type, activity_date):
@@ -920,20 +1021,10 @@ class MongoDBProxy(BaseProxy):
         if end_index is None:
             end_index = len(strengths)
 
-        bulk_op = collection.initialize_unordered_bulk_op()
-        has_operations = False
-
-        for index in range(start_index, end_index):
-            has_operations = True
-
-            strength_doc = strengths[index]
-            update_clause = {"$set": {"strength": strength_doc["strength"]}}
-            bulk_op.find({"product": strength_doc["product"],
-                          "template_product": strength_doc[
-                              "template_product"]}).upsert().update(update_clause)
-
-        if has_operations:
-            bulk_op.execute(write_concern={'w': self.write_concern_level})
+        operations = (({"product": strength_doc["product"], "template_product": strength_doc["template_product"]},
+                       {"$set": {"strength": strength_doc["strength"]}})
+                      for strength_doc in strengths[start_index:end_index])
+        self._bulk_write(collection, operations)
 
     def hotswap_uu_strengths(self):
         """ See barbante.data.BaseProxy.
@@ -965,15 +1056,12 @@ class MongoDBProxy(BaseProxy):
     def save_df(self, language, df_by_term, increment=False, upsert=False):
         """ See barbante.data.BaseProxy.
         """
-        bulk_op = self.database_bulk.df.initialize_unordered_bulk_op()
-        has_operations = False
+        operations = []
 
         for term, df in df_by_term.items():
             if df <= 0:
                 continue
 
-            has_operations = True
-
             record = {"language": language,
                       "term": term,
                       "df": df}
@@ -985,13 +1073,11 @@ class MongoDBProxy(BaseProxy):
                 else:
                     update_clause = {"$set": record}
 
-                bulk_op.find({"language": language,
-                              "term": term}).upsert().update(update_clause)
+                operations.append(({"language": language, "term": term}, update_clause))
             else:
-                bulk_op.insert(record)
+                operations.append((None, record))
 
-        if has_operations:
-            bulk_op.execute(write_concern={'w': self.write_concern_level})
+        self._bulk_write(self.database_bulk.df, operations)
 
     def find_df(self, language, term):
         """ See barbante.data.BaseProxy.
@@ -1055,6 +1141,35 @@ class MongoDBProxy(BaseProxy):
 
         return result
 
+    @profile
+    def fetch_tfidf_postings(self, attribute, terms):
+        """ See barbante.data.BaseProxy.
+        """
+        result = {}
+
+        fields = {"external_product_id": True, "term": True, "tfidf": True, "_id": False}
+        where = {"attribute": attribute,
+                 "term": {"$in": terms}}
+
+        cursor = self.database.tfidf.find(where, fields)  # covered by the (attribute, term, product, tfidf) index
+
+        for row in cursor:
+            postings = result.get(row["term"], {})
+            postings[row["external_product_id"]] = row["tfidf"]
+            result[row["term"]] = postings
+
+        return result
+
+    @profile
+    def fetch_tfidf_sums(self, attribute, product_ids):
+        """ See barbante.data.BaseProxy.
+        """
+        pipeline = [{"$match": {"attribute": attribute,
+                                "external_product_id": {"$in": product_ids}}},
+                    {"$group": {"_id": "$external_product_id", "sum": {"$sum": "$tfidf"}}}]
+        response = self.database.tfidf.aggregate(pipeline)
+        return {doc["_id"]: doc["sum"] for doc in response["result"]}
+
     def save_user_model(self, user_id, user_model):
         """ See barbante.data.BaseProxy.
         """
@@ -1221,14 +1336,44 @@ class MongoDBProxy(BaseProxy):
         collection.update(spec, update_clause, upsert=True, w=self.write_concern_level)
 
     def _insert_bulk(self, records, collection_name):
-        bulk_op = self.database_bulk[collection_name].initialize_unordered_bulk_op()
-        has_operations = len(records) > 0
+        self._bulk_write(self.database_bulk[collection_name], ((None, record) for record in records))
+
+    def _bulk_write(self, collection, operations, write_concern=None, wait=True):
+        """ Writes many operations through the BulkWriter of a collection.
 
-        for record in records:
-            bulk_op.insert(record)
+            :param collection: The pymongo collection.
+            :param operations: An iterable of (spec, update clause) pairs, for upserts, or of (None, document) pairs,
+                for inserts.
+            :param write_concern: The write concern. If None, self.write_concern_level is used.
+            :param wait: If False, the writes may be sent in the background (see flush_bulk_writes()).
+        """
+        key = (id(collection.database), collection.name)
+        with self._bulk_writers_lock:
+            writer = self.bulk_writers.get(key)
+            if writer is None:
+                writer = BulkWriter(collection,
+                                    self.context.bulk_write_max_batch_ops,
+                                    self.context.bulk_write_max_batch_bytes,
+                                    self.context.bulk_write_max_in_flight)
+                self.bulk_writers[key] = writer
+        writer.write(operations,
+                     write_concern if write_concern is not None else self.write_concern_level,
+                     background=self.context.bulk_write_background and not wait)
 
-        if has_operations:
-            bulk_op.execute(write_concern={'w': self.write_concern_level})
+    def flush_bulk_writes(self):
+        """ See barbante.data.BaseProxy.
+        """
+        with self._bulk_writers_lock:
+            writers = list(self.bulk_writers.values())
+        for writer in writers:
+            writer.flush()
+        log.info("Bulk writes: {0}".format(self.get_bulk_write_stats()))
+
+    def get_bulk_write_stats(self):
+        """ See barbante.data.BaseProxy.
+        """
+        with self._bulk_writers_lock:
+            return {writer.collection.name: writer.get_stats() for writer in self.bulk_writers.values()}
 
     def get_user_count(self):
         """ See barbante.data.BaseProxy.
@@ -1482,6 +1627,11 @@ class MongoDBProxy(BaseProxy):
                                                 ("timestamp", pymongo.DESCENDING),
                                                 ("cutoff_date", pymongo.DESCENDING)])
 
+        # Raw users
+        log.info("Ensuring indexes for users (raw database)...")
+        self.database_raw.users.ensure_index([("anonymous", pymongo.ASCENDING),
+                                              ("external_id", pymongo.ASCENDING)])
+
         # Raw products
         log.info("Ensuring indexes for products (raw database)...")
         self.database_raw.products.ensure_index([("external_id", pymongo.ASCENDING),
@@ -0,0 +1,117 @@
+""" Tests barbante.data.AsyncMongoDBProxy.
+"""
+
+import unittest.mock as mock
+
+import nose
+import nose.tools
+import pymongo.errors
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import barbante.maintenance.product_templates as pt
+import barbante.maintenance.user_templates as ut
+import barbante.tests.dummy_data_populator as dp
+import barbante.tests as tests
+from barbante.utils.deadline import DeadlineExceeded
+
+
+class TestAsyncMongoDBProxy:
+    """ Class for testing the asynchronous reads of barbante.data.AsyncMongoDBProxy against
+        their blocking counterparts in barbante.data.MongoDBProxy.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        try:
+            from barbante.data.AsyncMongoDBProxy import AsyncMongoDBProxy
+        except ImportError:
+            raise nose.SkipTest("motor is not installed")
+        cls.proxy_class = AsyncMongoDBProxy
+
+        cls.session_context = tests.init_session()
+        cls.db_proxy = cls.session_context.data_proxy
+
+        cls.db_proxy.drop_database()
+
+        dp.populate_products(cls.session_context)
+        dp.populate_users(cls.session_context)
+        dp.populate_activities(cls.session_context)
+        dp.populate_impressions(cls.session_context)
+        cls.db_proxy.ensure_indexes(create_ttl_indexes=False)
+
+        ut.generate_templates(cls.session_context)
+        pt.generate_templates(cls.session_context)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.db_proxy.drop_database()
+
+    def setup(self):
+        # the motor connection is bound to the IOLoop on which it is made, hence a new proxy per IOLoop
+        self.async_proxy = self.proxy_class(self.session_context.customer_context)
+        self.io_loop = IOLoop()
+
+    def teardown(self):
+        self.io_loop.close()
+
+    def _run(self, coroutine):
+        return self.io_loop.run_sync(coroutine)
+
+    def test_fetch_day_of_latest_user_activity_async(self):
+        for user_id in ["u_eco_1", "u_tec_1", "nonexistent_user"]:
+            day = self._run(lambda: self.async_proxy.fetch_day_of_latest_user_activity_async(user_id, False))
+            nose.tools.eq_(day, self.async_proxy.fetch_day_of_latest_user_activity(user_id, False),
+                           "Wrong day of latest activity for user [{0}]".format(user_id))
+
+    def test_fetch_activity_summaries_by_user_async(self):
+        user_ids = ["u_eco_1", "u_eco_2", "u_tec_1"]
+        for indexed_fields_only in [True, False]:
+            summaries = self._run(lambda: self.async_proxy.fetch_activity_summaries_by_user_async(
+                False, user_ids=user_ids, num_activities=10, indexed_fields_only=indexed_fields_only))
+            nose.tools.ok_(len(summaries) > 0, "No activities were fetched")
+            nose.tools.eq_(summaries, self.async_proxy.fetch_activity_summaries_by_user(
+                False, user_ids=user_ids, num_activities=10, indexed_fields_only=indexed_fields_only),
+                "Wrong activity summaries")
+
+    def test_fetch_impressions_summary_async(self):
+        user_ids = ["u_eco_1", "u_tec_1"]
+        for group_by_product in [True, False]:
+            summary = self._run(lambda: self.async_proxy.fetch_impressions_summary_async(
+                False, user_ids=user_ids, group_by_product=group_by_product))
+            nose.tools.ok_(len(summary) > 0, "No impressions were fetched")
+            nose.tools.eq_(summary, self.async_proxy.fetch_impressions_summary(
+                False, user_ids=user_ids, group_by_product=group_by_product), "Wrong impressions summary")
+
+    def test_fetch_user_templates_async(self):
+        user_ids = ["u_eco_1", "u_eco_2", "u_tec_1"]
+        templates = self._run(lambda: self.async_proxy.fetch_user_templates_async(user_ids))
+        nose.tools.ok_(len(templates) > 0, "No user templates were fetched")
+        nose.tools.eq_(templates, self.async_proxy.fetch_user_templates(user_ids), "Wrong user templates")
+
+    def test_fetch_product_templates_async(self):
+        product_ids = ["p_eco_1", "p_eco_2", "p_tec_1"]
+        templates = self._run(lambda: self.async_proxy.fetch_product_templates_async(product_ids))
+        nose.tools.ok_(len(templates) > 0, "No product templates were fetched")
+        nose.tools.eq_(templates, self.async_proxy.fetch_product_templates(product_ids), "Wrong product templates")
+
+    def test_fetch_product_models_async(self):
+        product_ids = ["p_eco_1", "p_eco_2", "p_tec_1"]
+        models = self._run(lambda: self.async_proxy.fetch_product_models_async(product_ids))
+        expected_models = self.async_proxy.fetch_product_models(product_ids)
+        nose.tools.eq_(set(models), set(product_ids), "Wrong product models")
+        for product_id, model in models.items():
+            nose.tools.eq_(model.to_dict(), expected_models[product_id].to_dict(),
+                           "Wrong model of product [{0}]".format(product_id))
+
+        ids = self._run(lambda: self.async_proxy.fetch_product_models_async(product_ids, ids_only=True))
+        nose.tools.eq_(sorted(ids), sorted(product_ids), "Wrong product ids")
+
+    def test_query_exceeding_its_time_limit(self):
+        @gen.coroutine
+        def slow_find(query, max_time_ms=None):
+            raise pymongo.errors.ExecutionTimeout("operation exceeded time limit")
+
+        with mock.patch.object(self.async_proxy, '_find_async', slow_find):
+            nose.tools.assert_raises(DeadlineExceeded, self._run,
+                                     lambda: self.async_proxy.fetch_user_templates_async(["u_eco_1"], max_time_ms=1))
@@ -0,0 +1,87 @@
+""" Test module for barbante.data.BulkWriter.
+"""
+
+import threading
+import unittest.mock as mock
+
+import nose.tools
+
+from barbante.data.BulkWriter import BulkWriter
+
+
+class FakeCollection(object):
+    """ Records the batches executed through unordered bulk operations.
+    """
+
+    def __init__(self, release=None):
+        self.batches = []
+        self.release = release
+        self.lock = threading.Lock()
+
+    def initialize_unordered_bulk_op(self):
+        operations = []
+        bulk_op = mock.MagicMock()
+        bulk_op.insert.side_effect = lambda document: operations.append((None, document))
+        bulk_op.find.side_effect = lambda spec: mock.MagicMock(**{
+            "upsert.return_value.update.side_effect": lambda clause: operations.append((spec, clause))})
+
+        def execute(write_concern):
+            if self.release is not None:
+                self.release.wait()
+            with self.lock:
+                self.batches.append(operations)
+        bulk_op.execute.side_effect = execute
+        return bulk_op
+
+
+def test_batches_are_bounded():
+    """ Tests that batches are split by number of operations and by size.
+    """
+    collection = FakeCollection()
+    writer = BulkWriter(collection, max_batch_ops=3, max_batch_bytes=10 ** 6, max_in_flight=1)
+    writer.write(((None, {"i": i}) for i in range(7)), write_concern=0)
+    nose.tools.eq_([len(batch) for batch in collection.batches], [3, 3, 1], "Wrong batches")
+
+    collection = FakeCollection()
+    writer = BulkWriter(collection, max_batch_ops=100, max_batch_bytes=100, max_in_flight=1)
+    writer.write((({"k": i}, {"$set": {"v": "x" * 20}}) for i in range(6)), write_concern=0)
+    nose.tools.ok_(len(collection.batches) > 1, "Batches should be split by size")
+    nose.tools.eq_(sum(len(batch) for batch in collection.batches), 6, "Operations are missing")
+    nose.tools.eq_(collection.batches[0][0], ({"k": 0}, {"$set": {"v": "x" * 20}}), "Wrong upsert")
+
+    stats = writer.get_stats()
+    nose.tools.eq_(stats["docs"], 6, "Wrong number of docs")
+    nose.tools.eq_(stats["batches"], len(collection.batches), "Wrong number of batches")
+    nose.tools.ok_(stats["bytes"] > 0, "Wrong number of bytes")
+
+
+def test_background_writes():
+    """ Tests that background writes do not block the caller until the in-flight limit is reached,
+        and that flush() waits for all of them.
+    """
+    release = threading.Event()
+    collection = FakeCollection(release)
+    writer = BulkWriter(collection, max_batch_ops=1, max_batch_bytes=10 ** 6, max_in_flight=2)
+    writer.write([(None, {"i": 0}), (None, {"i": 1})], write_concern=0, background=True)
+    nose.tools.eq_(len(collection.batches), 0, "The caller should not wait for the writes")
+    nose.tools.eq_(writer.get_stats()["in_flight"], 2, "Wrong number of pending batches")
+
+    caller = threading.Thread(target=writer.write, args=([(None, {"i": 2})], 0, True))
+    caller.start()
+    caller.join(0.1)
+    nose.tools.ok_(caller.is_alive(), "The caller should block while the in-flight limit is reached")
+
+    release.set()
+    caller.join()
+    writer.flush()
+    nose.tools.eq_(len(collection.batches), 3, "All batches should have been written")
+
+
+def test_background_errors_are_raised_on_flush():
+    """ Tests that the errors of background writes are raised by flush().
+    """
+    collection = mock.MagicMock()
+    collection.initialize_unordered_bulk_op.return_value.execute.side_effect = RuntimeError("write failed")
+    writer = BulkWriter(collection, max_batch_ops=10, max_batch_bytes=10 ** 6, max_in_flight=1)
+    writer.write([(None, {"i": 0})], write_concern=0, background=True)
+    nose.tools.assert_raises(RuntimeError, writer.flush)
@@ -0,0 +1,84 @@
+""" Tests barbante.data.InMemoryProxy.
+"""
+
+import nose.tools
+
+import barbante.context as context
+import barbante.data.tests.test_data_proxy as test_data_proxy
+import barbante.tests.dummy_data_populator as dp
+import barbante.tests as tests
+from barbante.data.InMemoryProxy import InMemoryProxy, matches
+
+
+class TestInMemoryProxy(test_data_proxy.TestDataProxy):
+    """ Runs all barbante.data.BaseProxy tests against an InMemoryProxy, with no database behind it.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        customer_context = context.create_customer_context(tests.TEST_ENV, data_proxy=InMemoryProxy)
+        cls.session_context = context.init_session(customer_ctx=customer_context)
+        cls.db_proxy = cls.session_context.data_proxy
+
+        cls.db_proxy.drop_database()
+
+        dp.populate_products(cls.session_context)
+        dp.populate_users(cls.session_context)
+        dp.populate_activities(cls.session_context)
+        dp.populate_impressions(cls.session_context)
+
+        cls.db_proxy.backup_database()
+
+    def test_top_uu_strengths_in_descending_order(self):
+        self.db_proxy.save_uu_strengths({("u1", "u2"): {"user": "u1", "template_user": "u2", "strength": 0.2},
+                                         ("u1", "u3"): {"user": "u1", "template_user": "u3", "strength": 0.9},
+                                         ("u1", "u4"): {"user": "u1", "template_user": "u4", "strength": 0},
+                                         ("u1", "u5"): {"user": "u1", "template_user": "u5", "strength": 0.5}})
+        top = list(self.db_proxy.fetch_top_uu_strengths("u1", 2))
+        nose.tools.eq_(top, [(0.9, "u3"), (0.5, "u5")], "Wrong top user-user strengths")
+
+    def test_top_pp_strengths_with_blocked_products(self):
+        self.db_proxy.save_pp_strengths({("p1", "p2"): {"product": "p1", "template_product": "p2", "strength": 0.7},
+                                         ("p1", "p3"): {"product": "p1", "template_product": "p3", "strength": 0.8},
+                                         ("p1", "p4"): {"product": "p1", "template_product": "p4", "strength": 0.1}})
+        templates, templates_tfidf = self.db_proxy.fetch_top_pp_strengths("p1", 2, blocked_products=["p3"])
+        nose.tools.eq_(templates, [[0.7, "p2"], [0.1, "p4"]], "Wrong top product-product strengths")
+        nose.tools.eq_(templates_tfidf, [], "Unexpected tfidf-based strengths")
+
+    def test_hotswap_pp_strengths(self):
+        self.db_proxy.save_pp_strengths({("p1", "p2"): {"product": "p1", "template_product": "p2", "strength": 0.7}})
+        self.db_proxy.save_pp_strengths({("p1", "p3"): {"product": "p1", "template_product": "p3", "strength": 0.8}},
+                                        deferred_publication=True)
+        nose.tools.eq_(self.db_proxy.fetch_product_product_strengths(products=["p1"]), {("p1", "p2"): 0.7},
+                       "Deferred strengths should not be visible before the hotswap")
+        self.db_proxy.hotswap_pp_strengths()
+        nose.tools.eq_(self.db_proxy.fetch_product_product_strengths(products=["p1"]), {("p1", "p3"): 0.8},
+                       "Wrong strengths after the hotswap")
+
+    def test_tfidf_map(self):
+        self.db_proxy.insert_tfidf_records([{"external_product_id": "p1", "attribute": "title", "term": "rock",
+                                             "tfidf": 0.5}])
+        nose.tools.eq_(self.db_proxy.fetch_tfidf_map("title", ["p1", "p2"]), {"p1": {"rock": 0.5}},
+                       "Wrong tfidf map")
+        self.db_proxy.remove_tfidf(["title"], "p1")
+        nose.tools.eq_(self.db_proxy.fetch_tfidf_map("title", ["p1"]), {}, "Tfidf records were not removed")
+
+    def test_tfidf_postings_and_sums(self):
+        self.db_proxy.insert_tfidf_records([{"external_product_id": "p1", "attribute": "title", "term": "rock",
+                                             "tfidf": 0.5},
+                                            {"external_product_id": "p1", "attribute": "title", "term": "roll",
+                                             "tfidf": 0.25},
+                                            {"external_product_id": "p2", "attribute": "title", "term": "rock",
+                                             "tfidf": 0.1}])
+        nose.tools.eq_(self.db_proxy.fetch_tfidf_postings("title", ["rock", "pop"]), {"rock": {"p1": 0.5, "p2": 0.1}},
+                       "Wrong tfidf postings")
+        nose.tools.eq_(self.db_proxy.fetch_tfidf_sums("title", ["p1", "p3"]), {"p1": 0.75}, "Wrong tfidf sums")
+
+
+def test_query_matching():
+    doc = {"language": "english", "resources": {"title": "Let it be"}, "tags": ["rock", "pop"], "price": 10}
+    nose.tools.ok_(matches(doc, {"language": "english", "tags": "rock"}), "Equality should match")
+    nose.tools.ok_(matches(doc, {"resources.title": {"$ne": "Help"}}), "Nested fields should match")
+    nose.tools.ok_(matches(doc, {"$or": [{"price": {"$gt": 20}}, {"price": {"$lte": 10}}]}), "$or should match")
+    nose.tools.ok_(not matches(doc, {"price": {"$gte": 5, "$lt": 10}}), "Range should not match")
+    nose.tools.ok_(not matches(doc, {"author": {"$exists": True}}), "Missing field should not exist")
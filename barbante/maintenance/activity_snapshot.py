@@ -0,0 +1,264 @@
+""" Compact, columnar snapshots of the (non-anonymous) activity window, for batch maintenance.
+
+    The activity summaries are dumped once, in a single sequential scan, into a directory of memory-mappable
+    numpy columns (one row per (user, product) pair):
+
+        - *user_idx.npy* (int32) and *product_idx.npy* (int32): the positions of the ids in the dictionaries
+          *users.json* and *products.json*;
+        - *rating.npy* (uint8): the (implicit) rating of the activity;
+        - *day.npy* (int32): the day of the activity, as the number of days since 1970-01-01 (UTC).
+
+    Batch engines (see user_templates.generate_strengths_sparse() and product_templates.generate_strengths_sparse())
+    may then build their rating matrices off the snapshot instead of paging through the database, so that all
+    jobs of a maintenance run are fed by the same sequential read. Before that, they bring the snapshot up to
+    date (see ActivitySnapshot.catch_up()), since they record all activities in the database as processed.
+"""
+
+import array
+import datetime as dt
+import json
+import os
+
+import numpy as np
+import pytz
+import scipy.sparse as sparse
+
+from barbante.utils.id_dictionary import IdDictionary
+import barbante.utils.logging as barbante_logging
+
+
+log = barbante_logging.get_logger(__name__)
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+_COLUMNS = {"user_idx": np.int32, "product_idx": np.int32, "rating": np.uint8, "day": np.int32}
+""" The dtypes of the columns, by name. """
+
+_ARRAY_TYPECODES = {np.int32: "i", np.uint8: "B"}
+
+
+def _day_number(date, round_up=False):
+    """ Converts a datetime into a number of days since 1970-01-01 (UTC).
+
+        :param round_up: If True, a date past midnight is mapped onto the following day (so that
+            "day >= date" holds for all days whose number is at least the result).
+    """
+    if date.tzinfo is None:
+        date = pytz.utc.localize(date)
+    elapsed = date - EPOCH
+    if round_up and (elapsed.seconds > 0 or elapsed.microseconds > 0):
+        return elapsed.days + 1
+    return elapsed.days
+
+
+def _read_columns(session_context, users, products, min_date):
+    """ Reads the activity summaries since *min_date* (all of them, if None) into columns.
+
+        :param users: The IdDictionary in which the user ids are interned.
+        :param products: The IdDictionary in which the product ids are interned.
+
+        :returns: A dict {column name: array.array}.
+    """
+    columns = {name: array.array(_ARRAY_TYPECODES[dtype]) for name, dtype in _COLUMNS.items()}
+    for activity in session_context.data_proxy.fetch_all_activity_summaries(min_day=min_date):
+        columns["user_idx"].append(users.intern(activity["external_user_id"]))
+        columns["product_idx"].append(products.intern(activity["external_product_id"]))
+        columns["rating"].append(session_context.rating_by_activity[activity["activity"]])
+        columns["day"].append(_day_number(activity["day"]))
+    return columns
+
+
+def _is_member(values, members):
+    """ :returns: A boolean array telling which of the *values* are among the *members* (both int arrays).
+    """
+    members = np.unique(members)
+    if len(members) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(members, values), len(members) - 1)
+    return members[positions] == values
+
+
+class ActivitySnapshot(object):
+    """ An in-memory (or memory-mapped) columnar snapshot of the activity summaries.
+    """
+
+    def __init__(self, users, products, user_idx, product_idx, ratings, days, min_day=None, exported_day=None):
+        self.users = users
+        """ The IdDictionary of user_idx. """
+        self.products = products
+        """ The IdDictionary of product_idx. """
+        self.user_idx = user_idx
+        """ The int32 column with the positions of the users of the activities in *users*. """
+        self.product_idx = product_idx
+        """ The int32 column with the positions of the products of the activities in *products*. """
+        self.ratings = ratings
+        """ The uint8 column with the ratings of the activities. """
+        self.days = days
+        """ The int32 column with the days of the activities (in days since 1970-01-01 UTC). """
+        self.min_day = min_day
+        """ The first day covered by the snapshot (in days since 1970-01-01 UTC), or None if it holds all
+            activities.
+        """
+        self.exported_day = exported_day
+        """ The day of the export (in days since 1970-01-01 UTC). Activities summarized from then on may be
+            missing from the snapshot.
+        """
+
+    def __len__(self):
+        return len(self.ratings)
+
+    @staticmethod
+    def export(session_context, path, min_date=None):
+        """ Dumps the activity summaries into a snapshot directory (created if needed).
+
+            :param session_context: The session context.
+            :param path: The snapshot directory.
+            :param min_date: The date before which no activities will be exported. If None, all activities are.
+
+            :returns: The snapshot, with memory-mapped columns.
+        """
+        users = IdDictionary()
+        products = IdDictionary()
+        exported_at = session_context.get_present_date()
+        columns = _read_columns(session_context, users, products, min_date)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, dtype in _COLUMNS.items():
+            np.save(os.path.join(path, name + ".npy"), np.frombuffer(columns[name], dtype=dtype))
+        users.save(os.path.join(path, "users.json"))
+        products.save(os.path.join(path, "products.json"))
+        # the metadata is written last, so that incomplete snapshots cannot be loaded
+        with open(os.path.join(path, "meta.json"), "w") as meta_file:
+            json.dump({"min_day": _day_number(min_date, round_up=True) if min_date is not None else None,
+                       "count": len(columns["rating"]),
+                       "exported_at": exported_at.isoformat(),
+                       "exported_day": _day_number(exported_at)}, meta_file)
+
+        log.info("Exported [%d] activities of [%d] users on [%d] products to [%s]" %
+                 (len(columns["rating"]), len(users), len(products), path))
+        return ActivitySnapshot.load(path)
+
+    @staticmethod
+    def load(path):
+        """ Opens a snapshot directory, memory-mapping its columns.
+
+            :param path: The snapshot directory.
+
+            :returns: The snapshot.
+        """
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        users = IdDictionary.load(os.path.join(path, "users.json"))
+        products = IdDictionary.load(os.path.join(path, "products.json"))
+        columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in _COLUMNS}
+        return ActivitySnapshot(users, products, columns["user_idx"], columns["product_idx"],
+                                columns["rating"], columns["day"], meta["min_day"], meta["exported_day"])
+
+    def catch_up(self, session_context):
+        """ Brings the snapshot up to date with the activities summarized in the database since the day of its
+            export. The summaries of that period override the activities of the same (user, product) pairs in
+            the snapshot, so that the ratings are those which a batch run would have read from the database.
+
+            :param session_context: The session context.
+
+            :returns: The up-to-date snapshot, with in-memory columns.
+        """
+        users = IdDictionary(self.users.ids)
+        products = IdDictionary(self.products.ids)
+        caught_up_at = session_context.get_present_date()
+        columns = {name: np.array(column, dtype=_COLUMNS[name]) for name, column in
+                   _read_columns(session_context, users, products, EPOCH + dt.timedelta(self.exported_day)).items()}
+
+        # drops the outdated activities of the pairs that were summarized again...
+        user_idx = np.asarray(self.user_idx)
+        product_idx = np.asarray(self.product_idx)
+        outdated = _is_member(user_idx.astype(np.int64) * len(products) + product_idx,
+                              columns["user_idx"].astype(np.int64) * len(products) + columns["product_idx"])
+        kept = ~outdated
+
+        # ...and appends their summaries
+        log.info("Caught up with [%d] activities summarized since the export (replacing [%d])" %
+                 (len(columns["rating"]), np.count_nonzero(outdated)))
+        return ActivitySnapshot(users, products,
+                                np.concatenate((user_idx[kept], columns["user_idx"])),
+                                np.concatenate((product_idx[kept], columns["product_idx"])),
+                                np.concatenate((np.asarray(self.ratings)[kept], columns["rating"])),
+                                np.concatenate((np.asarray(self.days)[kept], columns["day"])),
+                                self.min_day, _day_number(caught_up_at))
+
+    def rating_matrix(self, min_date=None, users_list=None, products_list=None):
+        """ Builds a sparse user x product matrix with the ratings of the activities since *min_date*.
+
+            :param min_date: The date before which no activities will be considered. If None, it will be disregarded.
+            :param users_list: The ids of the rows. If None, the users with activities since *min_date* are used.
+                Activities of other users are disregarded.
+            :param products_list: The ids of the columns. If None, the products with activities since *min_date*
+                are used. Activities on other products are disregarded.
+
+            :returns: A tuple (list of user ids, list of product ids, CSR matrix with one row per user and
+                one column per product, whose values are the ratings).
+        """
+        mask = None
+        if min_date is not None:
+            min_day = _day_number(min_date, round_up=True)
+            if self.min_day is not None and min_day < self.min_day:
+                raise ValueError("The snapshot does not cover activities before {0}".format(
+                    EPOCH + dt.timedelta(self.min_day)))
+            mask = np.asarray(self.days) >= min_day
+        elif self.min_day is not None:
+            raise ValueError("The snapshot does not cover all activities")
+
+        user_idx = np.asarray(self.user_idx)
+        product_idx = np.asarray(self.product_idx)
+        ratings = np.asarray(self.ratings)
+        if mask is not None:
+            user_idx, product_idx, ratings = user_idx[mask], product_idx[mask], ratings[mask]
+
+        # drops the activities of users and products out of the informed lists...
+        rows = cols = None
+        if users_list is not None:
+            rows = self._position_by_index(users_list, self.users)[user_idx]
+        if products_list is not None:
+            cols = self._position_by_index(products_list, self.products)[product_idx]
+        if rows is not None or cols is not None:
+            kept = np.ones(len(ratings), dtype=bool)
+            for positions in (rows, cols):
+                if positions is not None:
+                    kept &= positions >= 0
+            user_idx, product_idx, ratings = user_idx[kept], product_idx[kept], ratings[kept]
+            rows = rows[kept] if rows is not None else None
+            cols = cols[kept] if cols is not None else None
+
+        # ...and makes up the lists which were not informed out of the remaining activities
+        if rows is None:
+            rows, users_list = self._compact(user_idx, self.users)
+        if cols is None:
+            cols, products_list = self._compact(product_idx, self.products)
+
+        matrix = sparse.csr_matrix((ratings.astype(np.int8), (rows, cols)),
+                                   shape=(len(users_list), len(products_list)))
+        return users_list, products_list, matrix
+
+    @staticmethod
+    def _position_by_index(ids_list, dictionary):
+        """ Maps the indices of a dictionary onto the positions of the corresponding ids in *ids_list*
+            (-1 for the ids which are not in it).
+
+            :returns: An array with one position per index of the dictionary.
+        """
+        position_by_index = np.full(len(dictionary), -1, dtype=np.int64)
+        indices = dictionary.indices(ids_list)
+        known = indices >= 0
+        position_by_index[indices[known]] = np.arange(len(ids_list))[known]
+        return position_by_index
+
+    @staticmethod
+    def _compact(indices, dictionary):
+        """ Maps the indices of a dictionary onto consecutive positions.
+
+            :returns: A tuple (array of positions, list of the ids referred to by *indices*,
+                in the order of the positions).
+        """
+        used_indices, positions = np.unique(indices, return_inverse=True)
+        return positions, dictionary.externals(used_indices.tolist())
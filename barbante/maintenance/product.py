@@ -1,4 +1,5 @@
 import concurrent.futures
+import contextlib
 import datetime as dt
 import heapq
 import math
@@ -16,12 +17,16 @@ log = barbante_logging.get_logger(__name__)
 
 
 @profile
-def process_products_from_scratch(session_context, days=None):
+def process_products_from_scratch(session_context, days=None, use_processes=False):
     """ Processes product models and product terms for all non-deleted, valid products in the database.
 
         :param session_context: The customer context.
         :param days: The number of days which should be considered. Only products whose date
             attribute lies within the last days
+        :param use_processes: If True, the stemming of the product model and TF stages runs on a pool of
+            worker processes, so that it is not serialized by the GIL. All reads and writes are still performed
+            by this process, through the data proxy of the informed context; the workers are only shipped the
+            product contents and the settings required to stem them.
     """
     session_context.data_proxy.reset_all_product_content_data()
 
@@ -51,10 +56,11 @@ def process_products_from_scratch(session_context, days=None):
     max_workers = session_context.max_workers_batch_process_products
     pages_processed = 0
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with _worker_processes(max_workers, use_processes) as process_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_page = {
             executor.submit(wrap(__process_product_models), session_context, page, product_ids_list,
-                            session_context.flush_size / max_workers): page
+                            session_context.flush_size / max_workers, process_executor): page
             for page in range(n_pages)}
 
         for future in concurrent.futures.as_completed(future_to_page):
@@ -77,6 +83,7 @@ def process_products_from_scratch(session_context, days=None):
                                                                                                    n_pages))
 
     session_context.data_proxy.hotswap_product_models()
+    session_context.invalidate_product_models()
 
     # With all product models duly created, we split the processing of terms by language.
 
@@ -114,10 +121,11 @@ def process_products_from_scratch(session_context, days=None):
         n_pages = language_products_count // session_context.page_size_batch_process_products + 1
         max_workers = session_context.max_workers_batch_process_products
         pages_processed = 0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with _worker_processes(max_workers, use_processes) as process_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
             future_to_page = {
                 executor.submit(wrap(__process_product_terms), session_context, page, language_product_ids_list,
-                                language, session_context.flush_size / max_workers): page
+                                language, session_context.flush_size / max_workers, process_executor): page
                 for page in range(n_pages)}
 
             for future in concurrent.futures.as_completed(future_to_page):
@@ -196,6 +204,7 @@ def prepare_product_model(session_context, product, force_update=False, batch_pr
             # Otherwise, the caller will probably want to collect sufficiently many entries and save them in bulk.
                 log.debug("Saving product model...")
                 session_context.data_proxy.save_product_model(product_model.id, product_model)
+                session_context.invalidate_product_models([product_model.id])
 
         return product_model, has_pre_existing_model
 
@@ -320,7 +329,28 @@ def prepare_product_terms(session_context, product_dict, attributes=None, reproc
             raise error
 
 
-def __process_product_models(session_context, page, products_list, flush_size):
+@contextlib.contextmanager
+def _worker_processes(max_workers, use_processes):
+    """ Yields a pool of worker processes for the stemming of a batch stage, or None if *use_processes* is False,
+        in which case the threads of the stage stem the products themselves.
+    """
+    if not use_processes:
+        yield None
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as process_executor:
+        yield process_executor
+
+
+def _run_cpu_bound(process_executor, function, *args):
+    """ Runs *function* on the informed pool of worker processes and waits for its result, or simply runs it
+        right away if there is no such pool. The function and its arguments must be picklable.
+    """
+    if process_executor is None:
+        return function(*args)
+    return process_executor.submit(function, *args).result()
+
+
+def __process_product_models(session_context, page, products_list, flush_size, process_executor=None):
     session_context = session_context.new_session()
     start_idx = page * session_context.page_size_batch_process_products
     end_idx = min((page + 1) * session_context.page_size_batch_process_products, len(products_list))
@@ -330,31 +360,18 @@ def __process_product_models(session_context, page, products_list, flush_size):
     fields = session_context.product_text_fields + session_context.product_non_text_fields
     products_map = session_context.data_proxy.fetch_products(page_product_ids, fields_to_project=fields)
 
+    product_models, skipped = _run_cpu_bound(process_executor, _build_product_models,
+                                             session_context.product_model_factory, page_product_ids, products_map)
+
     products_by_language = {}
     product_model_records = []
 
-    skipped = 0
-
-    for product_id in page_product_ids:
+    for product_id, language, product_model_record in product_models:
 
-        product = products_map.get(product_id)
-        if product is None:
-            skipped += 1
-            continue
-
-        product_model_results = prepare_product_model(session_context, product, force_update=True,
-                                                      batch_processing=True)
-        if product_model_results is None:
-            skipped += 1
-            continue
-        product_model = product_model_results[0]
-
-        language = product_model.get_attribute("language")
         products = products_by_language.get(language, [])
         products += [product_id]
         products_by_language[language] = products
 
-        product_model_record = product_model.to_dict()
         product_model_records += [product_model_record]
 
         if len(product_model_records) >= flush_size:
@@ -366,7 +383,40 @@ def __process_product_models(session_context, page, products_list, flush_size):
     return products_by_language, skipped
 
 
-def __process_product_terms(session_context, page, products_list, language, flush_size):
+def _build_product_models(product_model_factory, page_product_ids, products_map):
+    """ Builds the product models of a page of products. It does not touch the database, so that it may run
+        within a worker process.
+
+        :param product_model_factory: The ProductModelFactory of the customer context.
+        :param page_product_ids: The ids of the products of the page.
+        :param products_map: A map {product_id: dict with raw product data}.
+
+        :returns: - a list of (product_id, language, product model dict) tuples, and
+                  - the number of skipped products.
+    """
+    product_models = []
+    skipped = 0
+
+    for product_id in page_product_ids:
+
+        product = products_map.get(product_id)
+        if product is None:
+            skipped += 1
+            continue
+
+        try:
+            product_model = product_model_factory.build(product_id, product)
+        except Exception:
+            log.exception("Skipped document (id = %s) due to exception: %s." % (product_id, traceback.format_exc()))
+            skipped += 1
+            continue
+
+        product_models += [(product_id, product_model.get_attribute("language"), product_model.to_dict())]
+
+    return product_models, skipped
+
+
+def __process_product_terms(session_context, page, products_list, language, flush_size, process_executor=None):
     session_context = session_context.new_session()
     start_idx = page * session_context.page_size_batch_process_products
     end_idx = min((page + 1) * session_context.page_size_batch_process_products, len(products_list))
@@ -387,29 +437,24 @@ def __process_product_terms(session_context, page, products_list, language, flus
         # Fetches the non-persisted text attributes from the raw products collection and stemmizes them.
         products_map = session_context.data_proxy.fetch_products(product_ids=page_product_ids,
                                                                  fields_to_project=list(non_persisted_text_fields))
+        text_documents_by_product = {}
         for p_id, product in products_map.items():
-            attributes_ok = True
             if p_id not in product_dicts_map:
-                attributes_ok = False
-            if attributes_ok:
-                product = utils.flatten_dict(product)
-                stemmed_attributes_map = {}
-                for attribute in non_persisted_text_fields:
-                    value = product.get(attribute)
-                    if value is not None:
-                        try:
-                            stemmed_attributes_map[attribute] = text.parse_text_to_stems(language, value)
-                        except Exception as err:
-                            log.error('Exception: {0}'.format(str(err)))
-                            log.error('Offending value: {0}'.format(value))
-                            attributes_ok = False
-                            continue
-            if attributes_ok:
-                product_dicts_map[p_id].update(stemmed_attributes_map)
-            else:
                 skipped += 1
-                if p_id in product_dicts_map:
-                    product_dicts_map.pop(p_id)
+                continue
+            product = utils.flatten_dict(product)
+            text_documents_by_product[p_id] = [(attribute, product[attribute])
+                                               for attribute in non_persisted_text_fields
+                                               if product.get(attribute) is not None]
+
+        stems_by_product, offending_products = _run_cpu_bound(process_executor, _stem_texts_of_products,
+                                                              language, text_documents_by_product)
+        for p_id in offending_products:
+            skipped += 1
+            product_dicts_map.pop(p_id)
+
+        for p_id, stems_by_attribute in stems_by_product.items():
+            product_dicts_map[p_id].update(stems_by_attribute)
 
     for product_dict in product_dicts_map.values():
 
@@ -434,6 +479,51 @@ def __process_product_terms(session_context, page, products_list, language, flus
     return df_by_term, skipped
 
 
+def _stem_texts_of_products(language, text_documents_by_product):
+    """ Stemmizes all the texts of a page of products at once. Should that fail, the texts are stemmized one product
+        at a time, so that only the offending products are left out. It does not touch the database, so that it
+        may run within a worker process.
+
+        :param language: The language of the texts.
+        :param text_documents_by_product: A map {product_id: list of (attribute, text) pairs}.
+
+        :returns: - a map {product_id: {attribute: list of stems}}, and
+                  - a list with the ids of the offending products.
+    """
+    try:
+        return _parse_texts_of_products_to_stems(language, text_documents_by_product), []
+    except Exception as err:
+        log.error('Exception: {0}'.format(str(err)))
+
+    stems_by_product = {}
+    offending_products = []
+    for p_id, text_documents in text_documents_by_product.items():
+        try:
+            stems_by_product.update(_parse_texts_of_products_to_stems(language, {p_id: text_documents}))
+        except Exception as err:
+            log.error('Exception: {0}'.format(str(err)))
+            log.error('Offending product: {0}'.format(p_id))
+            offending_products += [p_id]
+    return stems_by_product, offending_products
+
+
+def _parse_texts_of_products_to_stems(language, text_documents_by_product):
+    """ Stemmizes the text attributes of many products at once.
+
+        :param language: The language of the texts.
+        :param text_documents_by_product: A map {product_id: list of (attribute, text) pairs}.
+
+        :returns: A map {product_id: {attribute: list of stems}}.
+    """
+    document_keys = [(p_id, attribute) for p_id, text_documents in text_documents_by_product.items()
+                     for attribute, _ in text_documents]
+    texts = [(language, value) for text_documents in text_documents_by_product.values() for _, value in text_documents]
+    stems_by_product = {p_id: {} for p_id in text_documents_by_product}
+    for (p_id, attribute), stems in zip(document_keys, text.parse_texts_to_stems(texts)):
+        stems_by_product[p_id][attribute] = stems
+    return stems_by_product
+
+
 def __process_products_TFIDFs(session_context, page, products_list, total_products, language, df_by_term, flush_size):
     session_context = session_context.new_session()
     start_idx = page * session_context.page_size_batch_process_products
@@ -467,6 +557,7 @@ def __process_products_TFIDFs(session_context, page, products_list, total_produc
 @profile
 def delete_product(session_context, product_id):
     session_context.data_proxy.delete_product_model(product_id)
+    session_context.invalidate_product_models([product_id])
     attributes = session_context.product_text_fields
     if attributes:  # There will only be product terms and TFIDF to be deleted if there are product TEXT fields.
         session_context.data_proxy.remove_product_terms(attributes, product_id)
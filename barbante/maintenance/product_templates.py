@@ -3,8 +3,14 @@ import datetime as dt
 from random import shuffle
 from time import time
 
+import numpy as np
+import scipy.sparse as sparse
+
 import barbante.config as config
-from barbante.maintenance.template_consolidation import consolidate_product_templates
+import barbante.context
+import barbante.utils.matrices as matrices
+from barbante.maintenance.template_consolidation import consolidate_product_templates, fetch_allowed_templates
+from barbante.utils.id_dictionary import IdDictionary
 from barbante.utils.profiling import profile
 from barbante.context.context_manager import wrap
 import barbante.utils.logging as barbante_logging
@@ -18,9 +24,20 @@ AGGRESSIVE = 1
 MIN_ACCEPTABLE_PP_STRENGTH = 0.0001
 
 
-def generate_templates(session_context):
-    generate_strengths(session_context)
-    consolidate_product_templates(session_context, collaborative=True, tfidf=False)
+def generate_templates(session_context, snapshot=None):
+    """ Computes product x product strengths (from scratch) with the configured engine and consolidates the templates.
+
+        :param session_context: The session context.
+        :param snapshot: An optional barbante.maintenance.activity_snapshot.ActivitySnapshot to read the activities
+            from (supported by the sparse engine only).
+    """
+    if session_context.strengths_engine == barbante.context.SPARSE_ENGINE:
+        generate_strengths_sparse(session_context, snapshot)  # saves the consolidated templates as well
+    else:
+        if snapshot is not None:
+            log.warn("Activity snapshots are only supported by the sparse engine; reading activities from the database")
+        generate_strengths(session_context)
+        consolidate_product_templates(session_context, collaborative=True, tfidf=False)
 
 
 @profile
@@ -44,7 +61,10 @@ def generate_strengths(session_context):
     # shuffles the list to balance the workers
     shuffle(users_list)
 
-    # auxiliary in-memory maps (probably ok, linear-size in the overall number of recommendable activities)
+    # auxiliary in-memory maps (probably ok, linear-size in the overall number of recommendable activities),
+    # keyed by interned ids; external ids are only used when reading from and writing to the database
+    user_ids = IdDictionary()
+    product_ids = IdDictionary()
     template_products = set()
     users_by_base_product = {}
     users_by_base_product_size = 0  # let's monitor the number of users closely, just in case
@@ -58,7 +78,7 @@ def generate_strengths(session_context):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_page = {
             executor.submit(wrap(__compute_strength_numerators), session_context,
-                            page, users_list, session_context.flush_size / max_workers): page
+                            page, users_list, user_ids, product_ids, session_context.flush_size / max_workers): page
             for page in range(n_pages)}
         for future in concurrent.futures.as_completed(future_to_page):
             users_by_base_product_partial, template_products_partial = future.result()
@@ -76,6 +96,7 @@ def generate_strengths(session_context):
             log.info("In-memory users_by_base_product map size = %d products, %d users"
                      % (len(users_by_base_product), users_by_base_product_size))
 
+    session_context.data_proxy.flush_bulk_writes()  # the denominators phase reads the numerators back
     log.info("All numerators saved")
 
     del users_list
@@ -90,7 +111,7 @@ def generate_strengths(session_context):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_page = {
             executor.submit(wrap(__compute_denominators_and_strengths), session_context, page,
-                            template_products_list, users_by_base_product,
+                            template_products_list, users_by_base_product, user_ids, product_ids,
                             session_context.flush_size / max_workers): page
             for page in range(n_pages)}
 
@@ -104,6 +125,7 @@ def generate_strengths(session_context):
     log.info("Persisting data about activities considered in this batch...")
     session_context.data_proxy.copy_all_latest_activities_for_product_product_strengths(cutoff_date)
 
+    session_context.data_proxy.flush_bulk_writes()
     session_context.data_proxy.hotswap_pp_strengths()
 
     session_context.data_proxy.save_timestamp_product_product_strengths(
@@ -112,6 +134,147 @@ def generate_strengths(session_context):
     log.info("Product-product strengths generated successfully")
 
 
+@profile
+def generate_strengths_sparse(session_context, snapshot=None):
+    """ Computes product x product strengths (from scratch) based on the users' activities, just like
+        generate_strengths(), but without round-tripping numerator increments through the database.
+
+        The whole activity window is loaded once into sparse user x product matrices, and numerators are obtained
+        with sparse matrix products, one page of base products at a time. All pairs with non-zero numerators are
+        written, exactly as generate_strengths() writes them, so that on-the-fly updates keep building upon the
+        same operands. The consolidated product templates (the strongest templates of each product) are saved
+        along with them, so no separate consolidation pass is needed.
+
+        :param session_context: The session context.
+        :param snapshot: An optional barbante.maintenance.activity_snapshot.ActivitySnapshot covering the p-p strengths
+            window. If informed, the activities are read from it rather than from the database.
+    """
+    # drops the collections and recreates the necessary indexes
+    session_context.data_proxy.reset_product_product_strength_auxiliary_data()
+
+    # registers the start of the operation and the cutoff_date
+    timestamp = session_context.get_present_date()
+    cutoff_date = timestamp - dt.timedelta(session_context.product_product_strengths_window)
+    real_time_start = time()
+
+    users_list, products_list, ratings = _load_rating_matrix(session_context, cutoff_date, snapshot)
+    log.info("Loaded [%d] (implicit) ratings of [%d] users on [%d] products" %
+             (ratings.nnz, len(users_list), len(products_list)))
+
+    # base products: ratings sufficiently high for recommendation
+    base_products_transposed = matrices.threshold_mask(
+        ratings, session_context.min_rating_recommendable_from_product).T.tocsr()
+    # templates: conservatively high ratings (counted as aggressive as well when also aggressively high)
+    conservative = matrices.threshold_mask(ratings, session_context.min_rating_conservative)
+    aggressive = conservative.multiply(
+        matrices.threshold_mask(ratings, session_context.min_rating_aggressive)).tocsc()
+
+    if session_context.impressions_enabled:
+        # only templates the user has had impressions on are considered
+        # (the user might have consumed a product without a previous impression,
+        # and considering such products would bring about a serious bias)
+        impressions = matrices.load_impressions_matrix(session_context.data_proxy, users_list, products_list,
+                                                       session_context.page_size_product_product_numerators)
+        conservative = conservative.multiply(impressions).tocsc()
+        aggressive = aggressive.multiply(impressions).tocsc()
+        impressions = impressions.tocsc()
+        users_count_by_base_product = None
+    else:
+        conservative = conservative.tocsc()
+        impressions = None
+        users_count_by_base_product = np.asarray(base_products_transposed.sum(axis=1)).ravel()
+
+    # ties are broken by template id, as in the templates consolidation
+    product_ranks = np.empty(len(products_list), dtype=np.int64)
+    product_ranks[sorted(range(len(products_list)), key=products_list.__getitem__)] = np.arange(len(products_list))
+
+    allowed_templates = fetch_allowed_templates(session_context)
+    if allowed_templates:
+        product_idx_by_id = {p: idx for idx, p in enumerate(products_list)}
+        is_allowed_template = np.zeros(len(products_list), dtype=bool)
+        is_allowed_template[[product_idx_by_id[p] for p in allowed_templates if p in product_idx_by_id]] = True
+    else:
+        is_allowed_template = None
+
+    n_templates = 3 * session_context.product_templates_count
+    page_size = session_context.page_size_product_product_denominators
+    n_pages = len(products_list) // page_size + 1
+    strengths_map = {}
+    templates_by_product = {}
+
+    for page in range(n_pages):
+        start_idx = page * page_size
+        end_idx = min((page + 1) * page_size, len(products_list))
+        if start_idx >= end_idx:
+            break
+
+        base_products_page = base_products_transposed[start_idx:end_idx]
+        numerators_conservative = (base_products_page * conservative).tocoo()
+        not_self = numerators_conservative.row + start_idx != numerators_conservative.col
+        rows = numerators_conservative.row[not_self]
+        template_idx = numerators_conservative.col[not_self]
+        nc = numerators_conservative.data[not_self]
+
+        na = matrices.values_at(base_products_page * aggressive, rows, template_idx)
+        if impressions is not None:
+            # only the recommending users of the base product with impressions of the template are accounted for
+            denominators = matrices.values_at(base_products_page * impressions, rows, template_idx)
+        else:
+            denominators = users_count_by_base_product[rows + start_idx]
+
+        strengths = _compute_strength_values(session_context, nc, na, denominators)
+
+        for row, template, pair_nc, pair_na, denominator, strength in zip(
+                (rows + start_idx).tolist(), template_idx.tolist(), nc.tolist(), na.tolist(),
+                np.asarray(denominators).tolist(), strengths.tolist()):
+            base_product = products_list[row]
+            template_product = products_list[template]
+            strengths_map[(base_product, template_product)] = {"product": base_product,
+                                                               "template_product": template_product,
+                                                               "nc": int(pair_nc),
+                                                               "na": int(pair_na),
+                                                               "denominator": int(denominator),
+                                                               "strength": strength}
+            if len(strengths_map) >= session_context.flush_size:
+                _flush_strengths(session_context, strengths_map)
+
+        candidates = np.flatnonzero(strengths > 0)
+        if is_allowed_template is not None:
+            candidates = candidates[is_allowed_template[template_idx[candidates]]]
+        selected_as_templates = candidates[matrices.top_k_by_group(
+            rows[candidates], strengths[candidates], n_templates, product_ranks[template_idx[candidates]])]
+
+        for idx in selected_as_templates.tolist():
+            base_product = products_list[rows[idx] + start_idx]
+            templates = templates_by_product.setdefault(base_product, ([], []))
+            templates[0].append([float(strengths[idx]), products_list[template_idx[idx]]])
+
+        log.info("Processed [{0}] pages out of [{1}] during p-p strengths generation (sparse)".format(
+            page + 1, n_pages))
+
+    if len(strengths_map) > 0:
+        _flush_strengths(session_context, strengths_map)
+
+    # Finalizes batch write.
+
+    log.info("Persisting data about activities considered in this batch...")
+    session_context.data_proxy.copy_all_latest_activities_for_product_product_strengths(cutoff_date)
+
+    session_context.data_proxy.flush_bulk_writes()
+    session_context.data_proxy.hotswap_pp_strengths()
+
+    log.info("Saving templates of %d products..." % len(templates_by_product))
+    product_ids = list(templates_by_product)
+    for start_idx in range(0, len(product_ids), session_context.flush_size):
+        session_context.data_proxy.save_product_templates(
+            {p: templates_by_product[p] for p in product_ids[start_idx:start_idx + session_context.flush_size]})
+
+    session_context.data_proxy.save_timestamp_product_product_strengths(
+        timestamp, cutoff_date, time() - real_time_start)
+
+    log.info("Product-product strengths generated successfully")
+
+
 @profile
 def update_templates(session_context, new_activity,
                      u_p_activities_summary=None, first_impression_date=None,
@@ -486,6 +649,58 @@ def _compute_strength_value(session_context, numerator_tuple, denominator):
     return result
 
 
+def _compute_strength_values(session_context, nc, na, denominators):
+    """ Vectorized version of _compute_strength_value(), which also zeroes the strengths of pairs
+        with null denominators or with too few common users.
+    """
+    nc = nc.astype(np.float64)
+    na = na.astype(np.float64)
+    safe_denominators = np.where(denominators == 0, 1, denominators)
+    result = (na * session_context.risk_factor + nc * (1 - session_context.risk_factor)) / safe_denominators
+    result[(result < MIN_ACCEPTABLE_PP_STRENGTH) |
+           (denominators == 0) |
+           (nc < session_context.min_product_product_strength_numerator)] = 0
+    return result
+
+
+def _load_rating_matrix(session_context, cutoff_date, snapshot=None):
+    """ Loads the (implicit) ratings of all users within the p-p strengths window into a sparse matrix.
+
+        :param snapshot: If not None, the ratings are read from this ActivitySnapshot (caught up with the summaries
+            written since its export) rather than by paging through the database.
+
+        :returns: A tuple (list of user ids, list of product ids, CSR matrix with one row per user and
+            one column per product, whose values are the ratings of the latest activities).
+    """
+    users_list = [u for u in session_context.data_proxy.fetch_all_user_ids()]
+    if snapshot is not None:
+        return snapshot.catch_up(session_context).rating_matrix(cutoff_date, users_list=users_list)
+
+    products = IdDictionary()
+    rows, cols, values = [], [], []
+    page_size = session_context.page_size_product_product_numerators
+
+    for start_idx in range(0, len(users_list), page_size):
+        page_user_ids = users_list[start_idx:start_idx + page_size]
+        products_by_rating_by_user = session_context.data_proxy.fetch_products_by_rating_by_user(
+            user_ids=page_user_ids,
+            min_date=cutoff_date,
+            max_date=session_context.get_present_date())[0]
+        for user_offset, user in enumerate(page_user_ids):
+            for rating, products_with_rating in products_by_rating_by_user.get(user, {}).items():
+                for product in products_with_rating:
+                    rows += [start_idx + user_offset]
+                    cols += [products.intern(product)]
+                    values += [rating]
+
+    products_list = products.ids
+
+    ratings = sparse.csr_matrix((np.array(values, dtype=np.int8), (np.array(rows, dtype=np.int64),
+                                                                   np.array(cols, dtype=np.int64))),
+                                shape=(len(users_list), len(products_list)))
+    return users_list, products_list, ratings
+
+
 def _prepare_strengths_map(session_context, product, strengths_map,
                            numerators_with_product_as_base, denominators_with_product_as_base,
                            numerators_with_product_as_template, denominators_with_product_as_template):
@@ -508,7 +723,15 @@ def _prepare_strengths_map(session_context, product, strengths_map,
         strengths_map[product_and_template]["template_product"] = product_and_template[1]
 
 
-def __compute_strength_numerators(context, page, users_list, flush_size):
+def __compute_strength_numerators(context, page, users_list, user_ids, product_ids, flush_size):
+    """ Saves the increments to the product-product strength numerators brought about by the activities
+        of a page of users.
+
+        :param user_ids: The IdDictionary of the users (shared by all pages).
+        :param product_ids: The IdDictionary of the products (shared by all pages).
+
+        :returns: A tuple (map {interned base product: set of interned users}, set of interned template products).
+    """
     context = context.new_session()
     start_idx = page * context.page_size_product_product_numerators
     end_idx = min((page + 1) * context.page_size_product_product_numerators, len(users_list))
@@ -531,7 +754,10 @@ def __compute_strength_numerators(context, page, users_list, flush_size):
               page_users_count, context.product_product_strengths_window))
 
     log.info("[Page %d] Processing numerators..." % (page + 1))
-    for user, products_by_rating in products_by_rating_by_user.items():
+    for external_user, external_products_by_rating in products_by_rating_by_user.items():
+        user = user_ids.intern(external_user)
+        products_by_rating = {rating: set(product_ids.intern_many(products))
+                              for rating, products in external_products_by_rating.items()}
 
         template_products = set()
         for rating in range(context.min_rating_conservative, 6):
@@ -545,10 +771,10 @@ def __compute_strength_numerators(context, page, users_list, flush_size):
             # gathers products the user has had impressions on
             # (the user might have consumed a product without a previous impression,
             # and considering such products would bring about a serious bias)
-            template_products = context.data_proxy.fetch_products_with_impressions_by_user(
-                user_ids=[user],
-                product_ids=list(template_products),
-                anonymous=False).get(user, set())
+            template_products = set(product_ids.intern_many(context.data_proxy.fetch_products_with_impressions_by_user(
+                user_ids=[external_user],
+                product_ids=product_ids.externals(template_products),
+                anonymous=False).get(external_user, set())))
 
         all_template_products |= template_products
 
@@ -572,20 +798,28 @@ def __compute_strength_numerators(context, page, users_list, flush_size):
                     strength_numerators[(base_product, template_product)] = strength_num
 
                     if len(strength_numerators) >= flush_size:
-                        _flush_numerators(context, strength_numerators)
+                        _flush_numerators(context, strength_numerators, product_ids)
 
     if len(strength_numerators) > 0:
-        _flush_numerators(context, strength_numerators)
+        _flush_numerators(context, strength_numerators, product_ids)
 
     return users_by_base_product, all_template_products
 
 
-def __compute_denominators_and_strengths(context, page, template_products_list, users_by_base_product, flush_size):
+def __compute_denominators_and_strengths(context, page, template_products_list, users_by_base_product,
+                                         user_ids, product_ids, flush_size):
+    """ Saves the product-product strengths of a page of template products.
+
+        :param template_products_list: The list of all (interned) template products.
+        :param users_by_base_product: A map {interned base product: set of interned users}.
+        :param user_ids: The IdDictionary of the users.
+        :param product_ids: The IdDictionary of the products.
+    """
     context = context.new_session()
     total_products = len(template_products_list)
     start_idx = page * context.page_size_product_product_denominators
     end_idx = min((page + 1) * context.page_size_product_product_denominators, total_products)
-    page_product_ids = template_products_list[start_idx:end_idx]
+    page_product_ids = product_ids.externals(template_products_list[start_idx:end_idx])
 
     log.info("[Page %d] Querying db for numerators with template products [%d] to [%d] out of [%d]..." %
              (page, start_idx + 1, end_idx, total_products))
@@ -602,19 +836,21 @@ def __compute_denominators_and_strengths(context, page, template_products_list,
 
         if context.impressions_enabled:
             # Retrieves the users who received impressions of the template product.
-            users_with_impressions = context.data_proxy.fetch_users_with_impressions_by_product(
-                product_ids=[template_product], anonymous=False).get(template_product, set())
+            users_with_impressions = {user_ids.index(user) for user in
+                                      context.data_proxy.fetch_users_with_impressions_by_product(
+                                          product_ids=[template_product], anonymous=False).get(template_product, set())}
 
         for base_product in numerators_by_base_product:
             numerator_tuple = numerators_by_base_product[base_product]
+            base_product_users = users_by_base_product[product_ids.index(base_product)]
 
             if context.impressions_enabled:
                 # Computes the intersection of the users who rated the base product sufficiently high
                 # with the users who received impressions of the template product.
-                intersection = users_by_base_product[base_product] & users_with_impressions
+                intersection = base_product_users & users_with_impressions
                 denominator = len(intersection)
             else:
-                denominator = len(users_by_base_product[base_product])
+                denominator = len(base_product_users)
 
             # Computes the strength based on the customer-defined risk factor.
             if denominator == 0 or numerator_tuple[CONSERVATIVE] < context.min_product_product_strength_numerator:
@@ -638,16 +874,19 @@ def __compute_denominators_and_strengths(context, page, template_products_list,
         _flush_strengths(context, strengths_map)
 
 
-def _flush_numerators(context, strength_numerators):
+def _flush_numerators(context, strength_numerators, product_ids):
     log.debug("Saving {0} increments to product-product strength numerators...".format(len(strength_numerators)))
-    context.data_proxy.save_product_product_numerators(strength_numerators, increment=True, upsert=True)
+    context.data_proxy.save_product_product_numerators(
+        {(product_ids.external(base), product_ids.external(template)): numerator
+         for (base, template), numerator in strength_numerators.items()},
+        increment=True, upsert=True, wait=False)
     strength_numerators.clear()
     log.debug("Product-product strength numerator increments saved")
 
 
 def _flush_strengths(context, strengths_map):
     log.debug("Saving {0} product-product strengths...".format(len(strengths_map)))
-    context.data_proxy.save_pp_strengths(strengths_map, upsert=False, deferred_publication=True)
+    context.data_proxy.save_pp_strengths(strengths_map, upsert=False, deferred_publication=True, wait=False)
     strengths_map.clear()
     log.debug("Product-product strengths saved")
 
@@ -664,7 +903,10 @@ def get_product_templates(context, product_ids, blocked_products=None):
     if blocked_products is None:
         blocked_products = []
 
-    templates_map = context.data_proxy.fetch_product_templates(product_ids)
+    if context.user_context is not None:
+        templates_map = context.user_context.fetch_product_templates(product_ids)
+    else:
+        templates_map = context.data_proxy.fetch_product_templates(product_ids)
     for p_id, templates_tuple in templates_map.items():
         approved_templates = [t for t in templates_tuple[0] if t[1] not in blocked_products]
         result[p_id] = approved_templates
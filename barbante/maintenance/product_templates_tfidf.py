@@ -1,9 +1,14 @@
 import datetime as dt
+import heapq
 from time import time
 
+import numpy as np
+import scipy.sparse as sparse
+
 import barbante.context as ctx
 from barbante.maintenance.product import pinpoint_near_identical_products
-from barbante.maintenance.template_consolidation import consolidate_product_templates
+from barbante.maintenance.template_consolidation import consolidate_product_templates, fetch_allowed_templates
+from barbante.utils.deadline import DeadlineExceeded
 from barbante.utils.profiling import profile
 import barbante.utils.logging as barbante_logging
 import barbante.model.product_model as pm
@@ -49,6 +54,11 @@ def generate_strengths(session_context):
     log.info("Partitioning products by language...")
     product_ids_by_language = _partition_products_by_language(product_models)
 
+    allowed_templates = None
+    if session_context.prune_product_product_strengths_tfidf:
+        allowed_templates = fetch_allowed_templates(session_context)
+        allowed_templates = set(allowed_templates) if allowed_templates else None
+
     log.info("Processing %d languages..." % len(product_ids_by_language))
 
     for language_idx, language in enumerate(product_ids_by_language):
@@ -62,22 +72,44 @@ def generate_strengths(session_context):
             log.info("Skipped. No products.")
             continue
 
-        # Processes the contributions of all TEXT fields.
+        n_templates = 3 * session_context.product_templates_count
+        prune_while_computing = session_context.prune_product_product_strengths_tfidf and \
+            session_context.strengths_engine == ctx.SPARSE_ENGINE
 
-        for attribute in text_fields:
-            weight = session_context.similarity_weights_by_type[pm.TEXT].get(attribute, 0)
-            if weight == 0:
-                continue
+        if prune_while_computing:
+            log.info("Computing the top [%d] templates of each of [%d] %s documents..." %
+                     (n_templates, len(product_ids_list), language_name))
+            strengths = _compute_top_strengths_sparse(session_context, product_models, product_ids_list,
+                                                      n_templates, allowed_templates)
+
+        else:
+            # Processes the contributions of all TEXT fields.
 
-            log.info("Fetching TFIDF maps for attribute [%s] in [%d] products..." % (attribute, len(product_ids_list)))
-            tfidf_by_term_by_product = session_context.data_proxy.fetch_tfidf_map(attribute, product_ids_list)
+            for attribute in text_fields:
+                weight = session_context.similarity_weights_by_type[pm.TEXT].get(attribute, 0)
+                if weight == 0:
+                    continue
+
+                log.info("Fetching TFIDF maps for attribute [%s] in [%d] products..." %
+                         (attribute, len(product_ids_list)))
+                tfidf_by_term_by_product = session_context.data_proxy.fetch_tfidf_map(attribute, product_ids_list)
 
-            log.info("Computing strengths among [%d] %s documents..." % (len(product_ids_list), language_name))
-            _process_text_attribute_contributions(strengths, tfidf_by_term_by_product, weight)
+                log.info("Computing strengths among [%d] %s documents..." % (len(product_ids_list), language_name))
+                if session_context.strengths_engine == ctx.SPARSE_ENGINE:
+                    _process_text_attribute_contributions_sparse(strengths, tfidf_by_term_by_product, weight,
+                                                                 session_context.page_size_product_product_tfidf)
+                else:
+                    _process_text_attribute_contributions(strengths, tfidf_by_term_by_product, weight)
 
-        # Now it processes the non-TEXT fields, but only for those product pairs which already have non-zero strengths
-        # (in other words, if a pair zeroes all text fields, it won't be further considered and its strength will be 0).
-        _process_non_text_attributes_contributions(session_context, product_models, strengths)
+            # Now it processes the non-TEXT fields, but only for those product pairs which already have non-zero
+            # strengths (in other words, if a pair zeroes all text fields, it won't be further considered and its
+            # strength will be 0).
+            _process_non_text_attributes_contributions(session_context, product_models, strengths)
+
+            if session_context.prune_product_product_strengths_tfidf:
+                log.info("Keeping the top [%d] templates of each product out of [%d] strengths..." %
+                         (n_templates, len(strengths)))
+                strengths = _select_top_strengths(strengths, n_templates, allowed_templates)
 
         # Saves in the db.
 
@@ -140,20 +172,31 @@ def update_templates(session_context, product_id, language, tfidf_by_top_term_by
         if weight == 0:
             continue
 
-        log.info("Fetching products with common terms in attribute [%s]..." % attribute)
-        terms = [term for term in tfidf_by_top_term_by_attribute.get(attribute, [])]
-        new_product_models = session_context.data_proxy.fetch_product_models_for_top_tfidf_terms(
-            attribute, language, terms, min_date=cutoff_date, max_date=session_context.get_present_date())
+        tfidf_by_term = tfidf_by_top_term_by_attribute.get(attribute, {})
+        if len(tfidf_by_term) == 0:
+            continue
+
+        log.info("Fetching the postings of the top terms in attribute [%s]..." % attribute)
+        postings_by_term = session_context.data_proxy.fetch_tfidf_postings(attribute, list(tfidf_by_term))
+        product_ids = set()
+        for postings in postings_by_term.values():
+            product_ids |= postings.keys()
+        product_ids.add(product_id)
+
+        new_product_models = session_context.data_proxy.fetch_product_models(
+            product_ids=list(product_ids), min_date=cutoff_date, max_date=session_context.get_present_date())
         product_models.update(new_product_models)
 
-        if len(new_product_models) > 1:  # we require at least one product model other than that of the current product
-            product_ids_list = [p_id for p_id in new_product_models]
+        if len(new_product_models) > 1 and product_id in new_product_models:
+            # we require at least one product model other than that of the current product
+            template_ids = [p_id for p_id in new_product_models if p_id != product_id]
 
-            log.info("Fetching TFIDF maps for attribute [%s] in [%d] products..." % (attribute, len(product_ids_list)))
-            tfidf_by_term_by_product = session_context.data_proxy.fetch_tfidf_map(attribute, product_ids_list)
+            log.info("Fetching TFIDF sums for attribute [%s] in [%d] products..." % (attribute, len(template_ids)))
+            sum_tfidf_by_product = session_context.data_proxy.fetch_tfidf_sums(attribute, template_ids)
 
             log.info("Computing strengths...")
-            _process_text_attribute_contributions(strengths, tfidf_by_term_by_product, weight, product_id)
+            _process_text_attribute_contributions_for_product(strengths, product_id, tfidf_by_term, postings_by_term,
+                                                              sum_tfidf_by_product, weight)
 
     # Processes the non-TEXT attributes.
     _process_non_text_attributes_contributions(session_context, product_models, strengths)
@@ -298,6 +341,177 @@ def _process_text_attribute_contributions(strengths, tfidf_map, weight=1, produc
         strengths[(product, template)] = new_strength
 
 
+@profile
+def _process_text_attribute_contributions_sparse(strengths, tfidf_map, weight=1, page_size=1000):
+    """ Adds the contribution of the terms in *tfidf_map* to the informed map of strengths, just like
+        _process_text_attribute_contributions() does for all pairs, but with sparse matrix operations.
+
+        The debt of a template w.r.t. the terms it misses adds up to 1 minus the sum of the normalized tfidf's
+        of the common terms in the product, so the contribution of the attribute boils down to a sum over the
+        common terms only: the sum of (tfidf_p / sum_p) * (1 - max(0, tfidf_p - tfidf_t)). These sums are obtained
+        one page of products at a time (see _generate_text_attribute_contributions_sparse()), by joining each
+        (product, term) entry of the page with the postings of the term, so memory usage is bounded by the page size.
+
+        :param strengths: A map {(product, template_product): strength_value} with partially computed strengths
+                       (possibly resulting from the contributions of other product attributes).
+        :param tfidf_map: A map {product: {term: tfidf}} containing the tfidf of the most relevant terms
+                       in each product.
+        :param weight: The weight of the contributions (as per the definition of PRODUCT_MODEL in the
+                       customer configuration).
+        :param page_size: The number of products (as base products of the pairs) processed at a time.
+    """
+    for page_contributions in _generate_text_attribute_contributions_sparse(tfidf_map, list(tfidf_map), page_size):
+        for product_and_template, contribution in page_contributions:
+            strengths[product_and_template] = strengths.get(product_and_template, 0) + contribution * weight
+
+
+def _generate_text_attribute_contributions_sparse(tfidf_map, products_list, page_size):
+    """ Generates the (unweighted) contributions of the terms in *tfidf_map* to the strengths of the product pairs,
+        one page of *products_list* at a time, as described in _process_text_attribute_contributions_sparse().
+
+        :param tfidf_map: A map {product: {term: tfidf}} containing the tfidf of the most relevant terms
+                       in each product.
+        :param products_list: The products to be paged through (as base products of the pairs). Products which
+                       are not in this list are disregarded. Pages of different attributes line up as long as the
+                       same list is informed.
+        :param page_size: The number of products (as base products of the pairs) processed at a time.
+
+        :returns: A generator of lists of ((product, template_product), contribution) tuples, one list per page.
+            The list of a page holds all pairs whose base products belong to that page.
+    """
+    term_idx_by_term = {}
+    rows, cols, values = [], [], []
+    for product_idx, product in enumerate(products_list):
+        for term, tfidf in tfidf_map.get(product, {}).items():
+            rows += [product_idx]
+            cols += [term_idx_by_term.setdefault(term, len(term_idx_by_term))]
+            values += [tfidf]
+
+    n_products = len(products_list)
+    n_terms = len(term_idx_by_term)
+    coordinates = (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))
+    tfidf_matrix = sparse.csr_matrix((np.array(values, dtype=np.float64), coordinates),
+                                     shape=(n_products, n_terms))
+    postings = tfidf_matrix.T.tocsr()
+    sum_tfidf_by_product = np.asarray(tfidf_matrix.sum(axis=1)).ravel()
+
+    log.info("Processing common terms (sparse)...")
+
+    for start_idx in range(0, n_products, page_size):
+        page = tfidf_matrix[start_idx:start_idx + page_size].tocoo()
+
+        # one row per (product, term) entry of the page, holding the tfidf's of that term in all products
+        term_selector = sparse.csr_matrix((np.ones(page.nnz), (np.arange(page.nnz), page.col)),
+                                          shape=(page.nnz, n_terms))
+        common_terms = (term_selector * postings).tocoo()
+
+        product_idx = page.row[common_terms.row] + start_idx
+        template_idx = common_terms.col
+        tfidf_in_product = page.data[common_terms.row]
+        tfidf_in_template = common_terms.data
+        contributions = tfidf_in_product / sum_tfidf_by_product[product_idx] * \
+            (1 - np.maximum(0., tfidf_in_product - tfidf_in_template))
+
+        # sums the contributions of the common terms of each pair (explicit zeros are kept, as pairs)
+        not_self = product_idx != template_idx
+        page_contributions = sparse.coo_matrix(
+            (contributions[not_self], (product_idx[not_self], template_idx[not_self])),
+            shape=(n_products, n_products)).tocsr().tocoo()
+
+        yield [((products_list[product], products_list[template]), contribution)
+               for product, template, contribution in zip(page_contributions.row.tolist(),
+                                                          page_contributions.col.tolist(),
+                                                          page_contributions.data.tolist())]
+
+        done = min(n_products, start_idx + page_size)
+        log.debug_progress(done, n_products, page_size)
+
+
+def _compute_top_strengths_sparse(session_context, product_models, product_ids_list, n_templates,
+                                  allowed_templates=None):
+    """ Computes the strengths among the informed products with the sparse engine, keeping only the strongest
+        templates of each product (see _select_top_strengths()).
+
+        The pages of base products of all TEXT attributes are walked in lockstep, so that the strengths of the pairs
+        of a page are complete (non-TEXT contributions included) once its last attribute has contributed. Each page
+        is then pruned right away, and only the selected pairs are accumulated.
+
+        :param session_context: The session context.
+        :param product_models: A map {product_id: ProductModel} with the intended products.
+        :param product_ids_list: The ids of the intended products (of a same language).
+        :param n_templates: The maximum number of templates per product.
+        :param allowed_templates: See _select_top_strengths().
+
+        :returns: A map {(product, template_product): strength_value} with the selected templates.
+    """
+    weights = []
+    pages_by_attribute = []
+    for attribute in session_context.product_text_fields:
+        weight = session_context.similarity_weights_by_type[pm.TEXT].get(attribute, 0)
+        if weight == 0:
+            continue
+
+        log.info("Fetching TFIDF maps for attribute [%s] in [%d] products..." % (attribute, len(product_ids_list)))
+        tfidf_by_term_by_product = session_context.data_proxy.fetch_tfidf_map(attribute, product_ids_list)
+        weights += [weight]
+        pages_by_attribute += [_generate_text_attribute_contributions_sparse(
+            tfidf_by_term_by_product, product_ids_list, session_context.page_size_product_product_tfidf)]
+
+    strengths = {}
+    for page_contributions_by_attribute in zip(*pages_by_attribute):
+        page_strengths = {}
+        for weight, page_contributions in zip(weights, page_contributions_by_attribute):
+            for product_and_template, contribution in page_contributions:
+                page_strengths[product_and_template] = page_strengths.get(product_and_template, 0) + \
+                    contribution * weight
+
+        _process_non_text_attributes_contributions(session_context, product_models, page_strengths)
+        strengths.update(_select_top_strengths(page_strengths, n_templates, allowed_templates))
+
+    return strengths
+
+
+def _process_text_attribute_contributions_for_product(strengths, product_id, tfidf_by_term, postings_by_term,
+                                                      sum_tfidf_by_product, weight=1):
+    """ Adds the contribution of the terms of a single product to the informed map of strengths, just like
+        _process_text_attribute_contributions() does for all pairs, but scoring only the pairs of that product
+        (in both directions) against the postings of its top terms.
+
+        As the debts w.r.t. missing terms add up to 1 minus the sum of the normalized tfidf's of the common terms,
+        the contribution to (product, template) is the sum over the common terms of
+        (tfidf_p / sum_p) * (1 - max(0, tfidf_p - tfidf_t)), and vice versa.
+
+        :param strengths: A map {(product, template_product): strength_value} with partially computed strengths
+                       (possibly resulting from the contributions of other product attributes).
+        :param product_id: The intended product.
+        :param tfidf_by_term: A map {term: tfidf} with the top terms of the intended product.
+        :param postings_by_term: A map {term: {product: tfidf}} with the products having each top term of the
+                       intended product as one of their own top terms.
+        :param sum_tfidf_by_product: A map {product: sum of tfidf's} with the sums of the tfidf's of the top terms
+                       of the candidate templates. Products which are not keys in this map are disregarded.
+        :param weight: The weight of the contributions (as per the definition of PRODUCT_MODEL in the
+                       customer configuration).
+    """
+    sum_tfidf_in_product = sum(tfidf_by_term.values())
+    contributions = {}
+
+    for term, tfidf_in_product in tfidf_by_term.items():
+        for template, tfidf_in_template in postings_by_term.get(term, {}).items():
+            if template == product_id or template not in sum_tfidf_by_product:
+                continue
+
+            contribution = tfidf_in_product / sum_tfidf_in_product * \
+                (1 - max(0., tfidf_in_product - tfidf_in_template))
+            contributions[(product_id, template)] = contributions.get((product_id, template), 0.) + contribution
+
+            contribution = tfidf_in_template / sum_tfidf_by_product[template] * \
+                (1 - max(0., tfidf_in_template - tfidf_in_product))
+            contributions[(template, product_id)] = contributions.get((template, product_id), 0.) + contribution
+
+    for product_and_template, contribution in contributions.items():
+        strengths[product_and_template] = strengths.get(product_and_template, 0) + contribution * weight
+
+
 def _process_non_text_attributes_contributions(context, products, strengths):
     """ Adds the contribution of the non-text product attributes to the informed map of strengths.
 
@@ -336,6 +550,36 @@ def _process_non_text_attributes_contributions(context, products, strengths):
                 strengths[(product_id, template_id)] += contribution * weight
 
 
+def _select_top_strengths(strengths, n_templates, allowed_templates=None):
+    """ Selects the strongest templates of each product, in the same order the consolidation of templates
+        would pick them (descending strength, then ascending template id).
+
+        :param strengths: A map {(product, template_product): strength_value}.
+        :param n_templates: The maximum number of templates per product.
+        :param allowed_templates: If not None, the strongest *allowed* templates of each product are kept as well,
+            so that the consolidation of templates (which disregards the other ones) is not affected.
+
+        :returns: A map {(product, template_product): strength_value} with the selected templates,
+            all of them with acceptable (non-zero) strengths.
+    """
+    strengths_by_template_by_product = {}
+    for (product, template), strength in strengths.items():
+        if strength >= MIN_ACCEPTABLE_PP_STRENGTH_TFIDF:
+            strengths_by_template_by_product.setdefault(product, {})[template] = strength
+
+    result = {}
+    for product, strength_by_template in strengths_by_template_by_product.items():
+        def sort_key(t):
+            return -strength_by_template[t], t
+        templates = heapq.nsmallest(n_templates, strength_by_template, key=sort_key)
+        if allowed_templates is not None:
+            templates += heapq.nsmallest(n_templates, (t for t in strength_by_template if t in allowed_templates),
+                                         key=sort_key)
+        for template in templates:
+            result[(product, template)] = strength_by_template[template]
+    return result
+
+
 def _partition_products_by_language(products):
     """ Partitions the given product models into language buckets of product id's.
 
@@ -371,7 +615,10 @@ def get_product_templates_tfidf(context, product_ids, blocked_products=None):
     if blocked_products is None:
         blocked_products = []
 
-    templates_map = context.data_proxy.fetch_product_templates(product_ids)
+    if context.user_context is not None:
+        templates_map = context.user_context.fetch_product_templates(product_ids)
+    else:
+        templates_map = context.data_proxy.fetch_product_templates(product_ids)
     for p_id, templates_tuple in templates_map.items():
         approved_templates = [t for t in templates_tuple[1] if t[1] not in blocked_products]
         result[p_id] = approved_templates
@@ -387,9 +634,17 @@ def get_product_templates_tfidf(context, product_ids, blocked_products=None):
 
     products_with_missing_product_models = all_products - product_models.keys()
     if len(products_with_missing_product_models) > 0 and context.filter_strategy == ctx.AFTER_SCORING:
-        product_models.update(context.data_proxy.fetch_product_models(list(products_with_missing_product_models)))
+        try:
+            product_models.update(context.data_proxy.fetch_product_models(
+                list(products_with_missing_product_models), max_time_ms=context.deadline.max_time_ms()))
+        except DeadlineExceeded as err:
+            log.warn("Deadline reached: skipped the near-identical filter of content-based templates ({0})".format(err))
+            return result
 
     if (context.near_identical_filter_field is not None) and (context.near_identical_filter_threshold is not None):
+        if context.deadline.expired():
+            log.warn("Deadline reached: skipped the near-identical filter of content-based templates")
+            return result
         for product_id, templates_with_strengths in result.items():
             templates = [t[1] for t in templates_with_strengths if t[1] in product_models]
             templates_to_disregard = pinpoint_near_identical_products(context, templates, product_models,
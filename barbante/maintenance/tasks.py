@@ -195,7 +195,7 @@ def process_product(session_context, product_id, product=None, force_update=Fals
     session_context.clear_context_filters_cache()
 
 
-def process_products(session_context, days=None, resume=False):
+def process_products(session_context, days=None, resume=False, use_processes=False):
     if resume:
         # registers the start of the operation and the cutoff_date
         timestamp = session_context.get_present_date()
@@ -226,7 +226,7 @@ def process_products(session_context, days=None, resume=False):
         log.info("Done.")
 
     else:
-        prd.process_products_from_scratch(session_context, days)
+        prd.process_products_from_scratch(session_context, days, use_processes)
 
 
 def delete_product(session_context, product_id):
@@ -56,16 +56,7 @@ def consolidate_product_templates(session_context, products_list=None, collabora
 
     log.info("Performing consolidation of templates on %d products..." % total_products)
 
-    allowed_templates = None
-    if session_context.recommendable_product_start_date_field or \
-            session_context.recommendable_product_end_date_field:
-        allowed_templates = session_context.data_proxy.fetch_date_filtered_products(
-            reference_date=session_context.get_present_date(),
-            lte_date_field=session_context.recommendable_product_start_date_field,
-            gte_date_field=session_context.recommendable_product_end_date_field)
-        log.info("(%d templates are allowed, based on due dates)" % len(allowed_templates))
-    else:
-        log.info("(no restrictions will be applied to templates)")
+    allowed_templates = fetch_allowed_templates(session_context)
 
     # shuffles the list to balance the workers
     shuffle(products_list)
@@ -90,6 +81,25 @@ def consolidate_product_templates(session_context, products_list=None, collabora
             log.info("Processed [%d] pages out of %d" % (pages_processed, n_pages))
 
 
+def fetch_allowed_templates(session_context):
+    """ Retrieves the products which are allowed as product templates, based on their due dates.
+
+        :param session_context: The session context.
+
+        :returns: A list of product ids, or None if no restrictions apply.
+    """
+    if session_context.recommendable_product_start_date_field or \
+            session_context.recommendable_product_end_date_field:
+        allowed_templates = session_context.data_proxy.fetch_date_filtered_products(
+            reference_date=session_context.get_present_date(),
+            lte_date_field=session_context.recommendable_product_start_date_field,
+            gte_date_field=session_context.recommendable_product_end_date_field)
+        log.info("(%d templates are allowed, based on due dates)" % len(allowed_templates))
+        return allowed_templates
+    log.info("(no restrictions will be applied to templates)")
+    return None
+
+
 def __gather_user_templates(context, page, users_list, page_sizes, flush_size):
     templates_map = {}
     context = context.new_session()
@@ -7,6 +7,8 @@ import datetime as dt
 import barbante.maintenance.tasks as maintenance
 from barbante.maintenance.tests.fixtures.MaintenanceFixture import MaintenanceFixture
 import barbante.tests as tests
+from barbante.utils.cache import Cache
+from barbante.utils.tests.test_cache import _CacheSettings, _FakeMemcacheClient
 
 
 class TestProduct(MaintenanceFixture):
@@ -74,6 +76,72 @@ class TestProduct(MaintenanceFixture):
         tfidf_by_term = self.db_proxy.fetch_tfidf_map(self.text_field, ["p_mus_4"]).get("p_mus_4", {})
         nose.tools.ok_(abs(tfidf_by_term.get("músic") - 1) < tests.FLOAT_DELTA)
 
+    def test_process_products_in_worker_processes(self):
+        """ Tests whether processing all products in worker processes yields the same TF's, DF's and TFIDF's.
+        """
+        product = "p_mus_4"
+        tf_map = self.db_proxy.fetch_tf_map(self.text_field, [product]).get(product)
+        tfidf_map = self.db_proxy.fetch_tfidf_map(self.text_field, [product]).get(product)
+
+        maintenance.process_products(self.session_context, use_processes=True)
+
+        nose.tools.eq_(self.db_proxy.fetch_tf_map(self.text_field, [product]).get(product), tf_map, "Wrong TF's")
+        nose.tools.eq_(self.db_proxy.find_df("portuguese", "rock"), 4, "Wrong DF")
+        tfidf_by_term = self.db_proxy.fetch_tfidf_map(self.text_field, [product]).get(product)
+        nose.tools.eq_(tfidf_by_term.keys(), tfidf_map.keys(), "Wrong top terms")
+        for term, tfidf in tfidf_map.items():
+            nose.tools.ok_(abs(tfidf_by_term[term] - tfidf) < tests.FLOAT_DELTA, "Wrong TFIDF of [%s]" % term)
+
+    def test_process_products_skips_offending_texts(self):
+        """ Tests that a product whose text cannot be stemmized is skipped, without affecting the other products
+            of its page.
+        """
+        self.db_proxy.update_product("p_mus_4", self.text_field, 12345)  # not a text
+
+        maintenance.process_products(self.session_context)
+
+        tf_map = self.db_proxy.fetch_tf_map(self.text_field, ["p_aut_1"]).get("p_aut_1")
+        nose.tools.eq_(tf_map["civic"], 2, "The other products should have been processed")
+        nose.tools.ok_(not self.db_proxy.fetch_tf_map(self.text_field, ["p_mus_4"]).get("p_mus_4"),
+                       "The offending product should have been skipped")
+
+    def test_product_models_cache(self):
+        """ Tests that product models are served from the process-wide cache until the product is deleted.
+        """
+        session = tests.init_session()
+        product = "p_mus_4"
+        hits = session.product_models_cache.hits
+
+        nose.tools.ok_(product in session.get_product_models([product]), "Product model should have been fetched")
+        nose.tools.ok_(product in session.get_product_models([product]), "Product model should have been cached")
+        nose.tools.eq_(session.product_models_cache.hits, hits + 1, "The second fetch should hit the cache")
+
+        maintenance.delete_product(session, product)
+        nose.tools.eq_(session.get_product_models([product]), {}, "Product model should have been invalidated")
+
+    def test_product_models_cache_across_processes(self):
+        """ Tests that product models invalidated by one process are evicted from the caches of the other processes
+            sharing the same memcache servers.
+        """
+        memcached = _FakeMemcacheClient()
+        sessions = []
+        for _ in range(2):  # one session per process, each with its own caches
+            context_filters_cache = Cache(_CacheSettings(), "context_filters")
+            context_filters_cache.memcached = memcached
+            sessions.append(tests.init_session(custom_settings={'context_filters_cache': context_filters_cache}))
+        session1, session2 = sessions
+        product = "p_mus_4"
+
+        session2.get_product_models([product])
+        hits = session2.product_models_cache.hits
+        session2.get_product_models([product])
+        nose.tools.eq_(session2.product_models_cache.hits, hits + 1, "The second fetch should hit the cache")
+
+        session1.invalidate_product_models([product])
+        session2.context_filters_cache._generation_checked_at = 0  # forces session2 to re-read the generation
+        nose.tools.ok_(product in session2.get_product_models([product]), "Product model should have been fetched")
+        nose.tools.eq_(session2.product_models_cache.hits, hits + 1, "Product model should have been invalidated")
+
     def test_missing_required_field_shouldnt_return_when_defined(self):
         required_fields = self.session_context.product_model_factory.get_custom_required_attributes()
         product_id = "p_mus_U"
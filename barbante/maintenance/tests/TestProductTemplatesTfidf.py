@@ -4,6 +4,7 @@
 import nose.tools
 import datetime as dt
 
+import barbante.context as ctx
 import barbante.maintenance.product_templates_tfidf as pttfidf
 import barbante.maintenance.tasks as maintenance
 from barbante.maintenance.tests.fixtures.MaintenanceFixture import MaintenanceFixture
@@ -182,6 +183,98 @@ class TestProductTemplatesTfidf(MaintenanceFixture):
         for product in all_products:
             compare_templates(product)
 
+    def test_product_product_strengths_tfidf_sparse_engine(self):
+        """ Tests whether the sparse engine yields the same product x product strengths (TFIDF)
+            as the default engine.
+        """
+        strengths_default = self.db_proxy.fetch_product_product_strengths_tfidf()
+
+        session_context = tests.init_session({"strengths_engine": ctx.SPARSE_ENGINE})
+        pttfidf.generate_strengths(session_context)
+        strengths_sparse = self.db_proxy.fetch_product_product_strengths_tfidf()
+
+        nose.tools.eq_(set(strengths_sparse), set(strengths_default), "Product pairs do not match")
+        for product_pair, strength in strengths_default.items():
+            nose.tools.ok_(abs(strengths_sparse[product_pair] - strength) < tests.FLOAT_DELTA,
+                           "Strengths do not match for product pair (%s, %s): " % product_pair +
+                           "[default --> %.6f] [sparse --> %.6f]" % (strength, strengths_sparse[product_pair]))
+
+    def test_product_product_strengths_tfidf_pruned(self):
+        """ Tests whether only the top product x product strengths (TFIDF) of each product are kept
+            when pruning is enabled, and whether the consolidated templates remain the same.
+        """
+        session_context = tests.init_session({"product_templates_count": 2})
+        n_templates = 3 * session_context.product_templates_count
+        pttfidf.generate_templates(session_context)
+        all_products = list(self.db_proxy.fetch_all_product_ids())
+        strengths_all = self.db_proxy.fetch_product_product_strengths_tfidf()
+        templates_all = self.db_proxy.fetch_product_templates(all_products)
+
+        session_context = tests.init_session({"product_templates_count": 2,
+                                              "prune_product_product_strengths_tfidf": True})
+        pttfidf.generate_templates(session_context)
+        strengths_pruned = self.db_proxy.fetch_product_product_strengths_tfidf()
+        templates_pruned = self.db_proxy.fetch_product_templates(all_products)
+
+        nose.tools.ok_(len(strengths_pruned) < len(strengths_all), "No strengths were pruned")
+        for product_pair, strength in strengths_pruned.items():
+            nose.tools.ok_(abs(strengths_all[product_pair] - strength) < tests.FLOAT_DELTA,
+                           "Wrong strength for product pair (%s, %s)" % product_pair)
+        for product in all_products:
+            top_templates = sorted([(-strength, pair[1]) for pair, strength in strengths_all.items()
+                                    if pair[0] == product])[:n_templates]
+            for _, template in top_templates:
+                nose.tools.ok_((product, template) in strengths_pruned,
+                               "Top template %s of product %s was pruned" % (template, product))
+            nose.tools.eq_(templates_pruned.get(product, (None, []))[1], templates_all.get(product, (None, []))[1],
+                           "Templates do not match for product %s" % product)
+
+    def test_product_product_strengths_tfidf_pruned_sparse_engine(self):
+        """ Tests whether pruning the strengths of each page of products with the sparse engine keeps the same
+            product x product strengths (TFIDF) as pruning them all at once with the default engine.
+        """
+        session_context = tests.init_session({"product_templates_count": 2,
+                                              "prune_product_product_strengths_tfidf": True})
+        pttfidf.generate_templates(session_context)
+        strengths_default = self.db_proxy.fetch_product_product_strengths_tfidf()
+
+        session_context = tests.init_session({"product_templates_count": 2,
+                                              "prune_product_product_strengths_tfidf": True,
+                                              "strengths_engine": ctx.SPARSE_ENGINE,
+                                              "page_size_product_product_tfidf": 3})
+        pttfidf.generate_templates(session_context)
+        strengths_sparse = self.db_proxy.fetch_product_product_strengths_tfidf()
+
+        nose.tools.eq_(set(strengths_sparse), set(strengths_default), "Product pairs do not match")
+        for product_pair, strength in strengths_default.items():
+            nose.tools.ok_(abs(strengths_sparse[product_pair] - strength) < tests.FLOAT_DELTA,
+                           "Strengths do not match for product pair (%s, %s)" % product_pair)
+
+    def test_text_attribute_contributions_for_product(self):
+        """ Tests whether scoring a single product against the postings of its top terms yields the same
+            strengths as processing all product pairs.
+        """
+        attribute = "full_content"
+        product_id = "p_mus_2"
+        all_products = list(self.db_proxy.fetch_all_product_ids())
+        tfidf_map = self.db_proxy.fetch_tfidf_map(attribute, all_products)
+
+        strengths_all_pairs = {}
+        pttfidf._process_text_attribute_contributions(strengths_all_pairs, tfidf_map, 0.5, product_id)
+
+        tfidf_by_term = tfidf_map[product_id]
+        postings_by_term = self.db_proxy.fetch_tfidf_postings(attribute, list(tfidf_by_term))
+        sum_tfidf_by_product = self.db_proxy.fetch_tfidf_sums(attribute, all_products)
+        strengths = {}
+        pttfidf._process_text_attribute_contributions_for_product(strengths, product_id, tfidf_by_term,
+                                                                  postings_by_term, sum_tfidf_by_product, 0.5)
+
+        nose.tools.ok_(len(strengths) > 0, "No strengths were computed")
+        nose.tools.eq_(set(strengths), set(strengths_all_pairs), "Product pairs do not match")
+        for product_pair, strength in strengths_all_pairs.items():
+            nose.tools.ok_(abs(strengths[product_pair] - strength) < tests.FLOAT_DELTA,
+                           "Strengths do not match for product pair (%s, %s)" % product_pair)
+
     def test_multi_attribute_similarity(self):
         """ Tests whether the product-product similarities respect the customer-defined weights and filters.
 
@@ -42,3 +42,10 @@ class TestProductTemplatesWithImpressionsFromEmptyDatabase(ProductTemplatesFixtu
         # With no previous impressions, no templates will be generated in this test --- let's skip it.
         pass
 
+    def test_product_product_strengths_from_activity_snapshot(self):
+        # With no previous impressions, no templates will be generated in this test --- let's skip it.
+        pass
+
+    def test_product_product_strengths_from_activity_snapshot_with_later_activities(self):
+        # With no previous impressions, no templates will be generated in this test --- let's skip it.
+        pass
@@ -41,3 +41,11 @@ class TestUserTemplatesWithImpressionsFromEmptyDatabase(UserTemplatesFixture):
     def test_user_user_strengths_incremental_random(self):
         # With no previous impressions, no templates will be generated in this test --- let's skip it.
         pass
+
+    def test_user_user_strengths_from_activity_snapshot(self):
+        # With no previous impressions, no templates will be generated in this test --- let's skip it.
+        pass
+
+    def test_user_user_strengths_from_activity_snapshot_with_later_activities(self):
+        # With no previous impressions, no templates will be generated in this test --- let's skip it.
+        pass
@@ -6,8 +6,10 @@ import pytz
 import datetime as dt
 import dateutil.parser
 import random
+import tempfile
 
 import barbante.config as config
+from barbante.maintenance.activity_snapshot import ActivitySnapshot
 import barbante.maintenance.product_templates as pt
 from barbante.maintenance.tests.fixtures.MaintenanceFixture import MaintenanceFixture
 import barbante.maintenance.tasks as tasks
@@ -305,10 +307,110 @@ class ProductTemplatesFixture(MaintenanceFixture):
 
             self.compare_incremental_vs_from_scratch()
 
+    def test_product_product_strengths_sparse_engine(self):
+        """ Tests whether the sparse engine yields the same product templates as the default engine.
+        """
+        products = list(self.db_proxy.fetch_all_product_ids())
+        strengths_upsert = self.db_proxy.fetch_product_product_strengths()
+        templates_upsert = self.db_proxy.fetch_product_templates(products)
+
+        pt.generate_strengths_sparse(self.session_context)
+        strengths_sparse = self.db_proxy.fetch_product_product_strengths()
+        templates_sparse = self.db_proxy.fetch_product_templates(products)
+
+        nose.tools.ok_(len(strengths_sparse) > 0, "No strengths were generated")
+        for product_pair, strength in strengths_sparse.items():
+            nose.tools.ok_(abs(strength - strengths_upsert.get(product_pair, 0)) < 0.00001,
+                           "Strengths do not match for " + str(product_pair) + ": " +
+                           "[upsert --> %.6f] [sparse --> %.6f]"
+                           % (strengths_upsert.get(product_pair, 0), strength))
+        for product in products:
+            nose.tools.eq_(templates_sparse.get(product, ([], []))[0], templates_upsert.get(product, ([], []))[0],
+                           "Templates do not match for " + product)
+
+    def test_product_product_strengths_incremental_after_sparse_engine(self):
+        """ Tests whether the product x product strengths updated on a step-by-step basis, starting off
+            the strengths generated by the sparse engine, match exactly those created from scratch.
+            Few templates are consolidated, so that most strengths are not published as templates.
+        """
+        session_context = tests.init_session(dict(self.custom_settings or {}, product_templates_count=1))
+        pt.generate_strengths_sparse(session_context)
+
+        for user, product, rating in [("u_eco_1", "p_mus_1", 5), ("u_eco_2", "p_eco_1", 2), ("u_tec_1", "p_eco_2", 5)]:
+            activity = {"external_user_id": user,
+                        "external_product_id": product,
+                        "activity": session_context.activities_by_rating[rating][0],
+                        "created_at": session_context.get_present_date()}
+            pt.update_templates(session_context, activity)
+            tasks.update_summaries(session_context, activity)
+
+        self.compare_incremental_vs_from_scratch(session_context)
+
+    def test_product_product_strengths_from_activity_snapshot(self):
+        """ Tests whether the sparse engine yields the same product templates when reading the activities
+            from a snapshot instead of the database.
+        """
+        products = list(self.db_proxy.fetch_all_product_ids())
+        pt.generate_strengths_sparse(self.session_context)
+        strengths_database = self.db_proxy.fetch_product_product_strengths()
+        templates_database = self.db_proxy.fetch_product_templates(products)
+
+        cutoff_date = self.session_context.get_present_date() - dt.timedelta(
+            self.session_context.product_product_strengths_window)
+        snapshot = ActivitySnapshot.export(self.session_context, tempfile.mkdtemp(), cutoff_date)
+        pt.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_snapshot = self.db_proxy.fetch_product_product_strengths()
+        templates_snapshot = self.db_proxy.fetch_product_templates(products)
+
+        nose.tools.ok_(len(strengths_snapshot) > 0, "No strengths were generated")
+        nose.tools.eq_(set(strengths_snapshot), set(strengths_database), "The pairs of products do not match")
+        for product_pair, strength in strengths_snapshot.items():
+            nose.tools.ok_(abs(strength - strengths_database[product_pair]) < 0.00001,
+                           "Strengths do not match for " + str(product_pair) + ": " +
+                           "[database --> %.6f] [snapshot --> %.6f]" % (strengths_database[product_pair], strength))
+        for product in products:
+            nose.tools.eq_(templates_snapshot.get(product, ([], []))[0], templates_database.get(product, ([], []))[0],
+                           "Templates do not match for " + product)
+
+    def test_product_product_strengths_from_activity_snapshot_with_later_activities(self):
+        """ Tests whether the sparse engine accounts for the activities saved after the export of the snapshot
+            it reads (just like those saved before), since all of them are recorded as processed.
+        """
+        cutoff_date = self.session_context.get_present_date() - dt.timedelta(
+            self.session_context.product_product_strengths_window)
+        snapshot = ActivitySnapshot.export(self.session_context, tempfile.mkdtemp(), cutoff_date)
+        pt.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_before = self.db_proxy.fetch_product_product_strengths()
+
+        activity = {"external_user_id": "u_eco_1",
+                    "external_product_id": "p_esp_1",
+                    "activity": "buy",
+                    "created_at": self.session_context.get_present_date()}
+        tasks.update_summaries(self.session_context, activity)
+
+        pt.generate_strengths_sparse(self.session_context)
+        strengths_database = self.db_proxy.fetch_product_product_strengths()
+        nose.tools.ok_(strengths_database != strengths_before, "The new activity should have changed the strengths")
+
+        pt.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_snapshot = self.db_proxy.fetch_product_product_strengths()
+
+        nose.tools.eq_(set(strengths_snapshot), set(strengths_database), "The pairs of products do not match")
+        for product_pair, strength in strengths_snapshot.items():
+            nose.tools.ok_(abs(strength - strengths_database[product_pair]) < 0.00001,
+                           "Strengths do not match for " + str(product_pair) + ": " +
+                           "[database --> %.6f] [snapshot --> %.6f]" % (strengths_database[product_pair], strength))
+
     @nose.tools.nottest
-    def compare_incremental_vs_from_scratch(self):
+    def compare_incremental_vs_from_scratch(self, session_context=None):
         """ Helper method to compare strengths generated incrementally vs from-scratch.
+
+            :param session_context: The session context used to regenerate the strengths from scratch.
+                If None, the session context of the fixture is used.
         """
+        if session_context is None:
+            session_context = self.session_context
+
         def compare_strengths(incremental, from_scratch, pair_of_products):
             strength1 = incremental[pair_of_products]
             strength2 = from_scratch[pair_of_products]
@@ -332,7 +434,7 @@ class ProductTemplatesFixture(MaintenanceFixture):
         templates_incremental = self.db_proxy.fetch_product_templates(products)
 
         # regenerates all strengths from scratch
-        pt.generate_templates(self.session_context)
+        pt.generate_templates(session_context)
 
         # saves locally the strengths obtained from scratch
         strengths_from_scratch = self.db_proxy.fetch_product_product_strengths()
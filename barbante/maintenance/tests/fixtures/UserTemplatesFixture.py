@@ -6,8 +6,10 @@ import pytz
 import dateutil.parser
 import datetime as dt
 import random
+import tempfile
 
 import barbante.config as config
+from barbante.maintenance.activity_snapshot import ActivitySnapshot
 from barbante.maintenance.tests.fixtures.MaintenanceFixture import MaintenanceFixture
 import barbante.maintenance.user_templates as ut
 import barbante.maintenance.tasks as tasks
@@ -318,6 +320,70 @@ class UserTemplatesFixture(MaintenanceFixture):
             self.compare_incremental_vs_from_scratch(
                 target_users=[user] if self.session_context.impressions_enabled else None)
 
+    def test_user_user_strengths_sparse_engine(self):
+        """ Tests whether the sparse engine yields the same user-user strengths as the default engine.
+        """
+        strengths_upsert = self.db_proxy.fetch_user_user_strengths()
+
+        ut.generate_strengths_sparse(self.session_context)
+        strengths_sparse = self.db_proxy.fetch_user_user_strengths()
+
+        for user_pair in set(strengths_upsert) | set(strengths_sparse):
+            strength1 = strengths_upsert.get(user_pair, 0)
+            strength2 = strengths_sparse.get(user_pair, 0)
+            nose.tools.ok_(abs(strength1 - strength2) < 0.00001,
+                           "Strengths do not match for " + str(user_pair) + ": " +
+                           "[upsert --> %.6f] [sparse --> %.6f]" % (strength1, strength2))
+
+    def test_user_user_strengths_from_activity_snapshot(self):
+        """ Tests whether the sparse engine yields the same user-user strengths when reading the activities
+            from a snapshot instead of the database.
+        """
+        ut.generate_strengths_sparse(self.session_context)
+        strengths_database = self.db_proxy.fetch_user_user_strengths()
+
+        cutoff_date = self.session_context.get_present_date() - dt.timedelta(
+            self.session_context.user_user_strengths_window)
+        snapshot = ActivitySnapshot.export(self.session_context, tempfile.mkdtemp(), cutoff_date)
+        ut.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_snapshot = self.db_proxy.fetch_user_user_strengths()
+
+        nose.tools.ok_(len(strengths_snapshot) > 0, "No strengths were generated")
+        nose.tools.eq_(set(strengths_snapshot), set(strengths_database), "The pairs of users do not match")
+        for user_pair, strength in strengths_snapshot.items():
+            nose.tools.ok_(abs(strength - strengths_database[user_pair]) < 0.00001,
+                           "Strengths do not match for " + str(user_pair) + ": " +
+                           "[database --> %.6f] [snapshot --> %.6f]" % (strengths_database[user_pair], strength))
+
+    def test_user_user_strengths_from_activity_snapshot_with_later_activities(self):
+        """ Tests whether the sparse engine accounts for the activities saved after the export of the snapshot
+            it reads (just like those saved before), since all of them are recorded as processed.
+        """
+        cutoff_date = self.session_context.get_present_date() - dt.timedelta(
+            self.session_context.user_user_strengths_window)
+        snapshot = ActivitySnapshot.export(self.session_context, tempfile.mkdtemp(), cutoff_date)
+        ut.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_before = self.db_proxy.fetch_user_user_strengths()
+
+        activity = {"external_user_id": "u_eco_1",
+                    "external_product_id": "p_esp_1",
+                    "activity": "buy",
+                    "created_at": self.session_context.get_present_date()}
+        tasks.update_summaries(self.session_context, activity)
+
+        ut.generate_strengths_sparse(self.session_context)
+        strengths_database = self.db_proxy.fetch_user_user_strengths()
+        nose.tools.ok_(strengths_database != strengths_before, "The new activity should have changed the strengths")
+
+        ut.generate_strengths_sparse(self.session_context, snapshot)
+        strengths_snapshot = self.db_proxy.fetch_user_user_strengths()
+
+        nose.tools.eq_(set(strengths_snapshot), set(strengths_database), "The pairs of users do not match")
+        for user_pair, strength in strengths_snapshot.items():
+            nose.tools.ok_(abs(strength - strengths_database[user_pair]) < 0.00001,
+                           "Strengths do not match for " + str(user_pair) + ": " +
+                           "[database --> %.6f] [snapshot --> %.6f]" % (strengths_database[user_pair], strength))
+
     @nose.tools.nottest
     def compare_incremental_vs_from_scratch(self, target_users=None):
         """ Helper method to compare strengths generated incrementally vs from-scratch.
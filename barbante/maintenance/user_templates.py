@@ -3,8 +3,14 @@ import datetime as dt
 from random import shuffle
 from time import time
 
+import numpy as np
+import scipy.sparse as sparse
+
 import barbante.config as config
+import barbante.context
+import barbante.utils.matrices as matrices
 from barbante.maintenance.template_consolidation import consolidate_user_templates
+from barbante.utils.id_dictionary import IdDictionary
 from barbante.utils.profiling import profile
 from barbante.context.context_manager import wrap
 import barbante.utils.logging as barbante_logging
@@ -18,8 +24,19 @@ AGGRESSIVE = 1
 MIN_ACCEPTABLE_UU_STRENGTH = 0.0001
 
 
-def generate_templates(session_context):
-    generate_strengths(session_context)
+def generate_templates(session_context, snapshot=None):
+    """ Computes user x user strengths (from scratch) with the configured engine and consolidates the templates.
+
+        :param session_context: The session context.
+        :param snapshot: An optional barbante.maintenance.activity_snapshot.ActivitySnapshot to read the activities
+            from (supported by the sparse engine only).
+    """
+    if session_context.strengths_engine == barbante.context.SPARSE_ENGINE:
+        generate_strengths_sparse(session_context, snapshot)
+    else:
+        if snapshot is not None:
+            log.warn("Activity snapshots are only supported by the sparse engine; reading activities from the database")
+        generate_strengths(session_context)
     consolidate_user_templates(session_context)
 
 @profile
@@ -45,7 +62,10 @@ def generate_strengths(session_context):
     # shuffles the list to balance the workers
     shuffle(products_list)
 
-    # auxiliary in-memory maps (probably ok, linear-size in the overall number of recommendable activities)
+    # auxiliary in-memory maps (probably ok, linear-size in the overall number of recommendable activities),
+    # keyed by interned ids; external ids are only used when reading from and writing to the database
+    user_ids = IdDictionary()
+    product_ids = IdDictionary()
     target_users = set()
     products_by_template_user = {}
     products_by_template_user_size = 0  # let's monitor the number of products closely, just in case
@@ -59,7 +79,7 @@ def generate_strengths(session_context):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_page = {
             executor.submit(wrap(__compute_strength_numerators), session_context,
-                            page, products_list, session_context.flush_size / max_workers): page
+                            page, products_list, user_ids, product_ids, session_context.flush_size / max_workers): page
             for page in range(n_pages)}
         for future in concurrent.futures.as_completed(future_to_page):
             products_by_template_user_partial, target_users_partial = future.result()
@@ -77,6 +97,7 @@ def generate_strengths(session_context):
             log.info("In-memory products_by_template_user map size = %d users, %d products"
                      % (len(products_by_template_user), products_by_template_user_size))
 
+    session_context.data_proxy.flush_bulk_writes()  # the denominators phase reads the numerators back
     log.info("All numerators saved")
 
     del products_list
@@ -91,7 +112,7 @@ def generate_strengths(session_context):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_page = {
             executor.submit(wrap(__compute_denominators_and_strengths), session_context, page,
-                            target_users_list, products_by_template_user,
+                            target_users_list, products_by_template_user, user_ids, product_ids,
                             session_context.flush_size / max_workers): page
             for page in range(n_pages)}
 
@@ -105,6 +126,116 @@ def generate_strengths(session_context):
     log.info("Persisting data about activities considered in this batch...")
     session_context.data_proxy.copy_all_latest_activities_for_user_user_strengths(cutoff_date)
 
+    session_context.data_proxy.flush_bulk_writes()
+    session_context.data_proxy.hotswap_uu_strengths()
+
+    session_context.data_proxy.save_timestamp_user_user_strengths(
+        timestamp, cutoff_date, time() - real_time_start)
+
+    log.info("User-user strengths generated successfully")
+
+
+@profile
+def generate_strengths_sparse(session_context, snapshot=None):
+    """ Computes user x user strengths (from scratch) based on their past activities, just like generate_strengths(),
+        but without round-tripping numerator increments through the database.
+
+        The whole activity window is loaded once into sparse user x product matrices, and numerators are obtained
+        with sparse matrix products, one page of target users at a time. Only the final strengths are written.
+
+        :param session_context: The session context.
+        :param snapshot: An optional barbante.maintenance.activity_snapshot.ActivitySnapshot covering the u-u strengths
+            window. If informed, the activities are read from it rather than from the database.
+    """
+    # drops the collections and recreates the necessary indexes
+    session_context.data_proxy.reset_user_user_strength_auxiliary_data()
+
+    # registers the start of the operation and the cutoff date
+    timestamp = session_context.get_present_date()
+    cutoff_date = timestamp - dt.timedelta(session_context.user_user_strengths_window)
+    real_time_start = time()
+
+    products_list = [p for p in session_context.data_proxy.fetch_all_product_ids(
+        allow_deleted=True, min_date=session_context.long_term_cutoff_date,
+        max_date=session_context.get_present_date())]
+
+    users_list, ratings = _load_rating_matrix(session_context, products_list, cutoff_date, snapshot)
+    log.info("Loaded [%d] (implicit) ratings of [%d] users on [%d] products" %
+             (ratings.nnz, len(users_list), len(products_list)))
+
+    # targets: conservatively high ratings (counted as aggressive as well when also aggressively high)
+    conservative = matrices.threshold_mask(ratings, session_context.min_rating_conservative)
+    aggressive = conservative.multiply(
+        matrices.threshold_mask(ratings, session_context.min_rating_aggressive)).tocsr()
+    # templates: ratings sufficiently high for recommendation
+    templates_transposed = matrices.threshold_mask(
+        ratings, session_context.min_rating_recommendable_from_user).T.tocsc()
+
+    if session_context.impressions_enabled:
+        impressions = matrices.load_impressions_matrix(session_context.data_proxy, users_list, products_list,
+                                                       session_context.page_size_user_user_denominators)
+        conservative = conservative.multiply(impressions).tocsr()
+        aggressive = aggressive.multiply(impressions).tocsr()
+        products_count_by_template = None
+    else:
+        impressions = None
+        products_count_by_template = np.asarray(templates_transposed.sum(axis=0)).ravel()
+
+    page_size = session_context.page_size_user_user_denominators
+    n_pages = len(users_list) // page_size + 1
+    strengths_map = {}
+
+    for page in range(n_pages):
+        start_idx = page * page_size
+        end_idx = min((page + 1) * page_size, len(users_list))
+        if start_idx >= end_idx:
+            break
+
+        numerators_conservative = (conservative[start_idx:end_idx] * templates_transposed).tocoo()
+        target_idx = numerators_conservative.row + start_idx
+        template_idx = numerators_conservative.col
+        not_self = target_idx != template_idx
+        rows = numerators_conservative.row[not_self]
+        target_idx = target_idx[not_self]
+        template_idx = template_idx[not_self]
+        nc = numerators_conservative.data[not_self]
+
+        na = matrices.values_at(aggressive[start_idx:end_idx] * templates_transposed, rows, template_idx)
+        if impressions is not None:
+            # only the products of the template user with impressions for the target user are accounted for
+            denominators = matrices.values_at(impressions[start_idx:end_idx] * templates_transposed,
+                                              rows, template_idx)
+        else:
+            denominators = products_count_by_template[template_idx]
+
+        strengths = _compute_strength_values(session_context, nc, na, denominators)
+
+        for target, template, nc_value, na_value, denominator, strength in zip(
+                target_idx.tolist(), template_idx.tolist(), nc.tolist(), na.tolist(),
+                denominators.tolist(), strengths.tolist()):
+            target_user = users_list[target]
+            template_user = users_list[template]
+            strengths_map[(target_user, template_user)] = {"user": target_user,
+                                                           "template_user": template_user,
+                                                           "nc": int(nc_value),
+                                                           "na": int(na_value),
+                                                           "denominator": int(denominator),
+                                                           "strength": strength}
+            if len(strengths_map) >= session_context.flush_size:
+                _flush_strengths(session_context, strengths_map)
+
+        log.info("Processed [{0}] pages out of [{1}] during u-u strengths generation (sparse)".format(
+            page + 1, n_pages))
+
+    if len(strengths_map) > 0:
+        _flush_strengths(session_context, strengths_map)
+
+    # Finalizes batch write.
+
+    log.info("Persisting data about activities considered in this batch...")
+    session_context.data_proxy.copy_all_latest_activities_for_user_user_strengths(cutoff_date)
+
+    session_context.data_proxy.flush_bulk_writes()
     session_context.data_proxy.hotswap_uu_strengths()
 
     session_context.data_proxy.save_timestamp_user_user_strengths(
@@ -113,6 +244,59 @@ def generate_strengths(session_context):
     log.info("User-user strengths generated successfully")
 
 
+def _load_rating_matrix(session_context, products_list, cutoff_date, snapshot=None):
+    """ Loads the (implicit) ratings of all non-anonymous users on the given products into a sparse matrix.
+
+        :param snapshot: If not None, the ratings are read from this ActivitySnapshot (caught up with the summaries
+            written since its export) rather than by paging through the database.
+
+        :returns: A tuple (list of user ids, CSR matrix with one row per user and one column per product,
+            in the order of *products_list*, whose values are the ratings of the latest activities).
+    """
+    if snapshot is not None:
+        users_list, _, ratings = snapshot.catch_up(session_context).rating_matrix(cutoff_date,
+                                                                                  products_list=products_list)
+        return users_list, ratings
+
+    users = IdDictionary()
+    rows, cols, values = [], [], []
+    page_size = session_context.page_size_user_user_numerators
+
+    for start_idx in range(0, len(products_list), page_size):
+        page_product_ids = products_list[start_idx:start_idx + page_size]
+        users_by_rating_by_product = session_context.data_proxy.fetch_users_by_rating_by_product(
+            product_ids=page_product_ids,
+            min_date=cutoff_date,
+            max_date=session_context.get_present_date())[0]
+        for product_offset, product in enumerate(page_product_ids):
+            for rating, users_with_rating in users_by_rating_by_product.get(product, {}).items():
+                for user in users_with_rating:
+                    rows += [users.intern(user)]
+                    cols += [start_idx + product_offset]
+                    values += [rating]
+
+    users_list = users.ids
+
+    ratings = sparse.csr_matrix((np.array(values, dtype=np.int8), (np.array(rows, dtype=np.int64),
+                                                                   np.array(cols, dtype=np.int64))),
+                                shape=(len(users_list), len(products_list)))
+    return users_list, ratings
+
+
+def _compute_strength_values(session_context, nc, na, denominators):
+    """ Vectorized version of _compute_strength_value(), which also zeroes the strengths of pairs
+        with null denominators or with too few common products.
+    """
+    nc = nc.astype(np.float64)
+    na = na.astype(np.float64)
+    safe_denominators = np.where(denominators == 0, 1, denominators)
+    result = (na * session_context.risk_factor + nc * (1 - session_context.risk_factor)) / safe_denominators
+    result[(result < MIN_ACCEPTABLE_UU_STRENGTH) |
+           (denominators == 0) |
+           (nc < session_context.min_user_user_strength_numerator)] = 0
+    return result
+
+
 @profile
 def update_templates(session_context, new_activity,
                      u_p_activities_summary=None, first_impression_date=None,
@@ -506,7 +690,14 @@ def _prepare_strengths_map(session_context, user, strengths_map,
         strengths_map[user_and_template]["template_user"] = user_and_template[1]
 
 
-def __compute_strength_numerators(context, page, products_list, flush_size):
+def __compute_strength_numerators(context, page, products_list, user_ids, product_ids, flush_size):
+    """ Saves the increments to the user-user strength numerators brought about by the activities on a page of products.
+
+        :param user_ids: The IdDictionary of the users (shared by all pages).
+        :param product_ids: The IdDictionary of the products (shared by all pages).
+
+        :returns: A tuple (map {interned template user: set of interned products}, set of interned target users).
+    """
     context = context.new_session()
     start_idx = page * context.page_size_user_user_numerators
     end_idx = min((page + 1) * context.page_size_user_user_numerators, len(products_list))
@@ -529,7 +720,10 @@ def __compute_strength_numerators(context, page, products_list, flush_size):
               page_products_count, context.user_user_strengths_window))
 
     log.info("[Page %d] Processing numerators..." % (page + 1))
-    for product, users_by_rating in users_by_rating_by_product.items():
+    for external_product, external_users_by_rating in users_by_rating_by_product.items():
+        product = product_ids.intern(external_product)
+        users_by_rating = {rating: set(user_ids.intern_many(users))
+                           for rating, users in external_users_by_rating.items()}
 
         target_users = set()
         for rating in range(context.min_rating_conservative, 6):
@@ -544,10 +738,10 @@ def __compute_strength_numerators(context, page, products_list, flush_size):
             # (the product might have been consumed by a user without a previous impression,
             #  and considering such users would bring about a serious bias)
             log.debug("[Page %d] Retrieving users with impressions..." % (page + 1))
-            target_users = context.data_proxy.fetch_users_with_impressions_by_product(
-                product_ids=[product],
-                user_ids=list(target_users),
-                anonymous=False).get(product, set())
+            target_users = set(user_ids.intern_many(context.data_proxy.fetch_users_with_impressions_by_product(
+                product_ids=[external_product],
+                user_ids=user_ids.externals(target_users),
+                anonymous=False).get(external_product, set())))
 
         all_target_users |= target_users
 
@@ -571,20 +765,28 @@ def __compute_strength_numerators(context, page, products_list, flush_size):
                     strength_numerators[(target_user, template_user)] = strength_num
 
                     if len(strength_numerators) >= flush_size:
-                        _flush_numerators(context, strength_numerators)
+                        _flush_numerators(context, strength_numerators, user_ids)
 
     if len(strength_numerators) > 0:
-        _flush_numerators(context, strength_numerators)
+        _flush_numerators(context, strength_numerators, user_ids)
 
     return products_by_template_user, all_target_users
 
 
-def __compute_denominators_and_strengths(context, page, target_users_list, products_by_template_user, flush_size):
+def __compute_denominators_and_strengths(context, page, target_users_list, products_by_template_user,
+                                         user_ids, product_ids, flush_size):
+    """ Saves the user-user strengths of a page of target users.
+
+        :param target_users_list: The list of all (interned) target users.
+        :param products_by_template_user: A map {interned template user: set of interned products}.
+        :param user_ids: The IdDictionary of the users.
+        :param product_ids: The IdDictionary of the products.
+    """
     context = context.new_session()
     total_users = len(target_users_list)
     start_idx = page * context.page_size_user_user_denominators
     end_idx = min((page + 1) * context.page_size_user_user_denominators, total_users)
-    page_user_ids = target_users_list[start_idx:end_idx]
+    page_user_ids = user_ids.externals(target_users_list[start_idx:end_idx])
 
     log.info("[Page %d] Querying db for strength numerators with target users [%d] to [%d] out of [%d]..." %
              (page, start_idx + 1, end_idx, total_users))
@@ -601,19 +803,21 @@ def __compute_denominators_and_strengths(context, page, target_users_list, produ
 
         if context.impressions_enabled:
             # Retrieves the products with impressions for the target user.
-            products_with_impressions = context.data_proxy.fetch_products_with_impressions_by_user(
-                user_ids=[target_user], anonymous=False).get(target_user, set())
+            products_with_impressions = {product_ids.index(product) for product in
+                                         context.data_proxy.fetch_products_with_impressions_by_user(
+                                             user_ids=[target_user], anonymous=False).get(target_user, set())}
 
         for template_user in numerators_by_template_user:
             numerator_tuple = numerators_by_template_user[template_user]
+            template_user_products = products_by_template_user[user_ids.index(template_user)]
 
             if context.impressions_enabled:
                 # Computes the intersection of the top-rated products of the template user
                 # with the products with impressions for the target user.
-                intersection = products_by_template_user[template_user] & products_with_impressions
+                intersection = template_user_products & products_with_impressions
                 denominator = len(intersection)
             else:
-                denominator = len(products_by_template_user[template_user])
+                denominator = len(template_user_products)
 
             # Computes the strength based on the customer-defined risk factor.
             if denominator == 0 or numerator_tuple[CONSERVATIVE] < context.min_user_user_strength_numerator:
@@ -637,16 +841,19 @@ def __compute_denominators_and_strengths(context, page, target_users_list, produ
         _flush_strengths(context, strengths_map)
 
 
-def _flush_numerators(context, strength_numerators):
+def _flush_numerators(context, strength_numerators, user_ids):
     log.debug("Saving {0} increments to user-user strength numerators...".format(len(strength_numerators)))
-    context.data_proxy.save_user_user_numerators(strength_numerators, increment=True, upsert=True)
+    context.data_proxy.save_user_user_numerators(
+        {(user_ids.external(target), user_ids.external(template)): numerator
+         for (target, template), numerator in strength_numerators.items()},
+        increment=True, upsert=True, wait=False)
     strength_numerators.clear()
     log.debug("User-user strength numerator increments saved")
 
 
 def _flush_strengths(context, strengths_map):
     log.debug("Saving {0} user-user strengths...".format(len(strengths_map)))
-    context.data_proxy.save_uu_strengths(strengths_map, upsert=False, deferred_publication=True)
+    context.data_proxy.save_uu_strengths(strengths_map, upsert=False, deferred_publication=True, wait=False)
     strengths_map.clear()
     log.debug("User-user strengths saved")
 
@@ -1,5 +1,6 @@
+import sys
+
 import barbante.utils.decay_functions as df
-import barbante.utils as utils
 
 
 FIXED = 'fixed'
@@ -10,6 +11,12 @@ TEXT = 'text'
 
 
 class ProductModel(object):
+    """ A compact product model, whose attribute values are kept in slots laid out according to
+        the attribute index of its ProductModelFactory. Stems of TEXT attributes are stored as tuples
+        of interned strings.
+    """
+
+    __slots__ = ("id", "validator", "_slots", "_extra")
 
     def __init__(self, validator, product_id, product_model_values):
         """ Constructor.
@@ -20,11 +27,31 @@ class ProductModel(object):
         if product_model_values is None:
             raise ValueError('The product cannot be null')
         self.id = product_id
-        self.values = product_model_values
         self.validator = validator
+        self._slots = [None] * len(validator.attribute_index)
+        self._extra = None
+        for key, value in product_model_values.items():
+            self._set(key, value)
+
+    def _set(self, field, value):
+        position = self.validator.attribute_index.get(field)
+        if position is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[field] = value
+        elif position in self.validator.text_attribute_positions and isinstance(value, list):
+            self._slots[position] = tuple(sys.intern(stem) if type(stem) is str else stem for stem in value)
+        else:
+            self._slots[position] = value
 
     def get_attribute(self, field):
-        return self.values.get(field)
+        position = self.validator.attribute_index.get(field)
+        if position is None:
+            return self._extra.get(field) if self._extra is not None else None
+        value = self._slots[position]
+        if type(value) is tuple and position in self.validator.text_attribute_positions:
+            return list(value)
+        return value
 
     @staticmethod
     def from_dict(product_id, product_model_dict, validator):
@@ -33,13 +60,22 @@ class ProductModel(object):
             constructor expects a raw product.
 
             :param product_id: The id of the intended product.
-            :param product_model_dict: A flat dict of attributes.
+            :param product_model_dict: A dict of attributes, either flat or nested (as persisted).
             :param validator: an instance of a ProductModelFactory.
             :returns: a ProductModel instance.
         """
-        product_id = product_id
-        product_model_values = utils.flatten_dict(product_model_dict)
-        return ProductModel(validator, product_id, product_model_values)
+        product_model = ProductModel(validator, product_id, {})
+        for field, path in validator.attribute_paths:
+            value = product_model_dict.get(field)
+            if value is None and len(path) > 1:
+                value = product_model_dict
+                for attr in path:
+                    value = value.get(attr) if isinstance(value, dict) else None
+                    if value is None:
+                        break
+            if value is not None:
+                product_model._set(field, value)
+        return product_model
 
     def to_dict(self):
         """ Converts the ProductModel instance into a dict.
@@ -50,7 +86,7 @@ class ProductModel(object):
         """
         result = {}
         for key in self.validator.persisted_attributes:
-            value = self.values.get(key)
+            value = self.get_attribute(key)
             path = key.split('.')
             d = result
 
@@ -65,7 +101,11 @@ class ProductModel(object):
         return result
 
     def keys(self):
-        return [key for key in self.values]
+        result = [field for field, position in self.validator.attribute_index.items()
+                  if self._slots[position] is not None]
+        if self._extra is not None:
+            result += [key for key in self._extra]
+        return result
 
 
 def parse_external_product(fields, product_id, external_product):
@@ -47,6 +47,17 @@ class ProductModelFactory(object):
         self.model_attributes = self.parse_model_attributes(model_attributes)
         """ Holds the complete list of attributes as defined in the product model configuration for a customer.
         """
+        attribute_names = [self._ID_ATTRIBUTE] + sorted(set(self.model_attributes) - {self._ID_ATTRIBUTE})
+        self.attribute_index = {attribute_name: position for position, attribute_name in enumerate(attribute_names)}
+        """ A map {attribute name: slot position} shared by all ProductModel instances built by this factory.
+        """
+        self.attribute_paths = [(attribute_name, attribute_name.split('.')) for attribute_name in attribute_names]
+        """ A list of (attribute name, list of nested keys) pairs, used to read attributes off nested documents.
+        """
+        self.text_attribute_positions = frozenset(self.attribute_index[attribute_name]
+                                                  for attribute_name in self.attributes_by_type.get(pm.TEXT, []))
+        """ The slot positions of the TEXT attributes.
+        """
 
     def validate_mandatory_attributes(self, model_attributes):
         attribute_keys = set(model_attributes.keys())
@@ -130,6 +141,8 @@ class ProductModelFactory(object):
             raise ValueError("The Product ID is a required attribute")
 
         model_values = {self._ID_ATTRIBUTE: product_id}
+        text_attributes = []
+        text_documents = []
 
         for attribute_name, attribute_properties in self.model_attributes.items():
             default = self.default_values.get(attribute_name)
@@ -148,13 +161,22 @@ class ProductModelFactory(object):
                         language = self.get_language(product_fields)
                         if language is None:
                             raise AttributeError("Text attributes are only supported when a language is defined")
-                        model_values[attribute_name] = text.parse_text_to_stems(language, value)
+                        text_attributes += [attribute_name]
+                        text_documents += [(language, value)]
 
             except Exception as err:
                 log.error('Exception: {0}'.format(str(err)))
                 log.error('Offending product: {0}'.format(product_fields))
                 raise err
 
+        if len(text_documents) > 0:
+            try:
+                model_values.update(zip(text_attributes, text.parse_texts_to_stems(text_documents)))
+            except Exception as err:
+                log.error('Exception: {0}'.format(str(err)))
+                log.error('Offending product: {0}'.format(product_fields))
+                raise err
+
         return ProductModel(self, product_id, model_values)
 
     def get_custom_required_attributes(self):
@@ -294,3 +294,26 @@ def test_conversion_from_dict():
     nose.tools.assert_list_equal(product.get_attribute('b.d.e'),
                                  model_dict['b']['d']['e'], 'Attribute does not match')
     nose.tools.eq_(product.get_attribute('b.d.f'), model_dict['b']['d']['f'], 'Attribute does not match')
+
+
+def test_compact_representation():
+    """ Tests that product models keep their attributes in slots, with stems stored as shared tuples.
+    """
+    model_definition = {
+        'language': {'type': 'fixed', 'default': 'english'},
+        'b.d.e': {'type': 'text', 'persisted': True}
+    }
+    factory = ProductModelFactory(model_definition)
+    stems = text.parse_text_to_stems('english', 'a value that should be stemmed')
+    model_dict = {'language': 'english', 'b': {'d': {'e': stems}}}
+    product1 = pm.ProductModel.from_dict('p1', model_dict, factory)
+    fresh_stems = [''.join(list(stem)) for stem in stems]  # equal, but distinct string objects
+    product2 = pm.ProductModel.from_dict('p2', {'language': 'english', 'b.d.e': fresh_stems}, factory)
+
+    nose.tools.ok_(not hasattr(product1, '__dict__'), 'Product models should not have an instance dict')
+    nose.tools.eq_(product1.get_attribute('b.d.e'), stems, 'Attribute does not match')
+    nose.tools.eq_(product2.get_attribute('b.d.e'), stems, 'Attribute does not match')
+    stored1 = product1._slots[factory.attribute_index['b.d.e']]
+    stored2 = product2._slots[factory.attribute_index['b.d.e']]
+    nose.tools.ok_(all(s1 is s2 for s1, s2 in zip(stored1, stored2)), 'Stems should be interned')
+    nose.tools.eq_(product1.to_dict()['b']['d']['e'], stems, 'Attribute does not match')
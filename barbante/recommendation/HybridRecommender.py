@@ -2,11 +2,12 @@
 """
 
 import abc
-import concurrent.futures
+import heapq
 from time import time
 import traceback
 
-from barbante.recommendation.Recommender import Recommender
+import barbante.context as ctx
+from barbante.recommendation.Recommender import Recommender, PRE_FILTER
 import barbante.utils.logging as barbante_logging
 from barbante.context.context_manager import wrap
 
@@ -52,23 +53,18 @@ class HybridRecommender(Recommender):
         """
         log.info(barbante_logging.PERF_BEGIN)
 
-        n_algorithms = len(self.algorithms_including_fill_in)
-
         candidate_products_by_algorithm = {}
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=n_algorithms) as executor:
-                future_to_algorithm = {
-                    executor.submit(wrap(self._gather_candidate_products), algorithm, n_recommendations): algorithm
-                    for algorithm in self.algorithms_including_fill_in}
-                for future in concurrent.futures.as_completed(future_to_algorithm,
-                                                              timeout=self.session_context.recommendation_timeout):
-                    candidate_products_by_algorithm.update(future.result())
-
-        except concurrent.futures._base.TimeoutError as err:
-            log.error("Specialist recommender timeout error: {0}".format(str(err)))
-            log.info("Specialists that returned within time limit: {0}".format(candidate_products_by_algorithm.keys()))
-            log.info("Specialists that timed out: {0}".format(
-                set(self.algorithms_including_fill_in) - set(candidate_products_by_algorithm.keys())))
+        results_by_algorithm, timed_out_algorithms = self.session_context.specialist_executor.run(
+            {algorithm: (wrap(self._gather_candidate_products), (algorithm, n_recommendations))
+             for algorithm in self.algorithms_including_fill_in},
+            timeout=self.session_context.deadline.remaining(self.session_context.recommendation_timeout))
+        for result in results_by_algorithm.values():
+            candidate_products_by_algorithm.update(result)
+
+        if len(timed_out_algorithms) > 0:
+            log.error("Specialist recommender timeout error")
+            log.info("Specialists that returned within time limit: {0}".format(results_by_algorithm.keys()))
+            log.info("Specialists that timed out: {0}".format(timed_out_algorithms))
 
         log.info(barbante_logging.PERF_END)
         return candidate_products_by_algorithm
@@ -93,31 +89,116 @@ class HybridRecommender(Recommender):
 
         log.debug("Querying %d distinct recommenders" % n_algorithms)
 
-        sorted_scores_by_algorithm = {}
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=n_algorithms) as executor:
-                future_to_algorithm = {
-                    executor.submit(wrap(self._query_recommender), self.recommenders[algorithm],
-                                    candidate_product_ids_by_algorithm, n_recommendations): algorithm
-                    for algorithm in self.algorithms_including_fill_in}
-
-                for future in concurrent.futures.as_completed(future_to_algorithm,
-                                                              timeout=self.session_context.recommendation_timeout):
-                    sorted_scores_by_algorithm[future_to_algorithm[future]] = future.result()
-
-        except concurrent.futures._base.TimeoutError as err:
-            log.error("Specialist recommender timeout error: {0}".format(str(err)))
+        sorted_scores_by_algorithm, timed_out_algorithms = self.session_context.specialist_executor.run(
+            {algorithm: (wrap(self._query_recommender), (self.recommenders[algorithm],
+                                                         candidate_product_ids_by_algorithm, n_recommendations))
+             for algorithm in self.algorithms_including_fill_in},
+            timeout=self.session_context.deadline.remaining(self.session_context.recommendation_timeout))
+
+        if len(timed_out_algorithms) > 0:
+            log.error("Specialist recommender timeout error")
             log.info("Specialists that returned within time limit: {0}".format(sorted_scores_by_algorithm.keys()))
-            log.info("Specialists that timed out: {0}".format(
-                set(self.algorithms_including_fill_in) - set(sorted_scores_by_algorithm.keys())))
+            log.info("Specialists that timed out: {0}".format(timed_out_algorithms))
+
+        recommendations = self._merge_specialist_scores(sorted_scores_by_algorithm, n_recommendations)
 
+        log.info(barbante_logging.PERF_END)
+        return recommendations
+
+    def _gather_candidates_and_scores(self, n_recommendations):
+        """ See barbante.recommendation.Recommender.
+
+            Each specialist scores and post-processes its own candidates in a single task, so that specialists
+            run all the way through in parallel. When the filter strategy is AFTER_SCORING, the specialists first
+            gather their candidates in parallel, and the union of those candidates is then pos-filtered by a single
+            query issued from the calling thread (see _pos_filter_candidates), so that no pooled task ever waits
+            for another one.
+        """
+        log.info(barbante_logging.PERF_BEGIN)
+
+        algorithms = self.algorithms_including_fill_in
+        if self.session_context.deadline.expired() and self.fill_in_algorithm is not None:
+            # There is no time left for the specialists: the fill-in algorithm alone is given one last chance.
+            log.warn("Deadline reached: falling back to [{0}]".format(self.fill_in_algorithm))
+            algorithms = [self.fill_in_algorithm]
+            timeout = self.session_context.recommendation_timeout
+        else:
+            timeout = self.session_context.deadline.remaining(self.session_context.recommendation_timeout)
+
+        for algorithm in algorithms:
+            if self.recommenders.get(algorithm) is None:
+                self.recommenders[algorithm] = self.session_context.get_recommender(algorithm)
+
+        n_candidates = max(500, 3 * n_recommendations)
+        # Hack to add some slack and make sure we bring enough products to overcome a possible subsequent pruning
+        # by history decay, deleted and already consumed products.
+
+        if self.session_context.filter_strategy == ctx.BEFORE_SCORING:
+            candidate_products_by_algorithm = self._gather_pre_filtered_product_ids()
+            number_of_recommendations_to_ask_for = min(3 * n_recommendations,
+                                                       len(candidate_products_by_algorithm[PRE_FILTER]))
+            candidates_by_specialist = {algorithm: candidate_products_by_algorithm for algorithm in algorithms}
+        else:
+            candidate_products_by_algorithm = {}
+            number_of_recommendations_to_ask_for = 3 * n_recommendations
+            end_time = time() + timeout if timeout is not None else None
+
+            candidates_by_specialist, timed_out_algorithms = self.session_context.specialist_executor.run(
+                {algorithm: (wrap(self._gather_candidate_products), (algorithm, n_candidates))
+                 for algorithm in algorithms},
+                timeout=timeout)
+
+            if len(timed_out_algorithms) > 0:
+                log.error("Specialist recommender timeout error while gathering candidates")
+                log.info("Specialists that timed out: {0}".format(timed_out_algorithms))
+
+            candidates_by_specialist = self._pos_filter_candidates(candidates_by_specialist)
+            timeout = max(0, end_time - time()) if end_time is not None else None
+
+        sorted_scores_by_algorithm, timed_out_algorithms = self.session_context.specialist_executor.run(
+            {algorithm: (wrap(self._query_recommender), (self.recommenders[algorithm], candidate_products,
+                                                         number_of_recommendations_to_ask_for))
+             for algorithm, candidate_products in candidates_by_specialist.items()},
+            timeout=timeout)
+
+        if len(timed_out_algorithms) > 0:
+            log.error("Specialist recommender timeout error")
+            log.info("Specialists that returned within time limit: {0}".format(sorted_scores_by_algorithm.keys()))
+            log.info("Specialists that timed out: {0}".format(timed_out_algorithms))
+
+        recommendations = self._merge_specialist_scores(sorted_scores_by_algorithm,
+                                                        number_of_recommendations_to_ask_for)
+
+        log.info(barbante_logging.PERF_END)
+        return candidate_products_by_algorithm, recommendations
+
+    def _pos_filter_candidates(self, candidates_by_specialist):
+        """ Pos-filters the candidates of all specialists at once, with a single query.
+
+            :param candidates_by_specialist: A map {algorithm: {alg_suffix: set of candidate product ids}} with the
+                candidates gathered by each specialist.
+
+            :returns: A map {algorithm: {alg_suffix: set of candidate product ids}} with the candidates of each
+                specialist which pass the session context filter and have no blocking activities.
+        """
+        products_set = set()
+        for candidate_products_by_algorithm in candidates_by_specialist.values():
+            for products in candidate_products_by_algorithm.values():
+                products_set |= products
+        products_set = {product_id for product_id in products_set if not self._has_blocking_activity(product_id)}
+        filtered_products = self.session_context.apply_pos_filter_to_products(list(products_set))
+
+        return {algorithm: {alg: products & filtered_products
+                            for alg, products in candidate_products_by_algorithm.items()}
+                for algorithm, candidate_products_by_algorithm in candidates_by_specialist.items()}
+
+    def _merge_specialist_scores(self, sorted_scores_by_algorithm, n_recommendations):
         # Merges the contributions of different specialists.
         recommendations = self.merge_algorithm_contributions(sorted_scores_by_algorithm, n_recommendations)
 
         # Calls for the fill-in algorithm, when need be.
         self.include_fill_in_recommendations(recommendations, sorted_scores_by_algorithm, n_recommendations)
 
-        log.info(barbante_logging.PERF_END)
         return recommendations
 
     def include_fill_in_recommendations(self, recommendations, sorted_scores_by_algorithm, n_recommendations):
@@ -199,7 +280,9 @@ class HybridRecommender(Recommender):
 
             log.info('Post-processing scores for [{}]...'.format(type(recommender).__name__))
             processed_scores = recommender.post_process_scores(product_scores)
-            sorted_scores = sorted(processed_scores, reverse=True)
+            # Merging consumes at most n_recommendations new products from each specialist, after skipping
+            # at most as many products already contributed by other specialists.
+            sorted_scores = heapq.nlargest(2 * n_recommendations, processed_scores)
 
             log.info('[%s] returned [%d] scores before post-processing ([%d] after post-processing). '
                      'Took %d milliseconds.'
@@ -3,6 +3,7 @@
 
 import abc
 import heapq
+import numpy as np
 import random
 from time import time
 
@@ -146,23 +147,9 @@ class Recommender():
         start_time = time()
         log.info("Retrieving {0} recommendations for user [{1}]".format(n_recommendations,
                                                                         self.session_context.user_id))
-        # Obtains the candidate products.
-        candidate_products_by_algorithm = self._gather_processed_candidate_products(
-            max(500, 3 * n_recommendations)
-            # Hack to add some slack and make sure we bring enough products to overcome a possible subsequent pruning
-            # by history decay, deleted and already consumed products.
-        )
-
-        if self.session_context.filter_strategy == ctx.BEFORE_SCORING:
-            number_of_recommendations_to_ask_for = min(3 * n_recommendations,
-                                                       len(candidate_products_by_algorithm[PRE_FILTER]))
-        else:
-            number_of_recommendations_to_ask_for = 3 * n_recommendations
-        # Here again we leave some slack, so we can post-process and still retain the intended number of products.
+        # Obtains and scores the candidate products.
+        candidate_products_by_algorithm, scored_recommendations = self._gather_candidates_and_scores(n_recommendations)
 
-        # Scores the products.
-        scored_recommendations = self.gather_recommendation_scores(candidate_products_by_algorithm,
-                                                                   number_of_recommendations_to_ask_for)
         if log.is_debug_enabled():
             log.debug('full recommendations: [{0}] => [{1}]'.format(len(scored_recommendations),
                                                                     scored_recommendations))
@@ -191,6 +178,9 @@ class Recommender():
 
         should_worry_about_near_identical = (self.session_context.near_identical_filter_field is not None) and \
                                             (self.session_context.near_identical_filter_threshold is not None)
+        if should_worry_about_near_identical and self.session_context.deadline.expired():
+            log.warn("Deadline reached: skipped the near-identical filter")
+            should_worry_about_near_identical = False
 
         # Ranks.
         slack_for_near_identical = 2 if should_worry_about_near_identical else 1
@@ -241,6 +231,33 @@ class Recommender():
 
         return result
 
+    def _gather_candidates_and_scores(self, n_recommendations):
+        """ Gathers the candidate products and scores them.
+
+            :param n_recommendations: The intended number of recommendations.
+
+            :returns: A map {algorithm_suffix: set of candidate product ids}, and a list of [score, product_id] pairs.
+        """
+        # Obtains the candidate products.
+        candidate_products_by_algorithm = self._gather_processed_candidate_products(
+            max(500, 3 * n_recommendations)
+            # Hack to add some slack and make sure we bring enough products to overcome a possible subsequent pruning
+            # by history decay, deleted and already consumed products.
+        )
+
+        if self.session_context.filter_strategy == ctx.BEFORE_SCORING:
+            number_of_recommendations_to_ask_for = min(3 * n_recommendations,
+                                                       len(candidate_products_by_algorithm[PRE_FILTER]))
+        else:
+            number_of_recommendations_to_ask_for = 3 * n_recommendations
+        # Here again we leave some slack, so we can post-process and still retain the intended number of products.
+
+        # Scores the products.
+        scored_recommendations = self.gather_recommendation_scores(candidate_products_by_algorithm,
+                                                                   number_of_recommendations_to_ask_for)
+
+        return candidate_products_by_algorithm, scored_recommendations
+
     def post_process_scores(self, scored_recommendations):
         """ Post-processes the scores of each recommendation candidate by applying appropriate weights based on
             previous consumption, impressions, etc.
@@ -256,39 +273,29 @@ class Recommender():
         else:
             start_index = 0
 
-        new_scored_recommendations = []
-        for score, product in scored_recommendations:
-
-            # product age decay factor
-            product_date = self.session_context.product_models.get(product).get_attribute(
-                self.session_context.default_product_date_field)
-            product_age_decay_factor = self.session_context.obtain_product_age_decay_factor(product_date)
-            if product_age_decay_factor <= 0:
-                continue  # should never recommend items with non-positive scores
-
-            # history decay factor
-            history_decay_factor = self.session_context.obtain_history_decay_factor(product)
-            if history_decay_factor <= 0:
-                continue  # should never recommend items with non-positive scores
-
-            # previous consumption factor
-            previous_consumption_factor = self.session_context.obtain_previous_consumption_factor(product)
-            if previous_consumption_factor <= 0:
-                continue  # should never recommend items with non-positive scores
-
-            # in-boost
-            in_boost = self.session_context.obtain_in_boost(product)
-
-            new_score = []
-            for idx, score_item in enumerate(score):
-                if idx < start_index:
-                    new_score += [score_item]
-                else:
-                    new_score += [score_item * product_age_decay_factor * history_decay_factor \
-                                             * previous_consumption_factor * in_boost]
-            new_scored_recommendations += [[new_score, product]]
+        scored_recommendations = list(scored_recommendations)
+        if len(scored_recommendations) == 0:
+            return []
+
+        products = [product for _, product in scored_recommendations]
+        product_date_field = self.session_context.default_product_date_field
+        product_models = self.session_context.product_models
+        product_dates = [product_models.get(product).get_attribute(product_date_field) for product in products]
+
+        product_age_decay_factors = self.session_context.obtain_product_age_decay_factors(product_dates)
+        history_decay_factors = self.session_context.obtain_history_decay_factors(products)
+        previous_consumption_factors = self.session_context.obtain_previous_consumption_factors(products)
+        in_boosts = self.session_context.obtain_in_boosts(products)
+
+        # should never recommend items with non-positive scores
+        positive = (product_age_decay_factors > 0) & (history_decay_factors > 0) & (previous_consumption_factors > 0)
+
+        values = np.array([score[start_index:] for score, _ in scored_recommendations], dtype=float)
+        values = values * product_age_decay_factors[:, np.newaxis] * history_decay_factors[:, np.newaxis] \
+            * previous_consumption_factors[:, np.newaxis] * in_boosts[:, np.newaxis]
 
-        return new_scored_recommendations
+        return [[list(scored_recommendations[idx][0][:start_index]) + values[idx].tolist(), products[idx]]
+                for idx in np.flatnonzero(positive)]
 
     def pick_candidate_products(self, candidate_product_ids):
         """ Selects the appropriate set of pre-fetched candidate products from the given map.
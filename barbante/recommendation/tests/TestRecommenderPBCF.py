@@ -1,8 +1,11 @@
 """ Test module for barbante.recommendation.RecommenderPBCF class.
 """
 
+import nose.tools
+
 import barbante.maintenance.product_templates as pt
 from barbante.recommendation.tests.fixtures.ProductBasedRecommenderFixture import ProductBasedRecommenderFixture
+import barbante.tests as tests
 
 
 class TestRecommenderPBCF(ProductBasedRecommenderFixture):
@@ -21,3 +24,19 @@ class TestRecommenderPBCF(ProductBasedRecommenderFixture):
         """ Tests whether meaningful recommendations were obtained according to Alg PBCF.
         """
         super().test_recommend(test_recommendation_quality=True)
+
+    def test_async_user_context_loading_prefetches_product_templates(self):
+        """ Tests whether the templates of the base products are pre-fetched when the user data is loaded
+            asynchronously, so that the recommender does not need to fetch them by itself.
+        """
+        session = tests.init_session_async(user_id="u_eco_1", algorithm=self.algorithm)
+        nose.tools.ok_("product_templates" in session.loading_times, "Product templates were not pre-fetched")
+        base_products = session.most_recently_consumed_products[:(3 * session.base_products_count)]
+        nose.tools.ok_(len(base_products) > 0, "Weak test fixture. There should be base products.")
+        nose.tools.eq_(set(session.user_context.product_templates), set(base_products),
+                       "Wrong pre-fetched product templates")
+
+        expected_recommendations = tests.init_session(user_id="u_eco_1", algorithm=self.algorithm) \
+            .get_recommender().recommend(10)
+        nose.tools.eq_(session.get_recommender().recommend(10), expected_recommendations,
+                       "Wrong recommendations with asynchronously loaded user data")
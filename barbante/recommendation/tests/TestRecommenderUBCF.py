@@ -1,7 +1,11 @@
 """ Test module for barbante.recommendation.RecommenderUBCF class.
 """
 
+import nose.tools
+
+import barbante.context as ctx
 from barbante.recommendation.tests.fixtures.UserBasedRecommenderFixture import UserBasedRecommenderFixture
+import barbante.tests as tests
 
 
 class TestRecommenderUBCF(UserBasedRecommenderFixture):
@@ -16,3 +20,38 @@ class TestRecommenderUBCF(UserBasedRecommenderFixture):
         """ Tests whether meaningful recommendations were obtained according to Alg UBCF.
         """
         super().test_recommend(test_recommendation_quality=True)
+
+    def test_concurrent_user_context_loading(self):
+        """ Tests whether the user data loaded concurrently matches the user data loaded sequentially.
+        """
+        for filter_strategy in [ctx.BEFORE_SCORING, ctx.AFTER_SCORING]:
+            sessions = [tests.init_session(user_id="u_eco_1", algorithm=self.algorithm,
+                                           custom_settings={"filter_strategy": filter_strategy,
+                                                            "concurrent_user_context_loading": concurrent})
+                        for concurrent in [False, True]]
+            for attribute in ["recent_activities", "blocked_products", "most_recently_consumed_products",
+                              "user_impressions_summary", "filtered_products", "user_templates",
+                              "recent_activities_by_product_by_template_user"]:
+                nose.tools.eq_(getattr(sessions[0], attribute), getattr(sessions[1], attribute),
+                               "Wrong [{0}] with the {1} strategy".format(attribute, filter_strategy))
+            nose.tools.eq_(set(sessions[0].product_models), set(sessions[1].product_models), "Wrong product models")
+            nose.tools.eq_(set(sessions[0].loading_times), set(sessions[1].loading_times), "Wrong loading stages")
+            nose.tools.ok_(len(sessions[0].user_templates) > 0, "Weak test fixture. There should be user templates.")
+
+    def test_async_user_context_loading(self):
+        """ Tests whether the user data loaded asynchronously matches the user data loaded synchronously.
+        """
+        for filter_strategy in [ctx.BEFORE_SCORING, ctx.AFTER_SCORING]:
+            custom_settings = {"filter_strategy": filter_strategy}
+            sessions = [tests.init_session(user_id="u_eco_1", algorithm=self.algorithm,
+                                           custom_settings=custom_settings),
+                        tests.init_session_async(user_id="u_eco_1", algorithm=self.algorithm,
+                                                 custom_settings=custom_settings)]
+            for attribute in ["recent_activities", "recent_activities_by_product", "blocked_products",
+                              "most_recently_consumed_products", "user_impressions_summary", "filtered_products",
+                              "user_templates", "recent_activities_by_product_by_template_user"]:
+                nose.tools.eq_(getattr(sessions[0], attribute), getattr(sessions[1], attribute),
+                               "Wrong [{0}] with the {1} strategy".format(attribute, filter_strategy))
+            nose.tools.eq_(set(sessions[0].product_models), set(sessions[1].product_models), "Wrong product models")
+            nose.tools.eq_(set(sessions[0].loading_times), set(sessions[1].loading_times), "Wrong loading stages")
+            nose.tools.ok_(len(sessions[0].user_templates) > 0, "Weak test fixture. There should be user templates.")
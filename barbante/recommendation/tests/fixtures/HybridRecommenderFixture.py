@@ -3,6 +3,8 @@
 
 import datetime as dt
 import nose.tools
+from time import time
+import unittest.mock as mock
 
 import barbante.context as ctx
 import barbante.maintenance.product_templates as pt
@@ -10,6 +12,8 @@ import barbante.maintenance.product_templates_tfidf as pt_tfidf
 import barbante.maintenance.user_templates as ut
 from barbante.recommendation.tests.fixtures.RecommenderFixture import RecommenderFixture
 import barbante.tests as tests
+from barbante.utils.deadline import Deadline, DeadlineExceeded
+from barbante.utils.executors import DeadlineExecutor
 
 
 class HybridRecommenderFixture(RecommenderFixture):
@@ -144,6 +148,75 @@ class HybridRecommenderFixture(RecommenderFixture):
 
         self._check_empty_filter_returning_all_products(custom_settings, intended_count, target_user)
 
+    def test_pos_filter_with_a_single_query(self):
+        """ Tests whether the candidates of all specialists are pos-filtered together, by a single query.
+        """
+        custom_settings = {
+            'filter_strategy': ctx.AFTER_SCORING
+        }
+        session = tests.init_session(user_id="u_eco_1", custom_settings=custom_settings, algorithm=self.algorithm)
+        user_context = session.user_context
+        pos_filter_calls = []
+        apply_pos_filter_to_products = user_context.apply_pos_filter_to_products
+
+        def counting_apply_pos_filter_to_products(product_ids):
+            pos_filter_calls.append(len(product_ids))
+            return apply_pos_filter_to_products(product_ids)
+
+        user_context.apply_pos_filter_to_products = counting_apply_pos_filter_to_products
+        results = session.get_recommender().recommend(self.n_recommendations)
+        nose.tools.ok_(len(results) > 0, "Hybrid recommenders should recommend with pos-filters")
+        nose.tools.eq_(len(pos_filter_calls), 1, "Candidates should have been pos-filtered by a single query")
+
+    def test_pos_filter_with_a_single_specialist_thread(self):
+        """ Tests whether pos-filtering the candidates of all specialists together does not make specialists
+            wait for one another within the specialists' thread pool.
+        """
+        custom_settings = {
+            'filter_strategy': ctx.AFTER_SCORING,
+            'recommendation_timeout': 10
+        }
+        session = tests.init_session(user_id="u_eco_1", custom_settings=custom_settings, algorithm=self.algorithm,
+                                     deadline=Deadline(10))
+        session.specialist_executor = DeadlineExecutor(max_workers=1)
+        start = time()
+        results = session.get_recommender().recommend(self.n_recommendations)
+        nose.tools.ok_(len(results) > 0, "Hybrid recommenders should recommend with pos-filters")
+        nose.tools.eq_(session.specialist_executor.timeouts, 0, "No specialist should have timed out")
+        nose.tools.ok_(time() - start < 5, "Specialists should not have waited for one another")
+
+    def test_expired_deadline_falls_back_to_fill_in_algorithm(self):
+        """ Tests whether only the fill-in algorithm is queried once the deadline is reached.
+        """
+        session = tests.init_session(user_id="u_eco_1", algorithm=self.algorithm, deadline=Deadline(1, start=0))
+        results = session.get_recommender().recommend(self.n_recommendations)
+        nose.tools.ok_(len(results) > 0, "The fill-in algorithm should have recommended")
+        for score, _ in results:
+            nose.tools.eq_(score[0], session.fill_in_algorithm, "Only the fill-in algorithm should have recommended")
+
+    def test_queries_running_past_the_deadline(self):
+        """ Tests whether recommendations are still served when every query bounded by the deadline runs past it,
+            as long as the user data the recommendations cannot do without is loaded.
+        """
+        def aborted_past_deadline(method):
+            def aborted_method(*args, **kwargs):
+                if kwargs.get("max_time_ms") is not None:
+                    raise DeadlineExceeded("{0} exceeded its time limit".format(method.__name__))
+                return method(*args, **kwargs)
+            return aborted_method
+
+        bounded_reads = ["fetch_day_of_latest_user_activity", "fetch_activity_summaries_by_user",
+                         "fetch_impressions_summary", "fetch_user_templates", "fetch_product_templates",
+                         "fetch_product_models"]
+        for strategy in [ctx.BEFORE_SCORING, ctx.AFTER_SCORING]:
+            with mock.patch.multiple(self.db_proxy, **{name: aborted_past_deadline(getattr(self.db_proxy, name))
+                                                       for name in bounded_reads}):
+                session = tests.init_session(user_id="u_eco_1", custom_settings={'filter_strategy': strategy},
+                                             algorithm=self.algorithm, deadline=Deadline(60))
+                results = session.get_recommender().recommend(self.n_recommendations)
+            nose.tools.ok_(len(session.recent_activities) > 0, "Recent activities should have been loaded")
+            nose.tools.ok_(len(results) > 0, "Hybrid recommenders should still recommend (%s)" % strategy)
+
     def test_pre_vs_pos_filter_without_missing_pre_filtered_candidates(self):
         filter_string = '{"language": "portuguese", "category": "Economia"}'
         n_recommendations = 4
@@ -73,6 +73,23 @@ class RecommenderFixture():
         results = recommender.recommend(self.n_recommendations)
         nose.tools.eq_(len(results), 0, "No recommendations should have been returned.")
 
+    def test_batch_recommend(self):
+        """ Tests whether recommendations obtained for a batch of users (sharing bulk-loaded data)
+            are the same as those obtained for each user separately.
+        """
+        if "Random" in self.algorithm:
+            return  # nothing to compare
+
+        targets = ["u_eco_" + str(i) for i in range(1, dp.N_USR_ECONOMIA + 1)] + ["Invalid user id"]
+        sessions = tests.init_sessions(targets, algorithm=self.algorithm)
+        nose.tools.eq_(set(sessions.keys()), set(targets), "Wrong sessions")
+
+        for target in targets:
+            session = tests.init_session(user_id=target, algorithm=self.algorithm)
+            expected = [r[1] for r in session.get_recommender().recommend(self.n_recommendations)]
+            actual = [r[1] for r in sessions[target].get_recommender().recommend(self.n_recommendations)]
+            nose.tools.eq_(actual, expected, "Batch recommendations differ from single-user ones for " + target)
+
     def test_recommend_with_blocking_activities(self):
         """ Tests whether blocking activities prevent items from being recommended.
         """
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks the retrieval of ids by rating (see MongoDBProxy.fetch_users_by_rating_by_product and
+    MongoDBProxy.fetch_products_by_rating_by_user) on the pages of the generation of user-user and
+    product-product strengths, comparing the server-side aggregation against the former client-side
+    grouping of activity summaries.
+
+    **Command-line parameters**
+
+        *environment*
+            The intended environment, as defined in mongoid.yml.
+
+        *n_pages*
+            The (optional) number of pages to benchmark for each strategy. Default: 3.
+
+    **Example of usage**
+
+        ``python3 -m barbante.scripts.benchmark_ids_by_rating development 5``
+
+    **Output**
+
+    Returns a JSON object as follows:
+        {"success": "true", "benchmarks": {page kind: {"client_side": {"seconds": s, "bytes": b},
+                                                        "aggregation": {"seconds": s, "bytes": b}}}},
+        if the benchmark ran fine; {"message": "some error message", "success": "false"}, otherwise.
+"""
+
+import datetime as dt
+import json
+import sys
+import traceback
+from time import time
+
+import bson
+
+from barbante.context import init_session
+from barbante.context.context_manager import new_context
+import barbante.utils.logging as barbante_logging
+
+
+log = barbante_logging.get_logger(__name__)
+
+DEFAULT_N_PAGES = 3
+
+
+def fetch_ids_by_rating_client_side(session_context, key_field, value_field, keys, min_day):
+    """ The former implementation: fetches one document per activity and groups them in Python.
+
+        :returns: The same results as MongoDBProxy.fetch_*_by_rating_by_*(), and the number of bytes transferred.
+    """
+    result = {}
+    count_by_rating = [0] * 5
+    transferred_bytes = 0
+
+    where = {"activity": {"$in": session_context.supported_activities},
+             key_field: {"$in": keys},
+             "day": {"$gte": min_day}}
+    fields = {"external_user_id": True, "external_product_id": True, "activity": True, "day": True, "_id": False}
+    cursor = session_context.data_proxy.database.activities_summary.find(where, fields).sort(
+        [(key_field, 1), ("day", -1)])
+
+    latest_pairs = set()
+    for rec in cursor:
+        transferred_bytes += len(bson.BSON.encode(rec))
+        pair = (rec[key_field], rec[value_field])
+        if pair in latest_pairs:
+            continue  # only considers the most recent activity for each (user, product) pair
+        latest_pairs.add(pair)
+        values_by_rating = result.setdefault(rec[key_field], {r: set() for r in range(1, 6)})
+        rating = session_context.rating_by_activity[rec["activity"]]
+        values_by_rating[rating].add(rec[value_field])
+        count_by_rating[rating - 1] += 1
+
+    return (result, count_by_rating), transferred_bytes
+
+
+def benchmark_pages(session_context, fetch_method, key_field, value_field, all_keys, page_size, days, n_pages):
+    min_day = session_context.get_present_date() - dt.timedelta(days)
+    totals = {"client_side": {"seconds": 0, "bytes": 0},
+              "aggregation": {"seconds": 0, "bytes": 0}}
+
+    for page in range(n_pages):
+        keys = all_keys[page * page_size:(page + 1) * page_size]
+        if len(keys) == 0:
+            break
+
+        start = time()
+        client_side_results, transferred_bytes = fetch_ids_by_rating_client_side(
+            session_context, key_field, value_field, keys, min_day)
+        totals["client_side"]["seconds"] += time() - start
+        totals["client_side"]["bytes"] += transferred_bytes
+
+        start = time()
+        aggregation_results = fetch_method(keys, min_date=min_day)
+        totals["aggregation"]["seconds"] += time() - start
+        totals["aggregation"]["bytes"] += sum(
+            len(bson.BSON.encode(doc))
+            for doc in session_context.data_proxy.aggregate_ids_by_rating(key_field, value_field, keys, min_day))
+
+        if aggregation_results != client_side_results:
+            log.error("[Page %d] The results of both strategies differ" % (page + 1))
+
+        log.info("[Page %d] %s" % (page + 1, totals))
+
+    return totals
+
+
+def main(argv):
+    if len(argv) < 1:
+        msg = "You must specify the environment"
+        log.error(msg)
+        return {"success": False, "message": msg}
+
+    try:
+        env = argv[0]
+        n_pages = int(argv[1]) if len(argv) >= 2 else DEFAULT_N_PAGES
+
+        session = init_session(env)
+        products_list = list(session.data_proxy.fetch_all_product_ids())
+        users_list = list(session.data_proxy.fetch_all_user_ids())
+
+        benchmarks = {
+            "user-user numerators (users by rating by product)": benchmark_pages(
+                session, session.data_proxy.fetch_users_by_rating_by_product,
+                "external_product_id", "external_user_id", products_list,
+                session.page_size_user_user_numerators, session.user_user_strengths_window, n_pages),
+            "product-product numerators (products by rating by user)": benchmark_pages(
+                session, session.data_proxy.fetch_products_by_rating_by_user,
+                "external_user_id", "external_product_id", users_list,
+                session.page_size_product_product_numerators, session.product_product_strengths_window, n_pages)}
+
+    except Exception:
+        log.exception('Exception on {0}'.format(__name__))
+        return {"success": False, "message": traceback.format_exc()}
+
+    return {"success": True, "benchmarks": benchmarks}
+
+
+if __name__ == '__main__':
+    with new_context():
+        print(json.dumps(main(sys.argv[1:])))
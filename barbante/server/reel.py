@@ -1,16 +1,20 @@
+import concurrent.futures
 from datetime import date
 import getopt
 import signal
 import sys
 import socket
 import re
+import threading
 
 from tornado import gen
+from tornado.concurrent import is_future
 import tornado.escape
 import tornado.ioloop
 import tornado.web
 
 import barbante
+import barbante.context
 import barbante.api.process_activity_slowlane as process_activity_slowlane
 import barbante.api.process_activity_fastlane as process_activity_fastlane
 import barbante.api.process_impression as process_impression
@@ -24,16 +28,146 @@ import barbante.api.consolidate_user_templates as consolidate_user_templates
 import barbante.api.get_user_templates as user_templates
 import barbante.utils.logging as barbante_logging
 from barbante.config import is_valid_customer_identifier
-from barbante.context.context_manager import new_context
+from barbante.context.context_manager import new_context, get_context
 
 
 _TRACER_ID_HEADER = 'tracerid'  # HTTP header is case-insensitive
 """ The HTTP header carrying the UUID used to identify log messages. """
 
+INLINE = 'inline'
+""" Executor mode: handlers run on the IOLoop thread itself (the original behaviour). """
+THREAD = 'thread'
+""" Executor mode: handlers run on a pool of worker threads, off the IOLoop. """
+PROCESS = 'process'
+""" Executor mode: handlers run on worker threads, which ship the actual API calls to a pool of processes.
+
+    Each worker process has its own in-process caches (the local tier of the context filters cache, and the
+    product models cache), so that /cache_stats reports those of whichever worker served it (see its "pid").
+    Invalidations reach all workers, though, through the cache generation they share in memcache.
+"""
+ASYNC = 'async'
+""" Executor mode: the handlers of ASYNC_ENDPOINTS run on the IOLoop itself, as coroutines which read from the
+    database asynchronously (see barbante.data.AsyncMongoDBProxy) and hand their CPU-bound work over to the
+    thread pool of their endpoint; all other handlers run on worker threads.
+"""
+EXECUTOR_MODES = (INLINE, THREAD, PROCESS, ASYNC)
+
+ASYNC_ENDPOINTS = {'recommend'}
+""" The endpoints whose handlers are coroutines in ASYNC mode. """
+
+DEFAULT_MAX_WORKERS = 16
+""" The default number of worker threads serving endpoints without a specific concurrency limit. """
+
+ENDPOINT_CONCURRENCY_LIMITS = {
+    'process_activity_slowlane': 4,
+    'consolidate_product_templates': 1,
+    'consolidate_user_templates': 1
+}
+""" The maximum number of concurrent requests for specific endpoints. Each limited endpoint is served
+    by a dedicated pool, so that heavy maintenance calls can never starve /recommend.
+"""
+
 
 log = barbante_logging.get_logger('barbante.server.reel')
 
 
+class WorkerPools:
+    """ Keeps the executors used to run request handlers off the Tornado IOLoop.
+    """
+
+    def __init__(self, mode=THREAD, max_workers=DEFAULT_MAX_WORKERS, max_processes=None, endpoint_limits=None):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError("Invalid executor mode: {0}".format(mode))
+
+        self.mode = mode
+        """ One of EXECUTOR_MODES.
+        """
+        self.max_workers = max_workers
+        """ The number of threads of the shared pool, used by endpoints without a specific limit.
+        """
+        self.max_processes = max_processes
+        """ The number of processes in PROCESS mode (None means the number of cores).
+        """
+        self.endpoint_limits = dict(ENDPOINT_CONCURRENCY_LIMITS)
+        """ A map {endpoint name: maximum number of concurrent requests}.
+        """
+        if endpoint_limits is not None:
+            self.endpoint_limits.update(endpoint_limits)
+
+        self._thread_pools = {}
+        """ A map {endpoint name (or None, for the shared pool): ThreadPoolExecutor}.
+        """
+        self._process_pool = None
+        """ The process pool, lazily created in PROCESS mode.
+        """
+        self._lock = threading.Lock()
+
+    def thread_pool(self, endpoint):
+        """ Retrieves the thread pool which should serve requests to the given endpoint.
+
+            :param endpoint: The endpoint name.
+            :returns: A ThreadPoolExecutor.
+        """
+        limit = self.endpoint_limits.get(endpoint)
+        key = endpoint if limit is not None else None
+        with self._lock:
+            pool = self._thread_pools.get(key)
+            if pool is None:
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers=limit or self.max_workers)
+                self._thread_pools[key] = pool
+        return pool
+
+    def process_pool(self):
+        """ Retrieves the process pool, creating it on first use.
+
+            :returns: A ProcessPoolExecutor.
+        """
+        with self._lock:
+            if self._process_pool is None:
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_processes)
+        return self._process_pool
+
+    def shutdown(self, wait=True):
+        """ Shuts down all executors.
+        """
+        with self._lock:
+            for pool in self._thread_pools.values():
+                pool.shutdown(wait=wait)
+            self._thread_pools = {}
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=wait)
+                self._process_pool = None
+
+
+worker_pools = WorkerPools()
+""" The executors currently used by all handlers. See configure_worker_pools().
+"""
+
+
+def configure_worker_pools(mode=THREAD, max_workers=DEFAULT_MAX_WORKERS, max_processes=None, endpoint_limits=None):
+    """ Replaces the executors used by all handlers, shutting down the previous ones.
+
+        :param mode: One of EXECUTOR_MODES.
+        :param max_workers: The number of threads of the shared pool.
+        :param max_processes: The number of processes in PROCESS mode (None means the number of cores).
+        :param endpoint_limits: A map {endpoint name: maximum number of concurrent requests}, which
+            overrides ENDPOINT_CONCURRENCY_LIMITS.
+    """
+    global worker_pools
+    previous_pools = worker_pools
+    worker_pools = WorkerPools(mode, max_workers, max_processes, endpoint_limits)
+    previous_pools.shutdown(wait=False)
+    log.info("Reel executor mode [{0}] with [{1}] shared workers and endpoint limits {2}".format(
+        mode, max_workers, worker_pools.endpoint_limits))
+
+
+def _run_in_new_context(func, params, tracer_id, endpoint, environment):
+    """ Runs an API entry point within a process pool worker, re-creating the caller's request context there.
+    """
+    with new_context(tracer_id=tracer_id, endpoint=endpoint, environment=environment):
+        return func(params)
+
+
 class FutureHandler(tornado.web.RequestHandler):
     """ Implements the async calls for POST and GET.
     """
@@ -74,13 +208,37 @@ class FutureHandler(tornado.web.RequestHandler):
         except IndexError:
             return None
 
+    def call_api(self, func, params):
+        """ Invokes an API entry point. In PROCESS mode the call is shipped to the process pool
+            (along with the current request context), and the calling worker thread waits for its result.
+
+            :param func: A module-level API function, such as barbante.api.recommend.main.
+            :param params: The list of arguments expected by *func*.
+            :returns: The API response.
+        """
+        if worker_pools.mode != PROCESS:
+            return func(params)
+        context = get_context()
+        future = worker_pools.process_pool().submit(_run_in_new_context, func, params,
+                                                    context.tracer_id, context.endpoint, context.environment)
+        return future.result()
+
     @gen.coroutine
     def handle_request(self, method, *args):
+        env = args[0] if len(args) > 0 and is_valid_customer_identifier(args[0]) else None
+        tracer_id = self._get_tracer_id()
+        endpoint = self._get_endpoint_name()
+
         def work():
-            env = args[0] if len(args) > 0 and is_valid_customer_identifier(args[0]) else None
-            with new_context(tracer_id=self._get_tracer_id(), endpoint=self._get_endpoint_name(), environment=env):
+            with new_context(tracer_id=tracer_id, endpoint=endpoint, environment=env):
                 return method(*args)
-        response = work()
+
+        if worker_pools.mode == INLINE or (worker_pools.mode == ASYNC and endpoint in ASYNC_ENDPOINTS):
+            response = work()
+            if is_future(response):
+                response = yield response
+        else:
+            response = yield worker_pools.thread_pool(endpoint).submit(work)
         self.write(response)
 
     @gen.coroutine
@@ -99,7 +257,7 @@ class GetUserTemplatesHandler(FutureHandler):
         super().__init__(*args, **kwargs)
 
     def do_get(self, *args):
-        return user_templates.main(args)
+        return self.call_api(user_templates.main, args)
 
 
 class ProcessActivitySlowlaneHandler(FutureHandler):
@@ -114,7 +272,7 @@ class ProcessActivitySlowlaneHandler(FutureHandler):
         product_id = self.get_argument('external_product_id', None)
         activity_type = self.get_argument('activity_type')
         activity_date = self.get_argument('activity_date')
-        return process_activity_slowlane.main([env, user_id, product_id, activity_type, activity_date])
+        return self.call_api(process_activity_slowlane.main, [env, user_id, product_id, activity_type, activity_date])
 
 
 class ProcessActivityFastlaneHandler(FutureHandler):
@@ -129,7 +287,7 @@ class ProcessActivityFastlaneHandler(FutureHandler):
         product_id = self.get_argument('external_product_id', None)
         activity_type = self.get_argument('activity_type')
         activity_date = self.get_argument('activity_date')
-        return process_activity_fastlane.main([env, user_id, product_id, activity_type, activity_date])
+        return self.call_api(process_activity_fastlane.main, [env, user_id, product_id, activity_type, activity_date])
 
 
 class ProcessImpressionHandler(FutureHandler):
@@ -143,7 +301,7 @@ class ProcessImpressionHandler(FutureHandler):
         user_id = self.get_argument('external_user_id')
         product_id = self.get_argument('external_product_id')
         impression_date = self.get_argument('impression_date')
-        return process_impression.main([env, user_id, product_id, impression_date])
+        return self.call_api(process_impression.main, [env, user_id, product_id, impression_date])
 
 
 class ProcessProductHandler(FutureHandler):
@@ -155,7 +313,7 @@ class ProcessProductHandler(FutureHandler):
     def do_post(self, *args):
         env = self.get_argument('env')
         product = self.get_argument('product')
-        return process_product.main([env, product])
+        return self.call_api(process_product.main, [env, product])
 
 
 class DeleteProductHandler(FutureHandler):
@@ -170,7 +328,7 @@ class DeleteProductHandler(FutureHandler):
         deletion_date = self.get_argument('deleted_on')
         if deletion_date == '':
             deletion_date = None
-        return delete_product.main([env, product_id, deletion_date])
+        return self.call_api(delete_product.main, [env, product_id, deletion_date])
 
 
 class RecommendationHandler(FutureHandler):
@@ -184,7 +342,27 @@ class RecommendationHandler(FutureHandler):
         context_filter = self.get_query_argument('filter', default=None)
         if context_filter:
             params.append(context_filter)
-        return recommend.main(params)
+        if worker_pools.mode == ASYNC:
+            return recommend.main_async(params, worker_pools.thread_pool(self._get_endpoint_name()))
+        return self.call_api(recommend.main, params)
+
+
+class BatchRecommendationHandler(FutureHandler):
+    """ Batch recommendation web handler.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def do_post(self, *args):
+        env = self.get_argument('env')
+        user_ids = tornado.escape.json_decode(self.get_argument('user_ids'))
+        count_recommendations = self.get_argument('count_recommendations')
+        algorithm = self.get_argument('algorithm')
+        params = [env, user_ids, count_recommendations, algorithm]
+        context_filter = self.get_argument('filter', None)
+        if context_filter:
+            params.append(context_filter)
+        return self.call_api(recommend.main_batch, params)
 
 
 class ConsolidateProductTemplatesHandler(FutureHandler):
@@ -195,7 +373,7 @@ class ConsolidateProductTemplatesHandler(FutureHandler):
 
     def do_post(self, *args):
         env = self.get_argument('env')
-        return consolidate_product_templates.main([env])
+        return self.call_api(consolidate_product_templates.main, [env])
 
 
 class ConsolidateUserTemplatesHandler(FutureHandler):
@@ -206,7 +384,7 @@ class ConsolidateUserTemplatesHandler(FutureHandler):
 
     def do_post(self, *args):
         env = self.get_argument('env')
-        return consolidate_user_templates.main([env])
+        return self.call_api(consolidate_user_templates.main, [env])
 
 
 class VersionHandler(FutureHandler):
@@ -227,7 +405,7 @@ class CacheStatsHandler(FutureHandler):
         super().__init__(*args, **kwargs)
 
     def do_get(self, *args):
-        return cache_stats.main(args)
+        return self.call_api(cache_stats.main, args)
 
 
 class ClearCacheHandler(FutureHandler):
@@ -237,7 +415,7 @@ class ClearCacheHandler(FutureHandler):
         super().__init__(*args, **kwargs)
 
     def do_get(self, *args):
-        return clear_cache.main(args)
+        return self.call_api(clear_cache.main, args)
 
 
 def handlers():
@@ -249,6 +427,7 @@ def handlers():
         /process_impression - BODY:<env>,<external_user_id>,<external_product_id>,<impression_date>
         /delete_product - BODY:<env>,<product_id>,<deleted_on>
         /recommend/<env>/<user_id>/<count_recommendations>/<algorithm>/<context_filter_string>
+        /recommend_batch - BODY:<env>,<user_ids (json list)>,<count_recommendations>,<algorithm>,<filter>
         /consolidate_product_templates/<env>
         /consolidate_user_templates/<env>
         /version
@@ -262,6 +441,7 @@ def handlers():
         (r"/process_product/?([^/]+)?/?([^/]+)?", ProcessProductHandler),
         (r"/process_impression", ProcessImpressionHandler),
         (r"/delete_product", DeleteProductHandler),
+        (r"/recommend_batch/?", BatchRecommendationHandler),
         (r"/recommend/([^/]+)/([^/]+)/([^/]+)/([^/]+)?(?:\?filter=([^&]+).*)?", RecommendationHandler),
         (r"/consolidate_product_templates/?([^/]+)?", ConsolidateProductTemplatesHandler),
         (r"/consolidate_user_templates/?([^/]+)?", ConsolidateUserTemplatesHandler),
@@ -287,18 +467,48 @@ def set_exit_handler(func):
 def sig_handler(sig, _):
     log.info("Exiting signal {0} received".format(sig))
     stop_tornado()
+    worker_pools.shutdown(wait=False)
     sys.exit(1)
 
 
 def main(argv):
+    """ Usage: reel.py [-p <port>] [-e inline|thread|process|async] [-w <max_workers>] [--processes=<n>]
+                         [--endpoint-limit=<endpoint>:<n> ...]
+
+        In async mode, the customer contexts are loaded with an AsyncMongoDBProxy (which requires motor:
+        install barbante with its 'async' extra).
+    """
     port = '8888'
-    options, remainder = getopt.getopt(argv, "p:", ['port='])
+    mode = THREAD
+    max_workers = DEFAULT_MAX_WORKERS
+    max_processes = None
+    endpoint_limits = {}
+    long_options = ['port=', 'executor=', 'workers=', 'processes=', 'endpoint-limit=']
+    options, remainder = getopt.getopt(argv, "p:e:w:", long_options)
     for opt, args in options:
         if opt in ('-p', '--port'):
             port = args
+        elif opt in ('-e', '--executor'):
+            mode = args
+        elif opt in ('-w', '--workers'):
+            max_workers = int(args)
+        elif opt == '--processes':
+            max_processes = int(args)
+        elif opt == '--endpoint-limit':
+            endpoint, limit = args.rsplit(':', 1)
+            endpoint_limits[endpoint] = int(limit)
     barbante_logging.setup_logging(filename_modifier=port)
     log.info("Reel server running on port [{0}]".format(port))
 
+    if mode == ASYNC:
+        try:
+            from barbante.data.AsyncMongoDBProxy import AsyncMongoDBProxy
+        except ImportError as err:
+            log.error("The async executor mode requires motor (pip install barbante[async]): {0}".format(err))
+            sys.exit(1)
+        barbante.context.DEFAULT_DB_PROXY_CLASS = AsyncMongoDBProxy
+    configure_worker_pools(mode, max_workers, max_processes, endpoint_limits)
+
     set_exit_handler(sig_handler)
     start_tornado(port)
 
@@ -1,5 +1,6 @@
 import http.client
 import json
+import os
 import urllib.parse
 
 from tornado import web, testing
@@ -149,6 +150,48 @@ class ReelTest(testing.AsyncHTTPTestCase):
         self.assertEqual(response.code, http.client.OK)
         self.assertEqual(json.loads(response.body.decode("utf-8"))["success"], False, "Wrong success indicator")
 
+    def test_recommend_success_in_async_mode(self):
+        # covers the coroutine handlers, reading through the default async reads of the test data proxy
+        # (barbante.data.AsyncMongoDBProxy itself is tested in barbante.data.tests.test_async_mongodb_proxy)
+        reel.configure_worker_pools(reel.ASYNC)
+        try:
+            response = self.fetch('/recommend/' + tests.TEST_ENV + '/u_eco_1/10/HRChunks?filter={"language":"english"}')
+        finally:
+            reel.configure_worker_pools()
+        self.assertEqual(response.code, http.client.OK)
+        self.assertEqual(json.loads(response.body.decode("utf-8"))["success"], True, "Wrong success indicator")
+
+    def test_cache_stats(self):
+        response = self.fetch('/cache_stats/' + tests.TEST_ENV)
+        self.assertEqual(response.code, http.client.OK)
+        response_json = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(response_json["success"], True, "Wrong success indicator")
+        self.assertEqual(response_json["pid"], os.getpid(), "Wrong process")
+        self.assertIn("hits", response_json["product_models"], "Missing product models cache stats")
+
+    def test_cache_stats_in_process_mode(self):
+        reel.configure_worker_pools(reel.PROCESS, max_processes=1)
+        try:
+            response = self.fetch('/cache_stats/' + tests.TEST_ENV)
+        finally:
+            reel.configure_worker_pools()
+        self.assertEqual(response.code, http.client.OK)
+        response_json = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(response_json["success"], True, "Wrong success indicator")
+        self.assertNotEqual(response_json["pid"], os.getpid(), "The stats should be those of a worker process")
+
+    def test_recommend_batch(self):
+        post_data = {'env': tests.TEST_ENV,
+                     'user_ids': json.dumps(['u_eco_1', 'u_eco_2']),
+                     'count_recommendations': 10,
+                     'algorithm': 'HRChunks'}
+        body = urllib.parse.urlencode(post_data)
+        response = self.fetch('/recommend_batch', method='POST', headers=None, body=body)
+        self.assertEqual(response.code, http.client.OK)
+        response_json = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(response_json["success"], True, "Wrong success indicator")
+        self.assertEqual(set(response_json["products_by_user"].keys()), {'u_eco_1', 'u_eco_2'}, "Wrong users")
+
     def test_consolidate_user_templates(self):
         post_data = {'env': tests.TEST_ENV}
         body = urllib.parse.urlencode(post_data)
@@ -204,3 +247,40 @@ class TracerIdTest(testing.AsyncHTTPTestCase):
                               headers={'tracerid': tracer_id})
         self.http_client.fetch(request, on_fetch)
         self.wait()
+
+
+class WorkerPoolsTest(testing.AsyncHTTPTestCase):
+
+    def tearDown(self):
+        reel.configure_worker_pools()
+        super().tearDown()
+
+    def get_app(self):
+        return web.Application([
+            (r"/echo", TracerIdTestHandler),
+            (r"/limited", TracerIdTestHandler)
+        ])
+
+    def test_endpoint_limits(self):
+        """ Limited endpoints should be served by dedicated pools, sized after their limits.
+        """
+        pools = reel.WorkerPools(max_workers=8, endpoint_limits={'limited': 2})
+        try:
+            nose.tools.eq_(pools.thread_pool('limited')._max_workers, 2)
+            nose.tools.eq_(pools.thread_pool('echo')._max_workers, 8)
+            nose.tools.ok_(pools.thread_pool('echo') is pools.thread_pool('recommend'))
+            nose.tools.ok_(pools.thread_pool('limited') is not pools.thread_pool('echo'))
+        finally:
+            pools.shutdown()
+
+    def test_invalid_mode(self):
+        nose.tools.assert_raises(ValueError, reel.WorkerPools, 'invalid')
+
+    def test_tracer_id_in_every_mode(self):
+        """ The request context should be propagated no matter where the handler runs.
+        """
+        tracer_id = '6c006821-0cb1-42e8-8ab1-fb6e059cabab'.replace('-', '')
+        for mode in (reel.INLINE, reel.THREAD, reel.ASYNC):
+            reel.configure_worker_pools(mode)
+            response = self.fetch('/limited', headers={'tracerid': tracer_id})
+            nose.tools.eq_(tracer_id, json.loads(response.body.decode('utf-8')).get('tracerid'))
@@ -2,6 +2,8 @@
 """
 import logging
 
+from tornado.ioloop import IOLoop
+
 from barbante import context
 
 # Disable logging to speed up tests:
@@ -44,7 +46,7 @@ def _init_context(custom_settings, use_custom_data_proxy=False):
 
 # noinspection PyProtectedMember
 def init_session(custom_settings=None, context_filter_string=None, user_id=None,
-                 algorithm=None, use_custom_data_proxy=False):
+                 algorithm=None, use_custom_data_proxy=False, deadline=None):
     """ Inits a test session.
 
         :param custom_settings: Used to override customer settings defined in the customer config
@@ -52,6 +54,7 @@ def init_session(custom_settings=None, context_filter_string=None, user_id=None,
         :param user_id: If None, UserContext won't be created.
         :param algorithm: The algorithm to be used for recommendations during the tests session.
         :param use_custom_data_proxy: Do not reuse the singleton data proxy; instead, create a new one.
+        :param deadline: The Deadline of the session. If None, the session is unbounded.
 
         :returns: the SessionContext that can be used to access settings and database
     """
@@ -64,5 +67,50 @@ def init_session(custom_settings=None, context_filter_string=None, user_id=None,
     test_session = context.init_session(customer_ctx=customer_context,
                                         user_id=user_id,
                                         context_filter_string=context_filter_string,
-                                        algorithm=algorithm)
+                                        algorithm=algorithm,
+                                        deadline=deadline)
     return test_session
+
+
+def init_sessions(user_ids, custom_settings=None, context_filter_string=None, algorithm=None):
+    """ Inits one test session per user, all of them sharing the same bulk-loaded user data.
+
+        :param user_ids: A list of user ids.
+        :param custom_settings: Used to override customer settings defined in the customer config
+        :param context_filter_string: A ContextFilter instance.
+        :param algorithm: The algorithm to be used for recommendations during the tests session.
+
+        :returns: a map {user_id: SessionContext}
+    """
+    customer_context = _init_context(custom_settings)
+    customer_context.data_proxy.write_concern_level = 1
+
+    return context.init_sessions(customer_ctx=customer_context,
+                                 user_ids=user_ids,
+                                 context_filter_string=context_filter_string,
+                                 algorithm=algorithm)
+
+
+def init_session_async(custom_settings=None, context_filter_string=None, user_id=None, algorithm=None, deadline=None):
+    """ Inits a test session by means of barbante.context.init_session_async(), on a new IOLoop.
+
+        :param custom_settings: Used to override customer settings defined in the customer config
+        :param context_filter_string: A ContextFilter instance.
+        :param user_id: If None, UserContext won't be created.
+        :param algorithm: The algorithm to be used for recommendations during the tests session.
+        :param deadline: The Deadline of the session. If None, the session is unbounded.
+
+        :returns: the SessionContext that can be used to access settings and database
+    """
+    customer_context = _init_context(custom_settings)
+    customer_context.data_proxy.write_concern_level = 1
+
+    io_loop = IOLoop()
+    try:
+        return io_loop.run_sync(lambda: context.init_session_async(customer_ctx=customer_context,
+                                                                   user_id=user_id,
+                                                                   context_filter_string=context_filter_string,
+                                                                   algorithm=algorithm,
+                                                                   deadline=deadline))
+    finally:
+        io_loop.close()
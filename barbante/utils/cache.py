@@ -1,19 +1,142 @@
+import collections
 import memcache
 import hashlib
+import random
+import threading
+import time
 
 import barbante.utils.logging as barbante_logging
 
 
 log = barbante_logging.get_logger(__name__)
 
+GENERATION_CHECK_INTERVAL = 1
+""" The minimum interval (in seconds) between two consecutive reads of the cache generation from memcache. """
+
+
+class LocalCache(object):
+    """ A bounded, thread-safe, in-process LRU cache whose entries expire after a time-to-live.
+
+        Each entry has a weight (the length of the value, when it has one), so that the cache may also be bounded
+        by the total weight of its values (e.g. the overall number of product ids held in memory).
+    """
+
+    def __init__(self, max_size=None, max_weight=None, ttl=None):
+        """
+        :param max_size: The maximum number of entries, or None for no limit.
+        :param max_weight: The maximum total weight of the values, or None for no limit.
+        :param ttl: The time-to-live of the entries (in seconds), or None for no expiration.
+        """
+        self.max_size = max_size
+        """ The maximum number of entries. """
+        self.max_weight = max_weight
+        """ The maximum total weight of the values. """
+        self.ttl = ttl
+        """ The time-to-live of the entries, in seconds. """
+        self.weight = 0
+        """ The current total weight of the values. """
+        self.hits = 0
+        """ The number of successful lookups. """
+        self.misses = 0
+        """ The number of unsuccessful lookups. """
+        self._entries = collections.OrderedDict()
+        """ A map {key: (value, weight, tag, expiration)}, from the least to the most recently used entry. """
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # Copies get their own (empty) storage, with the same bounds.
+        return LocalCache(self.max_size, self.max_weight, self.ttl)
+
+    def get(self, key, tag=None):
+        """ Retrieves a value, provided it has not expired and was stored with the same *tag*.
+
+            :returns: The cached value, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, _, entry_tag, expiration = entry
+                if entry_tag == tag and (expiration is None or expiration > time.time()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return None
+
+    def get_many(self, keys, tag=None):
+        """ Retrieves the values of many keys at once.
+
+            :returns: A map {key: value} with the keys which were found in the cache.
+        """
+        result = {}
+        for key in keys:
+            value = self.get(key, tag)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, values_by_key, tag=None):
+        """ Stores many values at once.
+        """
+        for key, value in values_by_key.items():
+            self.set(key, value, tag)
+
+    def invalidate(self, keys):
+        """ Removes the given keys from the cache.
+        """
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def set(self, key, value, tag=None):
+        """ Stores a value, evicting the least recently used entries if the cache overflows.
+        """
+        weight = len(value) if hasattr(value, "__len__") else 1
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        expiration = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, weight, tag, expiration)
+            self.weight += weight
+            while (self.max_size is not None and len(self._entries) > self.max_size) or \
+                    (self.max_weight is not None and self.weight > self.max_weight):
+                self._pop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def get_stats(self):
+        return {"size": len(self._entries),
+                "weight": self.weight,
+                "hits": self.hits,
+                "misses": self.misses}
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[1]
+
+
 class Cache(object):
-    """  Barbante interface to memcache
+    """  Barbante interface to memcache, fronted by an in-process LRU tier.
+
+         Both tiers are namespaced by a generation counter kept in memcache. Clearing the cache increments
+         the generation, which invalidates the entries of every process sharing the same memcache servers.
+         Should the counter itself be evicted, it is seeded again with a random generation, so that the
+         entries of former generations (which may still be in memcache) are never served again.
     """
 
-    def __init__(self, settings, prefix):
+    def __init__(self, settings, prefix, local_max_size=None, local_max_weight=None, local_ttl=None):
         """
         :param settings: config's _CacheSetting instance that provides environment and hosts
         :param prefix: the cache name
+        :param local_max_size: the maximum number of entries in the in-process tier
+        :param local_max_weight: the maximum total weight (length of the values) in the in-process tier
+        :param local_ttl: the time-to-live (in seconds) of the entries in the in-process tier
         :return: an instance of the cache
         """
         self.hosts = settings.hosts
@@ -21,27 +144,69 @@ class Cache(object):
         self.prefix = prefix
         self.key_prefix = "{0}.{1}.".format(self.environment, self.prefix)
         self.memcached = memcache.Client(self.hosts, server_max_key_length=10*1024, debug=0)
+        self.local = LocalCache(local_max_size, local_max_weight, local_ttl)
+        """ The in-process tier. """
+        self.hits = 0
+        """ The number of memcache hits of this process. """
+        self.misses = 0
+        """ The number of memcache misses of this process. """
+        self._generation = None
+        self._generation_checked_at = 0
+
+    def __deepcopy__(self, memo):
+        # The cache is a process-wide resource, shared by all (cloned) contexts.
+        return self
 
     def set(self, key, value):
         self.set_dictionary({key: value})
 
     def set_dictionary(self, dictionary):
+        generation = self.get_generation()
+        for key, value in dictionary.items():
+            self.local.set(key, value, generation)
         hashed_keys_dictionary = {self._hash(key): value for key, value in dictionary.items()}
-        self.memcached.set_multi(hashed_keys_dictionary, key_prefix=self.key_prefix)
+        self.memcached.set_multi(hashed_keys_dictionary, key_prefix=self._generation_key_prefix(generation))
 
     def get(self, key):
+        generation = self.get_generation()
+        value = self.local.get(key, generation)
+        if value is not None:
+            log.info("cache hit (local)")
+            return value
         values = [value for value in self.get_dictionary([key], False).values()]
         value = values[0] if len(values) == 1 else None
+        if value is not None:
+            self.local.set(key, value, generation)
         log.info("cache {0}".format("hit" if value else "miss"))
         return value
 
     def get_dictionary(self, keys, keys_already_hashed=True):
         hashed_keys = [self._hash(key) for key in keys] if not keys_already_hashed else keys
-        result = self.memcached.get_multi(hashed_keys, key_prefix=self.key_prefix)
+        result = self.memcached.get_multi(hashed_keys, key_prefix=self._generation_key_prefix(self.get_generation()))
+        self.hits += len(result)
+        self.misses += len(hashed_keys) - len(result)
         return result
 
+    def get_generation(self):
+        """ Returns the current generation of the cache, re-reading it from memcache at most once per
+            GENERATION_CHECK_INTERVAL seconds.
+        """
+        now = time.time()
+        if self._generation is None or now - self._generation_checked_at >= GENERATION_CHECK_INTERVAL:
+            generation = self.memcached.get(self._generation_key())
+            if generation is None:
+                generation = self._seed_generation()
+            self._generation = generation
+            self._generation_checked_at = now
+        return self._generation
+
     def clear(self):
-        self.memcached.flush_all()
+        generation = self.memcached.incr(self._generation_key())
+        if generation is None:
+            generation = self._seed_generation()
+        self._generation = generation
+        self._generation_checked_at = time.time()
+        self.local.clear()
 
     def get_stats(self):
         stats = {}
@@ -53,10 +218,22 @@ class Cache(object):
                          "hits": full_stats['get_hits'],
                          "misses": full_stats['get_misses'],
                          "current_connections": full_stats['curr_connections']}
+        stats["local"] = self.local.get_stats()
+        stats["memcache"] = {"hits": self.hits, "misses": self.misses}
         return stats
 
-    def _hash(self, string):
-        return hashlib.md5(string.encode('utf-8')).hexdigest()
+    def _seed_generation(self):
+        """ Sets a random generation, unless another process has just done so, and returns the generation.
+            (Restarting from a fixed generation would bring back the entries of former generations.)
+        """
+        self.memcached.add(self._generation_key(), random.SystemRandom().getrandbits(62))
+        return self.memcached.get(self._generation_key()) or 0
 
+    def _generation_key(self):
+        return self.key_prefix + "generation"
 
+    def _generation_key_prefix(self, generation):
+        return "{0}{1}.".format(self.key_prefix, generation)
 
+    def _hash(self, string):
+        return hashlib.md5(string.encode('utf-8')).hexdigest()
@@ -0,0 +1,55 @@
+""" Request-level deadlines.
+"""
+
+from time import time
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when an operation is aborted because the deadline of the request it serves has been reached.
+    """
+
+
+class Deadline(object):
+    """ The time budget of a request, shared by all stages of the recommendation pipeline.
+
+        Stages check it before starting optional work (so that the request degrades gracefully instead of
+        exceeding its time budget), and database queries are bounded by the time remaining (see max_time_ms()).
+    """
+
+    def __init__(self, timeout=None, start=None):
+        """
+        :param timeout: The time budget, in seconds, or None for an unbounded deadline.
+        :param start: The time (as in time.time()) when the request started. If None, the current time is used.
+        """
+        self.timeout = timeout
+        """ The time budget, in seconds. """
+        if start is None:
+            start = time()
+        self.expires_at = start + timeout if timeout is not None else None
+        """ The time (as in time.time()) when the deadline is reached, or None if it is unbounded. """
+
+    def is_bounded(self):
+        return self.expires_at is not None
+
+    def remaining(self, limit=None):
+        """ Returns the time left, in seconds (never less than zero).
+
+            :param limit: If not None, the result will not exceed this limit.
+
+            :returns: The time left, or None if both the deadline and the limit are unbounded.
+        """
+        if self.expires_at is None:
+            return limit
+        remaining = max(0., self.expires_at - time())
+        return min(remaining, limit) if limit is not None else remaining
+
+    def expired(self):
+        return self.expires_at is not None and time() >= self.expires_at
+
+    def max_time_ms(self):
+        """ Returns the time left in milliseconds (at least 1), to be used as the server-side time limit
+            of database queries, or None if the deadline is unbounded.
+        """
+        if self.expires_at is None:
+            return None
+        return max(1, int(1000 * (self.expires_at - time())))
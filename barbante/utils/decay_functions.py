@@ -1,6 +1,8 @@
 """ Decay functions.
 """
 
+import numpy as np
+
 
 def linear(x, root):
     """ Returns a decay factor based on the linear function
@@ -54,3 +56,25 @@ def step(x, high, low, threshold):
         return high
     else:
         return low
+
+
+def decay_factors(function_name, x, ttl=None, halflife=None):
+    """ Vectorized counterpart of the decay functions above, for many arguments at once.
+
+        :param function_name: One of "linear", "rational", "exponential" and "step". Any other value means no decay.
+        :param x: A sequence (or numpy array) of function arguments.
+        :param ttl: The *root* of the linear function, or the *threshold* of the step function.
+        :param halflife: The half-life of the exponential function.
+
+        :returns: A numpy array with the decay factor of each argument.
+    """
+    x = np.asarray(x, dtype=float)
+    if function_name == "linear":
+        return 1 - np.minimum(x, ttl) / ttl
+    elif function_name == "rational":
+        return 1 / (x + 1)
+    elif function_name == "exponential":
+        return np.power(2.0, -x / halflife)
+    elif function_name == "step":
+        return np.where(x < ttl, 1.0, -1.0)
+    return np.ones(len(x))
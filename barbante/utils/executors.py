@@ -0,0 +1,148 @@
+""" Long-lived executors shared across requests.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import barbante.utils.logging as barbante_logging
+
+
+log = barbante_logging.get_logger(__name__)
+
+
+class DeadlineExecutor(object):
+    """ A bounded thread pool, created once per process and reused by every request, which runs
+        fan-out calls under a true deadline: calls which do not complete in time are abandoned
+        (their results are discarded), rather than waited for.
+    """
+
+    def __init__(self, max_workers):
+        """
+        :param max_workers: The maximum number of threads.
+        """
+        self.max_workers = max_workers
+        """ The maximum number of threads. """
+        self.submitted = 0
+        """ The number of calls submitted so far. """
+        self.queued = 0
+        """ The number of submitted calls which have not started running yet. """
+        self.running = 0
+        """ The number of calls currently running (including abandoned ones). """
+        self.timeouts = 0
+        """ The number of calls abandoned for not completing within their deadline. """
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # The executor is a process-wide resource, shared by all (cloned) contexts.
+        return self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # A forked process cannot use the threads of its parent.
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args):
+        """ Submits a call to the pool.
+
+            :returns: A Future.
+        """
+        def tracked_call():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        executor = self._get_executor()
+        with self._lock:
+            self.submitted += 1
+            self.queued += 1
+        return executor.submit(tracked_call)
+
+    def run(self, calls, timeout):
+        """ Runs many calls concurrently, waiting at most *timeout* seconds for all of them.
+
+            :param calls: A map {key: (function, tuple of arguments)}.
+            :param timeout: The deadline, in seconds (None means no deadline).
+
+            :returns: A map {key: result} with the calls which completed in time,
+                and the set of keys of the calls which timed out.
+        """
+        key_by_future = {self.submit(fn, *args): key for key, (fn, args) in calls.items()}
+        done, not_done = concurrent.futures.wait(key_by_future, timeout=timeout)
+
+        timed_out = set()
+        cancelled = 0
+        for future in not_done:
+            if future.cancel():  # calls still in the queue will not even start
+                cancelled += 1
+            timed_out.add(key_by_future[future])
+        if len(timed_out) > 0:
+            with self._lock:
+                self.timeouts += len(timed_out)
+                self.queued -= cancelled
+
+        return {key_by_future[future]: future.result() for future in done}, timed_out
+
+    def run_graph(self, tasks):
+        """ Runs many interdependent calls, each one as soon as all the calls it depends on are completed
+            (so that independent calls run concurrently).
+
+            If a call raises an exception, the calls which depend on it are not run, and the exception is
+            re-raised once the calls already running are completed.
+
+            :param tasks: A map {key: (function with no arguments, set of keys of the tasks it depends on)}.
+
+            :returns: A map {key: elapsed time (in seconds) of the call}.
+        """
+        def timed_call(fn):
+            start = time.time()
+            fn()
+            return time.time() - start
+
+        pending = dict(tasks)
+        key_by_future = {}
+        completed = set()
+        elapsed_time_by_key = {}
+        error = None
+
+        while True:
+            if error is None:
+                ready = [key for key, (_, dependencies) in pending.items() if dependencies <= completed]
+                for key in ready:
+                    fn, _ = pending.pop(key)
+                    key_by_future[self.submit(timed_call, fn)] = key
+            if len(key_by_future) == 0:
+                break
+            done, _ = concurrent.futures.wait(key_by_future, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = key_by_future.pop(future)
+                try:
+                    elapsed_time_by_key[key] = future.result()
+                    completed.add(key)
+                except Exception as err:
+                    if error is None:
+                        error = err
+
+        if error is not None:
+            raise error
+        if len(pending) > 0:
+            raise ValueError("Unsatisfiable dependencies: {0}".format(sorted(pending)))
+        return elapsed_time_by_key
+
+    def get_stats(self):
+        return {"max_workers": self.max_workers,
+                "submitted": self.submitted,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "timeouts": self.timeouts}
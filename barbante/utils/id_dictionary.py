@@ -0,0 +1,88 @@
+""" Dictionary encoding of external ids.
+"""
+
+import json
+import threading
+
+import numpy as np
+
+
+class IdDictionary(object):
+    """ Interns external ids (arbitrary strings, such as user and product ids) into consecutive int32 indices,
+        in the order in which they are first seen.
+
+        Batch processes use the indices internally (as keys of maps and sets, or as positions in arrays and
+        sparse matrices), which is much cheaper in memory and hashing than using the external ids themselves,
+        and translate them back to external ids only when persisting their results.
+        Interning is thread-safe, so that a dictionary may be shared by the workers of a batch process.
+    """
+
+    def __init__(self, ids=None):
+        """
+        :param ids: An optional iterable of external ids to be interned right away.
+        """
+        self.ids = []
+        """ The list of external ids, by index. """
+        self._index_by_id = {}
+        self._lock = threading.Lock()
+        if ids is not None:
+            self.intern_many(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, external_id):
+        return external_id in self._index_by_id
+
+    def intern(self, external_id):
+        """ Returns the index of an external id, adding it to the dictionary if needed.
+        """
+        idx = self._index_by_id.get(external_id)
+        if idx is None:
+            with self._lock:
+                idx = self._index_by_id.get(external_id)
+                if idx is None:
+                    # the id is listed before it is indexed, so that lock-free readers never see a dangling index
+                    idx = len(self.ids)
+                    self.ids.append(external_id)
+                    self._index_by_id[external_id] = idx
+        return idx
+
+    def intern_many(self, external_ids):
+        """ Returns a list with the indices of many external ids, adding them to the dictionary if needed.
+        """
+        return [self.intern(external_id) for external_id in external_ids]
+
+    def index(self, external_id):
+        """ Returns the index of an external id, or None if it is not in the dictionary.
+        """
+        return self._index_by_id.get(external_id)
+
+    def indices(self, external_ids):
+        """ Returns an int32 array with the indices of many external ids (-1 for those not in the dictionary).
+        """
+        return np.array([self._index_by_id.get(external_id, -1) for external_id in external_ids], dtype=np.int32)
+
+    def external(self, idx):
+        """ Returns the external id of an index.
+        """
+        return self.ids[idx]
+
+    def externals(self, indices):
+        """ Returns a list with the external ids of many indices.
+        """
+        ids = self.ids
+        return [ids[idx] for idx in indices]
+
+    def save(self, filename):
+        """ Persists the dictionary as a JSON list of external ids (in the order of their indices).
+        """
+        with open(filename, "w") as dictionary_file:
+            json.dump(self.ids, dictionary_file)
+
+    @staticmethod
+    def load(filename):
+        """ Reads a dictionary persisted by save().
+        """
+        with open(filename) as dictionary_file:
+            return IdDictionary(json.load(dictionary_file))
@@ -0,0 +1,78 @@
+""" Module with sparse matrix helpers for the batch generation of strengths.
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+
+
+def threshold_mask(matrix, min_value):
+    """ Builds a binary CSR matrix flagging the entries greater than or equal to *min_value*.
+
+        :param matrix: A scipy sparse matrix.
+        :param min_value: The threshold.
+
+        :returns: A CSR matrix with the same shape as *matrix*, with ones where the threshold is met.
+    """
+    matrix = matrix.tocoo()
+    mask = matrix.data >= min_value
+    return sparse.csr_matrix((np.ones(np.count_nonzero(mask), dtype=np.int32),
+                              (matrix.row[mask], matrix.col[mask])), shape=matrix.shape)
+
+
+def values_at(matrix, rows, cols):
+    """ Retrieves the values of a sparse matrix at the given (row, col) coordinates.
+
+        :param matrix: A scipy sparse matrix.
+        :param rows: An array with the row indices.
+        :param cols: An array with the column indices, with the same length as *rows*.
+
+        :returns: A flat numpy array with one value per coordinate.
+    """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=matrix.dtype)
+    return np.asarray(matrix.tocsr()[rows, cols]).ravel()
+
+
+def top_k_by_group(groups, values, k, ranks):
+    """ Selects the k entries with the greatest values within each group.
+
+        :param groups: An array with the group of each entry.
+        :param values: An array with the value of each entry.
+        :param k: The maximum number of entries per group.
+        :param ranks: An array with the rank of each entry, used to break ties (lower ranks come first).
+
+        :returns: An array with the indices of the selected entries, ordered by group and then by descending value.
+    """
+    order = np.lexsort((ranks, -values, groups))
+    sorted_groups = groups[order]
+    position_in_group = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups, side="left")
+    return order[position_in_group < k]
+
+
+def load_impressions_matrix(data_proxy, users_list, products_list, page_size):
+    """ Loads the impressions of the given (non-anonymous) users on the given products into a binary matrix.
+
+        :param data_proxy: The data proxy.
+        :param users_list: The list of user ids, in the order of the rows.
+        :param products_list: The list of product ids, in the order of the columns.
+        :param page_size: The number of users whose impressions are fetched at a time.
+
+        :returns: A CSR matrix with one row per user and one column per product.
+    """
+    product_idx_by_id = {p: idx for idx, p in enumerate(products_list)}
+    rows, cols = [], []
+
+    for start_idx in range(0, len(users_list), page_size):
+        page_user_ids = users_list[start_idx:start_idx + page_size]
+        products_by_user = data_proxy.fetch_products_with_impressions_by_user(
+            user_ids=page_user_ids, anonymous=False)
+        for user_offset, user in enumerate(page_user_ids):
+            for product in products_by_user.get(user, set()):
+                product_idx = product_idx_by_id.get(product)
+                if product_idx is not None:
+                    rows += [start_idx + user_offset]
+                    cols += [product_idx]
+
+    coordinates = (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), coordinates),
+                             shape=(len(users_list), len(products_list)))
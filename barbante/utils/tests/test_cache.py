@@ -0,0 +1,109 @@
+""" Test module for barbante.utils.cache.
+"""
+
+import nose.tools
+
+import barbante.utils.cache as cache
+
+
+class _FakeMemcacheClient(object):
+    """ A dict-backed stand-in for memcache.Client, supporting the calls issued by barbante.utils.cache.Cache.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_multi(self, keys, key_prefix=""):
+        return {key: self.values[key_prefix + key] for key in keys if key_prefix + key in self.values}
+
+    def set_multi(self, mapping, key_prefix=""):
+        self.values.update({key_prefix + key: value for key, value in mapping.items()})
+
+    def add(self, key, value):
+        self.values.setdefault(key, value)
+
+    def incr(self, key):
+        if key not in self.values:
+            return None
+        self.values[key] += 1
+        return self.values[key]
+
+    def get_stats(self):
+        return []
+
+
+class _CacheSettings(object):
+
+    def __init__(self):
+        self.hosts = []
+        self.environment = "unit-test"
+
+
+def test_local_cache_lru_eviction():
+    """ Tests that the least recently used entries are evicted when the local tier exceeds its size.
+    """
+    local = cache.LocalCache(max_size=2)
+    local.set("a", {1})
+    local.set("b", {2})
+    local.get("a")
+    local.set("c", {3})
+    nose.tools.eq_(local.get("b"), None, "The least recently used entry should have been evicted")
+    nose.tools.eq_(local.get("a"), {1}, "Wrong cached value")
+    nose.tools.eq_(local.get("c"), {3}, "Wrong cached value")
+    nose.tools.eq_(local.get_stats(), {"size": 2, "weight": 2, "hits": 3, "misses": 1}, "Wrong stats")
+
+
+def test_local_cache_weight_and_ttl():
+    """ Tests the weight bound and the expiration of entries in the local tier.
+    """
+    local = cache.LocalCache(max_weight=3)
+    local.set("a", {1, 2})
+    local.set("b", {3, 4})
+    nose.tools.eq_(local.get("a"), None, "The entry should have been evicted by weight")
+    nose.tools.eq_(local.weight, 2, "Wrong weight")
+
+    local = cache.LocalCache(ttl=-1)
+    local.set("a", {1})
+    nose.tools.eq_(local.get("a"), None, "The entry should have expired")
+
+
+def test_cache_generation_invalidation():
+    """ Tests that clearing a cache invalidates the entries of other processes sharing the same memcache.
+    """
+    memcached = _FakeMemcacheClient()
+    node1 = cache.Cache(_CacheSettings(), "test")
+    node2 = cache.Cache(_CacheSettings(), "test")
+    node1.memcached = node2.memcached = memcached
+
+    node1.set("filter", {"p1", "p2"})
+    nose.tools.eq_(node2.get("filter"), {"p1", "p2"}, "The value should come from memcache")
+    nose.tools.eq_(node2.get("filter"), {"p1", "p2"}, "The value should come from the local tier")
+    stats = node2.get_stats()
+    nose.tools.eq_(stats["local"]["hits"], 1, "Wrong local hits")
+    nose.tools.eq_(stats["memcache"]["hits"], 1, "Wrong memcache hits")
+
+    node1.clear()
+    node2._generation_checked_at = 0  # forces node2 to re-read the generation
+    nose.tools.eq_(node2.get("filter"), None, "The value should have been invalidated")
+
+
+def test_cache_generation_eviction():
+    """ Tests that entries of former generations are not served again once the generation key is evicted.
+    """
+    memcached = _FakeMemcacheClient()
+    node1 = cache.Cache(_CacheSettings(), "test")
+    node2 = cache.Cache(_CacheSettings(), "test")
+    node1.memcached = node2.memcached = memcached
+
+    node1.set("filter", {"p1", "p2"})
+    node1.clear()
+    node1.set("filter", {"p3"})
+
+    del memcached.values[node1._generation_key()]  # evicted by memcache
+    nose.tools.eq_(node2.get("filter"), None, "Entries of former generations should not be served")
+    node1.clear()
+    node1._generation_checked_at = 0  # forces node1 to re-read the generation
+    nose.tools.eq_(node1.get("filter"), None, "Entries of former generations should not be served")
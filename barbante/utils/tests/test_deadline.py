@@ -0,0 +1,31 @@
+""" Test module for barbante.utils.deadline.
+"""
+
+import nose.tools
+
+from barbante.utils.deadline import Deadline
+
+
+def test_unbounded_deadline():
+    """ Tests that an unbounded deadline never expires nor limits database queries.
+    """
+    deadline = Deadline()
+    nose.tools.ok_(not deadline.expired(), "An unbounded deadline should never expire")
+    nose.tools.eq_(deadline.remaining(), None, "Wrong remaining time")
+    nose.tools.eq_(deadline.remaining(2), 2, "The remaining time should be that of the limit")
+    nose.tools.eq_(deadline.max_time_ms(), None, "Queries should not be limited")
+
+
+def test_bounded_deadline():
+    """ Tests the remaining time of bounded deadlines, before and after they expire.
+    """
+    deadline = Deadline(10)
+    nose.tools.ok_(not deadline.expired(), "The deadline should not have expired yet")
+    nose.tools.ok_(0 < deadline.remaining() <= 10, "Wrong remaining time")
+    nose.tools.eq_(deadline.remaining(2), 2, "The remaining time should not exceed the limit")
+    nose.tools.ok_(0 < deadline.max_time_ms() <= 10000, "Wrong query time limit")
+
+    deadline = Deadline(1, start=0)
+    nose.tools.ok_(deadline.expired(), "The deadline should have expired")
+    nose.tools.eq_(deadline.remaining(2), 0, "No time should remain")
+    nose.tools.eq_(deadline.max_time_ms(), 1, "Queries should still be given a (minimal) time limit")
@@ -0,0 +1,23 @@
+""" Test module for barbante.utils.decay_functions.
+"""
+
+import nose.tools
+
+import barbante.tests as tests
+import barbante.utils.decay_functions as df
+
+
+def test_decay_factors():
+    """ Tests that the vectorized decay factors match the scalar decay functions.
+    """
+    x = [0, 1, 3, 7, 10, 30]
+    expected_by_function = {"linear": [df.linear(value, 7) for value in x],
+                            "rational": [df.rational(value) for value in x],
+                            "exponential": [df.exponential(value, 3) for value in x],
+                            "step": [df.step(value, 1, -1, 7) for value in x],
+                            None: [1] * len(x)}
+    for function_name, expected in expected_by_function.items():
+        actual = df.decay_factors(function_name, x, ttl=7, halflife=3)
+        for actual_factor, expected_factor in zip(actual, expected):
+            nose.tools.ok_(abs(actual_factor - expected_factor) < tests.FLOAT_DELTA,
+                           "Wrong [%s] decay factor" % function_name)
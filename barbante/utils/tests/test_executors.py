@@ -0,0 +1,60 @@
+""" Test module for barbante.utils.executors.
+"""
+
+import threading
+from time import time
+
+import nose.tools
+
+import barbante.utils.executors as executors
+
+
+def test_deadline_executor():
+    """ Tests that calls which miss the deadline are abandoned rather than waited for.
+    """
+    executor = executors.DeadlineExecutor(max_workers=2)
+    release = threading.Event()
+
+    start = time()
+    results, timed_out = executor.run({"fast": (lambda x: x + 1, (1,)),
+                                       "slow": (release.wait, (5,))}, timeout=0.2)
+    elapsed = time() - start
+    release.set()
+
+    nose.tools.eq_(results, {"fast": 2}, "Wrong results")
+    nose.tools.eq_(timed_out, {"slow"}, "Wrong timed out calls")
+    nose.tools.ok_(elapsed < 2, "The slow call should have been abandoned")
+    stats = executor.get_stats()
+    nose.tools.eq_(stats["submitted"], 2, "Wrong number of submitted calls")
+    nose.tools.eq_(stats["timeouts"], 1, "Wrong number of timeouts")
+    nose.tools.eq_(stats["queue_depth"], 0, "Wrong queue depth")
+
+
+def test_run_graph():
+    """ Tests that interdependent calls run after their dependencies, and independent ones concurrently.
+    """
+    executor = executors.DeadlineExecutor(max_workers=2)
+    both_started = threading.Barrier(2, timeout=5)  # breaks unless "a" and "b" run at the same time
+    order = []
+
+    def task(key, barrier=None):
+        def call():
+            if barrier is not None:
+                barrier.wait()
+            order.append(key)
+        return call
+
+    elapsed_time_by_key = executor.run_graph({"a": (task("a", both_started), set()),
+                                              "b": (task("b", both_started), set()),
+                                              "c": (task("c"), {"a", "b"})})
+    nose.tools.eq_(set(elapsed_time_by_key), {"a", "b", "c"}, "Wrong timed calls")
+    nose.tools.eq_(order[-1], "c", "A call should only run after its dependencies")
+
+
+@nose.tools.raises(ZeroDivisionError)
+def test_run_graph_with_failure():
+    """ Tests that the exception raised by a call is re-raised by run_graph.
+    """
+    executor = executors.DeadlineExecutor(max_workers=2)
+    executor.run_graph({"a": (lambda: 1 / 0, set()),
+                        "b": (lambda: None, {"a"})})
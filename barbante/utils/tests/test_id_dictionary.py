@@ -0,0 +1,43 @@
+""" Test module for barbante.utils.id_dictionary.
+"""
+
+import concurrent.futures
+import os
+import tempfile
+
+import nose.tools
+
+from barbante.utils.id_dictionary import IdDictionary
+
+
+def test_interning():
+    """ Tests that ids are interned into consecutive indices, in the order in which they are first seen.
+    """
+    dictionary = IdDictionary(["u1", "u2"])
+    nose.tools.eq_(dictionary.intern_many(["u2", "u3", "u1"]), [1, 2, 0], "Wrong indices")
+    nose.tools.eq_(len(dictionary), 3, "Wrong dictionary size")
+    nose.tools.ok_("u3" in dictionary, "Interned id missing")
+    nose.tools.eq_(dictionary.index("u4"), None, "Looking an id up should not intern it")
+    nose.tools.eq_(dictionary.indices(["u3", "u4"]).tolist(), [2, -1], "Wrong indices")
+    nose.tools.eq_(dictionary.externals([2, 0]), ["u3", "u1"], "Wrong external ids")
+
+
+def test_concurrent_interning():
+    """ Tests that concurrent workers get the same index for the same id.
+    """
+    dictionary = IdDictionary()
+    ids = ["p" + str(i) for i in range(1000)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(dictionary.intern_many, [ids] * 8))
+    nose.tools.eq_(len(dictionary), len(ids), "Wrong dictionary size")
+    for indices in results:
+        nose.tools.eq_(dictionary.externals(indices), ids, "Wrong external ids")
+
+
+def test_persistence():
+    """ Tests that a saved dictionary is loaded back with the same indices.
+    """
+    filename = os.path.join(tempfile.mkdtemp(), "users.json")
+    IdDictionary(["u1", "u2", "u3"]).save(filename)
+    dictionary = IdDictionary.load(filename)
+    nose.tools.eq_(dictionary.intern_many(["u3", "u1", "u4"]), [2, 0, 3], "Wrong indices")
@@ -0,0 +1,35 @@
+""" Test module for barbante.utils.matrices.
+"""
+
+import nose.tools
+import numpy as np
+import scipy.sparse as sparse
+
+import barbante.utils.matrices as matrices
+
+
+def test_threshold_mask():
+    """ Tests the binary mask of the entries above a threshold.
+    """
+    ratings = sparse.csr_matrix(np.array([[5, 0, 3], [2, 4, 0]], dtype=np.int8))
+    mask = matrices.threshold_mask(ratings, 3)
+    nose.tools.eq_(mask.toarray().tolist(), [[1, 0, 1], [0, 1, 0]], "Wrong mask")
+
+
+def test_values_at():
+    """ Tests the retrieval of values at arbitrary coordinates.
+    """
+    matrix = sparse.csr_matrix(np.array([[1, 0, 2], [0, 3, 0]]))
+    values = matrices.values_at(matrix, np.array([0, 1, 1]), np.array([2, 1, 0]))
+    nose.tools.eq_(values.tolist(), [2, 3, 0], "Wrong values")
+    nose.tools.eq_(len(matrices.values_at(matrix, np.array([]), np.array([]))), 0, "Values should be empty")
+
+
+def test_top_k_by_group():
+    """ Tests the selection of the greatest entries by group, with ties broken by rank.
+    """
+    groups = np.array([0, 1, 0, 0, 1, 0])
+    values = np.array([0.1, 0.5, 0.7, 0.7, 0.2, 0.3])
+    ranks = np.array([0, 1, 3, 2, 0, 1])
+    selected = matrices.top_k_by_group(groups, values, 2, ranks)
+    nose.tools.eq_(selected.tolist(), [3, 2, 1, 4], "Wrong top entries")
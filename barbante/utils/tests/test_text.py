@@ -79,3 +79,34 @@ def test_count_common_terms_English():
     nose.tools.eq_(text.count_common_terms(text1_stems_no_stopwords,
                                            text2_stems_no_stopwords),
                    3)  # sentence, purpos3, tests
+
+
+def test_pipeline_reuse():
+    """ Tests that the per-language pipeline is shared and memoizes stems.
+    """
+    pipeline = text.get_pipeline("english")
+    nose.tools.ok_(text.get_pipeline("english") is pipeline, "Pipeline should be reused")
+    pipeline.stem.cache_clear()
+    nose.tools.eq_(pipeline.get_stems(["cooking", "cooks", "cooking"]), ["cook", "cook", "cook"], "Wrong stems")
+    nose.tools.eq_(pipeline.stem.cache_info().hits, 1, "Stem should have been memoized")
+
+
+def test_pipeline_unsupported_language():
+    """ Tests that tokens are kept untouched for languages without a stemmer.
+    """
+    nose.tools.eq_(text.get_stems(["cooking", "cooks"], "klingon"), ["cooking", "cooks"], "Tokens should be kept")
+
+
+def test_parse_texts_to_stems():
+    """ Tests that the batch parsing of multilingual texts matches the parsing of each text alone.
+    """
+    documents = [("english", "Cooks who don't love cooking don't cook well."),
+                 ("portuguese", "Eu não gostava do gosto gasto do gesto de agosto."),
+                 ("english", "The cook is going to Mountain View.")]
+    actual = text.parse_texts_to_stems(documents)
+    expected = [text.parse_text_to_stems(language, doc) for language, doc in documents]
+    nose.tools.eq_(actual, expected, "Wrong stems")
+
+    tfs = text.calculate_tfs_from_texts(documents)
+    nose.tools.eq_([stems for stems, _ in tfs], expected, "Wrong stems")
+    nose.tools.eq_(tfs[0][1]["cook"], 3, "Wrong TF")
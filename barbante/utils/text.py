@@ -1,7 +1,9 @@
 """ Module for text processing.
 """
 
-import nltk.tokenize
+import functools
+import nltk.corpus
+import nltk.stem
 import re
 
 from barbante.utils.profiling import profile
@@ -9,6 +11,98 @@ import barbante.utils.logging as barbante_logger
 
 log = barbante_logger.get_logger(__name__)
 
+STEM_CACHE_SIZE = 100000
+""" The maximum number of memoized stems per language. """
+
+EXTRA_STOPWORDS = frozenset(["amp", "quot", "href", "http", "://", ".&#"])
+""" Markup residues which are always treated as stopwords. """
+
+_INVALID_CHARACTERS_TABLE = str.maketrans("", "", "\n\t.,?!$\"")
+# We may want to replace each invalid character with a reserved mnemonic.
+
+_TOKEN_REGEX = re.compile(r"\w+|[^\w\s]+")
+# Same pattern as nltk's WordPunctTokenizer.
+
+
+class TextPipeline(object):
+    """ Per-language text processing resources (stemmer, stopwords), loaded once and reused across calls.
+    """
+
+    def __init__(self, language, stem_cache_size=STEM_CACHE_SIZE):
+        self.language = language
+        """ The language of the texts handled by this pipeline. """
+        try:
+            self.stemmer = nltk.stem.SnowballStemmer(language)
+        except ValueError:
+            self.stemmer = None
+        """ The snowball stemmer of the language, or None if the language is not supported. """
+        try:
+            self.stopwords = frozenset(nltk.corpus.stopwords.words(language)) | EXTRA_STOPWORDS
+        except Exception:
+            self.stopwords = None
+        """ The stopwords of the language, or None if they could not be loaded. """
+        self.stem = functools.lru_cache(maxsize=stem_cache_size)(self._stem)
+        """ Memoized version of the stemming of a single token. """
+
+    def _stem(self, token):
+        return self.stemmer.stem(token)
+
+    def get_stems(self, tokens):
+        """ See barbante.utils.text.get_stems.
+        """
+        if self.stemmer is None:
+            return tokens
+        result = []
+        for token in tokens:
+            try:
+                result += [self.stem(token)]
+            except Exception as err:
+                log.error("Error while stemming {0} term [{1}]: {2}".format(self.language, token, err))
+        return result
+
+    def map_stems(self, tokens):
+        """ Returns a {token: stem} map of the informed tokens (tokens which fail to be stemmed are left out).
+        """
+        if self.stemmer is None:
+            return {token: token for token in tokens}
+        result = {}
+        for token in tokens:
+            try:
+                result[token] = self.stem(token)
+            except Exception as err:
+                log.error("Error while stemming {0} term [{1}]: {2}".format(self.language, token, err))
+        return result
+
+    def remove_stopwords(self, tokens, min_len=1, max_len=30):
+        """ See barbante.utils.text.remove_stopwords.
+        """
+        if self.stopwords is None:
+            return tokens
+        stopwords = self.stopwords
+        try:
+            result = [w for w in tokens if w not in stopwords and
+                      min_len <= len(w) <= max_len]
+        except IOError:
+            return
+        except AttributeError:
+            return
+        except TypeError as error:
+            raise TypeError(
+                "barbante.utils.text.remove_stopwords: {0}".format(error))
+
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def get_pipeline(language):
+    """ Returns the (shared) text processing pipeline of the given language.
+
+        :param language: The language of the texts.
+
+        :returns: A TextPipeline instance.
+    """
+    return TextPipeline(language)
+
 
 def get_stems(tokens, language):
     """ Returns the stems of the informed tokens.
@@ -18,18 +112,7 @@ def get_stems(tokens, language):
 
         :returns: A list of tokens, in the same corresponding order as in the *tokens* list.
     """
-    result = []
-    try:
-        stemmer = nltk.stem.SnowballStemmer(language)
-    except ValueError:
-        return tokens
-    for token in tokens:
-        try:
-            stem = stemmer.stem(token)
-            result += [stem]
-        except Exception as err:
-            log.error("Error while stemming {0} term [{1}]: {2}".format(language, token, err))
-    return result
+    return get_pipeline(language).get_stems(tokens)
 
 
 @profile
@@ -40,11 +123,10 @@ def calculate_tf(lang="", doc=""):
     """
     tf_by_stem = {}
 
-    # Cleaning document
-    doc = re.sub(" +", " ", doc).lower()
-    tokens = remove_stopwords(tokenize(doc), lang, min_len=3, max_len=30)
+    pipeline = get_pipeline(lang)
+    tokens = pipeline.remove_stopwords(tokenize(doc.lower()), min_len=3, max_len=30)
 
-    stems = get_stems(tokens, lang)
+    stems = pipeline.get_stems(tokens)
 
     for stem in stems:
         tf_by_stem[stem] = tf_by_stem.get(stem, 0) + 1
@@ -76,29 +158,7 @@ def remove_stopwords(tokens, language, min_len=1, max_len=30):
 
         :returns: A list of tokens free of stopwords.
     """
-    try:
-        stopwords = set(nltk.corpus.stopwords.words(language))
-    except Exception:
-        return tokens
-
-    stopwords.add("amp")
-    stopwords.add("quot")
-    stopwords.add("href")
-    stopwords.add("http")
-    stopwords.add("://")
-    stopwords.add(".&#")
-    try:
-        result = [w for w in tokens if w not in stopwords and
-                  min_len <= len(w) <= max_len]
-    except IOError:
-        return
-    except AttributeError:
-        return
-    except TypeError as error:
-        raise TypeError(
-            "barbante.utils.text.remove_stopwords: {0}".format(error))
-
-    return result
+    return get_pipeline(language).remove_stopwords(tokens, min_len, max_len)
 
 
 def parse_text_to_stems(language, text, min_length=3):
@@ -110,10 +170,54 @@ def parse_text_to_stems(language, text, min_length=3):
 
         :returns: A list of terms.
     """
-    text = re.sub(" +", " ", text).lower()
+    pipeline = get_pipeline(language)
+    text = text.lower()
     tokens = tokenize(text)
-    stems = get_stems(tokens, language)
-    return remove_stopwords(stems, language, min_length)
+    stems = pipeline.get_stems(tokens)
+    return pipeline.remove_stopwords(stems, min_length)
+
+
+@profile
+def parse_texts_to_stems(documents, min_length=3):
+    """ Batch version of parse_text_to_stems, for many (possibly multilingual) documents at once.
+
+        Documents are grouped by language, so that each distinct token is stemmed only once per language.
+        Being a plain function of its arguments, it may be submitted to process pools as well as to thread pools.
+
+        :param documents: A list of (language, text) pairs.
+        :param min_length: The minimum number of characters that a word must have; otherwise it is discarded.
+
+        :returns: A list with the list of terms of each document, in the same order as *documents*.
+    """
+    results = [None] * len(documents)
+    tokens_by_doc_idx_by_language = {}
+    for doc_idx, (language, doc) in enumerate(documents):
+        tokens_by_doc_idx = tokens_by_doc_idx_by_language.setdefault(language, {})
+        tokens_by_doc_idx[doc_idx] = tokenize(doc.lower())
+
+    for language, tokens_by_doc_idx in tokens_by_doc_idx_by_language.items():
+        pipeline = get_pipeline(language)
+        distinct_tokens = set()
+        for tokens in tokens_by_doc_idx.values():
+            distinct_tokens.update(tokens)
+        stem_by_token = pipeline.map_stems(distinct_tokens)
+
+        for doc_idx, tokens in tokens_by_doc_idx.items():
+            stems = [stem_by_token[t] for t in tokens if t in stem_by_token]
+            results[doc_idx] = pipeline.remove_stopwords(stems, min_length)
+
+    return results
+
+
+def calculate_tfs_from_texts(documents, min_length=3):
+    """ Returns the TF maps of many (possibly multilingual) documents at once.
+
+        :param documents: A list of (language, text) pairs.
+        :param min_length: The minimum number of characters that a word must have; otherwise it is discarded.
+
+        :returns: A list of (stems, tf_by_stem) pairs, in the same order as *documents*.
+    """
+    return [(stems, calculate_tf_from_stems(stems)) for stems in parse_texts_to_stems(documents, min_length)]
 
 
 def tokenize(text):
@@ -128,24 +232,8 @@ def tokenize(text):
     if type(text) is not str:
         raise TypeError("barbante.utils.text.tokenize: text must be a string.")
 
-    invalid_characters = set()
-    invalid_characters.add("\n")
-    invalid_characters.add("\t")
-    invalid_characters.add(".")
-    invalid_characters.add(",")
-    invalid_characters.add("?")
-    invalid_characters.add("!")
-    invalid_characters.add("$")
-    invalid_characters.add('"')
-    # We may want to replace each invalid character with a reserved mnemonic.
-
-    text_as_list = [c for c in text if c not in invalid_characters]
-    text = ''.join(text_as_list)
-    text = text.strip()
-
-    tokens = nltk.tokenize.WordPunctTokenizer().tokenize(text)
-
-    return tokens
+    text = text.translate(_INVALID_CHARACTERS_TABLE).strip()
+    return _TOKEN_REGEX.findall(text)
 
 
 def count_common_terms(list1, list2):
@@ -20,5 +20,7 @@ setup(name='barbante',
                         'pymongo==2.7.2',
                         'pyyaml==3.11',
                         'pytz==2014.9',
+                        'scipy==0.14.1',
                         'tornado==4.0'],
+      extras_require={'async': ['motor>=0.3,<0.4']},
       test_suite='nose.collector')